@@ -20,6 +20,7 @@ except ImportError:
 from chromite.buildbot import cbuildbot_config
 from chromite.buildbot import cbuildbot_results as results_lib
 from chromite.buildbot import portage_utilities
+from chromite.buildbot import stage_cache
 from chromite.lib import cros_build_lib
 
 
@@ -35,6 +36,15 @@ class BuilderStage(object):
   # Class variable that stores the branch to build and test
   _target_manifest_branch = None
 
+  # Class variable that stores the StageCache used to skip stages whose
+  # inputs did not change, if any.
+  _stage_cache = None
+
+  # Class should set this to False if its stage cache entries depend on the
+  # state of the local machine (e.g. its chroot), so that they are not
+  # shared with other builders.
+  share_stage_cache = True
+
   # Class should set this if they have a corresponding no<stage> option that
   # skips their stage.
   option_name = None
@@ -43,10 +53,25 @@ class BuilderStage(object):
   # self._build_config that skips their stage.
   config_name = None
 
+  # The artifacts (e.g. 'chroot') that must exist before this stage runs, and
+  # the ones it creates.  Used to run stages in a StageGraph.
+  consumes = ()
+  produces = ()
+
   @staticmethod
   def SetManifestBranch(branch):
     BuilderStage._target_manifest_branch = branch
 
+  @staticmethod
+  def SetStageCache(cache):
+    BuilderStage._stage_cache = cache
+
+  @staticmethod
+  def UploadStageCache():
+    """Share the stage cache entries whose upload a stage deferred."""
+    if BuilderStage._stage_cache is not None:
+      BuilderStage._stage_cache.UploadPending()
+
   @classmethod
   def StageNamePrefix(cls):
     return cls.name_stage_re.match(cls.__name__).group(1)
@@ -72,6 +97,10 @@ class BuilderStage(object):
     if self._options.chrome_rev:
       self._chrome_rev = self._options.chrome_rev
 
+  def GetArtifacts(self):
+    """Return the lists of artifacts this stage consumes and produces."""
+    return list(self.consumes), list(self.produces)
+
   def _ExtractOverlays(self):
     """Extracts list of overlays into class."""
     overlays = portage_utilities.FindOverlays(
@@ -87,6 +116,70 @@ class BuilderStage(object):
 
     return overlays, push_overlays
 
+  def _GetCommonInputs(self):
+    """Return the inputs that the results of all cacheable stages depend on.
+
+    Returns:
+      A dict of the revisions of the checkout and the build config, or None
+      if the stage can't be cached, e.g. because Chrome is built from a local
+      source tree.
+    """
+    if self._options.chrome_root or self._options.clobber:
+      return None
+    manifest = cros_build_lib.RunCommandCaptureOutput(
+        ['repo', 'manifest', '-r', '-o', '-'], cwd=self._build_root,
+        print_cmd=False, extra_env={'PAGER': 'cat'}).output
+    return {
+        'manifest': manifest,
+        'config': self._build_config,
+        'chrome_rev': self._chrome_rev,
+        'chrome_version': self._options.chrome_version,
+    }
+
+  def _GetInputs(self):
+    """Return the inputs that the result of this stage depends on, or None.
+
+    Stages that return a JSON serializable value are skipped when the stage
+    cache holds a result for the same inputs, and their outputs restored
+    with _RestoreFromCache.  See also _GetCachedOutputs.
+    """
+    return None
+
+  def _GetCacheKey(self, get_inputs=None):
+    """Return the key of this stage in the stage cache, or None.
+
+    Args:
+      get_inputs: The function returning the inputs to hash; defaults to
+        _GetInputs.
+    """
+    if self._stage_cache is None:
+      return None
+    try:
+      inputs = (get_inputs or self._GetInputs)()
+    except (EnvironmentError, cros_build_lib.RunCommandError) as e:
+      cros_build_lib.Warning('Cannot hash the inputs of %s: %s', self.name, e)
+      return None
+    if inputs is None:
+      return None
+    return stage_cache.HashInputs(type(self).__name__, self.name, inputs)
+
+  def _GetCachedOutputs(self):
+    """Return what to keep in the stage cache once the stage succeeded.
+
+    Returns:
+      A tuple (outputs, metadata): a dict mapping names to the files or
+      directories to cache, and a JSON serializable dict.
+    """
+    return {}, {}
+
+  def _RestoreFromCache(self, _key, _metadata):
+    """Restore the outputs that _GetCachedOutputs cached under |_key|.
+
+    Returns:
+      True if the outputs were restored, so the stage can be skipped.
+    """
+    return True
+
   def _Print(self, msg):
     """Prints a msg to stderr."""
     sys.stdout.flush()
@@ -258,6 +351,17 @@ class BuilderStage(object):
 
     start_time = time.time()
 
+    cache_key = self._GetCacheKey()
+    if cache_key:
+      metadata = self._stage_cache.Lookup(cache_key,
+                                          shared=self.share_stage_cache)
+      if metadata is not None and self._RestoreFromCache(cache_key, metadata):
+        self._PrintLoudly('Skipping Stage %s (restored from cache)' %
+                          self.name)
+        results_lib.Results.Record(self.name, results_lib.Results.SUCCESS,
+                                   None, time=time.time() - start_time)
+        return
+
     # Set default values
     result = results_lib.Results.SUCCESS
     description = None
@@ -267,6 +371,10 @@ class BuilderStage(object):
     self._Begin()
     try:
       self._PerformStage()
+      if cache_key:
+        outputs, metadata = self._GetCachedOutputs()
+        self._stage_cache.Store(cache_key, outputs, metadata,
+                                shared=self.share_stage_cache)
     except SystemExit as e:
       if e.code != 0:
         result, description = self._HandleStageException(e)
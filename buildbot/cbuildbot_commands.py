@@ -140,12 +140,16 @@ def ValidateClobber(buildroot):
 def BuildRootGitCleanup(buildroot, debug_run):
   """Put buildroot onto manifest branch. Delete branches created on last run.
 
+  Broken checkouts are moved to the trash directory of the buildroot; see
+  osutils.EmptyTrash.
+
   Args:
     buildroot: buildroot to clean up.
     debug_run: whether the job is running with the --debug flag.  i.e., whether
                it is not a production run.
   """
   lock_path = os.path.join(buildroot, '.clean_lock')
+  trash_dir = os.path.join(buildroot, constants.TRASH_DIR)
 
   def RunCleanupCommands(cwd):
     with locking.FileLock(lock_path, verbose=False).read_lock() as lock:
@@ -159,8 +163,7 @@ def BuildRootGitCleanup(buildroot, debug_run):
         logging.warn('\n%s', result.output)
         logging.warn('Deleting %s because %s failed', cwd, e.result.cmd)
         lock.write_lock()
-        if os.path.isdir(cwd):
-          shutil.rmtree(cwd)
+        osutils.MoveToTrash(cwd, trash_dir)
         # Delete the backing store as well for production jobs, because we
         # want to make sure any corruption is wiped.  Don't do it for
         # tryjobs so the error is visible and can be debugged.
@@ -169,8 +172,7 @@ def BuildRootGitCleanup(buildroot, debug_run):
           projects_dir = os.path.join(buildroot, '.repo', 'projects')
           repo_store = '%s.git' % os.path.join(projects_dir, relpath)
           logging.warn('Deleting %s as well', repo_store)
-          if os.path.isdir(repo_store):
-            shutil.rmtree(repo_store)
+          osutils.MoveToTrash(repo_store, trash_dir)
         cros_build_lib.PrintBuildbotStepWarnings()
         return
 
@@ -206,12 +208,15 @@ def CleanUpMountPoints(buildroot):
 def WipeOldOutput(buildroot):
   """Wipes out build output directory.
 
+  The directory is moved to the trash directory of the buildroot; see
+  osutils.EmptyTrash.
+
   Args:
     buildroot: Root directory where build occurs.
-    board: Delete image directories for this board name.
   """
-  image_dir = os.path.join('src', 'build', 'images')
-  cros_build_lib.SudoRunCommand(['rm', '-rf', image_dir], cwd=buildroot)
+  image_dir = os.path.join(buildroot, 'src', 'build', 'images')
+  osutils.MoveToTrash(image_dir, os.path.join(buildroot, constants.TRASH_DIR),
+                      sudo=True)
 
 
 def MakeChroot(buildroot, replace, use_sdk, chrome_root=None, extra_env=None):
@@ -300,6 +305,16 @@ def SetupBoard(buildroot, board, usepkg, latest_toolchain, extra_env=None,
   _RunBuildScript(buildroot, cmd, extra_env=extra_env, enter_chroot=True)
 
 
+def UpdateToolchain(buildroot, board, usepkg, extra_env=None):
+  """Wrapper around update_chroot, updating the cross toolchain of |board|."""
+  cmd = ['./update_chroot', '--toolchain_boards=%s' % board]
+
+  if not usepkg:
+    cmd.append('--nousepkg')
+
+  _RunBuildScript(buildroot, cmd, extra_env=extra_env, enter_chroot=True)
+
+
 def Build(buildroot, board, build_autotest, usepkg, skip_toolchain_update,
           nowithdebug, packages=(), extra_env=None, chrome_root=None):
   """Wrapper around build_packages."""
@@ -361,7 +376,42 @@ def RunSignerTests(buildroot, board):
   _RunBuildScript(buildroot, cmd, enter_chroot=True)
 
 
-def RunUnitTests(buildroot, board, full, nowithdebug):
+def ListUnitTestPackages(buildroot, board, full):
+  """Return the packages whose unit tests RunUnitTests runs.
+
+  Args:
+    buildroot: The buildroot of the current build.
+    board: The board to list packages for.
+    full: If False, only list the packages that uprev noticed were changed.
+  """
+  if not full:
+    package_file = _PACKAGE_FILE % {'buildroot': buildroot}
+    if not os.path.exists(package_file):
+      return []
+    return osutils.ReadFile(package_file).split()
+
+  cmd = ['cros_workon', '--board=%s' % board, 'list', '--all']
+  result = _RunBuildScript(buildroot, cmd, capture_output=True,
+                           enter_chroot=True)
+  return result.output.split()
+
+
+def RunUnitTests(buildroot, board, full, nowithdebug, packages=None,
+                 capture_output=False):
+  """Run the unit tests of the packages of |board|.
+
+  Args:
+    buildroot: The buildroot of the current build.
+    board: The board to run unit tests for.
+    full: If False, only test the packages that uprev noticed were changed.
+    nowithdebug: Whether to build packages without debug support.
+    packages: If given, only test these packages; overrides |full|.
+    capture_output: Whether to capture, rather than print, the output of the
+      tests; the output is combined with any errors.
+
+  Returns:
+    A CommandResult object.
+  """
   cmd = ['cros_run_unit_tests', '--board=%s' % board]
 
   if nowithdebug:
@@ -369,11 +419,15 @@ def RunUnitTests(buildroot, board, full, nowithdebug):
 
   # If we aren't running ALL tests, then restrict to just the packages
   #   uprev noticed were changed.
-  if not full:
+  if packages is not None:
+    cmd.append('--packages=%s' % ' '.join(packages))
+  elif not full:
     package_file = _PACKAGE_FILE % {'buildroot': buildroot}
     cmd += ['--package_file=%s' % git.ReinterpretPathForChroot(package_file)]
 
-  _RunBuildScript(buildroot, cmd, enter_chroot=True)
+  return _RunBuildScript(buildroot, cmd, capture_output=capture_output,
+                         combine_stdout_stderr=capture_output,
+                         enter_chroot=True)
 
 
 def RunTestSuite(buildroot, board, image_dir, results_dir, test_type,
@@ -476,98 +530,148 @@ def RunHWTestSuite(build, suite, board, pool, num, file_bugs, wait_for_results,
     cros_build_lib.RunCommand(cmd)
 
 
-def GenerateStackTraces(buildroot, board, gzipped_test_tarball,
+# Number of frames of the crashing stack that identify a crash.
+_CRASH_SIGNATURE_FRAMES = 5
+
+
+def _SymbolizeMinidump(buildroot, board, minidump_path, output_path):
+  """Write the stack trace of |minidump_path| to |output_path|."""
+  symbol_dir = os.path.join('/build', board, 'usr', 'lib', 'debug', 'breakpad')
+  # Process the minidump from within chroot.
+  minidump = git.ReinterpretPathForChroot(minidump_path)
+  cwd = os.path.join(buildroot, 'src', 'scripts')
+  cros_build_lib.RunCommand(
+      ['minidump_stackwalk', minidump, symbol_dir], cwd=cwd,
+      enter_chroot=True, error_code_ok=True, redirect_stderr=True,
+      debug_level=logging.DEBUG, log_stdout_to_file=output_path)
+
+
+def _SymbolizeAsanLog(buildroot, board, asan_log_path, output_path):
+  """Write the symbolized and demangled |asan_log_path| to |output_path|."""
+  # Prepend '/build/$board' path to the stack trace in log.
+  board_path = os.path.join('/build', board)
+  log_content = ''
+  with open(asan_log_path) as f:
+    for line in f:
+      # Stack frame line example to be matched here:
+      #    #0 0x721d1831 (/opt/google/chrome/chrome+0xb837831)
+      stackline_match = re.search('^ *#[0-9]* 0x.* \(', line)
+      if stackline_match:
+        frame_end = stackline_match.span()[1]
+        line = line[:frame_end] + board_path + line[frame_end:]
+      log_content += line
+  # Symbolize and demangle it.
+  raw = cros_build_lib.RunCommandCaptureOutput(
+      ['asan_symbolize.py'], input=log_content, enter_chroot=True,
+      debug_level=logging.DEBUG,
+      extra_env = {'LLVM_SYMBOLIZER_PATH' : '/usr/bin/llvm-symbolizer'})
+  cros_build_lib.RunCommand(['c++filt'],
+                            input=raw.output, debug_level=logging.DEBUG,
+                            cwd=buildroot, redirect_stderr=True,
+                            log_stdout_to_file=output_path)
+
+
+def GetCrashSignature(stack_trace):
+  """Returns the frames that identify the crash in |stack_trace|.
+
+  Crashes with the same signature are the same crash hit by several tests
+  (or several processes of one test).
+
+  Arguments:
+    stack_trace: The output of minidump_stackwalk or the symbolized asan log.
+
+  Returns:
+    A tuple with the top frames of the crashing stack, without addresses, or
+    None if no frames are found.
+  """
+  frames = []
+  in_crashed_thread = False
+  for line in stack_trace.splitlines():
+    # minidump_stackwalk frame example to be matched here:
+    #  0  libc.so.6 + 0x2f3c1
+    # It only counts within the thread marked as crashed.
+    if re.match(r'^Thread \d+ \(crashed\)', line):
+      in_crashed_thread = True
+      continue
+    if in_crashed_thread:
+      if not line.strip():
+        break
+      match = re.match(r'^ *\d+  (.*)$', line)
+    else:
+      # Symbolized asan frame example to be matched here:
+      #    #0 0x721d1831 in base::Foo() base/foo.cc:12
+      match = re.match(r'^ *#\d+ 0x[0-9a-f]+ (.*)$', line)
+    if match:
+      frames.append(re.sub(r'( \+ )?0x[0-9a-f]+', '', match.group(1)).strip())
+      if len(frames) == _CRASH_SIGNATURE_FRAMES:
+        break
+  return tuple(frames) or None
+
+
+def GenerateStackTraces(buildroot, board, test_results_dir,
                         archive_dir, got_symbols):
-  """Generates stack traces for logs in |gzipped_test_tarball|
+  """Generates stack traces for the minidumps and asan logs in test results.
+
+  The files are symbolized in parallel, and each stack trace is written next
+  to its minidump or log, so ArchiveTestResults should run afterwards to
+  include them in the test results tarball.  Only the first stack trace of
+  each crash signature is archived separately.
 
   Arguments:
     buildroot: Root directory where build occurs.
     board: Name of the board being worked on.
-    gzipped_test_tarball: Path to the gzipped test tarball.
+    test_results_dir: Path from buildroot/chroot to find test results.
+      This must a subdir of /tmp.
     archive_dir: Local directory for archiving.
     got_symbols: True if breakpad symbols have been generated.
 
   Returns:
     List of stack trace file names.
   """
-  stack_trace_filenames = []
-  chroot = os.path.join(buildroot, 'chroot')
-  gzip = cros_build_lib.FindCompressor(cros_build_lib.COMP_GZIP, chroot=chroot)
-  chroot_tmp = os.path.join(chroot, 'tmp')
-  temp_dir = tempfile.mkdtemp(prefix='cbuildbot_dumps', dir=chroot_tmp)
-  asan_log_signaled = False
-
-  # We need to unzip the test results tarball first because we cannot update
-  # a compressed tarball.
-  cros_build_lib.RunCommand([gzip, '-df', gzipped_test_tarball],
-                            debug_level=logging.DEBUG)
-  test_tarball = os.path.splitext(gzipped_test_tarball)[0] + '.tar'
-
-  # Extract minidump and asan files from the tarball and symbolize them.
-  cmd = ['tar', 'xf', test_tarball, '--directory=%s' % temp_dir, '--wildcards']
-  cros_build_lib.RunCommand(cmd + ['*.dmp', '*asan_log.*'],
-                            debug_level=logging.DEBUG, error_code_ok=True)
-  symbol_dir = os.path.join('/build', board, 'usr', 'lib', 'debug', 'breakpad')
-  board_path = os.path.join('/build', board)
-  for curr_dir, _subdirs, files in os.walk(temp_dir):
-    for curr_file in files:
-      full_file_path = os.path.join(curr_dir, curr_file)
-      processed_file_path = '%s.txt' % full_file_path
+  results_path = os.path.join(buildroot, 'chroot', test_results_dir.lstrip('/'))
+  cros_build_lib.SudoRunCommand(['chmod', '-R', 'a+rw', results_path],
+                                print_cmd=False)
 
+  minidumps, asan_logs = [], []
+  for curr_dir, _subdirs, files in os.walk(results_path):
+    for curr_file in sorted(files):
+      full_file_path = os.path.join(curr_dir, curr_file)
+      inputs = [buildroot, board, full_file_path, '%s.txt' % full_file_path]
       # Distinguish whether the current file is a minidump or asan_log.
       if curr_file.endswith('.dmp'):
         # Skip crash files that were purposely generated or if
         # breakpad symbols are absent.
-        if not got_symbols or curr_file.find('crasher_nobreakpad') == 0:
-          continue
-        # Precess the minidump from within chroot.
-        minidump = git.ReinterpretPathForChroot(full_file_path)
-        cwd = os.path.join(buildroot, 'src', 'scripts')
-        cros_build_lib.RunCommand(
-            ['minidump_stackwalk', minidump, symbol_dir], cwd=cwd,
-            enter_chroot=True, error_code_ok=True, redirect_stderr=True,
-            debug_level=logging.DEBUG, log_stdout_to_file=processed_file_path)
-      # Process asan log.
-      else:
-        # Prepend '/chrome/$board' path to the stack trace in log.
-        log_content = ''
-        with open(full_file_path) as f:
-          for line in f:
-            # Stack frame line example to be matched here:
-            #    #0 0x721d1831 (/opt/google/chrome/chrome+0xb837831)
-            stackline_match = re.search('^ *#[0-9]* 0x.* \(', line)
-            if stackline_match:
-              frame_end = stackline_match.span()[1]
-              line = line[:frame_end] + board_path + line[frame_end:]
-            log_content += line
-        # Symbolize and demangle it.
-        raw = cros_build_lib.RunCommandCaptureOutput(
-            ['asan_symbolize.py'], input=log_content, enter_chroot=True,
-            debug_level=logging.DEBUG,
-            extra_env = {'LLVM_SYMBOLIZER_PATH' : '/usr/bin/llvm-symbolizer'})
-        cros_build_lib.RunCommand(['c++filt'],
-                                  input=raw.output, debug_level=logging.DEBUG,
-                                  cwd=buildroot, redirect_stderr=True,
-                                  log_stdout_to_file=processed_file_path)
-        # Break the bot if asan_log found. This is because some asan
-        # crashes may not fail any test so the bot stays green.
-        # Ex: crbug.com/167497
-        if not asan_log_signaled:
-          asan_log_signaled = True
-          cros_build_lib.Error(
-              'Asan crash occurred. See asan_logs in Artifacts.')
-          cros_build_lib.PrintBuildbotStepFailure()
-
-      # Append the processed file to archive.
-      filename = ArchiveFile(processed_file_path, archive_dir)
-      stack_trace_filenames.append(filename)
-  cmd = ['tar', 'uf', test_tarball, '--directory=%s' % temp_dir, '.']
-  cros_build_lib.RunCommand(cmd, debug_level=logging.DEBUG)
-  cros_build_lib.RunCommand('%s -c %s > %s'
-                            % (gzip, test_tarball, gzipped_test_tarball),
-                            shell=True, debug_level=logging.DEBUG)
-  os.unlink(test_tarball)
-  shutil.rmtree(temp_dir)
+        if got_symbols and not curr_file.startswith('crasher_nobreakpad'):
+          minidumps.append(inputs)
+      elif (fnmatch.fnmatch(curr_file, '*asan_log.*') and
+            not curr_file.endswith('.txt')):
+        asan_logs.append(inputs)
+
+  if minidumps:
+    parallel.RunTasksInProcessPool(_SymbolizeMinidump, minidumps)
+  if asan_logs:
+    parallel.RunTasksInProcessPool(_SymbolizeAsanLog, asan_logs)
+    # Break the bot if asan_log found. This is because some asan
+    # crashes may not fail any test so the bot stays green.
+    # Ex: crbug.com/167497
+    cros_build_lib.Error('Asan crash occurred. See asan_logs in Artifacts.')
+    cros_build_lib.PrintBuildbotStepFailure()
+
+  # Archive one stack trace per crash; all of them stay in the test results.
+  stack_trace_filenames = []
+  signatures = {}
+  for _buildroot, _board, _path, processed_file_path in minidumps + asan_logs:
+    if not os.path.exists(processed_file_path):
+      continue
+    signature = GetCrashSignature(osutils.ReadFile(processed_file_path))
+    if signature in signatures:
+      cros_build_lib.Info('Not archiving %s: same crash as %s',
+                          processed_file_path, signatures[signature])
+      continue
+    if signature is not None:
+      signatures[signature] = processed_file_path
+    filename = ArchiveFile(processed_file_path, archive_dir)
+    stack_trace_filenames.append(filename)
 
   return stack_trace_filenames
 
@@ -969,22 +1073,23 @@ def UploadArchivedFile(archive_path, upload_url, filename, debug,
   if upload_url:
     full_filename = os.path.join(archive_path, filename)
     full_url = '%s/%s' % (upload_url, filename)
-    if acl:
-      cmds = (
-          [_GSUTIL_PATH, 'cp', '-a', acl, full_filename, full_url],
-      )
+    if debug:
+      cros_build_lib.Info('UploadArchivedFile would upload %s to %s',
+                          full_filename, full_url)
     else:
-      cmds = (
-          [_GSUTIL_PATH, 'cp', full_filename, full_url],
-          [_GSUTIL_PATH, 'setacl', _GS_ACL, full_url],
-      )
-
-    for cmd in cmds:
-      if debug:
-        cros_build_lib.Info('UploadArchivedFile would run: %s' % ' '.join(cmd))
-      else:
-        with cros_build_lib.SubCommandTimeout(timeout):
-          cros_build_lib.RunCommandCaptureOutput(cmd, debug_level=logging.DEBUG)
+      ctx = gs.GSContext(gsutil_bin=_GSUTIL_PATH)
+      with cros_build_lib.SubCommandTimeout(timeout):
+        if os.path.getsize(full_filename) >= gs.COMPOSITE_UPLOAD_THRESHOLD:
+          # Large files are uploaded in resumable parallel chunks so that a
+          # network hiccup doesn't restart the whole upload.
+          ctx.ParallelCompositeUpload(full_filename, full_url,
+                                      acl=acl if acl else _GS_ACL,
+                                      skip_unchanged=True)
+        else:
+          ctx.Copy(full_filename, full_url, acl=acl, skip_unchanged=True,
+                   debug_level=logging.DEBUG)
+          if not acl:
+            ctx.SetACL(full_url, acl=_GS_ACL)
 
     # Update the list of uploaded files.
     if update_list:
@@ -1377,47 +1482,71 @@ def CreateTestRoot(build_root):
   return os.path.sep + os.path.relpath(test_root, start=chroot)
 
 
-def GenerateFullPayload(build_root, target_image_path, archive_dir):
-  """Generates the full and stateful payloads for hw testing.
+def GenerateUpdatePayload(build_root, target_image_path, payload_path,
+                          src_image_path=None):
+  """Generates one update payload for hw testing.
 
   Args:
     build_root: The root of the chromium os checkout.
-    target_image_path: The path to the image to generate payloads to.
-    archive_dir: Where to store payloads we generated.
+    target_image_path: The path to the image to generate the payload to.
+    payload_path: Where to write the payload.  Must be inside the chroot.
+    src_image_path: If set, generate a delta payload from this image rather
+      than a full payload.  Must be inside the chroot.
   """
-  crostestutils = os.path.join(build_root, 'src', 'platform', 'crostestutils')
-  payload_generator = 'generate_test_payloads/cros_generate_test_payloads.py'
-  cmd = [os.path.join(crostestutils, payload_generator),
-         '--target=%s' % target_image_path,
-         '--full_payload',
-         '--nplus1_archive_dir=%s' % archive_dir,
+  cmd = ['cros_generate_update_payload',
+         '--image=%s' % git.ReinterpretPathForChroot(target_image_path),
+         '--output=%s' % git.ReinterpretPathForChroot(payload_path),
         ]
-  cros_build_lib.RunCommandCaptureOutput(cmd)
+  if src_image_path:
+    cmd.append('--src_image=%s' % git.ReinterpretPathForChroot(src_image_path))
+  cros_build_lib.RunCommandCaptureOutput(
+      cmd, cwd=os.path.join(build_root, 'src', 'scripts'), enter_chroot=True)
 
 
-def GenerateNPlus1Payloads(build_root, previous_versions_dir, target_image_path,
-                           archive_dir):
-  """Generates nplus1 payloads for hw testing.
-
-  We generate the nplus1 payloads for testing. These include the full and
-  stateful payloads. In addition we generate the n-1->n and n->n delta payloads.
+def GenerateStatefulPayload(build_root, target_image_path, archive_dir):
+  """Generates the stateful payload for hw testing.
 
   Args:
     build_root: The root of the chromium os checkout.
-    previous_versions_dir: Path containing images for versions previously
-      archived.
-    target_image_path: The path to the image to generate payloads to.
-    archive_dir: Where to store payloads we generated.
+    target_image_path: The path to the image to generate the payload for.
+    archive_dir: Where to store the payload.  Must be inside the chroot.
+
+  Returns the path to the payload.
   """
-  crostestutils = os.path.join(build_root, 'src', 'platform', 'crostestutils')
-  payload_generator = 'generate_test_payloads/cros_generate_test_payloads.py'
-  cmd = [os.path.join(crostestutils, payload_generator),
-         '--target=%s' % target_image_path,
-         '--base_latest_from_dir=%s' % previous_versions_dir,
-         '--nplus1',
-         '--nplus1_archive_dir=%s' % archive_dir,
+  cmd = ['cros_generate_stateful_update_payload',
+         '--image=%s' % git.ReinterpretPathForChroot(target_image_path),
+         '--output=%s' % git.ReinterpretPathForChroot(archive_dir),
         ]
-  cros_build_lib.RunCommandCaptureOutput(cmd)
+  cros_build_lib.RunCommandCaptureOutput(
+      cmd, cwd=os.path.join(build_root, 'src', 'scripts'), enter_chroot=True)
+  return os.path.join(archive_dir, 'stateful.tgz')
+
+
+def ExtractPreviousImage(previous_versions_dir, archive_dir, image_name,
+                         output_dir):
+  """Extracts an image of the latest previously archived version.
+
+  Args:
+    previous_versions_dir: Path containing images for versions previously
+      archived, in image.zip files.
+    archive_dir: The archive directory of the current version, which is
+      skipped.
+    image_name: The name of the image in image.zip.
+    output_dir: Where to extract the image.
+
+  Returns:
+    The path to the extracted image, or None if no previous version was
+    archived.
+  """
+  zip_files = [x for x in glob.glob(os.path.join(previous_versions_dir, '*',
+                                                 'image.zip'))
+               if os.path.dirname(x) != archive_dir]
+  if not zip_files:
+    return None
+  latest = max(zip_files, key=os.path.getmtime)
+  cros_build_lib.RunCommandCaptureOutput(
+      ['unzip', '-o', latest, image_name, '-d', output_dir])
+  return os.path.join(output_dir, image_name)
 
 
 def GetChromeLKGM(svn_revision):
@@ -17,6 +17,7 @@ from chromite.lib import cros_build_lib_unittest
 from chromite.lib import cros_test_lib
 from chromite.lib import git
 from chromite.lib import osutils
+from chromite.lib import parallel_unittest
 from chromite.lib import partial_mock
 
 # TODO(build): Finish test wrapper (http://crosbug.com/37517).
@@ -132,23 +133,91 @@ class CBuildBotTest(cros_build_lib_unittest.RunCommandTempDirTestCase):
     self._chroot = os.path.join(self._buildroot, 'chroot')
     os.makedirs(os.path.join(self._buildroot, '.repo'))
 
+  STACK_TRACE = """Crash reason:  SIGSEGV
+Crash address: 0x0
+
+Thread 0 (crashed)
+ 0  chrome!Crash() [crash.cc : 12 + 0x4]
+    eip = 0x0804a1e5
+ 1  chrome!main [main.cc : 5 + 0x%x]
+    eip = 0x0804a2f0
+
+Thread 1
+ 0  libc.so.6 + 0x2f3c1
+"""
+
   def testGenerateStackTraces(self):
     """Test if we can generate stack traces for minidumps."""
-    os.makedirs(os.path.join(self._chroot, 'tmp'))
-    dump_file = os.path.join(self._chroot, 'tmp', 'test.dmp')
-    tarfile = os.path.join(self.tempdir, 'test_results.tar')
-    osutils.Touch(tarfile)
-    dump_file_dir, dump_file_name = os.path.split(dump_file)
-    ret = [(dump_file_dir, [''], [dump_file_name])]
-    with mock.patch('os.walk', return_value=ret):
-      gzipped_test_tarball = os.path.join(self.tempdir, 'test_results.tgz')
-      commands.GenerateStackTraces(self._buildroot, self._board,
-                                   gzipped_test_tarball, self.tempdir, True)
-      self.assertCommandContains([gzipped_test_tarball])
-      self.assertCommandContains(['tar', 'xf', tarfile, '*.dmp'])
-      self.assertCommandContains(['minidump_stackwalk'])
-      self.assertCommandContains(['tar', 'uf', tarfile])
-      self.assertFalse(os.path.exists(tarfile))
+    self.StartPatcher(parallel_unittest.ParallelMock())
+    results_dir = os.path.join(self._chroot, 'tmp', 'results')
+    for name, offset in (('a.dmp', 1), ('b.dmp', 2), ('c.dmp', None),
+                         ('crasher_nobreakpad.dmp', 3)):
+      osutils.Touch(os.path.join(results_dir, name), makedirs=True)
+      if offset is not None:
+        self.rc.AddCmdResult(
+            partial_mock.ListRegex('minidump_stackwalk .*/%s ' % name),
+            output=self.STACK_TRACE % offset)
+    archive_dir = os.path.join(self.tempdir, 'archive')
+    os.makedirs(archive_dir)
+    filenames = commands.GenerateStackTraces(self._buildroot, self._board,
+                                             '/tmp/results', archive_dir, True)
+    self.assertCommandContains(['minidump_stackwalk',
+                                git.ReinterpretPathForChroot(
+                                    os.path.join(results_dir, 'a.dmp'))])
+    self.assertCommandContains(['minidump_stackwalk',
+                                git.ReinterpretPathForChroot(
+                                    os.path.join(results_dir,
+                                                 'crasher_nobreakpad.dmp'))],
+                               expected=False)
+    # b.dmp is the same crash as a.dmp, and c.dmp has no frames.
+    self.assertEqual(filenames, ['a.dmp.txt', 'c.dmp.txt'])
+
+  def testGetCrashSignature(self):
+    """Test that crash signatures ignore addresses."""
+    self.assertEqual(commands.GetCrashSignature(self.STACK_TRACE % 1),
+                     ('chrome!Crash() [crash.cc : 12]',
+                      'chrome!main [main.cc : 5]'))
+    asan_log = ('==1==ERROR: AddressSanitizer: heap-use-after-free\n'
+                '    #0 0x7f2a3b in base::Foo() base/foo.cc:12\n'
+                '    #1 0x7f2a4c in main chrome/main.cc:5\n')
+    self.assertEqual(commands.GetCrashSignature(asan_log),
+                     ('in base::Foo() base/foo.cc:12',
+                      'in main chrome/main.cc:5'))
+    self.assertEqual(commands.GetCrashSignature('no frames'), None)
+
+  def testGenerateUpdatePayload(self):
+    """Test that delta payloads are generated from the source image."""
+    # The real path translation needs a checkout and the user's name.
+    self.PatchObject(git, 'ReinterpretPathForChroot',
+                     side_effect=lambda x: '/chroot' + x)
+    image = os.path.join(self._buildroot, 'src', 'build', 'images', 'test.bin')
+    payload = os.path.join(self._chroot, 'tmp', 'update.gz')
+    commands.GenerateUpdatePayload(self._buildroot, image, payload)
+    self.assertCommandContains(['cros_generate_update_payload',
+                                '--image=/chroot%s' % image,
+                                '--output=/chroot%s' % payload])
+    self.assertCommandContains(['--src_image'], expected=False)
+    commands.GenerateUpdatePayload(self._buildroot, image, payload,
+                                   src_image_path=image)
+    self.assertCommandContains(['--src_image=/chroot%s' % image])
+
+  def testExtractPreviousImage(self):
+    """Test that the image of the latest previous version is extracted."""
+    archive_root = os.path.join(self.tempdir, 'archive')
+    for mtime, version in enumerate(('R2', 'R1', 'R3')):
+      zip_file = os.path.join(archive_root, version, 'image.zip')
+      osutils.Touch(zip_file, makedirs=True)
+      os.utime(zip_file, (mtime, mtime))
+    current_dir = os.path.join(archive_root, 'R3')
+    output_dir = os.path.join(self.tempdir, 'previous')
+    path = commands.ExtractPreviousImage(archive_root, current_dir, 'test.bin',
+                                         output_dir)
+    self.assertEqual(path, os.path.join(output_dir, 'test.bin'))
+    self.assertCommandContains(
+        ['unzip', os.path.join(archive_root, 'R1', 'image.zip')])
+    self.assertEqual(commands.ExtractPreviousImage(current_dir, current_dir,
+                                                   'test.bin', output_dir),
+                     None)
 
   def testUprevAllPackages(self):
     """Test if we get None in revisions.pfq indicating Full Builds."""
@@ -254,6 +323,13 @@ ca-t3/pk-g4-4.0.1-r333
     self.testBuild(extra_env=extra_env)
     self.assertCommandContains(['./build_packages'], extra_env=extra_env)
 
+  def testUpdateToolchain(self):
+    """Test UpdateToolchain Command."""
+    commands.UpdateToolchain(self._buildroot, 'x86-generic', usepkg=False)
+    self.assertCommandContains(['./update_chroot',
+                                '--toolchain_boards=x86-generic',
+                                '--nousepkg'])
+
   def testUploadSymbols(self, official=False):
     """Test UploadSymbols Command."""
     commands.UploadSymbols(self.tempdir, self._board, official=official)
@@ -416,6 +416,15 @@ _settings = dict(
 #                   disk_layout for more info.
   disk_vm_layout=None,
 
+# stage_cache -- Skip stages whose inputs (manifest, config and prebuilts) are
+#                unchanged since a previous build, restoring their outputs
+#                from the stage cache instead.
+  stage_cache=False,
+
+# stage_cache_url -- If set, the gs:// URL to share stage cache entries
+#                    between builders in.
+  stage_cache_url=None,
+
 # TODO(sosa): Collapse to one option.
 # ====================== Dev installer prebuilts options =======================
 
@@ -5,13 +5,18 @@
 """Module containing the various stages that a builder runs."""
 
 import cPickle
+import datetime
 import functools
 import glob
+import hashlib
+import heapq
 import json
 import logging
+import math
 import multiprocessing
 import os
 import Queue
+import re
 import shutil
 import sys
 import tempfile
@@ -27,6 +32,7 @@ from chromite.buildbot import manifest_version
 from chromite.buildbot import portage_utilities
 from chromite.buildbot import repository
 from chromite.buildbot import trybot_patch_pool
+from chromite.buildbot import upload_scheduler
 from chromite.buildbot import validation_pool
 from chromite.lib import commandline
 from chromite.lib import cros_build_lib
@@ -41,6 +47,11 @@ _FULL_BINHOST = 'FULL_BINHOST'
 _PORTAGE_BINHOST = 'PORTAGE_BINHOST'
 _CROS_ARCHIVE_URL = 'CROS_ARCHIVE_URL'
 _PRINT_INTERVAL = 1
+# A package parallel_emerge is done with, e.g.
+# "Completed chromeos-base/shill-0.0.1-r1 (in 1m12.3s)".
+_EMERGE_TIMING_RE = re.compile(
+    r'^(?P<status>Completed|Failed) (?P<cpv>\S+) '
+    r'\(in (?P<min>\d+)m(?P<sec>[\d.]+)s\)', re.M)
 _VM_TEST_ERROR_MSG = """
 !!!VMTests failed!!!
 
@@ -84,6 +95,21 @@ class BoardSpecificBuilderStage(bs.BuilderStage):
     if len(self._boards) > 1 or build_config['grouped']:
       self.name = '%s [%s]' % (self.name, board)
 
+  def GetArtifacts(self):
+    """Return the artifacts of this stage, with %(board)s filled in."""
+    fields = {'board': self._current_board}
+    consumes, produces = super(BoardSpecificBuilderStage, self).GetArtifacts()
+    return ([x % fields for x in consumes], [x % fields for x in produces])
+
+  def _GetPrebuiltState(self):
+    """Return a hash of the binary packages index of the board, or None."""
+    packages = os.path.join(self._build_root, constants.DEFAULT_CHROOT_DIR,
+                            'build', self._current_board, 'packages',
+                            'Packages')
+    if not os.path.exists(packages):
+      return None
+    return hashlib.sha1(osutils.ReadFile(packages)).hexdigest()
+
   def GetImageDirSymlink(self, pointer='latest-cbuildbot'):
     """Get the location of the current image."""
     buildroot, board = self._options.buildroot, self._current_board
@@ -95,32 +121,40 @@ class CleanUpStage(bs.BuilderStage):
 
   This stage cleans up previous KVM state, temporary git commits,
   clobbers, and wipes tmp inside the chroot.
+
+  Paths are only moved to the trash directory of the buildroot, which is
+  emptied in the background while the build goes on.
   """
 
   option_name = 'clean'
 
+  # Wait for the trash to be emptied if less disk space than this is free.
+  MIN_FREE_SPACE = 20 * 1024 ** 3
+
+  def __init__(self, options, build_config):
+    super(CleanUpStage, self).__init__(options, build_config)
+    self._trash_dir = os.path.join(self._build_root, constants.TRASH_DIR)
+
   def _CleanChroot(self):
     commands.CleanupChromeKeywordsFile(self._boards,
                                        self._build_root)
     chroot_tmpdir = os.path.join(self._build_root, constants.DEFAULT_CHROOT_DIR,
                                  'tmp')
-    if os.path.exists(chroot_tmpdir):
-      cros_build_lib.SudoRunCommand(['rm', '-rf', chroot_tmpdir],
-                                    print_cmd=False)
+    if osutils.MoveToTrash(chroot_tmpdir, self._trash_dir, sudo=True):
       cros_build_lib.SudoRunCommand(['mkdir', '--mode', '1777', chroot_tmpdir],
                                     print_cmd=False)
 
   def _DeleteChroot(self):
     chroot = os.path.join(self._build_root, constants.DEFAULT_CHROOT_DIR)
     if os.path.exists(chroot):
-      cros_build_lib.RunCommand(['cros_sdk', '--delete', '--chroot', chroot],
-                                self._build_root,
-                                cwd=self._build_root)
+      # Nothing may be mounted in the chroot once it is in the trash.
+      commands.CleanUpMountPoints(chroot)
+      osutils.MoveToTrash(chroot, self._trash_dir, sudo=True)
 
   def _DeleteArchivedTrybotImages(self):
     """For trybots, clear all previus archive images to save space."""
     archive_root = ArchiveStage.GetArchiveRoot(self._build_root, trybot=True)
-    shutil.rmtree(archive_root, ignore_errors=True)
+    osutils.MoveToTrash(archive_root, self._trash_dir, sudo=True)
 
   def _DeleteArchivedPerfResults(self):
     """Clear any previously stashed perf results from hw testing."""
@@ -158,7 +192,6 @@ class CleanUpStage(bs.BuilderStage):
       # Clean mount points first to be safe about deleting.
       commands.CleanUpMountPoints(self._build_root)
 
-      commands.BuildRootGitCleanup(self._build_root, self._options.debug)
       tasks = [functools.partial(commands.BuildRootGitCleanup,
                                  self._build_root, self._options.debug),
                functools.partial(commands.WipeOldOutput, self._build_root),
@@ -170,6 +203,10 @@ class CleanUpStage(bs.BuilderStage):
         tasks.append(self._CleanChroot)
       parallel.RunParallelSteps(tasks)
 
+    # Also empties what an earlier build did not get to.
+    osutils.EmptyTrash(self._trash_dir, sudo=True,
+                       min_free_space=self.MIN_FREE_SPACE)
+
 
 class PatchChangesStage(bs.BuilderStage):
   """Stage that patches a set of Gerrit changes to the buildroot source tree."""
@@ -817,6 +854,22 @@ class ImportantBuilderFailedException(Exception):
 class LKGMCandidateSyncCompletionStage(ManifestVersionedSyncCompletionStage):
   """Stage that records whether we passed or failed to build/test manifest."""
 
+  def __init__(self, *args, **kwargs):
+    super(LKGMCandidateSyncCompletionStage, self).__init__(*args, **kwargs)
+    # Whether we stopped waiting for the slaves after one of them failed.
+    self._stopped_early = False
+
+  def _StopOnFailure(self, builder, status):
+    """Stop waiting for the slaves once one of them failed.
+
+    The master only waits for important slaves, so the run has failed as
+    soon as any of them did.
+    """
+    if status.Failed():
+      logging.info('Builder %s failed; not waiting for the others.', builder)
+      self._stopped_early = True
+    return self._stopped_early
+
   def _GetSlavesStatus(self):
     if self._options.debug:
       # In debug mode, nothing is uploaded to Google Storage, so we bypass
@@ -830,18 +883,18 @@ class LKGMCandidateSyncCompletionStage(ManifestVersionedSyncCompletionStage):
           [self._bot_id])
     elif not LKGMCandidateSyncStage.sub_manager:
       return ManifestVersionedSyncStage.manifest_manager.GetBuildersStatus(
-          self._GetSlavesForMaster())
+          self._GetSlavesForMaster(), callback=self._StopOnFailure)
     else:
       public_builders, private_builders = self._GetSlavesForUnifiedMaster()
       statuses = {}
       if public_builders:
         statuses.update(
           LKGMCandidateSyncStage.sub_manager.GetBuildersStatus(
-              public_builders))
-      if private_builders:
+              public_builders, callback=self._StopOnFailure))
+      if private_builders and not self._stopped_early:
         statuses.update(
             ManifestVersionedSyncStage.manifest_manager.GetBuildersStatus(
-                private_builders))
+                private_builders, callback=self._StopOnFailure))
       return statuses
 
   def HandleSuccess(self):
@@ -879,16 +932,17 @@ class LKGMCandidateSyncCompletionStage(ManifestVersionedSyncCompletionStage):
       statuses = self._GetSlavesStatus()
       failing_build_dict, inflight_build_dict = {}, {}
       for builder, status in statuses.iteritems():
-        if status.Failed():
-          failing_build_dict[builder] = status
-        elif status.Inflight():
+        if status is None or status.Inflight():
           inflight_build_dict[builder] = status
+        elif status.Failed():
+          failing_build_dict[builder] = status
 
       if failing_build_dict or inflight_build_dict:
         if failing_build_dict:
           self.HandleValidationFailure(failing_build_dict)
 
-        if inflight_build_dict:
+        # The builders still running after we stopped early did not time out.
+        if inflight_build_dict and not self._stopped_early:
           self.HandleValidationTimeout(inflight_build_dict)
 
       if failing_build_dict or inflight_build_dict:
@@ -934,6 +988,9 @@ class CommitQueueCompletionStage(LKGMCandidateSyncCompletionStage):
 
 class RefreshPackageStatusStage(bs.BuilderStage):
   """Stage for refreshing Portage package status in online spreadsheet."""
+
+  consumes = ('board_setup',)
+
   def _PerformStage(self):
     commands.RefreshPackageStatus(buildroot=self._build_root,
                                   boards=self._boards,
@@ -945,11 +1002,30 @@ class BuildBoardStage(bs.BuilderStage):
 
   option_name = 'build'
 
+  produces = ('chroot', 'board_setup')
+
+  # Whether the stage can be skipped depends on the local chroot.
+  share_stage_cache = False
+
   def __init__(self, options, build_config, boards=None):
     super(BuildBoardStage, self).__init__(options, build_config)
     if boards is not None:
       self._boards = boards
 
+  def _GetInputs(self):
+    # Only an existing chroot with all boards set up can be reused.
+    chroot_path = os.path.join(self._build_root, constants.DEFAULT_CHROOT_DIR)
+    board_paths = [os.path.join(chroot_path, 'build', x) for x in self._boards]
+    if (self._build_config['chroot_replace'] or
+        not all(os.path.isdir(x) for x in [chroot_path] + board_paths)):
+      return None
+    inputs = self._GetCommonInputs()
+    if inputs is not None:
+      version_file = os.path.join(chroot_path, 'etc', 'cros_chroot_version')
+      inputs['boards'] = self._boards
+      inputs['chroot_version'] = osutils.ReadFile(version_file)
+    return inputs
+
   def _PerformStage(self):
     chroot_upgrade = True
 
@@ -1000,12 +1076,22 @@ class UprevStage(bs.BuilderStage):
 
   option_name = 'uprev'
 
+  consumes = ('chroot',)
+  produces = ('uprev',)
+
   def __init__(self, options, build_config, boards=None, enter_chroot=True):
     super(UprevStage, self).__init__(options, build_config)
     self._enter_chroot = enter_chroot
     if boards is not None:
       self._boards = boards
 
+  def GetArtifacts(self):
+    """Return the artifacts of this stage, which only needs a chroot inside."""
+    consumes, produces = super(UprevStage, self).GetArtifacts()
+    if not self._enter_chroot:
+      consumes.remove('chroot')
+    return consumes, produces
+
   def _PerformStage(self):
     # Perform chrome uprev.
     chrome_atom_to_build = None
@@ -1037,6 +1123,9 @@ class SyncChromeStage(bs.BuilderStage):
 
   option_name = 'managed_chrome'
 
+  consumes = ('board_setup', 'uprev')
+  produces = ('chrome_source',)
+
   def _GetArchitectures(self):
     """Get the list of architectures built by this builder."""
     return set(self._GetPortageEnvVar('ARCH', b) for b in self._boards)
@@ -1068,6 +1157,9 @@ class PatchChromeStage(bs.BuilderStage):
 
   option_name = 'rietveld_patches'
 
+  consumes = ('chrome_source',)
+  produces = ('chrome_patched',)
+
   def _PerformStage(self):
     for patch in ' '.join(self._options.rietveld_patches).split():
       patch, colon, subdir = patch.partition(':')
@@ -1076,6 +1168,56 @@ class PatchChromeStage(bs.BuilderStage):
       commands.PatchChrome(self._options.chrome_root, patch, subdir)
 
 
+class BoardBuildSlots(object):
+  """Limits how many boards may compile and build images at the same time.
+
+  build_packages keeps every CPU busy, whereas build_image mostly waits on the
+  disk but holds a few loop devices per image.  BuildTargetStage holds a
+  compile slot for the former and an image slot for the latter, so that the
+  stages of several boards can run side by side: one board builds its images
+  while the next one compiles.
+
+  build_packages also updates the cross toolchains in the shared chroot, so
+  only one board compiles at a time unless the caller asks for more compile
+  slots.  In that case BuildTargetStage updates the toolchain under
+  ToolchainLock() first, and tells build_packages to skip it.
+
+  The slots are multiprocessing semaphores, so the stages sharing them may
+  run in separate processes.
+  """
+
+  # The number of loop devices a single build_image run may hold.
+  LOOP_DEVICES_PER_IMAGE = 4
+
+  def __init__(self, compile_slots=1, image_slots=None):
+    """Initialize the slots.
+
+    Args:
+      compile_slots: How many boards may compile at once.
+      image_slots: How many boards may build images at once.  Defaults to
+        one per LOOP_DEVICES_PER_IMAGE loop devices.
+    """
+    if image_slots is None:
+      loop_devices = glob.glob('/dev/loop[0-9]*')
+      image_slots = len(loop_devices) // self.LOOP_DEVICES_PER_IMAGE
+    self.compile_slots = max(1, compile_slots)
+    self._compile = multiprocessing.Semaphore(self.compile_slots)
+    self._image = multiprocessing.Semaphore(max(1, image_slots))
+    self._toolchain = multiprocessing.Lock()
+
+  def Compile(self):
+    """Return a context manager that holds a compile slot."""
+    return self._compile
+
+  def Image(self):
+    """Return a context manager that holds an image slot."""
+    return self._image
+
+  def ToolchainLock(self):
+    """Return a context manager that serializes toolchain updates."""
+    return self._toolchain
+
+
 class BuildTargetStage(BoardSpecificBuilderStage):
   """This stage builds Chromium OS for a target.
 
@@ -1084,7 +1226,11 @@ class BuildTargetStage(BoardSpecificBuilderStage):
 
   option_name = 'build'
 
-  def __init__(self, options, build_config, board, archive_stage, version):
+  consumes = ('board_setup', 'uprev', 'chrome_patched')
+  produces = ('image:%(board)s',)
+
+  def __init__(self, options, build_config, board, archive_stage, version,
+               build_slots=None):
     super(BuildTargetStage, self).__init__(options, build_config, board)
     self._env = {}
     if self._build_config.get('useflags'):
@@ -1099,6 +1245,7 @@ class BuildTargetStage(BoardSpecificBuilderStage):
     self._archive_stage = archive_stage
     self._tarball_dir = None
     self._version = version if version else ''
+    self._build_slots = build_slots or BoardBuildSlots(1, 1)
 
   def _CommunicateVersion(self):
     """Communicates to archive_stage the image path of this stage."""
@@ -1119,6 +1266,72 @@ class BuildTargetStage(BoardSpecificBuilderStage):
   def HandleSkip(self):
     self._CommunicateVersion()
 
+  def _GetImageInputs(self):
+    """Return the inputs of the images and autotest tarballs, or None.
+
+    This is called once the packages of the board are built, so that the
+    binary packages index of the board covers the packages that go into the
+    images.  The stage itself is never skipped: build_packages always runs,
+    since the stages that follow use the packages of the board.
+    """
+    prebuilts = self._GetPrebuiltState()
+    if not self._build_config['images'] or prebuilts is None:
+      return None
+    inputs = self._GetCommonInputs()
+    if inputs is not None:
+      inputs['board'] = self._current_board
+      inputs['prebuilts'] = prebuilts
+      inputs['version'] = self._version
+      inputs['env'] = self._env
+      inputs['tests'] = self._options.tests
+    return inputs
+
+  def _GetCachedOutputs(self):
+    image_dir = os.path.realpath(self.GetImageDirSymlink())
+    outputs = {os.path.basename(image_dir): image_dir}
+    if self._tarball_dir:
+      outputs['autotest'] = self._tarball_dir
+    return outputs, {'image_dir': os.path.basename(image_dir)}
+
+  def _RestoreFromCache(self, key, metadata):
+    # Restore next to the image directory, so it can be moved into place.
+    images_root = os.path.dirname(self.GetImageDirSymlink())
+    osutils.SafeMakedirs(images_root)
+    restore_dir = tempfile.mkdtemp(prefix='cbuildbot-cache', dir=images_root)
+    outputs = self._stage_cache.Restore(key, restore_dir)
+    if outputs is None:
+      osutils.RmDir(restore_dir)
+      return False
+
+    image_dir = os.path.join(images_root, metadata['image_dir'])
+    osutils.RmDir(image_dir, ignore_missing=True)
+    os.rename(outputs[metadata['image_dir']], image_dir)
+    cbuildbot_image_link = self.GetImageDirSymlink()
+    if os.path.lexists(cbuildbot_image_link):
+      os.remove(cbuildbot_image_link)
+    os.symlink(metadata['image_dir'], cbuildbot_image_link)
+
+    # Keep the autotest tarballs where a fresh build would put them, out of
+    # the images directory.
+    if 'autotest' in outputs:
+      self._tarball_dir = tempfile.mkdtemp(prefix='autotest')
+      for name in os.listdir(outputs['autotest']):
+        shutil.move(os.path.join(outputs['autotest'], name), self._tarball_dir)
+    osutils.RmDir(restore_dir)
+
+    if self._tarball_dir:
+      self._archive_stage.AutotestTarballsReady(
+          [os.path.join(self._tarball_dir, x)
+           for x in ('autotest.tar', 'test_suites.tar.bz2')])
+      full_autotest_tarball = os.path.join(self._tarball_dir,
+                                           'autotest.tar.bz2')
+      if os.path.exists(full_autotest_tarball):
+        self._archive_stage.FullAutotestTarballReady(full_autotest_tarball)
+    else:
+      self._archive_stage.AutotestTarballsReady(None)
+    self._CommunicateVersion()
+    return True
+
   def _BuildImages(self):
     # We only build base, dev, and test images from this stage.
     images_can_build = set(['base', 'dev', 'test'])
@@ -1175,15 +1388,34 @@ class BuildTargetStage(BoardSpecificBuilderStage):
     # the toolchain during build_packages.
     skip_toolchain_update = self._build_config['latest_toolchain']
 
-    commands.Build(self._build_root,
-                   self._current_board,
-                   build_autotest=build_autotest,
-                   skip_toolchain_update=skip_toolchain_update,
-                   usepkg=self._build_config['usepkg_build_packages'],
-                   nowithdebug=self._build_config['nowithdebug'],
-                   packages=self._build_config['packages'],
-                   chrome_root=self._options.chrome_root,
-                   extra_env=self._env)
+    with self._build_slots.Compile():
+      # Boards compiling side by side must not update the shared toolchain
+      # at the same time.
+      if self._build_slots.compile_slots > 1 and not skip_toolchain_update:
+        with self._build_slots.ToolchainLock():
+          commands.UpdateToolchain(
+              self._build_root, self._current_board,
+              usepkg=self._build_config['usepkg_build_packages'],
+              extra_env=self._env)
+        skip_toolchain_update = True
+
+      commands.Build(self._build_root,
+                     self._current_board,
+                     build_autotest=build_autotest,
+                     skip_toolchain_update=skip_toolchain_update,
+                     usepkg=self._build_config['usepkg_build_packages'],
+                     nowithdebug=self._build_config['nowithdebug'],
+                     packages=self._build_config['packages'],
+                     chrome_root=self._options.chrome_root,
+                     extra_env=self._env)
+
+    # Reuse the images of an earlier build of the same packages, if any.
+    cache_key = self._GetCacheKey(self._GetImageInputs)
+    if cache_key:
+      metadata = self._stage_cache.Lookup(cache_key)
+      if metadata is not None and self._RestoreFromCache(cache_key, metadata):
+        cros_build_lib.Info('Restored the images from the stage cache.')
+        return
 
     # Build images and autotest tarball in parallel.
     steps = []
@@ -1201,7 +1433,8 @@ class BuildTargetStage(BoardSpecificBuilderStage):
       steps.append(self._BuildImages)
     else:
       self._CommunicateVersion()
-    parallel.RunParallelSteps(steps)
+    with self._build_slots.Image():
+      parallel.RunParallelSteps(steps)
 
     # TODO(yjhong): Remove this and instruct archive_hwqual to copy the tarball
     # directly.
@@ -1210,6 +1443,12 @@ class BuildTargetStage(BoardSpecificBuilderStage):
                       os.path.join(self.GetImageDirSymlink(),
                                    'autotest.tar.bz2'))
 
+    # The images are stored before the test stages can change them, but
+    # they are only uploaded by a step that runs alongside those stages.
+    if cache_key:
+      outputs, metadata = self._GetCachedOutputs()
+      self._stage_cache.Store(cache_key, outputs, metadata, defer_upload=True)
+
   def _HandleStageException(self, exception):
     # In case of an exception, this prevents any consumer from starving.
     self._archive_stage.AutotestTarballsReady(None)
@@ -1239,7 +1478,11 @@ class SignerTestStage(BoardSpecificBuilderStage):
 
 
 class UnitTestStage(BoardSpecificBuilderStage):
-  """Run unit tests."""
+  """Run unit tests.
+
+  The packages are split into shards that are tested in parallel, balanced
+  by how long the unit tests of each package took in earlier builds.
+  """
 
   option_name = 'tests'
   config_name = 'unittests'
@@ -1248,12 +1491,156 @@ class UnitTestStage(BoardSpecificBuilderStage):
   # ten minutes to run.
   UNIT_TEST_TIMEOUT = 3600
 
+  # The number of CPUs the unit tests of a single package keep busy.
+  CPUS_PER_SHARD = 4
+
+  def _GetTimingsPath(self):
+    """Return where the unit test timings of the board are kept, or None."""
+    if not self._options.cache_dir:
+      return None
+    return os.path.join(self._options.cache_dir, constants.COMMON_CACHE,
+                        'unittest_timings', '%s.json' % self._current_board)
+
+  def _LoadTimings(self):
+    """Return how many seconds the tests of each package took last time."""
+    path = self._GetTimingsPath()
+    if path and os.path.exists(path):
+      try:
+        return json.loads(osutils.ReadFile(path))
+      except (IOError, ValueError) as e:
+        cros_build_lib.Warning('Ignoring unit test timings %s: %s', path, e)
+    return {}
+
+  def _SaveTimings(self, timings):
+    """Store the |timings| of the packages for later builds."""
+    path = self._GetTimingsPath()
+    if path:
+      osutils.WriteFile(path, json.dumps(timings, indent=2, sort_keys=True),
+                        atomic=True, makedirs=True)
+
+  @staticmethod
+  def ShardPackages(packages, timings, shards):
+    """Split |packages| into |shards| lists that take about as long to test.
+
+    Packages are handed out longest first, each to the shard with the least
+    work so far.  Packages without a timing are taken to be average.
+
+    Args:
+      packages: The packages to test.
+      timings: A dict mapping packages to how long their tests took.
+      shards: The number of shards to split the packages into.
+
+    Returns:
+      A list of lists of packages; never more lists than packages.
+    """
+    known = [timings[x] for x in packages if x in timings]
+    average = float(sum(known)) / len(known) if known else 0
+    cost = lambda x: timings.get(x, average)
+
+    heap = [(0, i, []) for i in xrange(max(1, min(shards, len(packages))))]
+    for package in sorted(packages, key=lambda x: (-cost(x), x)):
+      total, i, shard = heapq.heappop(heap)
+      shard.append(package)
+      heapq.heappush(heap, (total + cost(package), i, shard))
+    return [shard for _, _, shard in sorted(heap, key=lambda x: x[1])]
+
+  @staticmethod
+  def ParseEmergeTimings(output):
+    """Find how long the tests of each package took in emerge output.
+
+    parallel_emerge prints a line with the run time of every package it is
+    done with, e.g. "Completed chromeos-base/shill-0.0.1-r1 (in 1m12.3s)".
+
+    Args:
+      output: The output of cros_run_unit_tests.
+
+    Returns:
+      A tuple of a dict mapping packages to the seconds their tests took, and
+      the set of packages that failed (their last attempt did).
+    """
+    timings = {}
+    failed = set()
+    for m in _EMERGE_TIMING_RE.finditer(output):
+      cpv = portage_utilities.SplitCPV(m.group('cpv'))
+      if cpv is None:
+        continue
+      package = '%s/%s' % (cpv.category, cpv.package)
+      timings[package] = int(m.group('min')) * 60 + float(m.group('sec'))
+      if m.group('status') == 'Failed':
+        failed.add(package)
+      else:
+        failed.discard(package)
+    return timings, failed
+
+  def _TestShard(self, packages, timings_path):
+    """Run the unit tests of |packages| in one cros_run_unit_tests call.
+
+    The output is printed in one piece once the tests are done, and the
+    timings of the packages, as reported by emerge, are written to
+    |timings_path|.
+    """
+    failure = None
+    try:
+      result = commands.RunUnitTests(
+          self._build_root, self._current_board, full=True,
+          nowithdebug=self._build_config['nowithdebug'], packages=packages,
+          capture_output=True)
+    except results_lib.BuildScriptFailure as e:
+      failure = e
+      result = e.exception.result
+    sys.stdout.write(result.output)
+    sys.stdout.flush()
+
+    timings, failed = self.ParseEmergeTimings(result.output)
+    osutils.WriteFile(timings_path, json.dumps(timings))
+    if failure:
+      raise results_lib.PackageBuildFailure(
+          failure.exception, 'cros_run_unit_tests',
+          sorted(failed) or packages)
+
+  @staticmethod
+  def _FormatTime(seconds):
+    return datetime.timedelta(seconds=math.ceil(seconds))
+
+  def _ReportCriticalPath(self, shards, timings):
+    """Print the shard that took the longest, which decided the stage time."""
+    totals = [(sum(timings.get(x, 0) for x in shard), shard)
+              for shard in shards]
+    total, shard = max(totals)
+    lines = ['Unit test critical path (%s)' % self._FormatTime(total)]
+    lines += ['  %s (%s)' % (x, self._FormatTime(timings[x]))
+              for x in shard if x in timings]
+    self._PrintLoudly('\n'.join(lines))
+
   def _PerformStage(self):
-    with cros_build_lib.SubCommandTimeout(self.UNIT_TEST_TIMEOUT):
-      commands.RunUnitTests(self._build_root,
-                            self._current_board,
-                            full=(not self._build_config['quick_unit']),
-                            nowithdebug=self._build_config['nowithdebug'])
+    packages = commands.ListUnitTestPackages(
+        self._build_root, self._current_board,
+        full=(not self._build_config['quick_unit']))
+    if not packages:
+      cros_build_lib.Info('No packages to run unit tests for.')
+      return
+
+    timings = self._LoadTimings()
+    shards = self.ShardPackages(
+        packages, timings,
+        multiprocessing.cpu_count() // self.CPUS_PER_SHARD)
+    timings_dir = tempfile.mkdtemp(prefix='unittest_timings')
+    timings_paths = [os.path.join(timings_dir, '%d.json' % i)
+                     for i in xrange(len(shards))]
+    try:
+      with cros_build_lib.SubCommandTimeout(self.UNIT_TEST_TIMEOUT):
+        parallel.RunParallelSteps(
+            [functools.partial(self._TestShard, shard, path)
+             for shard, path in zip(shards, timings_paths)])
+    finally:
+      run_times = {}
+      for path in timings_paths:
+        if os.path.exists(path):
+          run_times.update(json.loads(osutils.ReadFile(path)))
+      osutils.RmDir(timings_dir)
+      timings.update(run_times)
+      self._SaveTimings(timings)
+      self._ReportCriticalPath(shards, run_times)
 
 
 class VMTestStage(BoardSpecificBuilderStage):
@@ -1281,16 +1668,27 @@ class VMTestStage(BoardSpecificBuilderStage):
 
   def _ArchiveTestResults(self, test_results_dir):
     """Archives test results to Google Storage."""
-    test_tarball = commands.ArchiveTestResults(
-        self._build_root, test_results_dir, prefix='')
     # Wait for breakpad symbols. The archive path will be ready by the time
     # the breakpad symbols are ready.
     got_symbols = self._archive_stage.WaitForBreakpadSymbols()
     archive_path = self._archive_stage.GetArchivePath()
     upload_url = self._archive_stage.GetGSUploadLocation()
-    filenames = commands.GenerateStackTraces(
-        self._build_root, self._current_board, test_tarball, archive_path,
-        got_symbols)
+    # The stack traces are written into the test results, so generate them
+    # before the results are tarred up.  If that fails, still archive the
+    # results, and only fail the stage once they are uploaded.
+    symbolize_exc_info = None
+    try:
+      filenames = commands.GenerateStackTraces(
+          self._build_root, self._current_board, test_results_dir,
+          archive_path, got_symbols)
+    except (cros_build_lib.RunCommandError, parallel.BackgroundFailure,
+            EnvironmentError):
+      symbolize_exc_info = sys.exc_info()
+      cros_build_lib.Error('Failed to generate stack traces; archiving the '
+                           'test results without them.')
+      filenames = []
+    test_tarball = commands.ArchiveTestResults(
+        self._build_root, test_results_dir, prefix='')
     filenames.append(commands.ArchiveFile(test_tarball, archive_path))
 
     cros_build_lib.Info('Uploading artifacts to Google Storage...')
@@ -1304,6 +1702,9 @@ class VMTestStage(BoardSpecificBuilderStage):
         # Treat gsutil flake as a warning if it's the only problem.
         self._HandleExceptionAsWarning(e)
 
+    if symbolize_exc_info:
+      raise symbolize_exc_info[0], symbolize_exc_info[1], symbolize_exc_info[2]
+
   def _PerformStage(self):
     # These directories are used later to archive test artifacts.
     test_results_dir = commands.CreateTestRoot(self._build_root)
@@ -1422,6 +1823,9 @@ class ASyncHWTestStage(HWTestStage, BoardSpecificBuilderStage,
 class SDKPackageStage(bs.BuilderStage):
   """Stage that performs preparing and packaging SDK files"""
 
+  consumes = ('chroot',)
+  produces = ('sdk',)
+
   # Version of the Manifest file being generated. Should be incremented for
   # Major format changes.
   MANIFEST_VERSION = '1'
@@ -1498,6 +1902,9 @@ class SDKTestStage(bs.BuilderStage):
 
   option_name = 'tests'
 
+  consumes = ('sdk',)
+  produces = ('sdk_tested',)
+
   def _PerformStage(self):
     tarball_location = os.path.join(self._build_root, 'built-sdk.tar.xz')
     new_chroot_cmd = ['cros_sdk', '--chroot', 'new-sdk-chroot']
@@ -1530,6 +1937,11 @@ class ArchiveStage(BoardSpecificBuilderStage):
   _BUILDBOT_ARCHIVE = 'buildbot_archive'
   _TRYBOT_ARCHIVE = 'trybot_archive'
 
+  # How many artifacts may be uploaded at once, and how many bytes per second
+  # all uploads may use together (None for no limit).
+  UPLOAD_PROCESSES = 10
+  UPLOAD_BYTES_PER_SECOND = None
+
   @classmethod
   def GetArchiveRoot(cls, buildroot, trybot=False):
     """Return the location where trybot archive images are kept."""
@@ -1557,10 +1969,11 @@ class ArchiveStage(BoardSpecificBuilderStage):
     self._hw_test_uploads_status_queue = multiprocessing.Queue()
     self._recovery_image_status_queue = multiprocessing.Queue()
 
-    self._release_upload_queue = multiprocessing.Queue()
-    self._upload_queue = multiprocessing.Queue()
+    # Files to upload, by priority: see UploadScheduler.
+    self._hw_test_upload_queue = multiprocessing.JoinableQueue()
+    self._release_upload_queue = multiprocessing.JoinableQueue()
+    self._upload_queue = multiprocessing.JoinableQueue()
     self._upload_symbols_queue = multiprocessing.Queue()
-    self._hw_test_upload_queue = multiprocessing.Queue()
 
     # Queues that are populated by other stages.
     self._version_queue = multiprocessing.Queue()
@@ -1887,26 +2300,46 @@ class ArchiveStage(BoardSpecificBuilderStage):
                                                          archive_path)])
 
     def ArchivePayloads():
-      """Archives update payloads when they are ready."""
-      if self._build_config['upload_hw_test_artifacts']:
-        update_payloads_dir = tempfile.mkdtemp(prefix='cbuildbot')
-        target_image_path = os.path.join(self.GetImageDirSymlink(),
-                                         'chromiumos_test_image.bin')
-        # For non release builds, we are only interested in generating payloads
-        # for the purpose of imaging machines. This means we shouldn't generate
-        # delta payloads for n-1->n testing.
-        if self._build_config['build_type'] != constants.CANARY_TYPE:
-          commands.GenerateFullPayload(
+      """Archives update payloads as each one is ready."""
+      if not self._build_config['upload_hw_test_artifacts']:
+        return
+
+      chroot_tmp = os.path.join(buildroot, 'chroot', 'tmp')
+      update_payloads_dir = tempfile.mkdtemp(prefix='cbuildbot', dir=chroot_tmp)
+      image_name = 'chromiumos_test_image.bin'
+      target_image_path = os.path.join(self.GetImageDirSymlink(), image_name)
+
+      def ArchivePayload(filename, src_image_path):
+        """Generates one update payload and queues it for upload."""
+        if filename == 'stateful.tgz':
+          payload_path = commands.GenerateStatefulPayload(
               buildroot, target_image_path, update_payloads_dir)
         else:
-          commands.GenerateNPlus1Payloads(
-              buildroot, self.bot_archive_root, target_image_path,
-              update_payloads_dir)
+          payload_path = os.path.join(update_payloads_dir, filename)
+          commands.GenerateUpdatePayload(buildroot, target_image_path,
+                                         payload_path, src_image_path)
+        hw_test_upload_queue.put([commands.ArchiveFile(payload_path,
+                                                       archive_path)])
+
+      inputs = [['update.gz', None], ['stateful.tgz', None]]
+      # For non release builds, we are only interested in generating payloads
+      # for the purpose of imaging machines. This means we shouldn't generate
+      # delta payloads for n-1->n testing.
+      if self._build_config['build_type'] == constants.CANARY_TYPE:
+        inputs.append(['update_nton.gz', target_image_path])
+        previous_image_path = commands.ExtractPreviousImage(
+            self.bot_archive_root, archive_path, image_name,
+            os.path.join(update_payloads_dir, 'previous'))
+        if previous_image_path:
+          inputs.append(['update_nplus1.gz', previous_image_path])
+        else:
+          cros_build_lib.Warning('No previous version was archived; not '
+                                 'generating the n-1->n delta payload.')
 
-        for payload in os.listdir(update_payloads_dir):
-          full_path = os.path.join(update_payloads_dir, payload)
-          hw_test_upload_queue.put([commands.ArchiveFile(full_path,
-                                                         archive_path)])
+      try:
+        parallel.RunTasksInProcessPool(ArchivePayload, inputs)
+      finally:
+        osutils.RmDir(update_payloads_dir, ignore_missing=True, sudo=True)
 
     def ArchiveDebugSymbols():
       """Generate debug symbols and upload debug.tgz."""
@@ -2041,14 +2474,26 @@ class ArchiveStage(BoardSpecificBuilderStage):
       commands.UploadArchivedFile(archive_path, upload_url, filename, debug,
                                   update_list=True, acl=acl)
 
-    def ArchiveArtifactsForHWTesting(num_upload_processes=6):
+    def GetArtifactSize(filename):
+      """Return the size of an archived artifact."""
+      return os.path.getsize(os.path.join(archive_path, filename))
+
+    # HWTest stages wait on their artifacts, so those are uploaded first;
+    # PushImage waits on the release artifacts.
+    uploads = upload_scheduler.UploadScheduler(
+        UploadArtifact,
+        [hw_test_upload_queue, release_upload_queue, upload_queue],
+        processes=self.UPLOAD_PROCESSES,
+        bytes_per_second=self.UPLOAD_BYTES_PER_SECOND,
+        get_size=GetArtifactSize)
+
+    def ArchiveArtifactsForHWTesting():
       """Archives artifacts required for HWTest stage."""
       success = False
       try:
-        with bg_task_runner(UploadArtifact, queue=hw_test_upload_queue,
-                            processes=num_upload_processes):
-          steps = [ArchiveAutotestTarballs, ArchivePayloads]
-          parallel.RunParallelSteps(steps)
+        steps = [ArchiveAutotestTarballs, ArchivePayloads]
+        parallel.RunParallelSteps(steps)
+        uploads.Wait(hw_test_upload_queue)
         success = True
       finally:
         self._hw_test_uploads_status_queue.put(success)
@@ -2081,15 +2526,14 @@ class ArchiveStage(BoardSpecificBuilderStage):
                           profile=self._options.profile or config['profile'],
                           sign_types=sign_types)
 
-    def ArchiveReleaseArtifacts(num_upload_processes=10):
-      with bg_task_runner(UploadArtifact, queue=release_upload_queue,
-                          processes=num_upload_processes):
-        steps = [ArchiveDebugSymbols, BuildAndArchiveAllImages,
-                 ArchiveFirmwareImages]
-        parallel.RunParallelSteps(steps)
+    def ArchiveReleaseArtifacts():
+      steps = [ArchiveDebugSymbols, BuildAndArchiveAllImages,
+               ArchiveFirmwareImages]
+      parallel.RunParallelSteps(steps)
+      uploads.Wait(release_upload_queue)
       PushImage()
 
-    def BuildAndArchiveArtifacts(num_upload_processes=10):
+    def BuildAndArchiveArtifacts():
       # Run archiving steps in parallel.
       steps = [ArchiveReleaseArtifacts, ArchiveArtifactsForHWTesting,
                self.ArchiveMetadataJson]
@@ -2098,10 +2542,10 @@ class ArchiveStage(BoardSpecificBuilderStage):
             [self.ArchiveStrippedChrome, self.BuildAndArchiveChromeSysroot,
              self.ArchiveChromeEbuildEnv, ArchiveImageScripts])
 
+      # Symbols are uploaded by a single long running tool, not per file.
       with bg_task_runner(UploadSymbols, queue=upload_symbols_queue,
                           processes=1):
-        with bg_task_runner(UploadArtifact, queue=upload_queue,
-                            processes=num_upload_processes):
+        with uploads:
           parallel.RunParallelSteps(steps)
 
     def MarkAsLatest():
@@ -2135,6 +2579,9 @@ class UploadPrebuiltsStage(BoardSpecificBuilderStage):
   option_name = 'prebuilts'
   config_name = 'prebuilts'
 
+  # Which previous binhosts are passed on depends on the local chroot.
+  share_stage_cache = False
+
   def __init__(self, options, build_config, board, archive_stage, suffix=None):
     super(UploadPrebuiltsStage, self).__init__(options, build_config,
                                                board, suffix)
@@ -2167,6 +2614,21 @@ class UploadPrebuiltsStage(BoardSpecificBuilderStage):
 
     return generated_args
 
+  def _GetInputs(self):
+    # Uploading the same packages with the same arguments again is a no-op.
+    prebuilts = self._GetPrebuiltState()
+    inputs = self._GetCommonInputs()
+    if prebuilts is None or inputs is None:
+      return None
+    inputs['board'] = self._current_board
+    inputs['prebuilts'] = prebuilts
+    inputs['args'] = self._GetUploadArgs()
+    return inputs
+
+  def _GetUploadArgs(self):
+    """Return the arguments the prebuilts are uploaded with."""
+    return self._GetUploads()
+
   @classmethod
   def _AddOptionsForSlave(cls, builder, board):
     """Inner helper method to add upload_prebuilts args for a slave builder.
@@ -2190,8 +2652,13 @@ class UploadPrebuiltsStage(BoardSpecificBuilderStage):
 
     return args
 
-  def _PerformStage(self):
-    """Uploads prebuilts for master and slave builders."""
+  def _GetUploads(self):
+    """Return the uploads of prebuilts for master and slave builders.
+
+    Returns:
+      A list of (private_bucket, board, extra_args) tuples, one for each
+      call of commands.UploadPrebuilts.
+    """
     prebuilt_type = self._prebuilt_type
     board = self._current_board
     binhosts = []
@@ -2248,27 +2715,28 @@ class UploadPrebuiltsStage(BoardSpecificBuilderStage):
     if unified_master:
       # Upload the public/private prebuilts sequentially for unified master.
       # We set board to None as the unified master is always internal.
-      commands.UploadPrebuilts(
-          category=prebuilt_type, chrome_rev=self._chrome_rev,
-          private_bucket=False, buildroot=self._build_root, board=None,
-          extra_args=generated_args + public_args)
-      commands.UploadPrebuilts(
-          category=prebuilt_type, chrome_rev=self._chrome_rev,
-          private_bucket=True, buildroot=self._build_root, board=board,
-          extra_args=generated_args + private_args)
+      return [(False, None, generated_args + public_args),
+              (True, board, generated_args + private_args)]
     else:
       # Upload prebuilts for all other types of builders.
       extra_args = private_args if private_bucket else public_args
+      return [(private_bucket, board, generated_args + extra_args)]
+
+  def _PerformStage(self):
+    """Uploads prebuilts for master and slave builders."""
+    for private_bucket, board, extra_args in self._GetUploads():
       commands.UploadPrebuilts(
-          category=prebuilt_type, chrome_rev=self._chrome_rev,
-          private_bucket=private_bucket,
-          buildroot=self._build_root, board=board,
-          extra_args=generated_args + extra_args)
+          category=self._prebuilt_type, chrome_rev=self._chrome_rev,
+          private_bucket=private_bucket, buildroot=self._build_root,
+          board=board, extra_args=extra_args)
 
 
 class DevInstallerPrebuiltsStage(UploadPrebuiltsStage):
   config_name = 'dev_installer_prebuilts'
 
+  def _GetUploadArgs(self):
+    return self.GenerateCommonArgs()
+
   def _PerformStage(self):
     generated_args = generated_args = self.GenerateCommonArgs()
     commands.UploadDevInstallerPrebuilts(
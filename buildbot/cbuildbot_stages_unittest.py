@@ -25,6 +25,7 @@ from chromite.buildbot import lkgm_manager
 from chromite.buildbot import manifest_version
 from chromite.buildbot import repository
 from chromite.buildbot import portage_utilities
+from chromite.buildbot import stage_cache
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_test_lib
 from chromite.lib import gs_unittest
@@ -121,6 +122,33 @@ class BuilderStageTest(AbstractStageTest):
     self.mox.VerifyAll()
     self.assertEqual(result, 'RESULT')
 
+  def _RunCachedStage(self, metadata):
+    """Run a stage with unchanged inputs, whose cache entry has |metadata|."""
+    cache = self.mox.CreateMock(stage_cache.StageCache)
+    self.mox.StubOutWithMock(bs.BuilderStage, '_GetInputs')
+    self.mox.StubOutWithMock(bs.BuilderStage, '_PerformStage')
+    bs.BuilderStage._GetInputs().AndReturn({'manifest': 'abc'})
+    cache.Lookup(mox.IsA(str), shared=True).AndReturn(metadata)
+    if metadata is None:
+      bs.BuilderStage._PerformStage()
+      cache.Store(mox.IsA(str), {}, {}, shared=True)
+    self.mox.ReplayAll()
+    bs.BuilderStage.SetStageCache(cache)
+    try:
+      with cros_test_lib.OutputCapturer():
+        self.RunStage()
+    finally:
+      bs.BuilderStage.SetStageCache(None)
+    self.mox.VerifyAll()
+
+  def testStageCacheHit(self):
+    """A stage whose inputs are in the stage cache is skipped."""
+    self._RunCachedStage({})
+
+  def testStageCacheMiss(self):
+    """A stage whose inputs are not in the stage cache runs and is cached."""
+    self._RunCachedStage(None)
+
 
 class ManifestVersionedSyncStageTest(AbstractStageTest,
                                      cros_test_lib.TempDirTestCase):
@@ -334,8 +362,10 @@ class LKGMCandidateSyncCompletionStage(AbstractStageTest,
     status2 = dict(s3='pass')
 
     bs.BuilderStage._GetSlavesForUnifiedMaster().AndReturn((p_bs, pr_bs,))
-    lkgm_manager.LKGMManager.GetBuildersStatus(p_bs).AndReturn(status1)
-    lkgm_manager.LKGMManager.GetBuildersStatus(pr_bs).AndReturn(status2)
+    lkgm_manager.LKGMManager.GetBuildersStatus(
+        p_bs, callback=mox.IgnoreArg()).AndReturn(status1)
+    lkgm_manager.LKGMManager.GetBuildersStatus(
+        pr_bs, callback=mox.IgnoreArg()).AndReturn(status2)
 
     self.mox.ReplayAll()
     stage = self.ConstructStage()
@@ -348,6 +378,35 @@ class LKGMCandidateSyncCompletionStage(AbstractStageTest,
     for k, v in status2.iteritems():
       self.assertTrue(v, statuses.get(k))
 
+  def testStopOnFailure(self):
+    """The master stops waiting once a slave failed, without a timeout."""
+    self.mox.StubOutWithMock(bs.BuilderStage, '_GetSlavesForMaster')
+    self.mox.StubOutWithMock(lkgm_manager.LKGMManager, 'GetBuildersStatus')
+    self.mox.StubOutWithMock(lkgm_manager.LKGMManager, 'UploadStatus')
+    self.mox.StubOutWithMock(stages.LKGMCandidateSyncCompletionStage,
+                             'HandleValidationFailure')
+    self.mox.StubOutWithMock(stages.LKGMCandidateSyncCompletionStage,
+                             'HandleValidationTimeout')
+    stages.LKGMCandidateSyncStage.sub_manager = None
+    failed = manifest_version.BuilderStatus('fail', None)
+    statuses = dict(s1=failed, s2=None)
+
+    def _Watch(_builders, callback):
+      self.assertTrue(callback('s1', failed))
+
+    lkgm_manager.LKGMManager.UploadStatus(success=True, message=None)
+    bs.BuilderStage._GetSlavesForMaster().AndReturn(['s1', 's2'])
+    lkgm_manager.LKGMManager.GetBuildersStatus(
+        ['s1', 's2'], callback=mox.IgnoreArg()).WithSideEffects(
+            _Watch).AndReturn(statuses)
+    stages.LKGMCandidateSyncCompletionStage.HandleValidationFailure(
+        {'s1': failed})
+    self.mox.ReplayAll()
+
+    stage = self.ConstructStage()
+    self.assertRaises(results_lib.StepFailure, stage._PerformStage)
+    self.mox.VerifyAll()
+
 
   def testGetSlavesForMaster(self):
     """Tests that we get the slaves for a fake master configuration."""
@@ -617,22 +676,58 @@ class VMTestStageTest(AbstractStageTest, cros_test_lib.MockTestCase):
     self.build_config['vm_tests'] = constants.SIMPLE_AU_TEST_TYPE
     self.RunStage()
 
+  def testArchiveWithoutStackTraces(self):
+    """Test results are archived even if the stack traces can't be made."""
+    error = cros_build_lib.RunCommandError('asan_symbolize.py failed', None)
+    commands.GenerateStackTraces.side_effect = error
+    stage = self.ConstructStage()
+    # pylint: disable=W0212
+    self.assertRaises(cros_build_lib.RunCommandError,
+                      stage._ArchiveTestResults, '/tmp/results')
+    self.assertTrue(commands.ArchiveTestResults.called)
+    self.assertEqual(commands.UploadArchivedFile.call_count, 1)
+
 
-class UnitTestStageTest(AbstractStageTest):
+class UnitTestStageTest(AbstractStageTest, cros_test_lib.MockTestCase):
 
   def setUp(self):
     self.bot_id = 'x86-generic-full'
     self.build_config = config.config[self.bot_id].copy()
+    self.options.cache_dir = self.tempdir
+    self.mox.StubOutWithMock(commands, 'ListUnitTestPackages')
     self.mox.StubOutWithMock(commands, 'RunUnitTests')
+    self.StartPatcher(parallel_unittest.ParallelMock())
 
   def ConstructStage(self):
     return stages.UnitTestStage(self.options, self.build_config,
                                 self._current_board)
 
+  def _ExpectPackages(self, full, packages, failed=()):
+    """Expect unit tests of |packages| to run, failing for |failed|."""
+    commands.ListUnitTestPackages(self.build_root, self._current_board,
+                                  full=full).AndReturn(packages)
+    if not packages:
+      return
+    # Run all packages in one shard.
+    self.PatchObject(stages.multiprocessing, 'cpu_count',
+                     return_value=stages.UnitTestStage.CPUS_PER_SHARD)
+    output = ''.join('%s %s-0.0.1-r1 (in 0m%d.0s)\n' %
+                     ('Failed' if x in failed else 'Completed', x, i + 1)
+                     for i, x in enumerate(packages))
+    result = cros_build_lib.CommandResult(output=output)
+    call = commands.RunUnitTests(
+        self.build_root, self._current_board, full=True,
+        nowithdebug=mox.IgnoreArg(), packages=mox.SameElementsAs(packages),
+        capture_output=True)
+    if failed:
+      call.AndRaise(results_lib.BuildScriptFailure(
+          cros_build_lib.RunCommandError('failed', result), 'unittests'))
+    else:
+      call.AndReturn(result)
+
   def testQuickTests(self):
     self.build_config['quick_unit'] = True
-    commands.RunUnitTests(self.build_root, self._current_board, full=False,
-                          nowithdebug=mox.IgnoreArg())
+    self._ExpectPackages(False, ['chromeos-base/shill'])
     self.mox.ReplayAll()
     self.RunStage()
     self.mox.VerifyAll()
@@ -640,11 +735,59 @@ class UnitTestStageTest(AbstractStageTest):
   def testFullTests(self):
     """Tests if full unit and cros_au_test_harness tests are run correctly."""
     self.build_config['quick_unit'] = False
-    commands.RunUnitTests(self.build_root, self._current_board, full=True,
-                          nowithdebug=mox.IgnoreArg())
+    self._ExpectPackages(True, ['chromeos-base/shill',
+                                'chromeos-base/cryptohome'])
     self.mox.ReplayAll()
     self.RunStage()
     self.mox.VerifyAll()
+    timings = self.ConstructStage()._LoadTimings()
+    self.assertEqual(timings, {'chromeos-base/shill': 1.0,
+                               'chromeos-base/cryptohome': 2.0})
+
+  def testNoPackages(self):
+    """Nothing is run if no package needs testing."""
+    self.build_config['quick_unit'] = True
+    self._ExpectPackages(False, [])
+    self.mox.ReplayAll()
+    self.RunStage()
+    self.mox.VerifyAll()
+
+  def testFailedPackages(self):
+    """All packages are tested, and the failed ones reported."""
+    self.build_config['quick_unit'] = False
+    self._ExpectPackages(True, ['a/b', 'c/d', 'e/f'], failed=['a/b', 'e/f'])
+    self.mox.ReplayAll()
+    stage = self.ConstructStage()
+    with cros_test_lib.OutputCapturer():
+      try:
+        stage._PerformStage()
+        self.fail('The failed packages were not reported')
+      except results_lib.PackageBuildFailure as e:
+        self.assertEqual(e.failed_packages, set(['a/b', 'e/f']))
+    self.mox.VerifyAll()
+
+  def testParseEmergeTimings(self):
+    """Timings and final failures are read from parallel_emerge output."""
+    output = '\n'.join([
+        'Started chromeos-base/shill-0.0.1-r1 (logged in /tmp/shill.log)',
+        'Failed chromeos-base/shill-0.0.1-r1 (in 0m3.5s), retrying later.',
+        'Completed chromeos-base/shill-0.0.1-r1 (in 1m2.5s)',
+        'Failed dev-libs/foo-1.2 (in 0m1.0s). Your build has failed.',
+    ])
+    self.assertEqual(stages.UnitTestStage.ParseEmergeTimings(output),
+                     ({'chromeos-base/shill': 62.5, 'dev-libs/foo': 1.0},
+                      set(['dev-libs/foo'])))
+
+  def testShardPackages(self):
+    """Packages are balanced across shards, longest first."""
+    timings = {'a': 10, 'b': 7, 'c': 5, 'd': 4, 'e': 2}
+    shard = stages.UnitTestStage.ShardPackages
+    self.assertEqual(shard(sorted(timings), timings, 2),
+                     [['a', 'd'], ['b', 'c', 'e']])
+    # Unknown packages are taken to be average.
+    self.assertEqual(shard(['a', 'x', 'e'], timings, 2), [['a'], ['x', 'e']])
+    self.assertEqual(shard(['a'], timings, 4), [['a']])
+    self.assertEqual(shard([], timings, 4), [[]])
 
 
 class HWTestStageTest(AbstractStageTest):
@@ -874,6 +1017,7 @@ class BuildTargetStageTest(AbstractStageTest, cros_test_lib.MockTestCase):
 
     self.mox.StubOutWithMock(shutil, 'move')
     self.mox.StubOutWithMock(commands, 'Build')
+    self.mox.StubOutWithMock(commands, 'UpdateToolchain')
     self.mox.StubOutWithMock(commands, 'UploadPrebuilts')
     self.mox.StubOutWithMock(commands, 'BuildImage')
     self.mox.StubOutWithMock(commands, 'BuildVMImageForTesting')
@@ -890,10 +1034,13 @@ class BuildTargetStageTest(AbstractStageTest, cros_test_lib.MockTestCase):
     # pylint: disable=E1101
     self.parallel_mock = self.StartPatcher(parallel_unittest.ParallelMock())
 
+    self.build_slots = None
+
   def ConstructStage(self):
     return stages.BuildTargetStage(
         self.options, self.build_config, self._current_board,
-        self.archive_stage_mock, self.version_to_test)
+        self.archive_stage_mock, self.version_to_test,
+        build_slots=self.build_slots)
 
   def testAllConditionalPaths(self):
     """Enable all paths to get line coverage."""
@@ -989,6 +1136,123 @@ class BuildTargetStageTest(AbstractStageTest, cros_test_lib.MockTestCase):
     self.RunStage()
     self.mox.VerifyAll()
 
+  def testImagesFromStageCache(self):
+    """Packages are always built, but images may come from the stage cache."""
+    # The images are not built, so don't expect the calls setUp recorded.
+    self.mox.ResetAll()
+    cache = self.mox.CreateMock(stage_cache.StageCache)
+    self.mox.StubOutWithMock(stages.BuildTargetStage, '_GetImageInputs')
+    self.mox.StubOutWithMock(stages.BuildTargetStage, '_RestoreFromCache')
+
+    commands.Build(self.build_root, self._current_board,
+                   build_autotest=mox.IgnoreArg(), usepkg=mox.IgnoreArg(),
+                   chrome_root=None, skip_toolchain_update=mox.IgnoreArg(),
+                   nowithdebug=mox.IgnoreArg(), packages=mox.IgnoreArg(),
+                   extra_env=mox.IgnoreArg())
+    stages.BuildTargetStage._GetImageInputs().AndReturn({'prebuilts': 'abc'})
+    cache.Lookup(mox.IsA(str)).AndReturn({'image_dir': 'myimage'})
+    stages.BuildTargetStage._RestoreFromCache(
+        mox.IsA(str), {'image_dir': 'myimage'}).AndReturn(True)
+
+    self.mox.ReplayAll()
+    bs.BuilderStage.SetStageCache(cache)
+    try:
+      self.RunStage()
+    finally:
+      bs.BuilderStage.SetStageCache(None)
+    self.mox.VerifyAll()
+
+  def testRestoreFromCache(self):
+    """The restored autotest tarballs do not stay in the images directory."""
+    self.mox.UnsetStubs()
+    self.mox.ResetAll()
+    self.PatchObject(stages.BuildTargetStage, '_CommunicateVersion')
+    cache = stage_cache.StageCache(os.path.join(self.tempdir, 'cache'))
+    src_dir = os.path.join(self.tempdir, 'src')
+    for name in ('myimage/image.bin', 'autotest/autotest.tar',
+                 'autotest/test_suites.tar.bz2'):
+      osutils.WriteFile(os.path.join(src_dir, name), name, makedirs=True)
+    cache.Store('abc', {'myimage': os.path.join(src_dir, 'myimage'),
+                        'autotest': os.path.join(src_dir, 'autotest')})
+    self.archive_stage_mock.AutotestTarballsReady(mox.IsA(list))
+
+    self.mox.ReplayAll()
+    bs.BuilderStage.SetStageCache(cache)
+    try:
+      stage = self.ConstructStage()
+      # pylint: disable=W0212
+      self.assertTrue(stage._RestoreFromCache('abc', {'image_dir': 'myimage'}))
+    finally:
+      bs.BuilderStage.SetStageCache(None)
+    self.mox.VerifyAll()
+
+    self.assertEqual(sorted(os.listdir(self.images_root)),
+                     ['latest-cbuildbot', 'myimage'])
+    self.assertEqual(os.readlink(self.latest_cbuildbot), 'myimage')
+    self.assertEqual(sorted(os.listdir(stage._tarball_dir)),
+                     ['autotest.tar', 'test_suites.tar.bz2'])
+    osutils.RmDir(stage._tarball_dir)
+
+  def _CheckSlotsHeld(self, compile_held, image_held):
+    """Check which of the build slots are currently held."""
+    # pylint: disable=W0212
+    for semaphore, held in ((self.build_slots._compile, compile_held),
+                            (self.build_slots._image, image_held)):
+      acquired = semaphore.acquire(False)
+      if acquired:
+        semaphore.release()
+      self.assertEqual(held, not acquired)
+
+  def testBuildSlots(self):
+    """Verify that compiling and building images hold separate slots."""
+    self.build_slots = stages.BoardBuildSlots(compile_slots=1, image_slots=1)
+    compiling = lambda *_args, **_kwargs: self._CheckSlotsHeld(True, False)
+    imaging = lambda *_args, **_kwargs: self._CheckSlotsHeld(False, True)
+
+    commands.Build(self.build_root, self._current_board,
+                   build_autotest=mox.IgnoreArg(), usepkg=mox.IgnoreArg(),
+                   chrome_root=None, skip_toolchain_update=mox.IgnoreArg(),
+                   nowithdebug=mox.IgnoreArg(), packages=mox.IgnoreArg(),
+                   extra_env=mox.IgnoreArg()).WithSideEffects(compiling)
+    self.archive_stage_mock.AutotestTarballsReady(None)
+    commands.BuildImage(self.build_root, self._current_board, ['test'],
+                        disk_layout=None, rootfs_verification=True,
+                        version=self.version,
+                        extra_env=mox.IgnoreArg()).WithSideEffects(imaging)
+    self.archive_stage_mock.SetVersion(self.branch_version)
+
+    self.mox.ReplayAll()
+    self.RunStage()
+    self.mox.VerifyAll()
+    self._CheckSlotsHeld(False, False)
+
+  def testSharedCompileSlots(self):
+    """Boards compiling side by side update the toolchain one at a time."""
+    self.build_slots = stages.BoardBuildSlots(compile_slots=2, image_slots=1)
+    self.build_config['latest_toolchain'] = False
+
+    def _CheckToolchainLocked(*_args, **_kwargs):
+      # pylint: disable=W0212
+      self.assertFalse(self.build_slots._toolchain.acquire(False))
+
+    commands.UpdateToolchain(
+        self.build_root, self._current_board, usepkg=mox.IgnoreArg(),
+        extra_env=mox.IgnoreArg()).WithSideEffects(_CheckToolchainLocked)
+    commands.Build(self.build_root, self._current_board,
+                   build_autotest=mox.IgnoreArg(), usepkg=mox.IgnoreArg(),
+                   chrome_root=None, skip_toolchain_update=True,
+                   nowithdebug=mox.IgnoreArg(), packages=mox.IgnoreArg(),
+                   extra_env=mox.IgnoreArg())
+    self.archive_stage_mock.AutotestTarballsReady(None)
+    commands.BuildImage(self.build_root, self._current_board, ['test'],
+                        disk_layout=None, rootfs_verification=True,
+                        version=self.version, extra_env=mox.IgnoreArg())
+    self.archive_stage_mock.SetVersion(self.branch_version)
+
+    self.mox.ReplayAll()
+    self.RunStage()
+    self.mox.VerifyAll()
+
   def testFalseTestArg(self):
     """Make sure our logic for build test arg can toggle to false."""
     self.build_config['vm_tests'] = None
@@ -13,6 +13,8 @@ CHROMITE_BIN_SUBDIR = 'chromite/bin'
 CHROMITE_BIN_DIR = os.path.join(SOURCE_ROOT, CHROMITE_BIN_SUBDIR)
 PATH_TO_CBUILDBOT = os.path.join(CHROMITE_BIN_SUBDIR, 'cbuildbot')
 DEFAULT_CHROOT_DIR = 'chroot'
+# Where paths in the buildroot are moved before they are deleted.
+TRASH_DIR = '.trash'
 SDK_TOOLCHAINS_OUTPUT = 'tmp/toolchain-pkgs'
 
 # Re-execution API constants.
@@ -19,6 +19,8 @@ from chromite.buildbot import constants
 from chromite.buildbot import manifest_version
 from chromite.lib import cros_build_lib
 from chromite.lib import git
+from chromite.lib import gs
+from chromite.lib import parallel
 
 
 # Paladin constants for manifest names.
@@ -96,6 +98,125 @@ class _LKGMCandidateInfo(manifest_version.VersionInfo):
     return self.VersionString()
 
 
+class SlaveStatusWatcher(object):
+  """Watches the statuses of a set of builders until they all complete.
+
+  Each round checks all of the pending builders at once.  If a GSContext is
+  given, the status files are first listed with one `gsutil ls -L`, and only
+  those whose generation changed since the last round are read again.  The
+  interval between rounds doubles while no status changes, up to
+  |max_interval|, and drops back to |min_interval| when one does.
+  """
+
+  # How many statuses to read at once.
+  MAX_THREADS = 16
+
+  def __init__(self, builders, version, get_status, ctx=None,
+               min_interval=5, max_interval=constants.SLEEP_TIMEOUT):
+    """Initialize the watcher.
+
+    Args:
+      builders: The builders to watch.
+      version: The version the builders are building.
+      get_status: Function returning the BuilderStatus of a (builder,
+        version), or None if the builder has not reported a status yet.
+      ctx: If given, a GSContext used to skip reading unchanged statuses.
+      min_interval: Seconds to wait between rounds after a status changed.
+      max_interval: Most seconds to wait between rounds.
+    """
+    self.builders = builders
+    self.version = version
+    self.statuses = dict.fromkeys(builders)
+    self._get_status = get_status
+    self._ctx = ctx
+    self._min_interval = min(min_interval, max_interval)
+    self._max_interval = max_interval
+    self._generations = {}
+
+  def GetPending(self):
+    """Returns the builders that have not completed yet."""
+    return [b for b in self.builders
+            if not self.statuses[b] or not self.statuses[b].Completed()]
+
+  def _GetChanged(self, builders):
+    """Returns the |builders| whose status may have changed.
+
+    Returns:
+      A list of (builder, generation) tuples, where generation is that of the
+      builder's status file, or None if it is not known.
+    """
+    if self._ctx is None:
+      return [(b, None) for b in builders]
+    # pylint: disable=W0212
+    get_url = manifest_version.BuildSpecsManager._GetStatusUrl
+    try:
+      objects = self._ctx.Stat(get_url('*', self.version))
+    except (gs.GSContextException, cros_build_lib.RunCommandError):
+      # The listing fails e.g. before any builder uploaded its status.
+      return [(b, None) for b in builders]
+
+    changed = []
+    for builder in builders:
+      metadata = objects.get(get_url(builder, self.version))
+      if metadata is None:
+        # The builder has not uploaded a status yet.
+        continue
+      generation = metadata.get('generation')
+      if generation is None or generation != self._generations.get(builder):
+        changed.append((builder, generation))
+    return changed
+
+  def Poll(self):
+    """Checks the pending builders once.
+
+    Yields:
+      A (builder, status) tuple for each builder whose status changed, as
+      soon as it is read.
+    """
+    def _CheckStatus(builder, generation):
+      logging.debug("Checking for builder %s's status", builder)
+      return builder, generation, self._get_status(builder, self.version)
+
+    inputs = self._GetChanged(self.GetPending())
+    for builder, generation, status in parallel.IterTasksInThreads(
+        _CheckStatus, inputs, threads=self.MAX_THREADS):
+      old_status = self.statuses[builder]
+      self.statuses[builder] = status
+      if status is None:
+        logging.warn('No status found for builder %s.', builder)
+        continue
+      # Only skip the status file from now on once it has been read.
+      if generation is not None:
+        self._generations[builder] = generation
+      if old_status is None or old_status.status != status.status:
+        yield builder, status
+
+  def Watch(self, timeout):
+    """Polls the builders until they all complete or |timeout| is reached.
+
+    Yields:
+      A (builder, status) tuple for each status change, as soon as it is seen.
+    """
+    start_time = time.time()
+    interval = self._min_interval
+    while True:
+      changed = False
+      for builder, status in self.Poll():
+        changed = True
+        yield builder, status
+
+      pending = self.GetPending()
+      if not pending or time.time() - start_time >= timeout:
+        return
+      logging.info('Still waiting for the following builds to complete: %r',
+                   sorted(pending))
+      if changed:
+        interval = self._min_interval
+      else:
+        interval = min(interval * 2, self._max_interval)
+      time.sleep(interval)
+
+
 class LKGMManager(manifest_version.BuildSpecsManager):
   """A Class to manage lkgm candidates and their states.
 
@@ -113,6 +234,8 @@ class LKGMManager(manifest_version.BuildSpecsManager):
   MAX_TIMEOUT_SECONDS = 300
   # Polling timeout for checking git repo for other build statuses.
   SLEEP_TIMEOUT = constants.SLEEP_TIMEOUT
+  # Shortest polling timeout for build statuses, used while they change.
+  MIN_SLEEP_TIMEOUT = 5
 
   # Sub-directories for LKGM and Chrome LKGM's.
   LKGM_SUBDIR = 'LKGM-candidates'
@@ -148,16 +271,20 @@ class LKGMManager(manifest_version.BuildSpecsManager):
       assert cbuildbot_config.IsPFQType(self.build_type)
       self.rel_working_dir = self.LKGM_SUBDIR
 
+  def _GetMaxTimeout(self, use_long_timeout=False):
+    """Returns how long to wait for other builders, in seconds."""
+    if not use_long_timeout:
+      return self.MAX_TIMEOUT_SECONDS
+    elif self.build_type == constants.PFQ_TYPE:
+      return self.LONG_MAX_TIMEOUT_SECONDS
+    else:
+      return self.CHROME_LONG_MAX_TIMEOUT_SECONDS
+
   def _RunLambdaWithTimeout(self, function_to_run, use_long_timeout=False):
     """Runs function_to_run until it returns a value or timeout is reached."""
     function_success = False
     start_time = time.time()
-    max_timeout = self.MAX_TIMEOUT_SECONDS
-    if use_long_timeout:
-      if self.build_type == constants.PFQ_TYPE:
-        max_timeout = self.LONG_MAX_TIMEOUT_SECONDS
-      else:
-        max_timeout = self.CHROME_LONG_MAX_TIMEOUT_SECONDS
+    max_timeout = self._GetMaxTimeout(use_long_timeout)
 
     # Monitor the repo until all builders report in or we've waited too long.
     while (time.time() - start_time) < max_timeout:
@@ -371,43 +498,35 @@ class LKGMManager(manifest_version.BuildSpecsManager):
     else:
       return None
 
-  def GetBuildersStatus(self, builders_array):
-    """Returns a build-names->status dictionary of build statuses."""
-    builders_completed = set()
-    builder_statuses = {}
-
-    def _CheckStatusOfBuildersArray():
-      """Helper function that iterates through current statuses."""
-      for b in builders_array:
-        cached_status = builder_statuses.get(b)
-        if not cached_status or not cached_status.Completed():
-          logging.debug("Checking for builder %s's status", b)
-          builder_status = self.GetBuildStatus(b, self.current_version)
-          builder_statuses[b] = builder_status
-          if builder_status is None:
-            logging.warn('No status found for builder %s.', b)
-          elif builder_status.Passed():
-            builders_completed.add(b)
-            logging.info('Builder %s completed with status passed', b)
-          elif builder_status.Failed():
-            builders_completed.add(b)
-            logging.info('Builder %s completed with status failed', b)
-
-
-      if len(builders_completed) < len(builders_array):
-        logging.info('Still waiting for the following builds to complete: %r',
-                     sorted(set(builders_array).difference(builders_completed)))
-        return None
-      else:
-        return 'Builds completed.'
+  def GetBuildersStatus(self, builders_array, callback=None):
+    """Returns a build-names->status dictionary of build statuses.
+
+    Args:
+      builders_array: The builders to wait for.
+      callback: If given, called with (builder, status) each time the status
+        of a builder changes.  If it returns True, stop waiting for the
+        remaining builders.
+    """
+    # Listing the statuses is only worth it if there are many to read.
+    ctx = None
+    if not self.dry_run and len(builders_array) > 1:
+      ctx = gs.GSContext(retries=0)
+    watcher = SlaveStatusWatcher(
+        builders_array, self.current_version, self.GetBuildStatus, ctx=ctx,
+        min_interval=self.MIN_SLEEP_TIMEOUT, max_interval=self.SLEEP_TIMEOUT)
 
     # Check for build completion until all builders report in.
-    builds_succeeded = self._RunLambdaWithTimeout(_CheckStatusOfBuildersArray,
-                                                  use_long_timeout=True)
-    if not builds_succeeded:
-      logging.error('Not all builds finished before MAX_TIMEOUT reached.')
+    for builder, status in watcher.Watch(self._GetMaxTimeout(True)):
+      if status.Completed():
+        logging.info('Builder %s completed with status %s', builder,
+                     status.status)
+      if callback and callback(builder, status):
+        break
+    else:
+      if watcher.GetPending():
+        logging.error('Not all builds finished before MAX_TIMEOUT reached.')
 
-    return builder_statuses
+    return watcher.statuses
 
   def PromoteCandidate(self, retries=manifest_version.NUM_RETRIES):
     """Promotes the current LKGM candidate to be a real versioned LKGM."""
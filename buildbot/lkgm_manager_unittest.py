@@ -22,6 +22,7 @@ from chromite.buildbot import repository
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_test_lib
 from chromite.lib import git
+from chromite.lib import gs
 from chromite.lib import osutils
 
 # TODO(build): Finish test wrapper (http://crosbug.com/37517).
@@ -73,6 +74,62 @@ class LKGMCandidateInfoTest(cros_test_lib.TestCase):
     self.assertTrue(info4 > info3)
 
 
+class SlaveStatusWatcherTest(cros_test_lib.MoxTestCase):
+  """Tests for the SlaveStatusWatcher class."""
+
+  VERSION = '1.2.4-rc3'
+
+  def _GetUrl(self, builder):
+    return manifest_version.BuildSpecsManager._GetStatusUrl(builder,
+                                                            self.VERSION)
+
+  def testSkipUnchanged(self):
+    """Only statuses whose generation changed are read again."""
+    ctx = self.mox.CreateMock(gs.GSContext)
+    get_status = self.mox.CreateMockAnything()
+    ctx.Stat(self._GetUrl('*')).AndReturn(
+        {self._GetUrl('build1'): {'generation': '1'},
+         self._GetUrl('build2'): {'generation': '1'}})
+    get_status('build1', self.VERSION).InAnyOrder().AndReturn(
+        manifest_version.BuilderStatus('inflight', None))
+    get_status('build2', self.VERSION).InAnyOrder().AndReturn(
+        manifest_version.BuilderStatus('inflight', None))
+    # build3 has not started; build1 is unchanged.
+    ctx.Stat(self._GetUrl('*')).AndReturn(
+        {self._GetUrl('build1'): {'generation': '1'},
+         self._GetUrl('build2'): {'generation': '2'}})
+    get_status('build2', self.VERSION).AndReturn(
+        manifest_version.BuilderStatus('pass', None))
+    self.mox.ReplayAll()
+
+    watcher = lkgm_manager.SlaveStatusWatcher(
+        ['build1', 'build2', 'build3'], self.VERSION, get_status, ctx=ctx)
+    self.assertEqual(len(list(watcher.Poll())), 2)
+    self.assertEqual([(b, s.status) for b, s in watcher.Poll()],
+                     [('build2', 'pass')])
+    self.assertEqual(watcher.GetPending(), ['build1', 'build3'])
+    self.mox.VerifyAll()
+
+  def testRereadAfterFailedRead(self):
+    """A status that could not be read is read again, even if unchanged."""
+    ctx = self.mox.CreateMock(gs.GSContext)
+    get_status = self.mox.CreateMockAnything()
+    listing = {self._GetUrl('build1'): {'generation': '1'}}
+    ctx.Stat(self._GetUrl('*')).AndReturn(listing)
+    get_status('build1', self.VERSION).AndReturn(None)
+    ctx.Stat(self._GetUrl('*')).AndReturn(listing)
+    get_status('build1', self.VERSION).AndReturn(
+        manifest_version.BuilderStatus('pass', None))
+    self.mox.ReplayAll()
+
+    watcher = lkgm_manager.SlaveStatusWatcher(
+        ['build1'], self.VERSION, get_status, ctx=ctx)
+    self.assertEqual(list(watcher.Poll()), [])
+    self.assertEqual([(b, s.status) for b, s in watcher.Poll()],
+                     [('build1', 'pass')])
+    self.mox.VerifyAll()
+
+
 class LKGMManagerTest(cros_test_lib.MoxTempDirTestCase):
   """Tests for the BuildSpecs manager."""
 
@@ -341,43 +398,62 @@ class LKGMManagerTest(cros_test_lib.MoxTempDirTestCase):
     osutils.Touch(manifest)
     return manifest, dir_pfx
 
-  def _GetBuildersStatus(self, builders, status_runs):
+  def _GetBuildersStatus(self, builders, status_runs, **kwargs):
     """Test a call to LKGMManager.GetBuildersStatus.
 
     Args:
       builders: List of builders to get status for.
-      status_runs: List of expected (builder, status) tuples.
+      status_runs: List of rounds of expected (builder, status) tuples.  The
+        statuses of one round are read in any order.
+      kwargs: Passed to GetBuildersStatus.
     """
     self.mox.StubOutWithMock(lkgm_manager.LKGMManager, 'GetBuildStatus')
-    for builder, status in status_runs:
-      # GetBuildStatus returns None if the builder has not even started yet
-      # (e.g. because the builder is down.)
-      if status is not None:
-        status = manifest_version.BuilderStatus(status, None)
-      lkgm_manager.LKGMManager.GetBuildStatus(
-          builder, mox.IgnoreArg()).AndReturn(status)
+    for i, status_round in enumerate(status_runs):
+      for builder, status in status_round:
+        # GetBuildStatus returns None if the builder has not even started yet
+        # (e.g. because the builder is down.)
+        if status is not None:
+          status = manifest_version.BuilderStatus(status, None)
+        lkgm_manager.LKGMManager.GetBuildStatus(
+            builder, mox.IgnoreArg()).InAnyOrder(i).AndReturn(status)
 
     self.mox.ReplayAll()
-    statuses = self.manager.GetBuildersStatus(builders)
+    statuses = self.manager.GetBuildersStatus(builders, **kwargs)
     self.mox.VerifyAll()
     return statuses
 
   def testGetBuildersStatusBothFinished(self):
     """Tests GetBuilderStatus where both builds have finished."""
-    status_runs = [('build1', 'fail'), ('build2', 'pass')]
+    status_runs = [[('build1', 'fail'), ('build2', 'pass')]]
     statuses = self._GetBuildersStatus(['build1', 'build2'], status_runs)
     self.assertTrue(statuses['build1'].Failed())
     self.assertTrue(statuses['build2'].Passed())
 
   def testGetBuildersStatusLoop(self):
     """Tests GetBuilderStatus where builds are inflight."""
-    status_runs = [('build1', 'inflight'), ('build2', None),
-                   ('build1', 'fail'), ('build2', 'inflight'),
-                   ('build2', 'pass')]
+    status_runs = [[('build1', 'inflight'), ('build2', None)],
+                   [('build1', 'fail'), ('build2', 'inflight')],
+                   [('build2', 'pass')]]
     statuses = self._GetBuildersStatus(['build1', 'build2'], status_runs)
     self.assertTrue(statuses['build1'].Failed())
     self.assertTrue(statuses['build2'].Passed())
 
+  def testGetBuildersStatusCallback(self):
+    """Tests that the callback sees each change, and can stop the wait."""
+    status_runs = [[('build1', 'inflight'), ('build2', 'inflight')],
+                   [('build1', 'inflight'), ('build2', 'fail')]]
+    changes = []
+    def _Callback(builder, status):
+      changes.append((builder, status.status))
+      return status.Failed()
+
+    statuses = self._GetBuildersStatus(['build1', 'build2'], status_runs,
+                                       callback=_Callback)
+    self.assertEqual(sorted(changes[:2]), [('build1', 'inflight'),
+                                           ('build2', 'inflight')])
+    self.assertEqual(changes[2:], [('build2', 'fail')])
+    self.assertTrue(statuses['build1'].Inflight())
+
   def testGenerateBlameListSinceLKGM(self):
     """Tests that we can generate a blamelist from two commit messages.
 
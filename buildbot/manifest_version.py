@@ -6,8 +6,10 @@
 A library to generate and store the manifests for cros builders to use.
 """
 
+import bisect
 import cPickle
-import fnmatch
+import hashlib
+import json
 import logging
 import os
 import re
@@ -352,6 +354,283 @@ class BuilderStatus(object):
       return cls.STATUS_FAILED
 
 
+_MANIFEST_REVISION_RE = re.compile(r'<manifest revision="[a-f0-9]+">', re.I)
+
+
+def GetManifestHash(manifest):
+  """Returns a hash of the |manifest| XML text.
+
+  Like RepoRepository.IsManifestDifferent, this ignores whitespace around
+  lines and the revision of the manifest repository itself, so manifests with
+  the same hash describe the same sources.  Manifests that only differ in the
+  lines IsManifestDifferent skips still hash differently.
+  """
+  lines = [_MANIFEST_REVISION_RE.sub('<manifest>', x.strip())
+           for x in manifest.splitlines()]
+  return hashlib.sha1('\n'.join(lines)).hexdigest()
+
+
+class BuildSpecIndex(object):
+  """An index of the buildspecs in a manifest-versions checkout.
+
+  Listing and sorting a directory of tens of thousands of buildspecs for each
+  lookup is slow.  Instead, for each directory of specs, the index stores the
+  git hash of every spec, along with the git tree the directory was indexed
+  at.  It is kept next to the checkout, so it survives checkout cleanups.
+  When the tree of a directory changes (e.g. after a fetch), only the specs
+  that differ between the two trees are updated.  In memory, the versions are
+  kept sorted, so the latest version for a prefix is found by bisection.
+
+  Builders record their result by adding a spec to their pass/ or fail/
+  directory, so the status of a version is a lookup in those two indexes.
+  The GetManifestHash of a spec is computed when first asked for, and kept
+  in the index along with the git hash it was computed from.
+
+  Directories that are not in a git checkout are listed on every lookup.
+  """
+
+  def __init__(self, manifest_dir, compare_versions_fn):
+    """Initialize the index.
+
+    Args:
+      manifest_dir: The manifest-versions checkout.
+      compare_versions_fn: Function returning the sort key of a version.
+    """
+    self.manifest_dir = manifest_dir
+    self.path = '%s.index' % manifest_dir.rstrip(os.sep)
+    self.compare_versions_fn = compare_versions_fn
+    # Maps the relative path of each indexed directory to a dict holding the
+    # 'tree' it was indexed at, its 'specs' as a version -> hash dict, and
+    # the GetManifestHash of some specs as a git hash -> hash dict in
+    # 'manifests'.
+    self._dirs = None
+    # Maps the relative path of a directory to the sorted (keys, versions).
+    self._sorted = {}
+
+  def _Load(self):
+    """Load the index from disk, if needed."""
+    if self._dirs is None:
+      self._dirs = {}
+      if os.path.exists(self.path):
+        try:
+          self._dirs = json.loads(osutils.ReadFile(self.path))
+        except ValueError:
+          logging.warning('Ignoring corrupt buildspec index %s', self.path)
+
+  def _Save(self):
+    """Write the index to disk."""
+    # Several stages may save the index at once; each uses its own file.
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(self.path),
+        prefix='%s.' % os.path.basename(self.path))
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump(self._dirs, f)
+      os.rename(temp_path, self.path)
+    except EnvironmentError:
+      osutils.SafeUnlink(temp_path)
+      raise
+
+  def _RunGit(self, cmd):
+    return git.RunGit(self.manifest_dir, cmd).output
+
+  def _GetTree(self, rel_dir):
+    """Returns the git tree of |rel_dir| at HEAD, or None if missing."""
+    result = git.RunGit(self.manifest_dir,
+                        ['rev-parse', '--verify', '-q', 'HEAD:%s' % rel_dir],
+                        error_code_ok=True)
+    return result.output.strip() if result.returncode == 0 else None
+
+  def _HasObject(self, obj):
+    """Returns whether the checkout has the git object |obj|."""
+    result = git.RunGit(self.manifest_dir, ['cat-file', '-e', obj],
+                        error_code_ok=True)
+    return result.returncode == 0
+
+  @staticmethod
+  def _GetVersion(filename):
+    """Returns the version of a buildspec filename, or None."""
+    version, ext = os.path.splitext(filename)
+    return version if ext == '.xml' else None
+
+  def _ListTree(self, tree):
+    """Returns the version -> hash dict of the specs in |tree|."""
+    specs = {}
+    for line in self._RunGit(['ls-tree', tree]).splitlines():
+      # <mode> <type> <hash>\t<filename>
+      info, filename = line.split('\t', 1)
+      version = self._GetVersion(filename)
+      if version:
+        specs[version] = info.split()[2]
+    return specs
+
+  def _DiffTrees(self, old_tree, new_tree):
+    """Yields the (version, hash) of the specs changed between two trees.
+
+    The hash is None for specs that were removed.
+    """
+    output = self._RunGit(['diff-tree', '--no-renames', old_tree, new_tree])
+    for line in output.splitlines():
+      # :<old mode> <new mode> <old hash> <new hash> <status>\t<filename>
+      info, filename = line.split('\t', 1)
+      version = self._GetVersion(filename)
+      if version:
+        new_hash = info.split()[3]
+        yield version, None if info.split()[4] == 'D' else new_hash
+
+  def _GetKey(self, version):
+    """Returns the sort key of |version|, or None if it is not a version."""
+    try:
+      return self.compare_versions_fn(version)
+    except (AssertionError, AttributeError, ValueError):
+      logging.debug('Ignoring buildspec with unknown version %s', version)
+      return None
+
+  def _SortVersions(self, versions):
+    """Returns the sorted (keys, versions) of the valid |versions|."""
+    pairs = sorted((self._GetKey(x), x) for x in versions)
+    pairs = [x for x in pairs if x[0] is not None]
+    return [x[0] for x in pairs], [x[1] for x in pairs]
+
+  def _InsertSorted(self, rel_dir, version):
+    """Add |version| to the sorted versions of |rel_dir|, if loaded."""
+    key = self._GetKey(version)
+    if rel_dir in self._sorted and key is not None:
+      keys, versions = self._sorted[rel_dir]
+      index = bisect.bisect(keys, key)
+      keys.insert(index, key)
+      versions.insert(index, version)
+
+  def _RemoveSorted(self, rel_dir, version):
+    """Remove |version| from the sorted versions of |rel_dir|, if loaded."""
+    key = self._GetKey(version)
+    if rel_dir in self._sorted and key is not None:
+      keys, versions = self._sorted[rel_dir]
+      index = bisect.bisect_left(keys, key)
+      if index < len(keys) and versions[index] == version:
+        del keys[index]
+        del versions[index]
+
+  def _Update(self, directory):
+    """Bring the index of |directory| up to date.
+
+    Returns:
+      The relative path of |directory|, or None if it is not in a checkout.
+    """
+    if not os.path.isdir(os.path.join(self.manifest_dir, '.git')):
+      return None
+    rel_dir = os.path.relpath(directory, self.manifest_dir)
+    tree = self._GetTree(rel_dir)
+    self._Load()
+    entry = self._dirs.get(rel_dir)
+    if entry is not None and entry['tree'] == tree:
+      return rel_dir
+
+    # The indexed tree is gone if the checkout was cloned again (possibly
+    # from the other manifest-versions repository), or if it was only in a
+    # local commit that was dropped.
+    if (entry is None or entry['tree'] is None or tree is None or
+        not self._HasObject(entry['tree'])):
+      specs = self._ListTree(tree) if tree else {}
+      manifests = {}
+      self._sorted.pop(rel_dir, None)
+    else:
+      specs = entry['specs']
+      manifests = entry.get('manifests', {})
+      for version, spec_hash in self._DiffTrees(entry['tree'], tree):
+        old_hash = specs.get(version)
+        if old_hash is not None:
+          manifests.pop(old_hash, None)
+        if spec_hash is None:
+          if specs.pop(version, None) is not None:
+            self._RemoveSorted(rel_dir, version)
+        else:
+          if version not in specs:
+            self._InsertSorted(rel_dir, version)
+          specs[version] = spec_hash
+    self._dirs[rel_dir] = {'tree': tree, 'specs': specs,
+                           'manifests': manifests}
+    self._Save()
+    return rel_dir
+
+  def Latest(self, directory, prefix=''):
+    """Returns the latest version in |directory| that starts with |prefix|.
+
+    Args:
+      directory: A directory of buildspecs in the checkout.
+      prefix: A version prefix made of whole components, e.g. '1234.' or ''.
+
+    Returns:
+      The latest version, or None if there is none.
+    """
+    rel_dir = self._Update(directory)
+    if rel_dir is None:
+      if not os.path.isdir(directory):
+        return None
+      keys, versions = self._SortVersions(
+          filter(None, map(self._GetVersion, os.listdir(directory))))
+    else:
+      if rel_dir not in self._sorted:
+        self._sorted[rel_dir] = self._SortVersions(self._dirs[rel_dir]['specs'])
+      keys, versions = self._sorted[rel_dir]
+
+    components = [int(x) for x in prefix.split('.') if x]
+    index = bisect.bisect(keys, components + [float('inf')]) - 1
+    if index >= 0 and keys[index][:len(components)] == components:
+      return versions[index]
+    return None
+
+  def Has(self, directory, version):
+    """Returns whether |directory| holds the spec of |version|."""
+    rel_dir = self._Update(directory)
+    if rel_dir is None:
+      return os.path.lexists(os.path.join(directory, '%s.xml' % version))
+    return version in self._dirs[rel_dir]['specs']
+
+  def GetStatus(self, version, pass_dir, fail_dir):
+    """Returns the completed status of |version| recorded in the checkout.
+
+    Args:
+      version: The version to look up.
+      pass_dir: The directory of the specs the builder passed.
+      fail_dir: The directory of the specs the builder failed.
+
+    Returns:
+      BuilderStatus.STATUS_PASSED or STATUS_FAILED, or None if the checkout
+      doesn't tell.
+    """
+    passed = self.Has(pass_dir, version)
+    failed = self.Has(fail_dir, version)
+    if passed != failed:
+      return BuilderStatus.GetCompletedStatus(passed)
+    return None
+
+  def GetManifestHash(self, directory, version):
+    """Returns the GetManifestHash of the spec of |version|, or None.
+
+    Args:
+      directory: A directory holding the specs themselves, not symlinks.
+      version: The version to look up.
+    """
+    rel_dir = self._Update(directory)
+    if rel_dir is None:
+      path = os.path.join(directory, '%s.xml' % version)
+      if not os.path.exists(path):
+        return None
+      return GetManifestHash(osutils.ReadFile(path))
+
+    entry = self._dirs[rel_dir]
+    spec_hash = entry['specs'].get(version)
+    if spec_hash is None:
+      return None
+    manifests = entry.setdefault('manifests', {})
+    if spec_hash not in manifests:
+      manifests[spec_hash] = GetManifestHash(
+          self._RunGit(['cat-file', 'blob', spec_hash]))
+      self._Save()
+    return manifests[spec_hash]
+
+
 class BuildSpecsManager(object):
   """A Class to manage buildspecs and their states."""
 
@@ -396,31 +675,26 @@ class BuildSpecsManager(object):
     self._latest_status = None
     self.latest_unprocessed = None
     self.compare_versions_fn = VersionInfo.VersionCompare
+    self._spec_index = None
 
     self.current_version = None
     self.rel_working_dir = ''
 
-  def _LatestSpecFromList(self, specs):
-    """Find the latest spec in a list of specs.
-
-    Args:
-      specs: List of specs.
-    Returns:
-      The latest spec if specs is non-empty.
-      None otherwise.
-    """
-    if specs:
-      return max(specs, key=self.compare_versions_fn)
+  def _GetSpecIndex(self):
+    """Returns the BuildSpecIndex of the manifest-versions checkout."""
+    index = self._spec_index
+    if (index is None or index.manifest_dir != self.manifest_dir or
+        index.compare_versions_fn != self.compare_versions_fn):
+      index = BuildSpecIndex(self.manifest_dir, self.compare_versions_fn)
+      self._spec_index = index
+    return index
 
   def _LatestSpecFromDir(self, version_info, directory):
     """Returns the latest buildspec that match '*.xml' in a directory.
     Args:
       directory: Directory of the buildspecs.
     """
-    if os.path.exists(directory):
-      match_string = version_info.BuildPrefix() + '*.xml'
-      specs = fnmatch.filter(os.listdir(directory), match_string)
-      return self._LatestSpecFromList([os.path.splitext(m)[0] for m in specs])
+    return self._GetSpecIndex().Latest(directory, version_info.BuildPrefix())
 
   def RefreshManifestCheckout(self):
     """Checks out manifest versions into the manifest directory."""
@@ -447,7 +721,14 @@ class BuildSpecsManager(object):
     # processed.
     self.latest = self._LatestSpecFromDir(version_info, self.all_specs_dir)
     if self.latest is not None:
-      self._latest_status = self.GetBuildStatus(self.build_name, self.latest)
+      # Completed builds are recorded in the checkout; only ask GS otherwise.
+      status = self._GetSpecIndex().GetStatus(self.latest, self.pass_dir,
+                                              self.fail_dir)
+      if status is not None:
+        self._latest_status = BuilderStatus(status, None)
+      else:
+        self._latest_status = self.GetBuildStatus(self.build_name,
+                                                  self.latest)
       if self._latest_status is None:
         self.latest_unprocessed = self.latest
 
@@ -460,11 +741,18 @@ class BuildSpecsManager(object):
     """Checks to see if we've previously built this checkout.
     """
     if self._latest_status and self._latest_status.Passed():
+      # We've built this checkout before if the manifest isn't different than
+      # the last one we've built.  The indexed hash answers that without
+      # reading the spec, unless they differ only in lines that don't count.
+      current = self.cros_source.ExportManifest()
+      latest_hash = self._GetSpecIndex().GetManifestHash(self.all_specs_dir,
+                                                         self.latest)
+      if latest_hash == GetManifestHash(current):
+        return True
       latest_spec_file = '%s.xml' % os.path.join(
           self.all_specs_dir, self.latest)
-      # We've built this checkout before if the manifest isn't different than
-      # the last one we've built.
-      return not self.cros_source.IsManifestDifferent(latest_spec_file)
+      return not self.cros_source.IsManifestDifferent(latest_spec_file,
+                                                      current=current)
     else:
       # We've never built this manifest before so this checkout is always new.
       return False
@@ -512,19 +800,29 @@ class BuildSpecsManager(object):
     return self._latest_status and self._latest_status.Failed()
 
   @staticmethod
-  def GetBuildStatus(builder, version, retries=3):
+  def GetBuildStatus(builder, version, retries=3, cache=None):
     """Returns a BuilderStatus instance for the given the builder.
 
     Args:
       builder: Builder to look at.
       version: Version string.
       retries: Number of retries for getting the status.
+      cache: If given, a gs.MetadataCache used to remember final statuses.
 
     Returns:
       A BuilderStatus instance containing the builder status and any optional
       message associated with the status passed by the builder.
     """
     url = BuildSpecsManager._GetStatusUrl(builder, version)
+    # The cache holds the status as JSON: unlike the pickle in GS, what is
+    # read back from a local file must be safe to load.
+    cached = cache.Lookup('status', url) if cache else None
+    if cached is not None:
+      try:
+        return BuilderStatus(**json.loads(cached))
+      except (TypeError, ValueError):
+        logging.warning('Ignoring corrupt cached status of %s', url)
+
     cmd = [gs.GSUTIL_BIN, 'cat', url]
     try:
       # TODO(davidjames): Use chromite.lib.gs here.
@@ -536,7 +834,13 @@ class BuildSpecsManager(object):
       if ex.result.error and ex.result.error.startswith('InvalidUriError:'):
         return None
       raise
-    return BuilderStatus(**cPickle.loads(result.output))
+
+    status_dict = cPickle.loads(result.output)
+    status = BuilderStatus(**status_dict)
+    if cache and status.Completed():
+      # A builder never changes its status once it has completed.
+      cache.Insert('status', url, json.dumps(status_dict), immutable=True)
+    return status
 
   def GetLatestPassingSpec(self):
     """Get the last spec file that passed in the current branch."""
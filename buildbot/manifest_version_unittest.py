@@ -6,6 +6,9 @@
 
 """Unittests for manifest_version. Needs to be run inside of chroot for mox."""
 
+import cPickle
+import json
+import mox
 import os
 import sys
 import tempfile
@@ -19,6 +22,7 @@ from chromite.buildbot import manifest_version
 from chromite.buildbot import repository
 from chromite.lib import cros_build_lib
 from chromite.lib import git
+from chromite.lib import gs
 from chromite.lib import cros_test_lib
 from chromite.lib import osutils
 
@@ -151,6 +155,103 @@ class VersionInfoTest(cros_test_lib.MoxTempDirTestCase):
     self.assertEqual(new_info.VersionString(), '2.0.0')
 
 
+class BuildSpecIndexTest(cros_test_lib.TempDirTestCase):
+  """Tests for the BuildSpecIndex class."""
+
+  def setUp(self):
+    self.manifest_dir = os.path.join(self.tempdir, 'manifest-versions')
+    self.specs_dir = os.path.join(self.manifest_dir, 'buildspecs',
+                                  CHROME_BRANCH)
+    osutils.SafeMakedirs(self.specs_dir)
+    git.RunGit(self.manifest_dir, ['init'])
+    self.index = manifest_version.BuildSpecIndex(
+        self.manifest_dir, manifest_version.VersionInfo.VersionCompare)
+
+  def _Commit(self, add=(), remove=()):
+    """Commit the addition and removal of the given versions."""
+    for version in add:
+      osutils.Touch(os.path.join(self.specs_dir, '%s.xml' % version))
+    for version in remove:
+      os.unlink(os.path.join(self.specs_dir, '%s.xml' % version))
+    git.RunGit(self.manifest_dir, ['add', '-A'])
+    git.RunGit(self.manifest_dir, ['-c', 'user.name=test',
+                                   '-c', 'user.email=test@chromium.org',
+                                   'commit', '-m', 'specs'])
+
+  def testLatest(self):
+    """The latest version matching a prefix is found."""
+    self._Commit(add=['100.0.0', '99.3.3', '99.1.10', '99.1.5'])
+    self.assertEqual(self.index.Latest(self.specs_dir, '99.1.'), '99.1.10')
+    self.assertEqual(self.index.Latest(self.specs_dir, '99.'), '99.3.3')
+    self.assertEqual(self.index.Latest(self.specs_dir), '100.0.0')
+    self.assertEqual(self.index.Latest(self.specs_dir, '98.'), None)
+    self.assertEqual(
+        self.index.Latest(os.path.join(self.specs_dir, 'missing')), None)
+    self.assertTrue(os.path.exists(self.index.path))
+
+  def testIncrementalUpdate(self):
+    """Specs added and removed after a lookup are seen by the next one."""
+    self._Commit(add=['99.1.5'])
+    self.assertEqual(self.index.Latest(self.specs_dir, '99.1.'), '99.1.5')
+    self._Commit(add=['99.1.10', '99.1.7'], remove=['99.1.5'])
+    self.assertEqual(self.index.Latest(self.specs_dir, '99.1.'), '99.1.10')
+    self._Commit(remove=['99.1.10'])
+    self.assertEqual(self.index.Latest(self.specs_dir, '99.1.'), '99.1.7')
+
+    # A new index, e.g. in the next build, reads the index from disk.
+    index = manifest_version.BuildSpecIndex(
+        self.manifest_dir, manifest_version.VersionInfo.VersionCompare)
+    self.assertEqual(index.Latest(self.specs_dir), '99.1.7')
+
+
+  def testRecloned(self):
+    """An index of a checkout that was cloned again is rebuilt."""
+    self._Commit(add=['99.1.5'])
+    self.assertEqual(self.index.Latest(self.specs_dir), '99.1.5')
+
+    # Recreate the checkout with a different history.
+    osutils.RmDir(os.path.join(self.manifest_dir, '.git'))
+    git.RunGit(self.manifest_dir, ['init'])
+    self._Commit(add=['99.1.7'], remove=['99.1.5'])
+    index = manifest_version.BuildSpecIndex(
+        self.manifest_dir, manifest_version.VersionInfo.VersionCompare)
+    self.assertEqual(index.Latest(self.specs_dir), '99.1.7')
+  def testStatus(self):
+    """The status of a version is looked up in the pass and fail dirs."""
+    pass_dir = os.path.join(self.manifest_dir, 'pass', CHROME_BRANCH)
+    fail_dir = os.path.join(self.manifest_dir, 'fail', CHROME_BRANCH)
+    for path in (os.path.join(pass_dir, '99.1.5.xml'),
+                 os.path.join(fail_dir, '99.1.7.xml')):
+      manifest_version.CreateSymlink(
+          os.path.join(self.specs_dir, os.path.basename(path)), path)
+    self._Commit(add=['99.1.5', '99.1.7', '99.1.8'])
+    self.assertEqual(self.index.GetStatus('99.1.5', pass_dir, fail_dir),
+                     manifest_version.BuilderStatus.STATUS_PASSED)
+    self.assertEqual(self.index.GetStatus('99.1.7', pass_dir, fail_dir),
+                     manifest_version.BuilderStatus.STATUS_FAILED)
+    self.assertEqual(self.index.GetStatus('99.1.8', pass_dir, fail_dir), None)
+
+  def testManifestHash(self):
+    """Manifest hashes ignore the manifest revision, and follow changes."""
+    spec = os.path.join(self.specs_dir, '99.1.5.xml')
+    osutils.WriteFile(spec, '<manifest revision="abc">\n  <project/>\n')
+    self._Commit()
+    self.assertEqual(
+        self.index.GetManifestHash(self.specs_dir, '99.1.5'),
+        manifest_version.GetManifestHash('<manifest revision="def">\n'
+                                         '<project/>'))
+    self.assertEqual(self.index.GetManifestHash(self.specs_dir, '99.1.6'),
+                     None)
+
+    osutils.WriteFile(spec, '<manifest revision="abc">\n  <other/>\n')
+    self._Commit()
+    index = manifest_version.BuildSpecIndex(
+        self.manifest_dir, manifest_version.VersionInfo.VersionCompare)
+    self.assertEqual(index.GetManifestHash(self.specs_dir, '99.1.5'),
+                     manifest_version.GetManifestHash(
+                         '<manifest revision="0">\n<other/>'))
+
+
 class BuildSpecsManagerTest(cros_test_lib.MoxTempDirTestCase):
   """Tests for the BuildSpecs manager."""
 
@@ -252,6 +353,53 @@ class BuildSpecsManagerTest(cros_test_lib.MoxTempDirTestCase):
     self.mox.VerifyAll()
     self.assertEqual(FAKE_VERSION_STRING_NEXT, version)
 
+  def testHasCheckoutBeenBuilt(self):
+    """Only manifests with a different hash are compared line by line."""
+    repo = self.manager.cros_source
+    self.mox.StubOutWithMock(repo, 'ExportManifest')
+    self.mox.StubOutWithMock(repo, 'IsManifestDifferent')
+    self.manager.all_specs_dir = os.path.join(self.tmpmandir, 'buildspecs')
+    self.manager.latest = FAKE_VERSION_STRING
+    self.manager._latest_status = manifest_version.BuilderStatus(
+        manifest_version.BuilderStatus.STATUS_PASSED, None)
+    spec = os.path.join(self.manager.all_specs_dir,
+                        '%s.xml' % FAKE_VERSION_STRING)
+    osutils.WriteFile(spec, '<manifest revision="abc">\n<project/>\n',
+                      makedirs=True)
+
+    same = '<manifest revision="def">\n  <project/>\n'
+    changed = '<manifest revision="def">\n  <project name="a"/>\n'
+    repo.ExportManifest().AndReturn(same)
+    repo.ExportManifest().AndReturn(changed)
+    repo.IsManifestDifferent(spec, current=changed).AndReturn(True)
+    self.mox.ReplayAll()
+    self.assertTrue(self.manager.HasCheckoutBeenBuilt())
+    self.assertFalse(self.manager.HasCheckoutBeenBuilt())
+    self.mox.VerifyAll()
+
+  def testGetBuildStatusCached(self):
+    """Tests that completed statuses are cached as JSON, not as pickles."""
+    status = {'status': manifest_version.BuilderStatus.STATUS_PASSED,
+              'message': None}
+    result = cros_build_lib.CommandResult(output=cPickle.dumps(status))
+    self.mox.StubOutWithMock(cros_build_lib, 'RunCommandWithRetries')
+    cros_build_lib.RunCommandWithRetries(
+        mox.IgnoreArg(), mox.IgnoreArg(), redirect_stdout=True,
+        redirect_stderr=True, debug_level=mox.IgnoreArg()).AndReturn(result)
+    self.mox.ReplayAll()
+
+    cache_dir = os.path.join(self.tempdir, 'cache')
+    for _ in range(2):
+      cache = gs.MetadataCache(cache_dir=cache_dir)
+      builder_status = self.manager.GetBuildStatus(
+          self.build_name, FAKE_VERSION_STRING, cache=cache)
+      self.assertTrue(builder_status.Passed())
+    self.mox.VerifyAll()
+    self.assertTrue(os.listdir(cache_dir))
+    for name in os.listdir(cache_dir):
+      self.assertEqual(
+          json.loads(osutils.ReadFile(os.path.join(cache_dir, name))), status)
+
   def NotestGetNextBuildSpec(self):
     """Meta test.  Re-enable if you want to use it to do a big test."""
     print self.manager.GetNextBuildSpec(retries=0)
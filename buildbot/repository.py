@@ -115,20 +115,18 @@ def CreateTrybotMarker(buildroot):
   osutils.WriteFile(GetTrybotMarkerPath(buildroot), '')
 
 def ClearBuildRoot(buildroot, preserve_paths=()):
-  """Remove and recreate the buildroot while preserving the trybot marker."""
+  """Remove and recreate the buildroot while preserving the trybot marker.
+
+  The contents of the buildroot are moved to its trash directory, to be
+  deleted by osutils.EmptyTrash.
+  """
   trybot_root = os.path.exists(GetTrybotMarkerPath(buildroot))
   if os.path.exists(buildroot):
-    cmd = ['find', buildroot, '-mindepth', '1', '-maxdepth', '1']
-
-    ignores = []
-    for path in preserve_paths:
-      if ignores:
-        ignores.append('-a')
-      ignores += ['!', '-name', path]
-    cmd.extend(ignores)
-
-    cmd += ['-exec', 'rm', '-rf', '{}', '+']
-    cros_build_lib.SudoRunCommand(cmd)
+    trash_dir = os.path.join(buildroot, constants.TRASH_DIR)
+    for name in os.listdir(buildroot):
+      if name != constants.TRASH_DIR and name not in preserve_paths:
+        osutils.MoveToTrash(os.path.join(buildroot, name), trash_dir,
+                            sudo=True)
   else:
     os.makedirs(buildroot)
   if trybot_root:
@@ -437,13 +435,14 @@ class RepoRepository(object):
     return output.replace("<manifest>", '<manifest revision="%s">' %
                           modified.output.strip())
 
-  def IsManifestDifferent(self, other_manifest):
+  def IsManifestDifferent(self, other_manifest, current=None):
     """Checks whether this manifest is different than another.
 
     May blacklists certain repos as part of the diff.
 
     Args:
       other_manfiest: Second manifest file to compare against.
+      current: The output of ExportManifest(), if the caller already has it.
     Returns:
       True: If the manifests are different
       False: If the manifests are same
@@ -455,7 +454,8 @@ class RepoRepository(object):
     manifest_revision_pattern = re.compile(r'<manifest revision="[a-f0-9]+">',
                                            re.I)
 
-    current = self.ExportManifest()
+    if current is None:
+      current = self.ExportManifest()
     with open(other_manifest, 'r') as manifest2_fh:
       for (line1, line2) in zip(current.splitlines(), manifest2_fh):
         line1 = line1.strip()
@@ -0,0 +1,178 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module for caching the results of stages by a hash of their inputs."""
+
+import errno
+import glob
+import hashlib
+import json
+import logging
+import os
+import tarfile
+import tempfile
+
+from chromite.lib import cros_build_lib
+from chromite.lib import gs
+from chromite.lib import osutils
+
+
+def HashInputs(*inputs):
+  """Return a hex digest of |inputs|, which must be JSON serializable."""
+  return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+class StageCache(object):
+  """A cache of stage results, keyed by a hash of the inputs of the stage.
+
+  An entry consists of a small JSON file of metadata plus a tarball of the
+  outputs of the stage.  Entries are kept in a local directory and, if
+  |gs_url| is given, also in Google Storage, so that they are shared between
+  builders.  Entries are written atomically; a failure to read or write the
+  cache only means that the stage is run.
+  """
+
+  def __init__(self, cache_dir, gs_url=None, ctx=None):
+    """Initialize the cache.
+
+    Args:
+      cache_dir: The local directory to keep entries in.
+      gs_url: If given, the gs:// directory to share entries in.
+      ctx: The GSContext to use; one is created if needed.
+    """
+    self.cache_dir = cache_dir
+    self.gs_url = gs_url.rstrip('/') if gs_url else None
+    self._ctx = ctx
+
+  @property
+  def ctx(self):
+    if self._ctx is None:
+      self._ctx = gs.GSContext()
+    return self._ctx
+
+  def _GetPaths(self, key):
+    """Return the local (metadata, tarball) paths of the entry for |key|."""
+    path = os.path.join(self.cache_dir, key[:2], key[2:])
+    return path + '.json', path + '.tar'
+
+  def _GetUrls(self, key):
+    """Return the gs:// (metadata, tarball) urls of the entry for |key|."""
+    url = '%s/%s' % (self.gs_url, key)
+    return url + '.json', url + '.tar'
+
+  def _GetPendingPath(self, key):
+    """Return the path marking the entry for |key| as not uploaded yet."""
+    json_path, _ = self._GetPaths(key)
+    return json_path + '.pending'
+
+  def _Upload(self, key):
+    """Upload the local entry for |key| to Google Storage."""
+    json_path, tar_path = self._GetPaths(key)
+    json_url, tar_url = self._GetUrls(key)
+    # The metadata goes last, so an entry with metadata is complete.
+    self.ctx.Copy(tar_path, tar_url)
+    self.ctx.Copy(json_path, json_url)
+
+  def _Fetch(self, key):
+    """Download the entry for |key| from Google Storage, if it exists."""
+    json_url, tar_url = self._GetUrls(key)
+    json_path, tar_path = self._GetPaths(key)
+    if not self.ctx.Exists(json_url):
+      return
+    osutils.SafeMakedirs(os.path.dirname(json_path))
+    # The metadata is written last, so an entry with metadata is complete.
+    for url, path in ((tar_url, tar_path), (json_url, json_path)):
+      fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+      os.close(fd)
+      self.ctx.Copy(url, tmp_path)
+      os.rename(tmp_path, path)
+
+  def Lookup(self, key, shared=True):
+    """Return the metadata of the entry for |key|, or None if there is none.
+
+    Args:
+      key: The hash of the inputs of the stage.
+      shared: Whether to look for the entry in Google Storage, too.
+    """
+    json_path, _ = self._GetPaths(key)
+    try:
+      if not os.path.exists(json_path) and self.gs_url and shared:
+        self._Fetch(key)
+      return json.loads(osutils.ReadFile(json_path))
+    except (IOError, OSError, ValueError, gs.GSContextException,
+            cros_build_lib.RunCommandError) as e:
+      if getattr(e, 'errno', None) != errno.ENOENT:
+        logging.warning('Cannot read stage cache entry %s: %s', key, e)
+      return None
+
+  def Restore(self, key, dest_dir):
+    """Extract the outputs of the entry for |key| into |dest_dir|.
+
+    Returns:
+      A dict mapping the name of each output to its path in |dest_dir|, or
+      None if the outputs could not be restored.
+    """
+    _, tar_path = self._GetPaths(key)
+    try:
+      with tarfile.open(tar_path) as tar:
+        names = [x.name for x in tar.getmembers() if '/' not in x.name]
+        tar.extractall(dest_dir)
+    except (IOError, OSError, tarfile.TarError) as e:
+      logging.warning('Cannot restore stage cache entry %s: %s', key, e)
+      return None
+    return dict((name, os.path.join(dest_dir, name)) for name in names)
+
+  def Store(self, key, outputs=None, metadata=None, shared=True,
+            defer_upload=False):
+    """Store an entry for |key|.
+
+    Args:
+      key: The hash of the inputs of the stage.
+      outputs: A dict mapping names to the paths of files or directories to
+        store; names may not contain slashes.
+      metadata: A JSON serializable dict to store along with the outputs.
+      shared: Whether to share the entry through Google Storage, too.  Entries
+        whose inputs depend on the state of the local machine must not be.
+      defer_upload: Only store the entry locally for now, and leave sharing
+        it to UploadPending.
+    """
+    json_path, tar_path = self._GetPaths(key)
+    try:
+      osutils.SafeMakedirs(os.path.dirname(json_path))
+      fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(tar_path))
+      with os.fdopen(fd, 'w') as f:
+        with tarfile.open(fileobj=f, mode='w') as tar:
+          for name, path in sorted((outputs or {}).iteritems()):
+            tar.add(path, arcname=name)
+      os.rename(tmp_path, tar_path)
+      osutils.WriteFile(json_path, json.dumps(metadata or {}), atomic=True)
+
+      if self.gs_url and shared:
+        if defer_upload:
+          osutils.Touch(self._GetPendingPath(key))
+        else:
+          self._Upload(key)
+    except (IOError, OSError, gs.GSContextException,
+            cros_build_lib.RunCommandError) as e:
+      # The cache is only an optimization; never fail the build over it.
+      logging.warning('Cannot store stage cache entry %s: %s', key, e)
+
+  def UploadPending(self):
+    """Upload the entries that Store left for later to Google Storage.
+
+    This may run in several processes at once; each entry is uploaded by the
+    process that removes its marker first.
+    """
+    if not self.gs_url:
+      return
+    for path in glob.glob(os.path.join(self.cache_dir, '*', '*.json.pending')):
+      key = (os.path.basename(os.path.dirname(path)) +
+             os.path.basename(path)[:-len('.json.pending')])
+      try:
+        os.unlink(path)
+        self._Upload(key)
+      except (OSError, gs.GSContextException,
+              cros_build_lib.RunCommandError) as e:
+        if getattr(e, 'errno', None) != errno.ENOENT:
+          logging.warning('Cannot upload stage cache entry %s: %s', key, e)
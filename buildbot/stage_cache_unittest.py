@@ -0,0 +1,121 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for stage_cache.py."""
+
+import mox
+import os
+import sys
+
+import constants
+if __name__ == '__main__':
+  sys.path.insert(0, constants.SOURCE_ROOT)
+
+from chromite.buildbot import stage_cache
+from chromite.lib import cros_test_lib
+from chromite.lib import gs
+from chromite.lib import osutils
+
+# pylint: disable=W0212
+
+
+class HashInputsTest(cros_test_lib.TestCase):
+  """Tests for the HashInputs function."""
+
+  def testOrderOfKeys(self):
+    """The order of the keys of a dict does not change the hash."""
+    self.assertEqual(stage_cache.HashInputs({'a': 1, 'b': 2}),
+                     stage_cache.HashInputs(dict([('b', 2), ('a', 1)])))
+
+  def testDifferentInputs(self):
+    """Different inputs give different hashes."""
+    self.assertNotEqual(stage_cache.HashInputs('x86-generic', 'abc'),
+                        stage_cache.HashInputs('x86-generic', 'abd'))
+
+
+class StageCacheTest(cros_test_lib.MoxTempDirTestCase):
+  """Tests for the StageCache class."""
+
+  KEY = stage_cache.HashInputs('BuildTargetStage', 'x86-generic')
+
+  def setUp(self):
+    self.ctx = self.mox.CreateMock(gs.GSContext)
+    self.cache = stage_cache.StageCache(os.path.join(self.tempdir, 'cache'),
+                                        ctx=self.ctx)
+    self.src_dir = os.path.join(self.tempdir, 'src')
+    osutils.WriteFile(os.path.join(self.src_dir, 'image', 'image.bin'),
+                      'image', makedirs=True)
+    osutils.WriteFile(os.path.join(self.src_dir, 'autotest.tar'), 'autotest')
+
+  def _Store(self):
+    self.cache.Store(self.KEY,
+                     {'image': os.path.join(self.src_dir, 'image'),
+                      'autotest.tar': os.path.join(self.src_dir,
+                                                   'autotest.tar')},
+                     {'image_dir': 'R1-1.0.0'})
+
+  def testStoreAndRestore(self):
+    """Stored outputs are restored along with their metadata."""
+    self._Store()
+    self.assertEqual(self.cache.Lookup(self.KEY), {'image_dir': 'R1-1.0.0'})
+
+    dest_dir = os.path.join(self.tempdir, 'dest')
+    outputs = self.cache.Restore(self.KEY, dest_dir)
+    self.assertEqual(outputs,
+                     {'image': os.path.join(dest_dir, 'image'),
+                      'autotest.tar': os.path.join(dest_dir, 'autotest.tar')})
+    self.assertEqual(
+        osutils.ReadFile(os.path.join(dest_dir, 'image', 'image.bin')),
+        'image')
+
+  def testMissingEntry(self):
+    """Looking up a key that was never stored returns None."""
+    self.assertEqual(self.cache.Lookup(self.KEY), None)
+    self.assertEqual(self.cache.Restore(self.KEY, self.tempdir), None)
+
+  def testGoogleStorage(self):
+    """Entries are uploaded to and looked up in Google Storage."""
+    self.cache.gs_url = 'gs://bucket/stages'
+    url = 'gs://bucket/stages/%s' % self.KEY
+    self.ctx.Copy(mox.IgnoreArg(), url + '.tar')
+    self.ctx.Copy(mox.IgnoreArg(), url + '.json')
+    self.ctx.Exists(url + '.json').AndReturn(False)
+    self.mox.ReplayAll()
+
+    self._Store()
+    # Another builder, with an empty local cache, does not find the entry.
+    self.cache.cache_dir = os.path.join(self.tempdir, 'other')
+    self.assertEqual(self.cache.Lookup(self.KEY), None)
+    self.mox.VerifyAll()
+
+  def testDeferredUpload(self):
+    """Deferred entries are only uploaded by UploadPending, and only once."""
+    self.cache.gs_url = 'gs://bucket/stages'
+    url = 'gs://bucket/stages/%s' % self.KEY
+    self.ctx.Copy(mox.IgnoreArg(), url + '.tar')
+    self.ctx.Copy(mox.IgnoreArg(), url + '.json')
+    self.mox.ReplayAll()
+
+    self.cache.Store(self.KEY, metadata={'image_dir': 'R1-1.0.0'},
+                     defer_upload=True)
+    self.assertEqual(self.cache.Lookup(self.KEY), {'image_dir': 'R1-1.0.0'})
+    self.cache.UploadPending()
+    self.cache.UploadPending()
+    self.mox.VerifyAll()
+
+  def testLocalEntries(self):
+    """Entries that are not shared never go to Google Storage."""
+    self.cache.gs_url = 'gs://bucket/stages'
+    self.mox.ReplayAll()
+
+    self.cache.Store(self.KEY, metadata={'boards': []}, shared=False)
+    self.assertEqual(self.cache.Lookup(self.KEY, shared=False), {'boards': []})
+    self.cache.cache_dir = os.path.join(self.tempdir, 'other')
+    self.assertEqual(self.cache.Lookup(self.KEY, shared=False), None)
+    self.mox.VerifyAll()
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -0,0 +1,136 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module for running the stages of a builder as their artifacts allow."""
+
+import collections
+import datetime
+import math
+
+from chromite.buildbot import cbuildbot_results as results_lib
+from chromite.lib import parallel
+
+
+class StageGraph(object):
+  """A set of steps that run as soon as the artifacts they consume exist.
+
+  Every step declares the artifacts it consumes and produces, e.g. 'chroot'
+  or 'image:x86-generic', and runs once all steps producing what it consumes
+  have finished.  Artifacts that no step in the graph produces are taken to
+  exist already.  Independent steps run in parallel.
+
+  Once the graph has run, the critical path of the build (the chain of
+  dependent steps that took the longest) can be reported.
+  """
+
+  def __init__(self):
+    self._names = []
+    self._steps = []
+    self._consumes = []
+    self._produces = []
+    # The (index, run time) of each step that finished, in order.
+    self._finished = []
+
+  def AddStep(self, name, step, consumes=(), produces=()):
+    """Add a step to the graph.
+
+    Args:
+      name: The name of the step, as shown in the critical path.
+      step: The function to run.
+      consumes: The artifacts that must exist before |step| runs.
+      produces: The artifacts that exist once |step| has run.
+    """
+    self._names.append(name)
+    self._steps.append(step)
+    self._consumes.append(list(consumes))
+    self._produces.append(list(produces))
+
+  def AddStage(self, stage, consumes=(), produces=()):
+    """Add a stage to the graph.
+
+    Args:
+      stage: The BuilderStage instance to run.
+      consumes: Artifacts the stage consumes, besides the ones it declares.
+      produces: Artifacts the stage produces, besides the ones it declares.
+    """
+    stage_consumes, stage_produces = stage.GetArtifacts()
+    self.AddStep(stage.name, stage.Run,
+                 consumes=stage_consumes + list(consumes),
+                 produces=stage_produces + list(produces))
+
+  def _GetDependencies(self):
+    """Return, for each step, the indexes of the steps it depends on."""
+    producers = collections.defaultdict(set)
+    for index, produces in enumerate(self._produces):
+      for artifact in produces:
+        producers[artifact].add(index)
+    dependencies = []
+    for index, consumes in enumerate(self._consumes):
+      deps = set()
+      for artifact in consumes:
+        deps.update(producers[artifact])
+      deps.discard(index)
+      dependencies.append(sorted(deps))
+    return dependencies
+
+  def _RunStep(self, index, previous):
+    """Run the step at |index|, remembering the |previous| results."""
+    # Steps running in the background start with cleared results; keep the
+    # stages completed in a previous run so that --resume still skips them.
+    results_lib.Results.GetPrevious().update(previous)
+    self._steps[index]()
+
+  def _StepFinished(self, index, run_time):
+    self._finished.append((index, run_time))
+
+  def Run(self):
+    """Run all steps, as far as possible in parallel.
+
+    See parallel.RunDependentSteps for how steps are run and failures
+    reported.
+    """
+    previous = dict(results_lib.Results.GetPrevious())
+    steps = [lambda i=i: self._RunStep(i, previous)
+             for i in xrange(len(self._steps))]
+    parallel.RunDependentSteps(steps, self._GetDependencies(),
+                               finished=self._StepFinished)
+
+  def GetFinished(self):
+    """Return the names of the steps that finished successfully."""
+    return [self._names[index] for index, _ in self._finished]
+
+  def GetCriticalPath(self):
+    """Return the longest chain of dependent steps that finished.
+
+    Returns:
+      A list of (name, run time) tuples, from the first step to the last.
+    """
+    dependencies = self._GetDependencies()
+    paths = {}
+    for index, run_time in self._finished:
+      # Steps finish after the steps they depend on.
+      total, path = max([paths[dep] for dep in dependencies[index]] or
+                        [(0, [])])
+      paths[index] = (total + run_time, path + [index])
+    run_times = dict(self._finished)
+    _, path = max(paths.values() or [(0, [])])
+    return [(self._names[index], run_times[index]) for index in path]
+
+  def ReportCriticalPath(self, out):
+    """Print the critical path of the build to |out|."""
+    path = self.GetCriticalPath()
+    if not path:
+      return
+
+    line = '*' * 60 + '\n'
+    edge = '*' * 2
+    total = sum(run_time for _, run_time in path)
+    out.write(line)
+    out.write('%s Critical Path (%s)\n' %
+              (edge, datetime.timedelta(seconds=math.ceil(total))))
+    out.write(line)
+    for name, run_time in path:
+      timestr = datetime.timedelta(seconds=math.ceil(run_time))
+      out.write('%s %s (%s)\n' % (edge, name, timestr))
+    out.write(line)
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for stage_graph.py."""
+
+import multiprocessing
+import Queue
+import StringIO
+import sys
+import time
+
+import constants
+if __name__ == '__main__':
+  sys.path.insert(0, constants.SOURCE_ROOT)
+
+from chromite.buildbot import stage_graph
+from chromite.lib import cros_test_lib
+
+# pylint: disable=W0212
+
+
+class _FakeStage(object):
+  """A stage that records when it runs."""
+
+  def __init__(self, name, order, consumes=(), produces=()):
+    self.name = name
+    self._order = order
+    self._artifacts = (list(consumes), list(produces))
+
+  def GetArtifacts(self):
+    return self._artifacts
+
+  def Run(self):
+    self._order.put((time.time(), self.name))
+
+
+class StageGraphTest(cros_test_lib.OutputTestCase):
+  """Tests for the StageGraph class."""
+
+  def setUp(self):
+    self.order = multiprocessing.Queue()
+    self.graph = stage_graph.StageGraph()
+
+  def _GetOrder(self):
+    """Return the names of the stages that ran, in the order they ran."""
+    order = []
+    while True:
+      try:
+        order.append(self.order.get(timeout=1))
+      except Queue.Empty:
+        return [name for _, name in sorted(order)]
+
+  def _AddStages(self):
+    """Add stages with two independent chains between the first and last."""
+    for name, consumes, produces in (
+        ('Last', ['image', 'chrome'], []),
+        ('Chroot', [], ['chroot']),
+        ('Image', ['chroot', 'prebuilts'], ['image']),
+        ('SyncChrome', ['chroot'], ['chrome_source']),
+        ('PatchChrome', ['chrome_source'], ['chrome'])):
+      self.graph.AddStage(_FakeStage(name, self.order, consumes, produces))
+
+  def testDependencies(self):
+    """Steps depend on the steps producing what they consume."""
+    self._AddStages()
+    self.assertEqual(self.graph._GetDependencies(),
+                     [[2, 4], [], [1], [1], [3]])
+
+  def testRun(self):
+    """Steps run after the steps they depend on."""
+    self._AddStages()
+    with self.OutputCapturer():
+      self.graph.Run()
+    order = self._GetOrder()
+    self.assertEqual(sorted(order), sorted(self.graph._names))
+    self.assertEqual(order[0], 'Chroot')
+    self.assertEqual(order[-1], 'Last')
+    self.assertTrue(order.index('SyncChrome') < order.index('PatchChrome'))
+    self.assertEqual(sorted(self.graph.GetFinished()), sorted(order))
+
+  def testCriticalPath(self):
+    """The longest chain of dependent steps is reported."""
+    self._AddStages()
+    self.graph._finished = [(1, 10), (3, 30), (2, 50), (4, 30), (0, 5)]
+    self.assertEqual(self.graph.GetCriticalPath(),
+                     [('Chroot', 10), ('SyncChrome', 30), ('PatchChrome', 30),
+                      ('Last', 5)])
+    out = StringIO.StringIO()
+    self.graph.ReportCriticalPath(out)
+    self.assertTrue('Critical Path (0:01:15)' in out.getvalue())
+    self.assertTrue('** PatchChrome (0:00:30)' in out.getvalue())
+
+  def testEmptyCriticalPath(self):
+    """Nothing is reported if no steps finished."""
+    self._AddStages()
+    out = StringIO.StringIO()
+    self.graph.ReportCriticalPath(out)
+    self.assertEqual(out.getvalue(), '')
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
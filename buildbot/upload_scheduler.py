@@ -0,0 +1,173 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Module for uploading build artifacts by priority."""
+
+import datetime
+import math
+import multiprocessing
+import Queue
+import time
+import traceback
+
+from chromite.lib import cros_build_lib
+from chromite.lib import parallel
+
+
+class UploadScheduler(object):
+  """Uploads the files put on several queues in one pool of processes.
+
+  The queues are given highest priority first.  Whenever an upload process
+  is free, it takes the next file from the first queue that is not empty,
+  so that the artifacts other stages wait on reach Google Storage before
+  the rest.  All uploads share one limit on the number of concurrent
+  uploads and, optionally, on bandwidth.  Progress and an estimate of the
+  remaining time are logged after each upload.
+
+  The queues must be multiprocessing.JoinableQueue objects holding lists of
+  arguments for the upload function, e.g. [filename].
+
+  Example:
+    with UploadScheduler(Upload, [urgent_queue, other_queue]) as uploads:
+      urgent_queue.put(['image.zip'])
+      # Blocks until image.zip is uploaded.
+      uploads.Wait(urgent_queue)
+    # Exiting the with statement blocks until all files are uploaded.
+  """
+
+  # How long idle upload processes sleep before looking for new files.
+  POLL_INTERVAL = 0.5
+
+  def __init__(self, upload, queues, processes=10, bytes_per_second=None,
+               get_size=None):
+    """Initialize the scheduler.
+
+    Args:
+      upload: The function to run on the arguments taken from the queues.
+      queues: The queues of files to upload, highest priority first.
+      processes: How many files may be uploaded at once.
+      bytes_per_second: If set, the bandwidth all uploads may use together.
+      get_size: A function that returns the size in bytes of the upload for
+        the arguments taken from the queues.  Needed for bandwidth limits
+        and progress; uploads count as empty without it.
+    """
+    self._upload = upload
+    self._queues = list(queues)
+    self._processes = processes
+    self._bytes_per_second = bytes_per_second
+    self._get_size = get_size
+    self._runner = None
+    self._start_time = None
+    self._stop = multiprocessing.Event()
+    self._lock = multiprocessing.Lock()
+    self._next_start = multiprocessing.Value('d', 0, lock=False)
+    self._uploaded = multiprocessing.Value('i', 0, lock=False)
+    self._uploaded_bytes = multiprocessing.Value('d', 0, lock=False)
+    self._failures = [multiprocessing.Value('i', 0, lock=False)
+                      for _ in self._queues]
+
+  def _GetSize(self, args):
+    """Return the size of the upload of |args|, or 0 if unknown."""
+    if self._get_size is None:
+      return 0
+    try:
+      return self._get_size(*args)
+    except EnvironmentError:
+      return 0
+
+  def _Throttle(self, size):
+    """Wait until |size| bytes may be uploaded without exceeding the limit."""
+    if not self._bytes_per_second:
+      return
+    with self._lock:
+      now = time.time()
+      start = max(now, self._next_start.value)
+      self._next_start.value = start + size / float(self._bytes_per_second)
+    time.sleep(start - now)
+
+  def _LogProgress(self, args, size, run_time):
+    """Log that the upload of |args| is done, and how much is left."""
+    with self._lock:
+      self._uploaded.value += 1
+      self._uploaded_bytes.value += size
+      uploaded, uploaded_bytes = (self._uploaded.value,
+                                  self._uploaded_bytes.value)
+    elapsed = max(time.time() - self._start_time, 1)
+    waiting = sum(x.qsize() for x in self._queues)
+    eta = datetime.timedelta(seconds=math.ceil(waiting * elapsed / uploaded))
+    cros_build_lib.Info(
+        'Uploaded %s (%.1f MB in %ds); %d uploaded at %.1f MB/s, %d waiting, '
+        'ETA %s', ' '.join(args), size / 2.0 ** 20, run_time, uploaded,
+        uploaded_bytes / 2.0 ** 20 / elapsed, waiting, eta)
+
+  def _Upload(self, index, args):
+    """Upload |args| taken from the queue at |index|."""
+    size = self._GetSize(args)
+    self._Throttle(size)
+    start_time = time.time()
+    try:
+      self._upload(*args)
+    except Exception:
+      # Keep uploading the other files; the failure is raised by Wait and
+      # when the scheduler exits.
+      cros_build_lib.Error('Uploading %s failed:\n%s', ' '.join(args),
+                           traceback.format_exc())
+      with self._lock:
+        self._failures[index].value += 1
+      return
+    self._LogProgress(args, size, time.time() - start_time)
+
+  def _RunUploads(self):
+    """Upload files from the queues, by priority, until stopped."""
+    while True:
+      for index, queue in enumerate(self._queues):
+        try:
+          args = queue.get_nowait()
+        except Queue.Empty:
+          continue
+        try:
+          self._Upload(index, args)
+        finally:
+          queue.task_done()
+        break
+      else:
+        if self._stop.is_set():
+          return
+        time.sleep(self.POLL_INTERVAL)
+
+  def _CheckFailures(self, queues):
+    """Raise a BackgroundFailure if any upload from |queues| failed."""
+    failures = sum(self._failures[self._queues.index(x)].value
+                   for x in queues)
+    if failures:
+      raise parallel.BackgroundFailure('%d uploads failed.' % failures)
+
+  def Wait(self, queue):
+    """Wait until all files put on |queue| so far are uploaded.
+
+    Raises:
+      BackgroundFailure if any of them failed to upload.
+    """
+    queue.join()
+    self._CheckFailures([queue])
+
+  def __enter__(self):
+    self._start_time = time.time()
+    self._runner = parallel.BackgroundTaskRunner(self._RunUploads,
+                                                 processes=self._processes)
+    runner_queue = self._runner.__enter__()
+    for _ in xrange(self._processes):
+      runner_queue.put([])
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    try:
+      if exc_type is None:
+        for queue in self._queues:
+          queue.join()
+    finally:
+      self._stop.set()
+      self._runner.__exit__(exc_type, exc_value, tb)
+    if exc_type is None:
+      self._CheckFailures(self._queues)
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for upload_scheduler.py."""
+
+import multiprocessing
+import Queue
+import sys
+import time
+
+import constants
+if __name__ == '__main__':
+  sys.path.insert(0, constants.SOURCE_ROOT)
+
+from chromite.buildbot import upload_scheduler
+from chromite.lib import cros_test_lib
+from chromite.lib import parallel
+
+
+class UploadSchedulerTest(cros_test_lib.TestCase):
+  """Tests for the UploadScheduler class."""
+
+  def setUp(self):
+    self.uploaded = multiprocessing.Queue()
+    self.queues = [multiprocessing.JoinableQueue() for _ in range(3)]
+
+  def _Upload(self, filename):
+    if filename.startswith('bad'):
+      raise ValueError(filename)
+    self.uploaded.put((time.time(), filename))
+
+  def _GetUploaded(self):
+    """Return the (time, filename) of the uploaded files, in order."""
+    uploaded = []
+    while True:
+      try:
+        uploaded.append(self.uploaded.get(timeout=1))
+      except Queue.Empty:
+        return sorted(uploaded)
+
+  def _CreateScheduler(self, **kwargs):
+    return upload_scheduler.UploadScheduler(
+        self._Upload, self.queues, get_size=lambda _: 100, **kwargs)
+
+  def testPriority(self):
+    """Files on the first queues are uploaded first."""
+    for queue, name in reversed(zip(self.queues, ['hwtest', 'release',
+                                                  'debug'])):
+      for i in range(2):
+        queue.put(['%s%d' % (name, i)])
+    # Let the queues flush the files to their pipes before uploads start.
+    time.sleep(0.5)
+    with cros_test_lib.OutputCapturer():
+      with self._CreateScheduler(processes=1):
+        pass
+    self.assertEqual([x for _, x in self._GetUploaded()],
+                     ['hwtest0', 'hwtest1', 'release0', 'release1', 'debug0',
+                      'debug1'])
+
+  def testWait(self):
+    """Wait returns once the files of a queue are uploaded."""
+    with cros_test_lib.OutputCapturer():
+      with self._CreateScheduler(processes=2) as uploads:
+        self.queues[1].put(['release'])
+        uploads.Wait(self.queues[1])
+        self.assertEqual([x for _, x in self._GetUploaded()], ['release'])
+
+  def testFailure(self):
+    """Failed uploads do not stop the others, but are reported."""
+    with cros_test_lib.OutputCapturer():
+      try:
+        with self._CreateScheduler(processes=1) as uploads:
+          self.queues[0].put(['bad'])
+          self.queues[2].put(['good'])
+          self.assertRaises(parallel.BackgroundFailure, uploads.Wait,
+                            self.queues[0])
+        self.fail('The failed upload was not reported')
+      except parallel.BackgroundFailure:
+        pass
+    self.assertEqual([x for _, x in self._GetUploaded()], ['good'])
+
+  def testBandwidth(self):
+    """Uploads do not start faster than the bandwidth allows."""
+    for i in range(3):
+      self.queues[0].put(['file%d' % i])
+    with cros_test_lib.OutputCapturer():
+      with self._CreateScheduler(processes=3, bytes_per_second=1000):
+        pass
+    times = [x for x, _ in self._GetUploaded()]
+    self.assertEqual(len(times), 3)
+    self.assertTrue(times[-1] - times[0] >= 0.19)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -9,8 +9,12 @@ ready for the commit queue to try.
 """
 
 import contextlib
+import functools
+import itertools
 import logging
+import os
 import sys
+import tempfile
 import time
 import urllib
 from xml.dom import minidom
@@ -22,6 +26,8 @@ from chromite.buildbot import portage_utilities
 from chromite.lib import cros_build_lib
 from chromite.lib import gerrit
 from chromite.lib import git
+from chromite.lib import osutils
+from chromite.lib import parallel
 from chromite.lib import patch as cros_patch
 
 _BUILD_DASHBOARD = 'http://build.chromium.org/p/chromiumos'
@@ -194,6 +200,154 @@ def _PatchWrapException(functor):
   return f
 
 
+class _DependencyGraph(object):
+  """The dependency graph of the changes a PatchSeries resolves.
+
+  The nodes are changes; the edges of a change lead to its uncommitted git
+  parents and CQ-DEPENDs.  The graph is explored from each change asked for,
+  and its strongly connected components are found with Tarjan's algorithm,
+  which completes them dependencies first.  So the transaction of each change
+  is computed once, from the memoized transactions of its dependencies,
+  rather than by walking all of its ancestry again for every change in the
+  pool.  Only changes within a cycle (which takes a CQ-DEPEND) are walked
+  from each of them, since the order of their transactions depends on where
+  the cycle is entered.
+  """
+
+  def __init__(self, get_deps):
+    """Initialize the graph.
+
+    Args:
+      get_deps: A function returning the (git parents, CQ-DEPENDs) of a
+        change, both as sequences of uncommitted changes.
+    """
+    self._get_deps = get_deps
+    # Change -> (git parents, CQ-DEPENDs), or the PatchException that
+    # looking them up raised.
+    self._deps = {}
+    # Change -> its transaction, or the PatchException resolving it raised.
+    self._transactions = {}
+    self._index = {}
+
+  def GetTransaction(self, change):
+    """Return the transaction of |change|; see PatchSeries.CreateTransaction.
+
+    Raises:
+      The cros_patch.PatchException (typically a DependencyError) that
+      resolving |change| hit.
+    """
+    if change not in self._transactions:
+      self._Explore(change)
+    result = self._transactions[change]
+    if isinstance(result, Exception):
+      raise result
+    return list(result)
+
+  def _GetDeps(self, change):
+    deps = self._deps.get(change)
+    if deps is None:
+      try:
+        deps = self._get_deps(change)
+      except cros_patch.PatchException, e:
+        deps = e
+      self._deps[change] = deps
+    return deps
+
+  def _IterEdges(self, change):
+    deps = self._GetDeps(change)
+    if isinstance(deps, Exception):
+      return iter(())
+    return itertools.chain(*deps)
+
+  def _Explore(self, root):
+    """Resolve the components reachable from |root|, in topological order."""
+    index, lowlink = self._index, {}
+    stack, on_stack, work = [], set(), []
+
+    def _Push(change):
+      index[change] = lowlink[change] = len(index)
+      stack.append(change)
+      on_stack.add(change)
+      work.append((change, self._IterEdges(change)))
+
+    _Push(root)
+    while work:
+      change, edges = work[-1]
+      for dep in edges:
+        if dep not in index:
+          _Push(dep)
+          break
+        elif dep in on_stack:
+          lowlink[change] = min(lowlink[change], index[dep])
+      else:
+        work.pop()
+        if work:
+          parent = work[-1][0]
+          lowlink[parent] = min(lowlink[parent], lowlink[change])
+        if lowlink[change] == index[change]:
+          component = []
+          while not component or component[-1] is not change:
+            component.append(stack.pop())
+            on_stack.discard(component[-1])
+          self._ResolveComponent(component)
+
+  def _ResolveComponent(self, component):
+    """Compute the transactions of the changes of a strongly connected
+    component, whose dependencies outside of it are already resolved."""
+    members = frozenset(component)
+    if len(component) > 1:
+      logging.info('Found cyclic dependencies between %s.',
+                   ', '.join(map(str, component)))
+    for change in component:
+      plan = []
+      try:
+        self._Resolve(change, plan, set(), set(), members)
+      except cros_patch.PatchException, e:
+        self._transactions[change] = e
+      else:
+        self._transactions[change] = plan
+
+  def _Resolve(self, change, plan, seen, stack, members):
+    """Add |change| and its dependencies into |plan|.
+
+    Git parents go before the change, and CQ-DEPENDs after it.  Changes
+    already on |stack| are skipped, since that's a cycle; if the earlier
+    resolution attempt succeeds, then implicitly this attempt will.
+    """
+    deps = self._deps[change]
+    if isinstance(deps, Exception):
+      raise deps
+    gdeps, pdeps = deps
+    stack.add(change)
+    try:
+      self._ResolveDeps(change, gdeps, plan, seen, stack, members)
+      plan.append(change)
+      seen.add(change)
+      self._ResolveDeps(change, pdeps, plan, seen, stack, members)
+    finally:
+      stack.discard(change)
+
+  def _ResolveDeps(self, change, deps, plan, seen, stack, members):
+    for dep in deps:
+      if dep in seen or dep in stack:
+        continue
+      try:
+        if dep in members:
+          self._Resolve(dep, plan, seen, stack, members)
+          continue
+        transaction = self._transactions[dep]
+        if isinstance(transaction, Exception):
+          raise transaction
+      except cros_patch.PatchException, e:
+        raise cros_patch.DependencyError, \
+              cros_patch.DependencyError(change, e), \
+              sys.exc_info()[2]
+      for x in transaction:
+        if x not in seen:
+          plan.append(x)
+          seen.add(x)
+
+
 class PatchSeries(object):
   """Class representing a set of patches applied to a single git repository."""
 
@@ -293,7 +447,12 @@ class PatchSeries(object):
           change.project,
           self.GetTrackingBranchForChange(change, True),
           query_text)
-    change = helper.QuerySingleRecord(query_text, must_match=True)
+    change = None
+    if query.isdigit() and not parent_lookup:
+      # The change may have been returned by a recent query already.
+      change = helper.GetCachedPatchset(query)
+    if change is None:
+      change = helper.QuerySingleRecord(query_text, must_match=True)
     # If the query was a gerrit number based query, check the projects/change-id
     # to see if we already have it locally, but couldn't map it since we didn't
     # know the gerrit number at the time of the initial injection.
@@ -380,37 +539,46 @@ class PatchSeries(object):
       A sequency of the necessary cros_patch.GitRepoPatch objects for
       this transaction.
     """
-    plan, stack = [], cros_patch.PatchCache()
-    self._ResolveChange(change, plan, stack, limit_to=limit_to)
-    return plan
+    if change in self._committed_cache:
+      return []
+    return self._GetDependencyGraph(limit_to).GetTransaction(change)
 
-  def _ResolveChange(self, change, plan, stack, limit_to=None):
-    """Helper for resolving a node and its dependencies into the plan.
+  def CreateTransactions(self, changes, limit_to=None):
+    """Resolve each of the given changes into a transaction.
 
-    No external code should call this; all internal code should invoke this
-    rather than ResolveTransaction since this maintains the necessary stack
-    tracking that is used to detect and handle cyclic dependencies.
+    This is CreateTransaction for a whole pool; the dependency graph of the
+    changes is built once, so changes shared by many transactions are only
+    resolved once.
 
-    Raises:
-      If the change couldn't be resolved, a DependencyError or
-      cros_patch.PatchException can be raised.
+    Args:
+      changes: A sequence of cros_patch.GitRepoPatch instances.
+      limit_to: See CreateTransaction.
+    Returns:
+      A list of (change, transaction, exception) tuples in the order of
+      |changes|; exception is the cros_patch.PatchException that resolving
+      the change hit (and transaction is None), or None.
     """
-    if change in self._committed_cache:
-      return
-    if change in stack:
-      # If the requested change is already in the stack, then immediately
-      # return- it's a cycle (requires CQ-DEPEND for it to occur); if
-      # the earlier resolution attempt succeeds, than implicitly this
-      # attempt will.
-      # TODO(ferringb,sosa): this check actually doesn't handle gerrit
-      # change numbers; support for that is broken currently anyways,
-      # but this is one of the spots that needs fixing for that support.
-      return
-    stack.Inject(change)
-    try:
-      self._PerformResolveChange(change, plan, stack, limit_to=limit_to)
-    finally:
-      stack.Remove(change)
+    graph = self._GetDependencyGraph(limit_to)
+    results = []
+    for change in changes:
+      if change in self._committed_cache:
+        results.append((change, [], None))
+        continue
+      try:
+        results.append((change, graph.GetTransaction(change), None))
+      except cros_patch.PatchException, e:
+        results.append((change, None, e))
+    return results
+
+  def _GetDependencyGraph(self, limit_to=None):
+    """Return a new _DependencyGraph of this series' uncommitted changes."""
+    def _GetDeps(change):
+      gdeps, pdeps = self._GetDepsForChange(change)
+      gdeps = self._LookupUncommittedChanges(change, gdeps, limit_to=limit_to,
+                                             parent_lookup=True)
+      pdeps = self._LookupUncommittedChanges(change, pdeps, limit_to=limit_to)
+      return gdeps, pdeps
+    return _DependencyGraph(_GetDeps)
 
   @_PatchWrapException
   def _GetDepsForChange(self, change):
@@ -434,30 +602,6 @@ class PatchSeries(object):
           change.PaladinDependencies(git_repo))
     return val
 
-  def _PerformResolveChange(self, change, plan, stack, limit_to=None):
-    """Resolve and ultimately add a change into the plan."""
-    # Pull all deps up front, then process them.  Simplifies flow, and
-    # localizes the error closer to the cause.
-    gdeps, pdeps = self._GetDepsForChange(change)
-    gdeps = self._LookupUncommittedChanges(change, gdeps, limit_to=limit_to,
-                                           parent_lookup=True)
-    pdeps = self._LookupUncommittedChanges(change, pdeps, limit_to=limit_to)
-
-    def _ProcessDeps(deps):
-      for dep in deps:
-        if dep in plan:
-          continue
-        try:
-          self._ResolveChange(dep, plan, stack, limit_to=limit_to)
-        except cros_patch.PatchException, e:
-          raise cros_patch.DependencyError, \
-                cros_patch.DependencyError(change, e), \
-                sys.exc_info()[2]
-
-    _ProcessDeps(gdeps)
-    plan.append(change)
-    _ProcessDeps(pdeps)
-
   def InjectCommittedPatches(self, changes):
     """Record that the given patches are already committed.
 
@@ -472,9 +616,170 @@ class PatchSeries(object):
     """
     self._lookup_cache.Inject(*changes)
 
+  # How many git repositories FetchChanges fetches into at the same time.
+  _FETCH_THREADS = 8
+
   def FetchChanges(self, changes):
+    """Fetch |changes| into their git repositories.
+
+    Changes to the same repository are fetched as one batch (see
+    cros_patch.FetchPatches), and the repositories are fetched in parallel.
+    """
+    by_repo = {}
     for change in changes:
-      change.Fetch(self.GetGitRepoForChange(change))
+      by_repo.setdefault(self.GetGitRepoForChange(change), []).append(change)
+    for _ in parallel.IterTasksInThreads(cros_patch.FetchPatches,
+                                         by_repo.items(),
+                                         threads=self._FETCH_THREADS):
+      pass
+
+  # How many projects PrescreenTransactions screens at the same time.
+  _PRESCREEN_THREADS = 8
+
+  def PrescreenTransactions(self, transactions, dryrun=False):
+    """Find the changes that can't apply to ToT, without touching the checkout.
+
+    For every project touched by |transactions|, the project's part of each
+    transaction is merged onto ToT in a temporary git index; the projects are
+    screened in parallel.  Changes that fail against ToT are
+    recorded in failed_tot, so that Apply gives up on their transactions
+    right away instead of applying and then rolling them back.
+
+    Args:
+      transactions: A sequence of transactions, as returned by
+        CreateTransaction.
+      dryrun: See Apply.
+    Returns:
+      A list of the cros_patch.ApplyPatchException instances of the changes
+      that failed against ToT.
+    """
+    chains, trivial = {}, {}
+    for transaction in transactions:
+      pending = [x for x in transaction if x not in self._committed_cache]
+      for change in pending:
+        if change not in trivial:
+          trivial[change] = False if dryrun else not self._IsContentMerging(
+              change)
+      by_repo = {}
+      for change in pending:
+        key = (self.GetGitRepoForChange(change),
+               self.GetTrackingBranchForChange(change))
+        by_repo.setdefault(key, []).append(change)
+      for key, chain in by_repo.iteritems():
+        if chain not in chains.setdefault(key, []):
+          chains[key].append(chain)
+
+    inputs = [[git_repo, upstream, repo_chains, trivial]
+              for (git_repo, upstream), repo_chains in chains.iteritems()]
+    failures = []
+    for repo_failures in parallel.IterTasksInThreads(
+        self._PrescreenProject, inputs, threads=self._PRESCREEN_THREADS):
+      failures.extend(repo_failures)
+    for failure in failures:
+      logging.info('Prescreening found that %s does not apply to ToT: %s',
+                   failure.patch, failure)
+      self.failed_tot[failure.patch.id] = failure
+    return failures
+
+  @staticmethod
+  def _MergeChange(git_repo, scratch, tree, change, trivial):
+    """Merge |change| onto |tree| in a temporary index, like a cherry-pick.
+
+    Files changed on both sides are merged with git merge-file, so neither
+    the checkout nor its index is touched.
+
+    Args:
+      git_repo: The git repo |change| was fetched into.
+      scratch: A directory to keep the temporary index and files in.
+      tree: The sha1 of the tree to merge |change| onto.
+      change: The change to merge.
+      trivial: Whether |change| may only be applied by trivial merges.
+
+    Returns:
+      A tuple of the sha1 of the resulting tree (or None), and the
+      cros_patch.ApplyPatchException that applying |change| would fail with
+      (or None).
+    """
+    index = os.path.join(scratch, 'index')
+    osutils.SafeUnlink(index)
+    run = functools.partial(git.RunGit, git_repo,
+                            extra_env={'GIT_INDEX_FILE': index})
+    sha1 = change.Fetch(git_repo)
+    run(['read-tree', '-m', '-i', '--aggressive', '%s^' % sha1, tree, sha1])
+
+    # Paths changed on both sides are left unmerged, one entry per stage:
+    # 1 is the parent of the change, 2 is |tree|, and 3 is the change.
+    unmerged = {}
+    for line in run(['ls-files', '-u', '-z']).output.split('\0'):
+      if line:
+        info, path = line.split('\t', 1)
+        mode, blob, stage = info.split()
+        unmerged.setdefault(path, {})[int(stage)] = (mode, blob)
+
+    conflicts = []
+    for path, stages in unmerged.iteritems():
+      if sorted(stages) != [1, 2, 3]:
+        # Added or deleted on one side, and changed on the other.
+        conflicts.append(path)
+        continue
+      files = []
+      for stage in (2, 1, 3):
+        files.append(os.path.join(scratch, 'stage%d' % stage))
+        osutils.WriteFile(
+            files[-1], run(['cat-file', 'blob', stages[stage][1]]).output)
+      if run(['merge-file', '-q'] + files, error_code_ok=True).returncode:
+        conflicts.append(path)
+        continue
+      blob = run(['hash-object', '-w', files[0]]).output.strip()
+      run(['update-index', '--cacheinfo', stages[2][0], blob, path])
+
+    if conflicts:
+      return None, cros_patch.ApplyPatchException(change, files=conflicts)
+    if unmerged and trivial:
+      return None, cros_patch.ApplyPatchException(change, trivial=True)
+    new_tree = run(['write-tree']).output.strip()
+    if new_tree == tree:
+      return None, cros_patch.PatchAlreadyApplied(change)
+    return new_tree, None
+
+  @staticmethod
+  def _PrescreenProject(git_repo, upstream, chains, trivial):
+    """Apply each of |chains| to ToT in a temporary index of |git_repo|.
+
+    If git fails, prescreening of the project is given up on; its changes
+    are then applied by Apply as if there were no prescreening.
+
+    Returns:
+      A list of the exceptions of the changes that failed against ToT.
+    """
+    failures = {}
+    scratch = tempfile.mkdtemp(prefix='prescreen.')
+    try:
+      tot = git.RunGit(
+          git_repo, ['rev-parse', '%s^{tree}' % upstream]).output.strip()
+      for chain in chains:
+        tree = tot
+        for change in chain:
+          if change.id in failures:
+            break
+          new_tree, error = PatchSeries._MergeChange(
+              git_repo, scratch, tree, change, trivial[change])
+          if error is not None and tree != tot:
+            # A change that only fails on top of the rest of its chain isn't
+            # known to fail against ToT.
+            _, error = PatchSeries._MergeChange(
+                git_repo, scratch, tot, change, trivial[change])
+            if error is None:
+              break
+          if error is not None:
+            failures[change.id] = error
+            break
+          tree = new_tree
+    except cros_build_lib.RunCommandError as e:
+      logging.warning('Not prescreening the changes to %s: %s', git_repo, e)
+    finally:
+      osutils.RmDir(scratch, ignore_missing=True)
+    return failures.values()
 
   def _ApplyDecorator(functor):
     """Decorator for Apply that does appropriate self.manifest manipulation.
@@ -510,7 +815,8 @@ class PatchSeries(object):
 
   @_ApplyDecorator
   def Apply(self, changes, dryrun=False, frozen=True,
-            honor_ordering=False, changes_filter=None):
+            honor_ordering=False, changes_filter=None, prescreen=False,
+            concurrent=False):
     """Applies changes from pool into the build root specified by the manifest.
 
     This method resolves each given change down into a set of transactions-
@@ -545,6 +851,10 @@ class PatchSeries(object):
         changes being inspected, and expand the changes if necessary.
         Primarily this is of use for cbuildbot patching when dealing w/
         uploaded/remote patches.
+      prescreen: If True, find the changes that can't apply to ToT up front
+        via PrescreenTransactions, so their transactions are never applied.
+      concurrent: If True, apply the transactions of unrelated git repos in
+        parallel; the results are the same as applying them in order.
     Returns:
       A tuple of changes-applied, Exceptions for the changes that failed
       against ToT, and Exceptions that failed inflight;  These exceptions
@@ -560,16 +870,15 @@ class PatchSeries(object):
     self.InjectLookupCache(changes)
     allowed_changes = cros_patch.PatchCache(changes) if frozen else None
     resolved, applied, failed = [], [], []
-    for change in changes:
-      try:
-        resolved.append(
-            (change, self.CreateTransaction(change, limit_to=allowed_changes)))
-      except cros_patch.PatchException, e:
+    for change, transaction, e in self.CreateTransactions(
+        changes, limit_to=allowed_changes):
+      if e is not None:
         logging.info("Failed creating transaction for %s: %s", change, e)
         failed.append(e)
       else:
+        resolved.append((change, transaction))
         logging.info("Transaction for %s is %s.",
-            change, ', '.join(map(str, resolved[-1][-1])))
+            change, ', '.join(map(str, transaction)))
 
     if not resolved:
       # No work to do; either no changes were given to us, or all failed
@@ -586,21 +895,21 @@ class PatchSeries(object):
         return -len(ids), position[data[0]]
       resolved.sort(key=mk_key)
 
-    for inducing_change, transaction_changes in resolved:
-      try:
-        with self._Transaction(transaction_changes):
-          logging.debug("Attempting transaction for %s: changes: %s",
-                        inducing_change,
-                        ', '.join(map(str, transaction_changes)))
-          self._ApplyChanges(inducing_change, transaction_changes,
-                             dryrun=dryrun)
-      except cros_patch.PatchException, e:
-        logging.info("Failed applying transaction for %s: %s",
-                     inducing_change, e)
-        failed.append(e)
-      else:
+    if prescreen:
+      self.PrescreenTransactions([x[1] for x in resolved], dryrun=dryrun)
+
+    if concurrent:
+      outcomes = self._ApplyTransactionsConcurrently(resolved, dryrun=dryrun)
+    else:
+      outcomes = [self._ApplyTransaction(inducing_change, transaction_changes,
+                                         dryrun=dryrun)
+                  for inducing_change, transaction_changes in resolved]
+
+    for (_, transaction_changes), e in zip(resolved, outcomes):
+      if e is None:
         applied.extend(transaction_changes)
-        self.InjectCommittedPatches(transaction_changes)
+      else:
+        failed.append(e)
 
     # Uniquify while maintaining order.
     def _uniq(l):
@@ -617,6 +926,85 @@ class PatchSeries(object):
     failed_inflight = [x for x in failed if x.inflight]
     return applied, failed_tot, failed_inflight
 
+  def _ApplyTransaction(self, inducing_change, transaction_changes,
+                        dryrun=False):
+    """Apply one transaction, rolling it back if it fails.
+
+    Returns:
+      None if the transaction was applied, else the cros_patch.PatchException
+      that made it fail.
+    """
+    try:
+      with self._Transaction(transaction_changes):
+        logging.debug("Attempting transaction for %s: changes: %s",
+                      inducing_change,
+                      ', '.join(map(str, transaction_changes)))
+        self._ApplyChanges(inducing_change, transaction_changes,
+                           dryrun=dryrun)
+    except cros_patch.PatchException, e:
+      logging.info("Failed applying transaction for %s: %s",
+                   inducing_change, e)
+      return e
+    self.InjectCommittedPatches(transaction_changes)
+    return None
+
+  # How many independent groups of projects Apply works on at the same time.
+  _APPLY_THREADS = 8
+
+  def _ApplyTransactionsConcurrently(self, resolved, dryrun=False):
+    """Apply transactions that touch unrelated git repos in parallel.
+
+    Transactions sharing a git repo (directly, or through other transactions,
+    such as by cross project CQ-DEPENDs) are grouped, and applied in order in
+    the same thread, so each group behaves exactly as if applied alone.  As
+    no change or repo is shared between groups, the outcome is the same as
+    applying all of |resolved| in order.
+
+    Args:
+      resolved: A list of (inducing change, transaction) tuples, in the order
+        they would be applied.
+      dryrun: See Apply.
+    Returns:
+      A list holding the outcome of each transaction of |resolved|, as
+      returned by _ApplyTransaction.
+    """
+    # Look up what content merging is allowed now, rather than from threads.
+    for _, transaction_changes in resolved:
+      for change in transaction_changes:
+        if not dryrun:
+          self._IsContentMerging(change)
+
+    # Union the git repos of each transaction.
+    roots = {}
+    def _Find(repo):
+      while roots[repo] != repo:
+        repo = roots[repo] = roots[roots[repo]]
+      return repo
+    for _, transaction_changes in resolved:
+      repos = [self.GetGitRepoForChange(x) for x in transaction_changes]
+      for repo in repos:
+        roots.setdefault(repo, repo)
+      for repo in repos[1:]:
+        roots[_Find(repo)] = _Find(repos[0])
+
+    groups = {}
+    for idx, (_, transaction_changes) in enumerate(resolved):
+      key = idx
+      if transaction_changes:
+        key = _Find(self.GetGitRepoForChange(transaction_changes[0]))
+      groups.setdefault(key, []).append(idx)
+
+    def _ApplyGroup(indices):
+      return [(idx, self._ApplyTransaction(*resolved[idx], dryrun=dryrun))
+              for idx in indices]
+
+    outcomes = {}
+    for group_outcomes in parallel.IterTasksInThreads(
+        _ApplyGroup, [[x] for x in groups.itervalues()],
+        threads=self._APPLY_THREADS):
+      outcomes.update(group_outcomes)
+    return [outcomes[idx] for idx in xrange(len(resolved))]
+
   @contextlib.contextmanager
   def _Transaction(self, commits):
     """ContextManager used to rollback changes to a build root if necessary.
@@ -655,7 +1043,9 @@ class PatchSeries(object):
             'stdout: %s\nstderr: %s'
             % (result.returncode, result.output, result.error))
 
-    committed_cache = self._committed_cache.copy()
+    # Note other transactions may be applied concurrently (in other repos), so
+    # only this transaction's changes are rolled back in the committed cache.
+    committed = [x for x in commits if x in self._committed_cache]
 
     try:
       yield
@@ -676,7 +1066,7 @@ class PatchSeries(object):
       for project_dir, sha1 in resets:
         git.RunGit(project_dir, ['reset', '--hard', sha1])
 
-      self._committed_cache = committed_cache
+      self._committed_cache.Remove(*[x for x in commits if x not in committed])
       raise
 
   @_PatchWrapException
@@ -966,9 +1356,15 @@ class ValidationPool(object):
       # Only master configurations should call this method.
       pool = ValidationPool(overlays, build_root, build_number, builder_name,
                             True, dryrun)
-      # Iterate through changes from all gerrit instances we care about.
-      for helper in cls.GetGerritHelpersForOverlays(overlays):
-        raw_changes = helper.Query(changes_query, sort='lastUpdated')
+      # Iterate through changes from all gerrit instances we care about,
+      # querying them all at the same time.
+      helpers = list(cls.GetGerritHelpersForOverlays(overlays))
+      def _Query(helper):
+        return helper, helper.Query(changes_query, sort='lastUpdated')
+      results = dict(parallel.IterTasksInThreads(
+          _Query, [[helper] for helper in helpers]))
+      for helper in helpers:
+        raw_changes = results[helper]
         raw_changes.reverse()
 
         changes, non_manifest_changes = ValidationPool._FilterNonCrosProjects(
@@ -1115,7 +1511,8 @@ class ValidationPool(object):
     try:
       # pylint: disable=E1123
       applied, failed_tot, failed_inflight = self._patch_series.Apply(
-          self.changes, dryrun=self.dryrun, manifest=manifest)
+          self.changes, dryrun=self.dryrun, manifest=manifest, prescreen=True,
+          concurrent=True)
     except (KeyboardInterrupt, RuntimeError, SystemExit):
       raise
     except Exception, e:
@@ -10,6 +10,7 @@ import contextlib
 import copy
 import functools
 import itertools
+import logging
 import mox
 import os
 import pickle
@@ -25,6 +26,8 @@ from chromite.buildbot import validation_pool
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_test_lib
 from chromite.lib import gerrit
+from chromite.lib import git
+from chromite.lib import osutils
 from chromite.lib import patch as cros_patch
 from chromite.lib import patch_unittest
 
@@ -145,6 +148,13 @@ class TestPatchSeries(base):
     # requires admin rights in gerrit.
     self.mox.StubOutWithMock(gerrit.GerritHelper,
                              'FindContentMergingProjects')
+    # Route batched fetches through each (mocked) patch's Fetch.
+    self.mox.stubs.Set(cros_patch, 'FetchPatches', self._FetchPatches)
+
+  @staticmethod
+  def _FetchPatches(git_repo, patches):
+    for patch in patches:
+      patch.Fetch(git_repo)
 
   @staticmethod
   def SetContentMergingProjects(series, projects=(),
@@ -198,15 +208,16 @@ class TestPatchSeries(base):
         trivial=trivial)
 
   def assertResults(self, series, changes, applied=(), failed_tot=(),
-                    failed_inflight=(), frozen=True, dryrun=False):
+                    failed_inflight=(), frozen=True, dryrun=False,
+                    concurrent=False):
     # Convenience; set the content pool as necessary.
     for remote in set(x.remote for x in changes):
       helper = series._helper_pool.GetHelper(remote)
       series._content_merging_projects.setdefault(helper, frozenset())
 
     manifest = MockManifest(self.build_root)
-    result = series.Apply(changes, dryrun=dryrun,
-                          frozen=frozen, manifest=manifest)
+    result = series.Apply(changes, dryrun=dryrun, frozen=frozen,
+                          manifest=manifest, concurrent=concurrent)
 
     _GetIds = lambda seq:[x.id for x in seq]
     _GetFailedIds = lambda seq: _GetIds(x.patch for x in seq)
@@ -357,6 +368,8 @@ class TestPatchSeries(base):
     if is_parent:
       query = "project:%s AND branch:%s AND %s" % (
           change.project, os.path.basename(change.tracking_branch), query)
+    elif query.isdigit():
+      helper.GetCachedPatchset(query).AndReturn(None)
     return helper.QuerySingleRecord(query, must_match=True)
 
   def testApplyMissingDep(self):
@@ -513,6 +526,33 @@ class TestPatchSeries(base):
     self.assertResults(series, patches, patches)
     self.mox.VerifyAll()
 
+  def testConcurrentApply(self):
+    """Test applying transactions of unrelated projects in parallel.
+
+    The results must match applying the same transactions in order; the
+    changes of the CQ-DEPEND linked projects c and d must go in together.
+    """
+    series = self.GetPatchSeries()
+
+    patch1, patch5 = self.GetPatches(2, project='a')
+    patch2 = self.GetPatches(project='b')
+    patch3 = self.GetPatches(project='c')
+    patch4 = self.GetPatches(project='d')
+    patches = [patch1, patch2, patch3, patch4, patch5]
+
+    for patch in patches:
+      self.SetPatchDeps(patch)
+    self.SetPatchDeps(patch3, cq=[patch4.id])
+
+    for patch in (patch1, patch2, patch3, patch4):
+      self.SetPatchApply(patch).InAnyOrder()
+    self.SetPatchApply(patch5).InAnyOrder().AndRaise(
+        cros_patch.ApplyPatchException(patch5))
+
+    self.mox.ReplayAll()
+    self.assertResults(series, patches, [patch3, patch4, patch1, patch2],
+                       [patch5], concurrent=True)
+    self.mox.VerifyAll()
 
 # pylint: disable=W0212,R0904
 class TestCoreLogic(base):
@@ -551,8 +591,8 @@ class TestCoreLogic(base):
     inflight = [self.MakeFailure(x, inflight=True) for x in inflight]
     # pylint: disable=E1123
     pool._patch_series.Apply(
-        changes, dryrun=dryrun, manifest=mox.IgnoreArg()
-        ).AndReturn((applied, tot, inflight))
+        changes, dryrun=dryrun, manifest=mox.IgnoreArg(), prescreen=True,
+        concurrent=True).AndReturn((applied, tot, inflight))
 
     for patch in applied:
       pool._HandleApplySuccess(patch).AndReturn(None)
@@ -734,9 +774,15 @@ class TestCoreLogic(base):
     pool = self.MakePool(dryrun=False)
 
     patch = self.GetPatches(1)
+    # Don't connect to the real gerrit.
+    self.stubs.Set(gerrit.SshConnectionPool, '_StartMaster',
+                   lambda *_args: False)
     # Force int conversion of gerrit_number to ensure the test is sane.
-    cmd = ('ssh -p 29418 gerrit.chromium.org gerrit review '
-           '--submit %i,%i' % (int(patch.gerrit_number), patch.patch_number))
+    cmd = ('ssh -p 29418 %s gerrit.chromium.org gerrit review '
+           '--submit %i,%i' % (
+               ' '.join(gerrit.GetSshConnectionPool().GetSshOptions(
+                   'gerrit.chromium.org', 29418)),
+               int(patch.gerrit_number), patch.patch_number))
     validation_pool._RunCommand(cmd.split(), False).AndReturn(None)
     self.mox.ReplayAll()
     pool._SubmitChange(patch)
@@ -754,8 +800,8 @@ class TestCoreLogic(base):
     self.mox.StubOutWithMock(pool._patch_series, 'Apply')
     # pylint: disable=E1123
     pool._patch_series.Apply(
-        patches, dryrun=False, manifest=mox.IgnoreArg()).AndRaise(
-        MyException)
+        patches, dryrun=False, manifest=mox.IgnoreArg(),
+        prescreen=True, concurrent=True).AndRaise(MyException)
 
     def _ValidateExceptioN(changes):
       for patch in changes:
@@ -826,6 +872,88 @@ class TestCoreLogic(base):
     compare(results[1], filtered_patches)
 
 
+class TestPrescreen(cros_test_lib.TempDirTestCase):
+  """Tests PatchSeries.PrescreenTransactions against real git repos."""
+
+  def _run(self, cmd, cwd):
+    return cros_build_lib.RunCommandCaptureOutput(
+        cmd, cwd=cwd, print_cmd=False).output.strip()
+
+  def _Commit(self, repo, filename, content, branch=None):
+    if branch is not None:
+      self._run(['git', 'checkout', '-q', branch], repo)
+    osutils.WriteFile(os.path.join(repo, filename), content)
+    self._run(['git', 'add', filename], repo)
+    self._run(['git', 'commit', '-q', '-m', 'Change to %s\n\nChange-Id: %s'
+               % (filename, cros_patch.MakeChangeId())], repo)
+    return self._run(['git', 'rev-parse', 'HEAD'], repo)
+
+  def testPrescreen(self):
+    upstream = os.path.join(self.tempdir, 'upstream')
+    os.mkdir(upstream)
+    self._run(['git', 'init', '-q'], upstream)
+    self._run(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'], upstream)
+    base_sha1 = self._Commit(upstream, 'monkeys', 'base')
+    for branch in ('conflicting', 'clean'):
+      self._run(['git', 'branch', branch, base_sha1], upstream)
+    patches = []
+    for branch, filename in (('conflicting', 'monkeys'), ('clean', 'poo')):
+      sha1 = self._Commit(upstream, filename, branch, branch)
+      patches.append(cros_patch.GitRepoPatch(
+          upstream, 'chromiumos/chromite', 'refs/heads/%s' % branch,
+          'master', constants.EXTERNAL_REMOTE, sha1=sha1))
+    self._Commit(upstream, 'monkeys', 'tot', 'master')
+
+    checkout = os.path.join(self.tempdir, 'checkout')
+    self._run(['git', 'clone', '-q', upstream, checkout], self.tempdir)
+    head = self._run(['git', 'rev-parse', 'HEAD'], checkout)
+    series = validation_pool.PatchSeries.WorkOnSingleRepo(
+        checkout, 'master', helper_pool=validation_pool.HelperPool())
+    series.FetchChanges(patches)
+
+    failures = series.PrescreenTransactions([[x] for x in patches])
+    self.assertEqual([x.patch for x in failures], patches[:1])
+    self.assertFalse(failures[0].inflight)
+    self.assertEqual(series.failed_tot, {patches[0].id: failures[0]})
+    # The checkout itself must be left alone.
+    self.assertEqual(head, self._run(['git', 'rev-parse', 'HEAD'], checkout))
+    self.assertFalse(git.DoesLocalBranchExist(checkout,
+                                              constants.PATCH_BRANCH))
+
+  def testMergeChange(self):
+    """Changes to other lines of a file need a content merge."""
+    repo = os.path.join(self.tempdir, 'repo')
+    os.mkdir(repo)
+    self._run(['git', 'init', '-q'], repo)
+    lines = ['%d\n' % i for i in range(10)]
+    root_sha1 = self._Commit(repo, 'lines', ''.join(lines))
+    self._run(['git', 'checkout', '-q', '-b', 'change'], repo)
+    sha1 = self._Commit(repo, 'lines', ''.join(lines[:-1] + ['change\n']))
+    patch = cros_patch.GitRepoPatch(
+        repo, 'chromiumos/chromite', 'refs/heads/change', 'master',
+        constants.EXTERNAL_REMOTE, sha1=sha1)
+    self._Commit(repo, 'lines', ''.join(['tot\n'] + lines[1:]), 'master')
+    tot = self._run(['git', 'rev-parse', 'master^{tree}'], repo)
+
+    merge = validation_pool.PatchSeries._MergeChange
+    tree, error = merge(repo, self.tempdir, tot, patch, False)
+    self.assertEqual(error, None)
+    self.assertEqual(self._run(['git', 'cat-file', 'blob', '%s:lines' % tree],
+                               repo).splitlines(),
+                     ['tot'] + [x.strip() for x in lines[1:-1]] + ['change'])
+    _, error = merge(repo, self.tempdir, tot, patch, True)
+    self.assertTrue(error.trivial)
+    _, error = merge(repo, self.tempdir, tree, patch, False)
+    self.assertTrue(isinstance(error, cros_patch.PatchAlreadyApplied))
+
+    # Git failing makes prescreening give up rather than fail the change.
+    root = cros_patch.GitRepoPatch(
+        repo, 'chromiumos/chromite', 'refs/heads/master', 'master',
+        constants.EXTERNAL_REMOTE, sha1=root_sha1)
+    self.assertEqual(validation_pool.PatchSeries._PrescreenProject(
+        repo, 'master', [[root]], {root: False}), [])
+
+
 class TestPickling(cros_test_lib.TempDirTestCase):
 
   """Tests to validate pickling of ValidationPool, covering CQ's needs"""
@@ -1069,5 +1197,79 @@ class TestCreateValidationFailureMessage(cros_test_lib.TestCase):
     self._AssertMessage(patch1, [patch1], [])
 
 
+class DepsPatch(object):
+  """A bare patch with fixed dependencies, for resolving large pools."""
+
+  remote = constants.EXTERNAL_REMOTE
+  internal = False
+  project = 'chromiumos/chromite'
+  tracking_branch = 'master'
+
+  def __init__(self, num, parents=(), cq=()):
+    self.gerrit_number = str(num)
+    self.change_id = self.id = 'I%s' % self.gerrit_number.rjust(40, '0')
+    self.parents = list(parents)
+    self.cq = list(cq)
+
+  def LookupAliases(self):
+    return [self.id, self.gerrit_number]
+
+  @staticmethod
+  def IsAlreadyMerged():
+    return False
+
+  def GerritDependencies(self, _git_repo, _upstream):
+    return [x.id for x in self.parents]
+
+  def PaladinDependencies(self, _git_repo):
+    return [x.id for x in self.cq]
+
+  def __str__(self):
+    return self.gerrit_number
+
+
+class PatchSeriesBenchmark(cros_test_lib.TestCase):
+  """Benchmark for resolving the transactions of a large pool."""
+
+  CHANGES = 200
+
+  def testResolveStackedPool(self):
+    # A single stack of changes, each the git parent of the next; changes 100
+    # through 150 are in a cycle due to a CQ-DEPEND from 100 on 150.
+    changes = []
+    for num in xrange(self.CHANGES):
+      changes.append(DepsPatch(num, parents=changes[-1:]))
+    changes[100].cq.append(changes[150])
+
+    series = validation_pool.PatchSeries(
+        'fakebuildroot', helper_pool=validation_pool.HelperPool(),
+        forced_manifest=MockManifest('fakebuildroot'))
+    series.InjectLookupCache(changes)
+    lookups = []
+    original_lookup = series._LookupUncommittedChanges
+    def _CountLookups(*args, **kwargs):
+      lookups.append(args[0])
+      return original_lookup(*args, **kwargs)
+    series._LookupUncommittedChanges = _CountLookups
+
+    start = time.time()
+    results = series.CreateTransactions(
+        changes, limit_to=cros_patch.PatchCache(changes))
+    elapsed = time.time() - start
+
+    # Every change's dependencies are looked up just once.
+    self.assertEqual(len(lookups), 2 * self.CHANGES)
+    for num, (change, transaction, e) in enumerate(results):
+      self.assertTrue(e is None)
+      self.assertEqual(change, changes[num])
+      if 100 <= num <= 150:
+        self.assertEqual(set(transaction), set(changes[:151]))
+      else:
+        self.assertEqual(transaction, changes[:num + 1])
+    self.assertEqual(results[120][1],
+                     changes[:101] + changes[121:151] + changes[101:121])
+    logging.info('Resolved %d transactions in %.2fs', self.CHANGES, elapsed)
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
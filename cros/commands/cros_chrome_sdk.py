@@ -36,6 +36,7 @@ class SDKFetcher(object):
 
   TARBALL_CACHE = 'tarballs'
   MISC_CACHE = 'misc'
+  METADATA_CACHE = 'gs_metadata'
 
   TARGET_TOOLCHAIN_KEY = 'target_toolchain'
 
@@ -52,6 +53,9 @@ class SDKFetcher(object):
         os.path.join(self.cache_base, self.TARBALL_CACHE))
     self.misc_cache = cache.DiskCache(
         os.path.join(self.cache_base, self.MISC_CACHE))
+    self.gs_cache = gs.MetadataCache(
+        ctx=self.gs_ctx, cache_dir=os.path.join(self.cache_base,
+                                                self.METADATA_CACHE))
     self.board = board
     self.gs_base = self._GetGSBaseForBoard(board)
 
@@ -89,8 +93,8 @@ class SDKFetcher(object):
     if gclient_root is not None:
       version = osutils.ReadFile(os.path.join(
           gclient_root, constants.PATH_TO_CHROME_LKGM))
-      real_path = self.gs_ctx.LS(os.path.join(
-          self.gs_base, 'R??-%s' % version)).output.splitlines()[0]
+      real_path = self.gs_cache.LS(os.path.join(
+          self.gs_base, 'R??-%s' % version))[0]
       if not real_path.startswith(self.gs_base):
         raise AssertionError('%s does not start with %s'
                              % (real_path, self.gs_base))
@@ -104,7 +108,7 @@ class SDKFetcher(object):
 
   def _GetNewestManifestVersion(self):
     version_file = '%s/LATEST-master' % self.gs_base
-    return self.gs_ctx.Cat(version_file).output
+    return self.gs_cache.Cat(version_file)
 
   def GetDefaultVersion(self):
     """Get the default SDK version to use.
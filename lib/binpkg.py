@@ -8,20 +8,308 @@
 
 import collections
 import cStringIO
+import hashlib
+import httplib
+import itertools
+import json
 import operator
 import os
+import socket
 import tempfile
+import threading
 import time
+import urllib
 import urllib2
+import urlparse
 
 from chromite.lib import cros_build_lib
 from chromite.lib import gs
+from chromite.lib import osutils
+from chromite.lib import parallel
 
 
 TWO_WEEKS = 60 * 60 * 24 * 7 * 2
 
+# How much of a Packages file to read at a time when parsing it.
+_READ_CHUNK_SIZE = 256 * 1024
+
+# Bump this whenever the layout of the saved PackageIndex sidecars changes.
+_SIDECAR_VERSION = 2
+
+# Seconds to wait on a binhost before giving up on a request.
+_HTTP_TIMEOUT = 60
+
+# How many redirects to follow for one request, like urllib2 does.
+_MAX_REDIRECTS = 10
+_REDIRECT_CODES = (301, 302, 303, 307)
+
 _Package = collections.namedtuple('_Package', ['mtime', 'uri'])
 
+# Maps a sorted tuple of keys to the _Layout shared by all packages that have
+# exactly those keys.  Most packages in an index have the same set of keys.
+_LAYOUTS = {}
+
+
+class _Layout(object):
+  """The (interned) keys of a PackageEntry and the index of each key."""
+
+  __slots__ = ('keys', 'index', '_added')
+
+  def __init__(self, keys):
+    self.keys = keys
+    self.index = dict((k, i) for i, k in enumerate(keys))
+    self._added = {}
+
+  def Add(self, key):
+    """Return (layout, position) for these keys plus |key|."""
+    result = self._added.get(key)
+    if result is None:
+      layout = _GetLayout(tuple(sorted(self.keys + (key,))))
+      result = self._added[key] = (layout, layout.index[key])
+    return result
+
+
+def _GetLayout(keys):
+  """Return the shared _Layout for the given sorted tuple of keys."""
+  layout = _LAYOUTS.get(keys)
+  if layout is None:
+    keys = tuple(intern(k) for k in keys)
+    layout = _LAYOUTS[keys] = _Layout(keys)
+  return layout
+
+
+class PackageEntry(object):
+  """A compact, dict-like record of a single package in a Packages file.
+
+  Entries are created from the raw text of their section in the Packages
+  file, and only split into keys and values when needed.  Once decoded, the
+  keys are shared with all other entries that have the same set of keys, and
+  the values are kept in a plain list.
+  """
+
+  __slots__ = ('_raw', '_layout', '_values')
+
+  # Bumped whenever an entry is changed from outside of PackageIndex, so that
+  # data derived from the values of entries can tell when it is out of date.
+  # PackageIndex changes entries with _SetValue, and drops its own derived
+  # data instead.
+  generation = 0
+
+  def __init__(self, raw=None, **kwargs):
+    """Constructor.
+
+    Args:
+      raw: The text of this package's section of a Packages file.
+      kwargs: Initial key/value pairs, if |raw| is not given.
+    """
+    self._raw = raw
+    self._layout = None
+    self._values = None
+    if raw is None:
+      self._SetItems(kwargs)
+
+  def _SetItems(self, d):
+    keys = tuple(sorted(d))
+    self._layout = _GetLayout(keys)
+    self._values = [d[k] for k in keys]
+    self._raw = None
+
+  def _Decode(self):
+    """Split the raw text into keys and values."""
+    if self._raw is not None:
+      d = {}
+      for line in self._raw.split('\n'):
+        line = line.split(': ', 1)
+        if len(line) == 2:
+          d[line[0]] = line[1]
+      self._SetItems(d)
+
+  def _FindRaw(self, key):
+    """Look up |key| in the raw text without decoding the whole entry."""
+    raw = self._raw
+    needle = '\n%s: ' % key
+    start = raw.rfind(needle)
+    if start != -1:
+      start += len(needle)
+    elif raw.startswith(needle[1:]):
+      start = len(needle) - 1
+    else:
+      raise KeyError(key)
+    end = raw.find('\n', start)
+    return raw[start:] if end == -1 else raw[start:end]
+
+  def __getitem__(self, key):
+    if self._raw is not None:
+      return self._FindRaw(key)
+    try:
+      return self._values[self._layout.index[key]]
+    except KeyError:
+      raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    PackageEntry.generation += 1
+    self._SetValue(key, value)
+
+  def _SetValue(self, key, value):
+    """Set |key| to |value| without bumping the generation."""
+    self._Decode()
+    idx = self._layout.index.get(key)
+    if idx is None:
+      self._layout, idx = self._layout.Add(key)
+      self._values.insert(idx, value)
+    else:
+      self._values[idx] = value
+
+  def __delitem__(self, key):
+    d = dict(self.iteritems())
+    del d[key]
+    self._SetItems(d)
+    PackageEntry.generation += 1
+
+  def __contains__(self, key):
+    try:
+      self[key]
+    except KeyError:
+      return False
+    return True
+
+  has_key = __contains__
+
+  def __iter__(self):
+    self._Decode()
+    return iter(self._layout.keys)
+
+  def __len__(self):
+    self._Decode()
+    return len(self._values)
+
+  def __eq__(self, other):
+    try:
+      return dict(self.iteritems()) == dict(other.iteritems())
+    except AttributeError:
+      return NotImplemented
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  def __repr__(self):
+    return '%s(%r)' % (self.__class__.__name__, dict(self.iteritems()))
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def setdefault(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      self[key] = default
+      return default
+
+  def pop(self, key, *args):
+    try:
+      value = self[key]
+    except KeyError:
+      if args:
+        return args[0]
+      raise
+    del self[key]
+    return value
+
+  def update(self, *args, **kwargs):
+    d = dict(self.iteritems())
+    d.update(*args, **kwargs)
+    self._SetItems(d)
+    PackageEntry.generation += 1
+
+  def keys(self):
+    return list(self)
+
+  iterkeys = __iter__
+
+  def values(self):
+    self._Decode()
+    return list(self._values)
+
+  def itervalues(self):
+    self._Decode()
+    return iter(self._values)
+
+  def iteritems(self):
+    self._Decode()
+    return itertools.izip(self._layout.keys, self._values)
+
+  def items(self):
+    return list(self.iteritems())
+
+  def copy(self):
+    """Return a plain dict copy of this entry."""
+    return dict(self.iteritems())
+
+  def __getstate__(self):
+    if self._raw is not None:
+      return self._raw
+    return (self._layout.keys, self._values)
+
+  def __setstate__(self, state):
+    if isinstance(state, basestring):
+      self._raw, self._layout, self._values = state, None, None
+    else:
+      keys, values = state
+      self._raw, self._layout, self._values = None, _GetLayout(keys), values
+
+
+def _IterSections(pkgfile, chunk_size=_READ_CHUNK_SIZE):
+  """Yield the blank-line separated sections of a Packages file.
+
+  The file is read in chunks, so only one section is held in memory at a time
+  in addition to the current chunk.
+
+  Args:
+    pkgfile: A python file object.
+    chunk_size: How many bytes to read at a time.
+  """
+  pending = ''
+  for chunk in iter(lambda: pkgfile.read(chunk_size), ''):
+    sections = (pending + chunk).split('\n\n')
+    pending = sections.pop()
+    for section in sections:
+      section = section.strip('\n')
+      if section:
+        yield section
+  pending = pending.strip('\n')
+  if pending:
+    yield pending
+
+
+def IterPackages(pkgfile, header=None):
+  """Iterate over the packages in a Packages file without storing them all.
+
+  Keys and values in the Packages file are separated by a colon and a space.
+  Lines that have content, and do not contain a valid key/value pair, are
+  ignored, as are sections without a CPV entry.  This is for compatibility
+  with the Portage package parser.
+
+  Args:
+    pkgfile: A python file object, positioned at the start of the file.
+    header: If given, a dict that is filled in with the header entries.
+
+  Yields:
+    A PackageEntry for each package in the file.
+  """
+  sections = _IterSections(pkgfile)
+  header_section = next(sections, None)
+  if header is not None and header_section is not None:
+    header.update(PackageEntry(header_section).iteritems())
+
+  for section in sections:
+    if section.startswith('CPV: ') or '\nCPV: ' in section:
+      yield PackageEntry(section)
+
+
 class PackageIndex(object):
   """A parser for the Portage Packages index file.
 
@@ -44,67 +332,111 @@ class PackageIndex(object):
     # specific package. E.g., it tracks the base URL of the packages.
     self.header = {}
 
-    # A list of packages (stored as a list of dictionaries).
+    # A list of packages (stored as a list of dict-like PackageEntry objects).
     self.packages = []
 
     # Whether or not the PackageIndex has been modified since the last time it
     # was written.
     self.modified = False
 
-  def _PopulateDuplicateDB(self, db, expires):
-    """Populate db with SHA1 -> URL mapping for packages.
-
-    Args:
-      db: Dictionary to populate with SHA1 -> URL mapping for packages.
-      expires: The time at which prebuilts expire from the binhost.
-    """
-
-    uri = gs.CanonicalizeURL(self.header['URI'])
-    for pkg in self.packages:
-      cpv, sha1, mtime = pkg['CPV'], pkg.get('SHA1'), pkg.get('MTIME')
-      oldpkg = db.get(sha1, _Package(0, None))
-      if sha1 and mtime and int(mtime) > max(expires, oldpkg.mtime):
-        path = pkg.get('PATH', cpv + '.tbz2')
-        db[sha1] = _Package(int(mtime), '%s/%s' % (uri.rstrip('/'), path))
-
-  def _ReadPkgIndex(self, pkgfile):
-    """Read a list of key/value pairs from the Packages file into a dictionary.
-
-    Both header entries and package entries are lists of key/value pairs, so
-    they can both be read by this function. Entries can be terminated by empty
-    lines or by the end of the file.
-
-    This function will read lines from the specified file until it encounters
-    the a blank line or the end of the file.
-
-    Keys and values in the Packages file are separated by a colon and a space.
-    Keys may contain capital letters, numbers, and underscores, but may not
-    contain colons. Values may contain any character except a newline. In
-    particular, it is normal for values to contain colons.
-
-    Lines that have content, and do not contain a valid key/value pair, are
-    ignored. This is for compatibility with the Portage package parser, and
-    to allow for future extensions to the Packages file format.
-
-    All entries must contain at least one key/value pair. If the end of the
-    fils is reached, an empty dictionary is returned.
-
-    Args:
-      pkgfile: A python file object.
-
-    Returns the dictionary of key-value pairs that was read from the file.
-    """
-    d = {}
-    for line in pkgfile:
-      line = line.rstrip('\n')
-      if not line:
-        assert d, 'Packages entry must contain at least one key/value pair'
-        break
-      line = line.split(': ', 1)
-      if len(line) == 2:
-        k, v = line
-        d[k] = v
-    return d
+    # CPV -> position in |packages| and SHA1 -> [packages] lookup tables.
+    # These are kept up to date by the methods of this class, and rebuilt if
+    # |packages| is replaced or resized behind our back.
+    self._cpv_index = {}
+    self._sha1_index = {}
+    self._indexed = None
+    # SHA1 -> newest _Package, for ResolveDuplicateUploads, along with the
+    # PackageEntry generation and URI it was computed for.  It depends on the
+    # values of the entries, so it's dropped when this class changes them,
+    # and rebuilt after anyone else did.
+    self._dup_db = None
+    self._dup_db_key = None
+
+  def __getstate__(self):
+    # The lookup tables are cheap to rebuild; don't serialize them.
+    state = self.__dict__.copy()
+    state.update(_cpv_index={}, _sha1_index={}, _indexed=None, _dup_db=None,
+                 _dup_db_key=None)
+    return state
+
+  def _IndexPackage(self, pkg, pos):
+    self._dup_db = None
+    self._cpv_index[pkg['CPV']] = pos
+    sha1 = pkg.get('SHA1')
+    if sha1:
+      self._sha1_index.setdefault(sha1, []).append(pkg)
+
+  def _UnindexPackage(self, pkg):
+    self._dup_db = None
+    sha1 = pkg.get('SHA1')
+    if sha1 in self._sha1_index:
+      remaining = [x for x in self._sha1_index[sha1] if x is not pkg]
+      if remaining:
+        self._sha1_index[sha1] = remaining
+      else:
+        del self._sha1_index[sha1]
+
+  def _UpdateIndexes(self):
+    """Make sure the lookup tables match the current list of packages."""
+    if self._indexed != (id(self.packages), len(self.packages)):
+      self._cpv_index, self._sha1_index = {}, {}
+      for pos, pkg in enumerate(self.packages):
+        self._IndexPackage(pkg, pos)
+      self._MarkIndexed()
+
+  def _MarkIndexed(self):
+    self._indexed = (id(self.packages), len(self.packages))
+
+  def GetPackage(self, cpv):
+    """Return the package with the given CPV, or None."""
+    self._UpdateIndexes()
+    pos = self._cpv_index.get(cpv)
+    return None if pos is None else self.packages[pos]
+
+  def GetPackagesBySHA1(self, sha1):
+    """Return the list of packages with the given SHA1."""
+    self._UpdateIndexes()
+    return list(self._sha1_index.get(sha1, ()))
+
+  def AddPackage(self, pkg):
+    """Add |pkg| to the index, replacing any package with the same CPV."""
+    self._UpdateIndexes()
+    pos = self._cpv_index.get(pkg['CPV'])
+    if pos is not None:
+      self._UnindexPackage(self.packages[pos])
+      self.packages[pos] = pkg
+    else:
+      pos = len(self.packages)
+      self.packages.append(pkg)
+    self._IndexPackage(pkg, pos)
+    self._MarkIndexed()
+    self.modified = True
+
+  def _SetPackageValue(self, pkg, key, value):
+    """Set |key| of |pkg| to |value|, only dropping our own derived data."""
+    if isinstance(pkg, PackageEntry):
+      pkg._SetValue(key, value)  # pylint: disable=W0212
+    else:
+      pkg[key] = value
+    self._dup_db = None
+
+  def _GetDuplicateDB(self):
+    """Return a SHA1 -> _Package mapping of the newest upload of each SHA1."""
+    self._UpdateIndexes()
+    key = (PackageEntry.generation, self.header['URI'])
+    if self._dup_db is None or self._dup_db_key != key:
+      # The SHA1 of an entry may have changed too, so don't trust
+      # |_sha1_index| here.
+      self._dup_db = {}
+      uri = gs.CanonicalizeURL(self.header['URI']).rstrip('/')
+      for pkg in self.packages:
+        sha1, mtime = pkg.get('SHA1'), pkg.get('MTIME')
+        best = self._dup_db.get(sha1)
+        if sha1 and mtime and int(mtime) > (best.mtime if best else 0):
+          path = pkg.get('PATH', pkg['CPV'] + '.tbz2')
+          self._dup_db[sha1] = _Package(int(mtime), '%s/%s' % (uri, path))
+      self._dup_db_key = key
+    return self._dup_db
 
   def _WritePkgIndex(self, pkgfile, entry):
     """Write header entry or package entry to packages file.
@@ -119,44 +451,16 @@ class PackageIndex(object):
     lines = ['%s: %s' % (k, v) for k, v in sorted(entry.items()) if v]
     pkgfile.write('%s\n\n' % '\n'.join(lines))
 
-  def _ReadHeader(self, pkgfile):
-    """Read header of packages file.
-
-    Args:
-      pkgfile: A python file object.
-    """
-    assert not self.header, 'Should only read header once.'
-    self.header = self._ReadPkgIndex(pkgfile)
-
-  def _ReadBody(self, pkgfile):
-    """Read body of packages file.
-
-    Before calling this function, you must first read the header (using
-    _ReadHeader).
-
-    Args:
-      pkgfile: A python file object.
-    """
-    assert self.header, 'Should read header first.'
-    assert not self.packages, 'Should only read body once.'
-
-    # Read all of the sections in the body by looping until we reach the end
-    # of the file.
-    while True:
-      d = self._ReadPkgIndex(pkgfile)
-      if not d:
-        break
-      if 'CPV' in d:
-        self.packages.append(d)
-
   def Read(self, pkgfile):
     """Read the entire packages file.
 
     Args:
       pkgfile: A python file object.
     """
-    self._ReadHeader(pkgfile)
-    self._ReadBody(pkgfile)
+    assert not self.header, 'Should only read header once.'
+    assert not self.packages, 'Should only read body once.'
+    self.packages = list(IterPackages(pkgfile, header=self.header))
+    self._indexed = None
 
   def RemoveFilteredPackages(self, filter_fn):
     """Remove packages which match filter_fn.
@@ -166,10 +470,12 @@ class PackageIndex(object):
                  the package should be removed.
     """
 
-    filtered = [p for p in self.packages if not filter_fn(p)]
-    if filtered != self.packages:
+    filtered = [pkg for pkg in self.packages if not filter_fn(pkg)]
+    if len(filtered) != len(self.packages):
       self.modified = True
       self.packages = filtered
+      # The remaining packages have moved, so rebuild the lookup tables.
+      self._indexed = None
 
   def ResolveDuplicateUploads(self, pkgindexes):
     """Point packages at files that have already been uploaded.
@@ -186,25 +492,34 @@ class PackageIndex(object):
     Returns:
       A list of the packages that still need to be uploaded.
     """
-    db = {}
     now = int(time.time())
     expires = now - TWO_WEEKS
     base_uri = gs.CanonicalizeURL(self.header['URI'])
-    for pkgindex in pkgindexes:
-      if gs.CanonicalizeURL(pkgindex.header['URI']) == base_uri:
-        # pylint: disable=W0212
-        pkgindex._PopulateDuplicateDB(db, expires)
+    candidates = [x for x in pkgindexes
+                  if gs.CanonicalizeURL(x.header['URI']) == base_uri]
+
+    # Look up all duplicates before touching any package, as we may be one of
+    # the candidates ourselves.
+    # pylint: disable=W0212
+    dbs = [x._GetDuplicateDB() for x in candidates]
+    dups = []
+    for pkg in self.packages:
+      sha1, dup = pkg.get('SHA1'), None
+      if sha1:
+        for db in dbs:
+          found = db.get(sha1)
+          if found and found.mtime > max(expires, dup.mtime if dup else 0):
+            dup = found
+      dups.append(dup)
 
     uploads = []
     base_uri = self.header['URI']
-    for pkg in self.packages:
-      sha1 = pkg.get('SHA1')
-      dup = db.get(sha1)
-      if sha1 and dup and dup.uri.startswith(base_uri):
-        pkg['PATH'] = dup.uri[len(base_uri):].lstrip('/')
-        pkg['MTIME'] = str(dup.mtime)
+    for pkg, dup in zip(self.packages, dups):
+      if dup and dup.uri.startswith(base_uri):
+        self._SetPackageValue(pkg, 'PATH', dup.uri[len(base_uri):].lstrip('/'))
+        self._SetPackageValue(pkg, 'MTIME', str(dup.mtime))
       else:
-        pkg['MTIME'] = str(now)
+        self._SetPackageValue(pkg, 'MTIME', str(now))
         uploads.append(pkg)
     return uploads
 
@@ -221,7 +536,8 @@ class PackageIndex(object):
     self.header['URI'] = base_uri
     for pkg in self.packages:
       path = pkg['CPV'] + '.tbz2'
-      pkg['PATH'] = '%s/%s' % (path_prefix.rstrip('/'), path)
+      self._SetPackageValue(pkg, 'PATH',
+                            '%s/%s' % (path_prefix.rstrip('/'), path))
 
   def Write(self, pkgfile):
     """Write a packages file to disk.
@@ -256,84 +572,358 @@ class PackageIndex(object):
     return f
 
 
-def _RetryUrlOpen(url, tries=3):
-  """Open the specified url, retrying if we run into temporary errors.
+class _UrllibResponse(object):
+  """A urllib2 response (or HTTPError) that looks like an HTTPResponse."""
+
+  def __init__(self, f):
+    self.status = f.code
+    self.reason = f.msg
+    self.msg = f.info()
+    self.body = f.read()
+
+  def getheader(self, name, default=None):
+    return self.msg.getheader(name, default)
+
+
+def _GetProxy(scheme, netloc):
+  """Return the proxy configured for |scheme| (e.g. in $http_proxy), if any."""
+  proxy = urllib.getproxies().get(scheme)
+  if proxy and not urllib.proxy_bypass(netloc):
+    return proxy
+  return None
+
+
+class _ConnectionPool(object):
+  """A thread-safe pool of idle keep-alive HTTP(S) connections, per host.
+
+  Redirects are followed, like urllib2.urlopen does.  Requests that have to
+  go through a proxy are handed to urllib2 instead.
+  """
+
+  def __init__(self, timeout=_HTTP_TIMEOUT):
+    self._timeout = timeout
+    self._idle = collections.defaultdict(list)
+    self._lock = threading.Lock()
+
+  def _GetConnection(self, scheme, netloc):
+    """Return (connection, reused) for the given host."""
+    with self._lock:
+      idle = self._idle[(scheme, netloc)]
+      if idle:
+        return idle.pop(), True
+    if scheme == 'https':
+      conn = httplib.HTTPSConnection(netloc, timeout=self._timeout)
+    else:
+      conn = httplib.HTTPConnection(netloc, timeout=self._timeout)
+    return conn, False
+
+  def _Get(self, parts, headers):
+    """Send one GET request for the url split into |parts|."""
+    path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+    while True:
+      conn, reused = self._GetConnection(parts.scheme, parts.netloc)
+      try:
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        response.body = response.read()
+      except (httplib.HTTPException, socket.error):
+        conn.close()
+        # The server may have dropped an idle connection; retry on a new one.
+        if reused:
+          continue
+        raise
+      if response.will_close:
+        conn.close()
+      else:
+        with self._lock:
+          self._idle[(parts.scheme, parts.netloc)].append(conn)
+      return response
+
+  def _GetWithUrllib(self, url, headers):
+    """Send a GET request for |url| through urllib2."""
+    request = urllib2.Request(url, headers=headers)
+    try:
+      f = urllib2.urlopen(request, timeout=self._timeout)
+    except urllib2.HTTPError as e:
+      f = e
+    try:
+      return _UrllibResponse(f)
+    finally:
+      f.close()
+
+  def Request(self, url, headers=None):
+    """Send a GET request for |url|, reusing an idle connection if possible.
+
+    Args:
+      url: The http(s) url to fetch.
+      headers: A dict of extra request headers.
+
+    Returns:
+      The httplib.HTTPResponse of the last request (after redirects), or
+      something that looks like one, with its body already read into |body|.
+    """
+    headers = headers or {}
+    for _ in xrange(_MAX_REDIRECTS + 1):
+      parts = urlparse.urlsplit(url)
+      if _GetProxy(parts.scheme, parts.netloc):
+        return self._GetWithUrllib(url, headers)
+      response = self._Get(parts, headers)
+      location = response.getheader('location')
+      if response.status not in _REDIRECT_CODES or not location:
+        return response
+      url = urlparse.urljoin(url, location)
+    raise httplib.HTTPException('Too many redirects while fetching %s' % url)
+
+
+_POOL = _ConnectionPool()
+
+
+def _RetryRequest(url, headers=None, tries=3, pool=None):
+  """Fetch the specified url, retrying if we run into temporary errors.
 
   We retry for both network errors and 5xx Server Errors. We do not retry
   for HTTP errors with a non-5xx code.
 
   Args:
     url: The specified url.
+    headers: A dict of extra request headers.
     tries: The number of times to try.
+    pool: The _ConnectionPool to use; defaults to a shared one.
 
   Returns:
-    The result of urllib2.urlopen(url).
+    The httplib.HTTPResponse, with the body available as |body|.
+
+  Raises:
+    urllib2.HTTPError for any status other than 2xx and 304 Not Modified.
   """
+  pool = _POOL if pool is None else pool
   for i in range(tries):
     try:
-      return urllib2.urlopen(url)
-    except urllib2.HTTPError as e:
-      if i + 1 >= tries or e.code < 500:
-        e.msg += ('\nwhile processing %s' % url)
-        raise
-      else:
-        print 'Cannot GET %s: %s' % (url, str(e))
-    except urllib2.URLError as e:
+      response = pool.Request(url, headers)
+    except (httplib.HTTPException, socket.error, urllib2.URLError) as e:
       if i + 1 >= tries:
         raise
-      else:
-        print 'Cannot GET %s: %s' % (url, str(e))
+      print 'Cannot GET %s: %s' % (url, str(e))
+    else:
+      if 200 <= response.status < 300 or response.status == 304:
+        return response
+      e = urllib2.HTTPError(url, response.status, response.reason,
+                            response.msg, None)
+      if i + 1 >= tries or response.status < 500:
+        e.msg += ('\nwhile processing %s' % url)
+        raise e
+      print 'Cannot GET %s: %s' % (url, str(e))
     print 'Sleeping for 10 seconds before retrying...'
     time.sleep(10)
 
 
-def GrabRemotePackageIndex(binhost_url):
+def _FetchHttpIndex(url, cache_key, pool=None):
+  """Fetch |url|, revalidating against |cache_key| if given.
+
+  Returns:
+    A tuple (data, key): |data| is the body, or None if the cached copy is
+    still current, and |key| is the validator tuple of the response.
+  """
+  headers = {}
+  if cache_key:
+    etag, last_modified = cache_key
+    if etag:
+      headers['If-None-Match'] = etag
+    if last_modified:
+      headers['If-Modified-Since'] = last_modified
+  response = _RetryRequest(url, headers=headers, pool=pool)
+  if response.status == 304:
+    return None, cache_key
+  key = (response.getheader('etag'), response.getheader('last-modified'))
+  return response.body, key
+
+
+def _FetchGsIndex(url, cache_key):
+  """Fetch |url| from GS, unless its generation matches |cache_key|.
+
+  Returns:
+    A tuple (data, key) as for _FetchHttpIndex.
+  """
+  key = None
+  if cache_key is not False:
+    cmd = [gs.GSUTIL_BIN, 'ls', '-L', url]
+    output = cros_build_lib.RunCommand(cmd, redirect_stdout=True,
+                                       print_cmd=False).output
+    stat = gs.ParseLsLong(output).get(url, {})
+    if stat.get('generation') or stat.get('md5'):
+      key = (stat.get('generation'), stat.get('md5'))
+      if key == cache_key:
+        return None, key
+  cmd = [gs.GSUTIL_BIN, 'cat', url]
+  output = cros_build_lib.RunCommand(cmd, redirect_stdout=True,
+                                     print_cmd=False).output
+  return output, key
+
+
+def GrabRemotePackageIndex(binhost_url, cache_dir=None, pool=None):
   """Grab the latest binary package database from the specified URL.
 
+  If |cache_dir| is given, the parsed index is kept there along with the
+  ETag/Last-Modified headers (for http) or the generation/md5 (for gs) of the
+  Packages file.  When the remote file hasn't changed, it is revalidated with
+  one cheap request instead of being downloaded and parsed again.
+
   Args:
     binhost_url: Base URL of remote packages (PORTAGE_BINHOST).
+    cache_dir: If given, the directory to cache parsed indexes in.
+    pool: The _ConnectionPool to use for http(s) urls.
 
   Returns:
     A PackageIndex object, if the Packages file can be retrieved. If the
     server returns status code 404, None is returned.
   """
   url = '%s/Packages' % binhost_url.rstrip('/')
-  pkgindex = PackageIndex()
+  cache_path = cache_key = cached = None
+  if cache_dir:
+    osutils.SafeMakedirs(cache_dir)
+    cache_path = os.path.join(cache_dir, hashlib.sha1(url).hexdigest())
+    cache_key, cached = _ReadSidecar(cache_path)
+    if cached is None:
+      cache_key = None
+
   if binhost_url.startswith('http'):
     try:
-      f = _RetryUrlOpen(url)
+      data, key = _FetchHttpIndex(url, cache_key, pool=pool)
     except urllib2.HTTPError as e:
       if e.code == 404:
         return None
       raise
   elif binhost_url.startswith('gs://'):
-    cmd = [gs.GSUTIL_BIN, 'cat', url]
     try:
-      output = cros_build_lib.RunCommand(cmd, redirect_stdout=True,
-                                         print_cmd=False).output
+      data, key = _FetchGsIndex(url, cache_key if cache_dir else False)
     except cros_build_lib.RunCommandError as e:
       print 'Cannot GET %s: %s' % (url, str(e))
       return None
-    f = cStringIO.StringIO(output)
   else:
     return None
+
+  if data is None:
+    return cached
+  f = cStringIO.StringIO(data)
+  pkgindex = PackageIndex()
   pkgindex.Read(f)
   pkgindex.header.setdefault('URI', binhost_url)
   f.close()
+  if cache_path and key and any(key):
+    _SaveSidecar(cache_path, key, pkgindex)
   return pkgindex
 
 
-def GrabLocalPackageIndex(package_path):
+def GrabRemotePackageIndexes(binhost_urls, cache_dir=None, threads=None):
+  """Grab the binary package databases of several binhosts at once.
+
+  The indexes are fetched concurrently, reusing HTTP connections to the same
+  host.  See GrabRemotePackageIndex for details.
+
+  Args:
+    binhost_urls: A list of base URLs of remote packages.
+    cache_dir: If given, the directory to cache parsed indexes in.
+    threads: How many indexes to fetch at the same time; defaults to all.
+
+  Returns:
+    A dict mapping each binhost url to its PackageIndex (or None).
+  """
+  def _Grab(binhost_url):
+    return binhost_url, GrabRemotePackageIndex(binhost_url, cache_dir=cache_dir)
+
+  return dict(parallel.IterTasksInThreads(
+      _Grab, [[url] for url in binhost_urls], threads=threads))
+
+
+def _FromJson(value):
+  """Turn the unicode strings and lists of json back into str and tuples."""
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  if isinstance(value, list):
+    return tuple(_FromJson(x) for x in value)
+  if isinstance(value, dict):
+    return dict((_FromJson(k), _FromJson(v)) for k, v in value.iteritems())
+  return value
+
+
+def _ReadSidecar(sidecar):
+  """Return the (source_key, PackageIndex) stored in |sidecar|.
+
+  The sidecar holds the header and the raw text of each package as JSON, so
+  reading it never runs code from the file.
+
+  Returns (None, None) if the sidecar is missing, unreadable or stale.
+  """
+  try:
+    with open(sidecar, 'rb') as f:
+      data = json.load(f)
+    if data.get('version') != _SIDECAR_VERSION:
+      return None, None
+    key = _FromJson(data['key'])
+    pkgindex = PackageIndex()
+    pkgindex.header = _FromJson(data['header'])
+    pkgindex.packages = [PackageEntry(x.encode('utf-8'))
+                         for x in data['packages']]
+  except (IOError, ValueError, TypeError, KeyError, AttributeError):
+    return None, None
+  return key, pkgindex
+
+
+def _LoadSidecar(sidecar, source_key):
+  """Load a saved PackageIndex, if it was made from the given source.
+
+  Args:
+    sidecar: Path to the saved index.
+    source_key: Opaque key describing the Packages file we want the index of.
+
+  Returns:
+    The PackageIndex, or None if the sidecar is missing, stale or unreadable.
+  """
+  key, pkgindex = _ReadSidecar(sidecar)
+  if key != _FromJson(json.loads(json.dumps(source_key))):
+    return None
+  return pkgindex
+
+
+def _SaveSidecar(sidecar, source_key, pkgindex):
+  """Save |pkgindex| to |sidecar| so later runs needn't parse it again."""
+  # pylint: disable=W0212
+  packages = [pkg._raw if getattr(pkg, '_raw', None) is not None else
+              '\n'.join('%s: %s' % x for x in sorted(pkg.items()))
+              for pkg in pkgindex.packages]
+  data = {'version': _SIDECAR_VERSION, 'key': source_key,
+          'header': pkgindex.header, 'packages': packages}
+  tmp = '%s.tmp.%d.%d' % (sidecar, os.getpid(),
+                          threading.current_thread().ident)
+  with open(tmp, 'wb') as f:
+    json.dump(data, f)
+  os.rename(tmp, sidecar)
+
+
+def GrabLocalPackageIndex(package_path, sidecar=None):
   """Read a local packages file from disk into a PackageIndex() object.
 
   Args:
     package_path: Directory containing Packages file.
+    sidecar: If given, path of a serialized copy of the parsed index.  It is
+      used instead of parsing the Packages file when it is up to date, and is
+      (re)written otherwise.
 
   Returns:
     A PackageIndex object.
   """
-  packages_file = file(os.path.join(package_path, 'Packages'))
+  packages_path = os.path.join(package_path, 'Packages')
+  if sidecar:
+    st = os.stat(packages_path)
+    source_key = (packages_path, st.st_size, st.st_mtime)
+    pkgindex = _LoadSidecar(sidecar, source_key)
+    if pkgindex is not None:
+      return pkgindex
+
+  packages_file = file(packages_path)
   pkgindex = PackageIndex()
   pkgindex.Read(packages_file)
   packages_file.close()
+  if sidecar:
+    _SaveSidecar(sidecar, source_key, pkgindex)
   return pkgindex
@@ -0,0 +1,420 @@
+#!/usr/bin/python
+# Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the binpkg module."""
+
+import cPickle
+import cStringIO
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+from chromite.lib import binpkg
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+
+# TODO(build): Finish test wrapper (http://crosbug.com/37517).
+# Until then, this has to be after the chromite imports.
+import mock
+
+
+PACKAGES_HEADER = """\
+ARCH: amd64
+PACKAGES: %(count)d
+TIMESTAMP: 1360000000
+URI: gs://chromeos-prebuilt/board/amd64-generic/packages/
+
+"""
+
+PACKAGE_ENTRY = """\
+BUILD_TIME: 1360000000
+CPV: %(category)s/pkg%(num)d-1.0.%(num)d
+DEFINED_PHASES: compile configure install prepare
+DEPEND: dev-libs/glib:2 sys-libs/zlib
+EAPI: 4
+IUSE: cros_host test
+KEYWORDS: amd64 arm x86
+LICENSE: BSD
+MD5: 0123456789abcdef0123456789abcdef
+MTIME: %(mtime)d
+RDEPEND: dev-libs/glib:2 sys-libs/zlib
+SHA1: %(sha1)040x
+SIZE: 123456
+SLOT: 0
+USE: amd64 elibc_glibc kernel_linux userland_GNU
+
+"""
+
+
+def GeneratePackages(count, mtime=1360000000):
+  """Return the text of a synthetic Packages file with |count| packages."""
+  out = cStringIO.StringIO()
+  out.write(PACKAGES_HEADER % {'count': count})
+  for num in xrange(count):
+    out.write(PACKAGE_ENTRY % {'category': 'cat-%d' % (num % 50), 'num': num,
+                               'mtime': mtime, 'sha1': num})
+  return out.getvalue()
+
+
+class PackageEntryTest(cros_test_lib.TestCase):
+  """Tests for the dict-like PackageEntry."""
+
+  RAW = 'CPV: foo/bar-1\nSHA1: abc\nnot a pair\nPATH: foo/bar-1.tbz2'
+
+  def testLazyLookup(self):
+    """Fields can be read without decoding the whole entry."""
+    entry = binpkg.PackageEntry(self.RAW)
+    self.assertEqual(entry['CPV'], 'foo/bar-1')
+    self.assertEqual(entry['PATH'], 'foo/bar-1.tbz2')
+    self.assertEqual(entry.get('MTIME'), None)
+    self.assertFalse('not a pair' in entry)
+    self.assertRaises(KeyError, entry.__getitem__, 'PAT')
+
+  def testDictSemantics(self):
+    """Entries compare and mutate like dicts."""
+    entry = binpkg.PackageEntry(self.RAW)
+    expected = {'CPV': 'foo/bar-1', 'SHA1': 'abc', 'PATH': 'foo/bar-1.tbz2'}
+    self.assertEqual(entry, expected)
+    self.assertEqual(len(entry), 3)
+    entry['MTIME'] = '5'
+    expected['MTIME'] = '5'
+    entry['SHA1'] = 'def'
+    expected['SHA1'] = 'def'
+    del entry['PATH']
+    del expected['PATH']
+    self.assertEqual(entry, expected)
+    self.assertEqual(sorted(entry), sorted(expected))
+    self.assertNotEqual(entry, {})
+
+  def testSharedLayout(self):
+    """Entries with the same keys share one key layout."""
+    # pylint: disable=W0212
+    a = binpkg.PackageEntry('CPV: a/b-1\nSHA1: 1')
+    b = binpkg.PackageEntry('SHA1: 2\nCPV: c/d-1')
+    a.keys()
+    b.keys()
+    self.assertTrue(a._layout is b._layout)
+
+
+class PackageIndexTest(cros_test_lib.TestCase):
+  """Tests for reading and writing PackageIndex objects."""
+
+  def testReadWrite(self):
+    """Verify Packages files round trip."""
+    pkgindex = binpkg.PackageIndex()
+    pkgindex.Read(cStringIO.StringIO(GeneratePackages(3)))
+    self.assertEqual(pkgindex.header['PACKAGES'], '3')
+    self.assertEqual([p['CPV'] for p in pkgindex.packages],
+                     ['cat-0/pkg0-1.0.0', 'cat-1/pkg1-1.0.1',
+                      'cat-2/pkg2-1.0.2'])
+    out = cStringIO.StringIO()
+    pkgindex.Write(out)
+    self.assertEqual(out.getvalue(), GeneratePackages(3))
+
+  def testIterPackages(self):
+    """Verify packages can be streamed in small chunks."""
+    header = {}
+    # pylint: disable=W0212
+    sections = binpkg._IterSections(cStringIO.StringIO(GeneratePackages(5)),
+                                    chunk_size=7)
+    self.assertEqual(len(list(sections)), 6)
+    cpvs = [p['CPV'] for p in binpkg.IterPackages(
+        cStringIO.StringIO(GeneratePackages(5)), header=header)]
+    self.assertEqual(len(cpvs), 5)
+    self.assertEqual(header['URI'],
+                     'gs://chromeos-prebuilt/board/amd64-generic/packages/')
+
+  def testSkipsEntriesWithoutCPV(self):
+    """Sections without a CPV are ignored, as portage does."""
+    data = 'URI: http://foo\n\nFOO: bar\n\nCPV: a/b-1\n'
+    pkgindex = binpkg.PackageIndex()
+    pkgindex.Read(cStringIO.StringIO(data))
+    self.assertEqual(pkgindex.packages, [{'CPV': 'a/b-1'}])
+
+
+class PackageIndexLookupTest(cros_test_lib.TempDirTestCase):
+  """Tests for the CPV/SHA1 lookup tables of PackageIndex."""
+
+  def _GetIndex(self, count=5, mtime=None):
+    if mtime is None:
+      mtime = int(time.time())
+    pkgindex = binpkg.PackageIndex()
+    pkgindex.Read(cStringIO.StringIO(GeneratePackages(count, mtime=mtime)))
+    return pkgindex
+
+  def testLookups(self):
+    """Lookups follow additions and removals."""
+    pkgindex = self._GetIndex()
+    pkg = pkgindex.GetPackage('cat-1/pkg1-1.0.1')
+    self.assertEqual(pkgindex.GetPackagesBySHA1(pkg['SHA1']), [pkg])
+    pkgindex.RemoveFilteredPackages(lambda p: p['CPV'] == pkg['CPV'])
+    self.assertTrue(pkgindex.modified)
+    self.assertEqual(pkgindex.GetPackage(pkg['CPV']), None)
+    self.assertEqual(pkgindex.GetPackagesBySHA1(pkg['SHA1']), [])
+    pkgindex.AddPackage(binpkg.PackageEntry(CPV=pkg['CPV'], SHA1='1234'))
+    self.assertEqual(pkgindex.GetPackage(pkg['CPV'])['SHA1'], '1234')
+    self.assertEqual(len(pkgindex.packages), 5)
+
+  def testReplacePackage(self):
+    """Adding a package with a known CPV replaces it in place."""
+    pkgindex = self._GetIndex()
+    pkgindex.AddPackage(binpkg.PackageEntry(CPV='cat-2/pkg2-1.0.2', SHA1='12'))
+    self.assertEqual(pkgindex.packages[2]['SHA1'], '12')
+    self.assertEqual(len(pkgindex.packages), 5)
+    pkgindex.RemoveFilteredPackages(lambda p: p['CPV'] == 'cat-0/pkg0-1.0.0')
+    pkgindex.AddPackage(binpkg.PackageEntry(CPV='cat-4/pkg4-1.0.4', SHA1='34'))
+    self.assertEqual(pkgindex.packages[3]['SHA1'], '34')
+    self.assertEqual(len(pkgindex.packages), 4)
+
+  def testExternalListChanges(self):
+    """Replacing or appending to |packages| directly is noticed."""
+    pkgindex = self._GetIndex()
+    pkgindex.packages.append({'CPV': 'a/b-1', 'SHA1': 'ff'})
+    self.assertEqual(pkgindex.GetPackage('a/b-1')['SHA1'], 'ff')
+    pkgindex.packages = pkgindex.packages[:1]
+    self.assertEqual(pkgindex.GetPackage('a/b-1'), None)
+
+  def testResolveDuplicateUploads(self):
+    """Packages already in another index point at the existing upload."""
+    old = self._GetIndex(count=3)
+    new = self._GetIndex(count=4, mtime=0)
+    new.SetUploadLocation(new.header['URI'], 'new')
+    old.SetUploadLocation(old.header['URI'], 'old')
+    uploads = new.ResolveDuplicateUploads([old])
+    self.assertEqual([p['CPV'] for p in uploads], ['cat-3/pkg3-1.0.3'])
+    self.assertEqual(new.packages[0]['PATH'], 'old/cat-0/pkg0-1.0.0.tbz2')
+
+  def testDuplicatesFollowEntryChanges(self):
+    """Changing an entry in place is seen by later duplicate lookups."""
+    old = self._GetIndex(count=3)
+    new = self._GetIndex(count=3, mtime=0)
+    self.assertEqual(new.ResolveDuplicateUploads([old]), [])
+    old.packages[1]['SHA1'] = 'ff'
+    uploads = new.ResolveDuplicateUploads([old])
+    self.assertEqual([p['CPV'] for p in uploads], ['cat-1/pkg1-1.0.1'])
+
+  def testDuplicateDBReused(self):
+    """Resolving one index doesn't invalidate the others' duplicate DBs."""
+    old = self._GetIndex(count=3)
+    db = old._GetDuplicateDB()  # pylint: disable=W0212
+    for _ in xrange(2):
+      new = self._GetIndex(count=3, mtime=0)
+      new.SetUploadLocation(new.header['URI'], 'new')
+      self.assertEqual(new.ResolveDuplicateUploads([old]), [])
+    self.assertTrue(old._GetDuplicateDB() is db)  # pylint: disable=W0212
+
+  def testExpiredDuplicates(self):
+    """Packages older than two weeks are uploaded again."""
+    old = self._GetIndex(count=3, mtime=1)
+    new = self._GetIndex(count=3)
+    self.assertEqual(len(new.ResolveDuplicateUploads([old])), 3)
+
+  def testSidecar(self):
+    """A sidecar is used instead of parsing when the index is unchanged."""
+    packages_path = os.path.join(self.tempdir, 'Packages')
+    sidecar = os.path.join(self.tempdir, 'Packages.json')
+    osutils.WriteFile(packages_path, GeneratePackages(3))
+    first = binpkg.GrabLocalPackageIndex(self.tempdir, sidecar=sidecar)
+    self.assertTrue(os.path.exists(sidecar))
+    with mock.patch.object(binpkg.PackageIndex, 'Read') as read:
+      second = binpkg.GrabLocalPackageIndex(self.tempdir, sidecar=sidecar)
+      self.assertFalse(read.called)
+    self.assertEqual(first.header, second.header)
+    self.assertEqual(first.packages, second.packages)
+    self.assertEqual(second.GetPackage('cat-2/pkg2-1.0.2')['SHA1'],
+                     first.packages[2]['SHA1'])
+
+    # Changing the Packages file invalidates the sidecar.
+    osutils.WriteFile(packages_path, GeneratePackages(4))
+    os.utime(packages_path, (0, 0))
+    third = binpkg.GrabLocalPackageIndex(self.tempdir, sidecar=sidecar)
+    self.assertEqual(len(third.packages), 4)
+
+  def testSidecarNotPickled(self):
+    """Sidecars are plain data; pickles left in their place are ignored."""
+    packages_path = os.path.join(self.tempdir, 'Packages')
+    sidecar = os.path.join(self.tempdir, 'Packages.json')
+    osutils.WriteFile(packages_path, GeneratePackages(3))
+    with open(sidecar, 'wb') as f:
+      cPickle.dump((1, None, binpkg.PackageIndex()), f)
+    pkgindex = binpkg.GrabLocalPackageIndex(self.tempdir, sidecar=sidecar)
+    self.assertEqual(len(pkgindex.packages), 3)
+    with open(sidecar) as f:
+      self.assertEqual(len(json.load(f)['packages']), 3)
+
+
+class FakeResponse(object):
+  """A minimal stand-in for httplib.HTTPResponse."""
+
+  def __init__(self, status, body='', headers=None):
+    self.status = status
+    self.reason = 'reason'
+    self.msg = ''
+    self.body = body
+    self._headers = headers or {}
+
+  def getheader(self, name, default=None):
+    return self._headers.get(name, default)
+
+
+class RemotePackageIndexTest(cros_test_lib.TempDirTestCase):
+  """Tests for fetching and caching remote Packages files."""
+
+  URL = 'http://binhost/board/packages'
+
+  def setUp(self):
+    self.pool = mock.Mock()
+
+  def _Grab(self, url=URL):
+    return binpkg.GrabRemotePackageIndex(url, cache_dir=self.tempdir,
+                                         pool=self.pool)
+
+  def testNotModified(self):
+    """A 304 response returns the cached index without parsing."""
+    self.pool.Request.return_value = FakeResponse(
+        200, GeneratePackages(3), {'etag': '"v1"'})
+    first = self._Grab()
+    self.assertEqual(len(first.packages), 3)
+
+    self.pool.Request.return_value = FakeResponse(304)
+    with mock.patch.object(binpkg.PackageIndex, 'Read') as read:
+      second = self._Grab()
+      self.assertFalse(read.called)
+    self.pool.Request.assert_called_with(self.URL + '/Packages',
+                                         {'If-None-Match': '"v1"'})
+    self.assertEqual(second.packages, first.packages)
+
+    # A changed index replaces the cached copy.
+    self.pool.Request.return_value = FakeResponse(
+        200, GeneratePackages(4), {'etag': '"v2"'})
+    self.assertEqual(len(self._Grab().packages), 4)
+    self.pool.Request.return_value = FakeResponse(304)
+    self.assertEqual(len(self._Grab().packages), 4)
+
+  def testErrors(self):
+    """A 404 returns None; other client errors are raised."""
+    self.pool.Request.return_value = FakeResponse(404)
+    self.assertEqual(self._Grab(), None)
+    self.pool.Request.return_value = FakeResponse(403)
+    self.assertRaises(binpkg.urllib2.HTTPError, self._Grab)
+
+  def testRedirects(self):
+    """Redirects are followed; other 3xx responses are errors."""
+    pool = binpkg._ConnectionPool()
+    responses = [FakeResponse(302, headers={'location': '/moved/Packages'}),
+                 FakeResponse(200, GeneratePackages(2))]
+    with mock.patch.object(pool, '_Get', side_effect=responses) as get:
+      pkgindex = binpkg.GrabRemotePackageIndex(self.URL, pool=pool)
+    self.assertEqual(len(pkgindex.packages), 2)
+    self.assertEqual(get.call_args[0][0].path, '/moved/Packages')
+
+    with mock.patch.object(pool, '_Get', return_value=FakeResponse(300)):
+      self.assertRaises(binpkg.urllib2.HTTPError,
+                        binpkg.GrabRemotePackageIndex, self.URL, pool=pool)
+
+  def testProxy(self):
+    """Requests that need a proxy go through urllib2."""
+    pool = binpkg._ConnectionPool()
+    f = mock.Mock(code=200, msg='OK')
+    f.read.return_value = GeneratePackages(2)
+    with mock.patch.dict(os.environ, {'http_proxy': 'http://proxy:3128'}):
+      with mock.patch.object(binpkg.urllib2, 'urlopen', return_value=f):
+        with mock.patch.object(pool, '_Get') as get:
+          pkgindex = binpkg.GrabRemotePackageIndex(self.URL, pool=pool)
+          self.assertFalse(get.called)
+    self.assertEqual(len(pkgindex.packages), 2)
+
+  def testGsGeneration(self):
+    """GS indexes are only downloaded when their generation changes."""
+    url = 'gs://binhost/board/packages'
+    ls_output = ('%s/Packages:\n'
+                 '\tGeneration:\t\t%%s\n'
+                 '\tHash (md5):\t\tAQIDBAUGBwgJCgsMDQ4PEA==\n' % url)
+    outputs = {'1': [ls_output % '1', GeneratePackages(2), ls_output % '1'],
+               '2': [ls_output % '2', GeneratePackages(5)]}
+    def _Run(cmd, **_kwargs):
+      result = mock.Mock()
+      result.output = outputs[generation].pop(0)
+      commands.append(cmd[1])
+      return result
+
+    commands = []
+    with mock.patch.object(binpkg.cros_build_lib, 'RunCommand',
+                           side_effect=_Run):
+      generation = '1'
+      self.assertEqual(len(self._Grab(url).packages), 2)
+      self.assertEqual(len(self._Grab(url).packages), 2)
+      generation = '2'
+      self.assertEqual(len(self._Grab(url).packages), 5)
+    self.assertEqual(commands, ['ls', 'cat', 'ls', 'ls', 'cat'])
+
+  def testGrabMany(self):
+    """Several binhosts can be fetched concurrently."""
+    urls = ['http://binhost/%d' % i for i in xrange(5)]
+    def _Grab(url, **_kwargs):
+      return url
+    with mock.patch.object(binpkg, 'GrabRemotePackageIndex',
+                           side_effect=_Grab):
+      results = binpkg.GrabRemotePackageIndexes(urls, threads=2)
+    self.assertEqual(results, dict((u, u) for u in urls))
+    self.assertEqual(binpkg.GrabRemotePackageIndexes([]), {})
+
+  def testGrabManyError(self):
+    """Errors fetching any binhost are passed on to the caller."""
+    with mock.patch.object(binpkg, 'GrabRemotePackageIndex',
+                           side_effect=ValueError):
+      self.assertRaises(ValueError, binpkg.GrabRemotePackageIndexes,
+                        ['http://a', 'http://b'])
+
+
+class PackageIndexBenchmark(cros_test_lib.BenchmarkTestCase):
+  """Parse benchmark on a large synthetic Packages file."""
+
+  PACKAGES = 50000
+
+  def testParse(self):
+    """Time reading a 50k entry Packages file."""
+    data = GeneratePackages(self.PACKAGES)
+
+    start = time.time()
+    count = sum(1 for _ in binpkg.IterPackages(cStringIO.StringIO(data)))
+    stream_time = time.time() - start
+    self.assertEqual(count, self.PACKAGES)
+
+    start = time.time()
+    pkgindex = binpkg.PackageIndex()
+    pkgindex.Read(cStringIO.StringIO(data))
+    sha1s = set(p['SHA1'] for p in pkgindex.packages)
+    read_time = time.time() - start
+    self.assertEqual(len(sha1s), self.PACKAGES)
+
+    logging.info('Parsed %d packages (%d bytes): streamed in %.2fs, read and '
+                 'looked up SHA1s in %.2fs', self.PACKAGES, len(data),
+                 stream_time, read_time)
+
+  def testResolveDuplicateUploads(self):
+    """Time deduplicating ten boards against ten binhosts."""
+    data = GeneratePackages(self.PACKAGES / 10, mtime=int(time.time()))
+    def _Read():
+      pkgindex = binpkg.PackageIndex()
+      pkgindex.Read(cStringIO.StringIO(data))
+      return pkgindex
+    binhosts = [_Read() for _ in xrange(10)]
+    boards = [_Read() for _ in xrange(10)]
+
+    start = time.time()
+    for pkgindex in boards:
+      self.assertEqual(pkgindex.ResolveDuplicateUploads(binhosts), [])
+    logging.info('Deduplicated %d boards against %d binhosts of %d packages '
+                 'in %.2fs', len(boards), len(binhosts), self.PACKAGES / 10,
+                 time.time() - start)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -695,6 +695,17 @@ class TempDirTestCase(TestCase):
     osutils._TempDirTearDown(self, self.sudo_cleanup)
 
 
+class BenchmarkTestCase(TestCase):
+  """Base class for benchmarks; these are slow, so only run on request.
+
+  Set CROS_TEST_BENCHMARKS=1 in the environment to run them.
+  """
+
+  def setUp(self):
+    if os.environ.get('CROS_TEST_BENCHMARKS') != '1':
+      self.skipTest('set CROS_TEST_BENCHMARKS=1 to run benchmarks')
+
+
 class _RunCommandMock(mox.MockObject):
   """Custom mock class used to suppress arguments we don't care about"""
 
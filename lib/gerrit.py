@@ -4,13 +4,24 @@
 
 """Module containing helper class and methods for interacting with Gerrit."""
 
+import atexit
+import errno
+import hashlib
 import itertools
 import json
 import logging
 import operator
+import os
+import socket
+import stat
+import tempfile
+import time
 
 from chromite.buildbot import constants
 from chromite.lib import cros_build_lib
+from chromite.lib import locking
+from chromite.lib import osutils
+from chromite.lib import parallel
 from chromite.lib import patch as cros_patch
 
 
@@ -31,13 +42,155 @@ class FailedToReachGerrit(GerritException):
   """Exception thrown if we failed to contact the Gerrit server."""
 
 
+# How long (in seconds) an idle shared ssh connection to gerrit stays open.
+SSH_CONTROL_PERSIST = 600
+
+
+class SshConnectionPool(object):
+  """Manages persistent, multiplexed ssh connections to gerrit servers.
+
+  Each (user, host, port) gets one ssh ControlMaster connection, whose control
+  socket lives in a directory private to the current user.  Every ssh command
+  given the options from GetSshOptions reuses that connection, so only the
+  first one of a build pays for the ssh handshake.  The master is started in
+  the background (by any process) the first time the options are asked for,
+  and then stays up until it has been idle for |persist| seconds, or the
+  process that made the pool exits.
+  """
+
+  def __init__(self, control_dir=None, persist=SSH_CONTROL_PERSIST):
+    if control_dir is None:
+      control_dir = os.path.join(tempfile.gettempdir(),
+                                 'cros-ssh-%d' % os.getuid())
+    self.control_dir = control_dir
+    self.persist = persist
+    self._used = {}
+    self._failed = set()
+    self._owner = os.getpid()
+    atexit.register(self.Close)
+
+  def GetControlPath(self, host, port, user=None):
+    """Return the path of the control socket for the given connection."""
+    # Keep the path short; unix socket paths are limited to ~100 chars.
+    key = hashlib.sha1('%s@%s:%s' % (user or '', host, port)).hexdigest()
+    return os.path.join(self.control_dir, key[:16])
+
+  @staticmethod
+  def IsAlive(control_path):
+    """Return True if an ssh master is listening on |control_path|."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(control_path)
+      return True
+    except socket.error:
+      return False
+    finally:
+      sock.close()
+
+  def IsPrivate(self):
+    """Return True if the control dir can only be used by the current user.
+
+    Anyone who can write to the dir can plant a socket that all later ssh
+    commands talk to, so it has to be a real dir owned by the current user
+    with mode 0700.  It is created if needed.
+    """
+    try:
+      os.makedirs(self.control_dir, 0700)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+    st = os.lstat(self.control_dir)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+        stat.S_IMODE(st.st_mode) != 0700):
+      logging.warning('Not sharing ssh connections: %s is not a private dir',
+                      self.control_dir)
+      return False
+    return True
+
+  def _StartMaster(self, host, port, user, control_path):
+    """Start a background ssh master for the given connection.
+
+    The master is detached from our stdio: one that inherited a captured
+    stderr would keep the command that started it from ever finishing.
+
+    Returns:
+      True if the master is up.
+    """
+    cmd = ['ssh', '-MNf', '-p', str(port),
+           '-o', 'ControlPath=%s' % control_path,
+           '-o', 'ControlPersist=%d' % self.persist, host]
+    if user:
+      cmd += ['-l', user]
+    result = cros_build_lib.RunCommand(
+        cmd, error_code_ok=True, print_cmd=False, log_stdout_to_file=os.devnull,
+        combine_stdout_stderr=True)
+    return result.returncode == 0
+
+  def GetSshOptions(self, host, port, user=None):
+    """Return the ssh options to share one connection to |host|:|port|.
+
+    If there is no live master for this connection yet, one is started.  If a
+    previous master died without cleaning up, its stale control socket is
+    removed first.  If the master can't be started, ssh commands given these
+    options just connect on their own.
+    """
+    if not self.IsPrivate():
+      return []
+
+    control_path = self.GetControlPath(host, port, user=user)
+    with locking.FileLock('%s.lock' % control_path, verbose=False).write_lock():
+      if control_path not in self._failed and not self.IsAlive(control_path):
+        if os.path.exists(control_path):
+          logging.debug('Removing stale ssh control socket %s', control_path)
+          osutils.SafeUnlink(control_path)
+        if not self._StartMaster(host, port, user, control_path):
+          logging.warning('Failed to start an ssh master for %s:%s',
+                          host, port)
+          self._failed.add(control_path)
+    self._used[control_path] = host
+    return ['-o', 'ControlMaster=no',
+            '-o', 'ControlPath=%s' % control_path]
+
+  def Close(self):
+    """Shut down the masters of all connections this process used."""
+    if os.getpid() != self._owner:
+      return
+    for control_path, host in self._used.items():
+      if self.IsAlive(control_path):
+        cros_build_lib.RunCommand(
+            ['ssh', '-O', 'exit', '-o', 'ControlPath=%s' % control_path, host],
+            error_code_ok=True, print_cmd=False, redirect_stdout=True,
+            redirect_stderr=True)
+    self._used.clear()
+
+
+_ssh_pool = None
+
+
+def GetSshConnectionPool():
+  """Return the SshConnectionPool shared by all GerritHelper instances."""
+  global _ssh_pool
+  if _ssh_pool is None:
+    _ssh_pool = SshConnectionPool()
+  return _ssh_pool
+
+
 class GerritHelper(object):
   """Helper class to manage interaction with Gerrit server."""
 
   _GERRIT_MAX_QUERY_RETURN = 500
 
+  # How many changes to look up in each query of QueryMultipleCurrentPatchset,
+  # and how many of those queries to run at once.
+  _QUERY_CHUNK_SIZE = 100
+  _QUERY_THREADS = 4
+
+  # How long (in seconds) the patches returned by a query are used to answer
+  # later lookups of the current patchset of those changes.
+  PATCHSET_CACHE_TTL = 120
+
   def __init__(self, host, remote, ssh_port=29418, ssh_user=None, suexec=None,
-               print_cmd=True):
+               print_cmd=True, ssh_pool=None):
     """Initializes variables for interaction with a gerrit server.
 
     Args:
@@ -49,6 +202,9 @@ class GerritHelper(object):
         commands.  Used only by maintenance accounts.
       print_cmd: This is passed to all RunCommand invocations; set it
         to False if you want things quiet.
+      ssh_pool: The SshConnectionPool used to share one ssh connection across
+        commands; defaults to the one from GetSshConnectionPool.  Pass False
+        to use a new connection for every command.
     """
     self.host = host
     self.remote = remote
@@ -57,6 +213,10 @@ class GerritHelper(object):
     self.suexec = suexec
     self.print_cmd = bool(print_cmd)
     self._version = None
+    self._patchset_cache = {}
+    if ssh_pool is None:
+      ssh_pool = GetSshConnectionPool()
+    self.ssh_pool = ssh_pool
 
   @classmethod
   def FromRemote(cls, remote, **kwds):
@@ -99,7 +259,11 @@ class GerritHelper(object):
 
   @property
   def base_ssh_prefix(self):
-    l = ['ssh', '-p', str(self.ssh_port), self.host]
+    l = ['ssh', '-p', str(self.ssh_port)]
+    if self.ssh_pool:
+      l += self.ssh_pool.GetSshOptions(self.host, self.ssh_port,
+                                       user=self.ssh_user)
+    l.append(self.host)
     if self.ssh_user:
       l.extend(['-l', self.ssh_user])
     return l
@@ -255,8 +419,64 @@ class GerritHelper(object):
                              % (query, results))
     return results[0]
 
+  def _IterQueryPages(self, query, current_patch=True, options=(),
+                      dryrun=False):
+    """Yield the raw results of a gerrit query, a page at a time.
+
+    Gerrit returns at most _GERRIT_MAX_QUERY_RETURN results per invocation;
+    the following pages are fetched by resuming from the sortKey of the last
+    result of the previous page.
+    """
+    cmd = self.ssh_prefix + ['gerrit', 'query', '--format=JSON']
+    cmd.extend(options)
+    if current_patch:
+      cmd.append('--current-patch-set')
+
+    # Note we intentionally cap the query to 500; gerrit does so
+    # already, but we force it so that if gerrit were to change
+    # its return limit, this wouldn't break.
+    cmd.extend(['--', query, 'limit:%i' % self._GERRIT_MAX_QUERY_RETURN])
+
+    if dryrun:
+      logging.info('Would have run %s', ' '.join(cmd))
+      return
+
+    resume = []
+    while True:
+      result = cros_build_lib.RunCommand(cmd + resume, redirect_stdout=True,
+                                         print_cmd=self.print_cmd)
+      page = self.InterpretJSONResults(query, result.output)
+      yield page
+      if len(page) < self._GERRIT_MAX_QUERY_RETURN:
+        return
+      resume = ['resume_sortkey:%s' % page[-1]['sortKey']]
+
+  def _MakePatches(self, results):
+    """Turn raw query |results| into GerritPatches, and cache them."""
+    patches = [cros_patch.GerritPatch(x, self.remote, self.ssh_url)
+               for x in results]
+    expiry = time.time() + self.PATCHSET_CACHE_TTL
+    for patch in patches:
+      self._patchset_cache[str(patch.gerrit_number)] = (expiry, patch)
+    return patches
+
+  def GetCachedPatchset(self, change_number):
+    """Return the current patchset of a change, if a recent query found it.
+
+    Args:
+      change_number: The gerrit change number.
+
+    Returns:
+      The GerritPatch of the current patchset of the change, as returned by a
+      query in the last PATCHSET_CACHE_TTL seconds, or None.
+    """
+    expiry, patch = self._patchset_cache.get(str(change_number), (0, None))
+    if expiry < time.time():
+      return None
+    return patch
+
   def Query(self, query, sort=None, current_patch=True, options=(),
-            dryrun=False, raw=False, _resume_sortkey=None):
+            dryrun=False, raw=False):
     """Freeform querying of a gerrit server
 
     Args:
@@ -274,45 +494,35 @@ class GerritHelper(object):
      RunCommandException if the invocation fails, or GerritException if
      there is something wrong w/ the query parameters given
     """
-
-    cmd = self.ssh_prefix + ['gerrit', 'query', '--format=JSON']
-    cmd.extend(options)
-    if current_patch:
-      cmd.append('--current-patch-set')
-    else:
+    if not current_patch:
       raw = True
 
-    # Note we intentionally cap the query to 500; gerrit does so
-    # already, but we force it so that if gerrit were to change
-    # its return limit, this wouldn't break.
-    overrides = ['limit:%i' % self._GERRIT_MAX_QUERY_RETURN]
-    if _resume_sortkey:
-      overrides += ['resume_sortkey:%s' % _resume_sortkey]
-
-    cmd.extend(['--', query] + overrides)
-
-    if dryrun:
-      logging.info('Would have run %s', ' '.join(cmd))
-      return []
-    result = cros_build_lib.RunCommand(cmd, redirect_stdout=True,
-                                       print_cmd=self.print_cmd)
-    result = self.InterpretJSONResults(query, result.output)
-
-    if len(result) == self._GERRIT_MAX_QUERY_RETURN:
-      # Gerrit cuts us off at 500; thus go recursive via the sortKey to
-      # get the rest of the results.
-      result += self.Query(query, _resume_sortkey=result[-1]['sortKey'],
-                           current_patch=current_patch,
-                           options=options, dryrun=dryrun, raw=True)
+    result = []
+    for page in self._IterQueryPages(query, current_patch=current_patch,
+                                     options=options, dryrun=dryrun):
+      result.extend(page)
 
     if sort:
       result = sorted(result, key=operator.itemgetter(sort))
     if not raw:
-      return [cros_patch.GerritPatch(x, self.remote, self.ssh_url)
-              for x in result]
+      return self._MakePatches(result)
 
     return result
 
+  def IterQuery(self, query, current_patch=True, options=(), dryrun=False,
+                raw=False):
+    """Like Query, but yields results as each page arrives from gerrit.
+
+    Results are not sorted; see Query for the meaning of the arguments.
+    """
+    if not current_patch:
+      raw = True
+
+    for page in self._IterQueryPages(query, current_patch=current_patch,
+                                     options=options, dryrun=dryrun):
+      for result in (page if raw else self._MakePatches(page)):
+        yield result
+
   def InterpretJSONResults(self, query, result_string, query_type='stats',
                            mode='query'):
     result = map(json.loads, result_string.splitlines())
@@ -355,32 +565,56 @@ class GerritHelper(object):
     # we can identify exactly which patchset returned no results; it's
     # basically impossible to do it if you query with mixed numeric/ID
 
-    numeric_queries = [x for x in queries if x.isdigit()]
+    numeric_queries = []
+    for query in queries:
+      if query.isdigit():
+        result = self.GetCachedPatchset(query)
+        if result is None:
+          numeric_queries.append(query)
+        else:
+          yield query, result
 
-    if numeric_queries:
-      query = ' OR '.join('change:%s' % x for x in numeric_queries)
-      results = self.Query(query, sort='number')
+    id_queries = sorted(cros_patch.FormatPatchDep(x, sha1=False)
+                        for x in queries if not x.isdigit())
 
-      # Sort via alpha comparison, rather than integer; Query sorts via the
-      # raw textual field, thus we need to match that.
-      numeric_queries = sorted(numeric_queries, key=str)
+    # Each stream is split into chunks, which are queried in parallel.  The
+    # id queries are sorted first, so matches of one Change-ID prefix stay
+    # within the same chunk.
+    size = self._QUERY_CHUNK_SIZE
+    tasks = [[self._QueryNumericChunk, numeric_queries[i:i + size]]
+             for i in xrange(0, len(numeric_queries), size)]
+    tasks += [[self._QueryIdChunk, id_queries[i:i + size]]
+              for i in xrange(0, len(id_queries), size)]
+    for results in parallel.IterTasksInThreads(lambda f, chunk: f(chunk),
+                                               tasks,
+                                               threads=self._QUERY_THREADS):
+      for query, result in results:
+        yield query, result
 
-      for query, result in itertools.izip_longest(numeric_queries, results):
-        if result is None or result.gerrit_number != query:
-          raise GerritException('Change number %s not found on server %s.'
-                                 % (query, self.host))
+  def _QueryNumericChunk(self, numeric_queries):
+    """Return (query, patch) pairs for a list of change numbers."""
+    query = ' OR '.join('change:%s' % x for x in numeric_queries)
+    results = self.Query(query, sort='number')
 
-        yield query, result
+    # Sort via alpha comparison, rather than integer; Query sorts via the
+    # raw textual field, thus we need to match that.
+    numeric_queries = sorted(numeric_queries, key=str)
 
-    id_queries = sorted(cros_patch.FormatPatchDep(x, sha1=False)
-                        for x in queries if not x.isdigit())
+    pairs = []
+    for query, result in itertools.izip_longest(numeric_queries, results):
+      if result is None or result.gerrit_number != query:
+        raise GerritException('Change number %s not found on server %s.'
+                               % (query, self.host))
 
-    if not id_queries:
-      return
+      pairs.append((query, result))
+    return pairs
 
+  def _QueryIdChunk(self, id_queries):
+    """Return (query, patch) pairs for a sorted list of Change-IDs."""
     results = self.Query(' OR '.join('change:%s' % x for x in id_queries),
                          sort='id')
 
+    pairs = []
     last_patch_id = None
     for query, result in itertools.izip_longest(id_queries, results):
       # case insensitivity to ensure that if someone queries for IABC
@@ -405,8 +639,9 @@ class GerritHelper(object):
             'back multiple results.  Please be more specific.  Server=%s'
             % (last_patch_id, self.host))
 
-      yield query, result
+      pairs.append((query, result))
       last_patch_id = query
+    return pairs
 
   @property
   def version(self):
@@ -511,21 +746,27 @@ def GetGerritPatchInfo(patches):
   internal_patches = [x for x in patches if x.startswith('*')]
   external_patches = [x for x in patches if not x.startswith('*')]
 
+  def _Query(remote, queries, prefix=''):
+    helper = GerritHelper.FromRemote(remote)
+    return [(prefix + k, v)
+            for k, v in helper.QueryMultipleCurrentPatchset(queries)]
+
+  # Both gerrit servers are queried at the same time.
+  tasks = []
   if internal_patches:
     # feed it id's w/ * stripped off, but bind them back
     # so that we can return patches in the supplied ordering.
     # while this may seem silly, we do this to preclude the potential
     # of a conflict between gerrit instances.  Since change-id is
     # effectively user controlled, better safe than sorry.
-    helper = GerritHelper.FromRemote(constants.INTERNAL_REMOTE)
     raw_ids = [x[1:] for x in internal_patches]
-    parsed_patches.update(('*' + k, v) for k, v in
-        helper.QueryMultipleCurrentPatchset(raw_ids))
+    tasks.append([constants.INTERNAL_REMOTE, raw_ids, '*'])
 
   if external_patches:
-    helper = GerritHelper.FromRemote(constants.EXTERNAL_REMOTE)
-    parsed_patches.update(
-        helper.QueryMultipleCurrentPatchset(external_patches))
+    tasks.append([constants.EXTERNAL_REMOTE, external_patches])
+
+  for results in parallel.IterTasksInThreads(_Query, tasks):
+    parsed_patches.update(results)
 
   seen = set()
   results = []
@@ -8,6 +8,7 @@
 
 import mox
 import os
+import socket
 import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
     os.path.abspath(__file__)))))
@@ -351,6 +352,37 @@ class GerritQueryTests(cros_test_lib.MoxTestCase):
        patch is returned"""
     self._common_test(['2144', 'Icb8e1d'], calls_allowed=2)
 
+  def testChunkedQueries(self):
+    """Chunks of changes are queried separately, and results are cached."""
+    helper = gerrit.GerritHelper.FromRemote(constants.EXTERNAL_REMOTE)
+    helper._QUERY_CHUNK_SIZE = 1
+
+    output_obj = cros_build_lib.CommandResult()
+    output_obj.returncode = 0
+    output_obj.output = self.result
+    for query in ('change:2144', 'change:Icb8e1d'):
+      cros_build_lib.RunCommand(
+          mox.In(query), redirect_stdout=True).InAnyOrder().AndReturn(
+              output_obj)
+
+    self.mox.ReplayAll()
+
+    results = dict(helper.QueryMultipleCurrentPatchset(['2144', 'Icb8e1d']))
+    self.assertEquals(sorted(results), ['2144', 'Icb8e1d'])
+    self.assertEquals(results['2144'].ref, 'refs/changes/44/2144/3')
+
+    # The change number is now answered without asking gerrit.
+    self.assertEquals(helper.GetCachedPatchset(2144).ref,
+                      'refs/changes/44/2144/3')
+    results = dict(helper.QueryMultipleCurrentPatchset(['2144']))
+    self.assertEquals(results['2144'].change_id,
+                      'Icb8e1d315d465a077ffcddd7d1ab2307573017d5')
+    self.mox.VerifyAll()
+
+    # Until the cached result expires.
+    helper._patchset_cache['2144'] = (0, results['2144'])
+    self.assertEquals(helper.GetCachedPatchset('2144'), None)
+
   def testPatchInfoParsing(self):
     """Test parsing of the JSON results."""
     patches = ['Icb8e1d315d465a07']
@@ -371,5 +403,109 @@ class GerritQueryTests(cros_test_lib.MoxTestCase):
     self.mox.VerifyAll()
 
 
+class SshConnectionPoolTest(cros_test_lib.MoxTempDirTestCase):
+  """Tests for the shared ssh connections."""
+
+  def setUp(self):
+    self.pool = gerrit.SshConnectionPool(
+        control_dir=os.path.join(self.tempdir, 'ssh'))
+    self.control_path = self.pool.GetControlPath('gerrit', 29418)
+    self.masters = []
+    self.stubs.Set(self.pool, '_StartMaster', self._StartMaster)
+
+  def _StartMaster(self, *args):
+    """Pretend to start an ssh master, remembering the connection."""
+    self.masters.append(args)
+    return True
+
+  def _Listen(self):
+    """Pretend to be an ssh master listening on the control socket."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(self.control_path)
+    sock.listen(1)
+    return sock
+
+  def testSshPrefix(self):
+    """GerritHelper commands share the pool's connection."""
+    helper = gerrit.GerritHelper('gerrit', 'cros', ssh_user='bot',
+                                 ssh_pool=self.pool)
+    prefix = helper.ssh_prefix
+    control_path = self.pool.GetControlPath('gerrit', 29418, user='bot')
+    self.assertEqual(prefix[prefix.index('ControlPath=%s' % control_path) - 1],
+                     '-o')
+    self.assertTrue('ControlMaster=no' in prefix)
+    self.assertEqual(prefix[-3:], ['gerrit', '-l', 'bot'])
+    self.assertNotEqual(control_path, self.control_path)
+
+    helper = gerrit.GerritHelper('gerrit', 'cros', ssh_pool=False)
+    self.assertEqual(helper.ssh_prefix, ['ssh', '-p', '29418', 'gerrit'])
+
+  def testHealthCheck(self):
+    """Stale control sockets are removed; live ones are kept."""
+    self.pool.GetSshOptions('gerrit', 29418)
+    self.assertFalse(self.pool.IsAlive(self.control_path))
+    self.assertEqual(len(self.masters), 1)
+
+    sock = self._Listen()
+    self.assertTrue(self.pool.IsAlive(self.control_path))
+    self.pool.GetSshOptions('gerrit', 29418)
+    self.assertTrue(os.path.exists(self.control_path))
+    self.assertEqual(len(self.masters), 1)
+
+    # The master died without removing its socket.
+    sock.close()
+    self.assertFalse(self.pool.IsAlive(self.control_path))
+    self.pool.GetSshOptions('gerrit', 29418)
+    self.assertFalse(os.path.exists(self.control_path))
+    self.assertEqual(self.masters[-1],
+                     ('gerrit', 29418, None, self.control_path))
+
+  def testNotPrivate(self):
+    """Control dirs that others could plant sockets in are not used."""
+    os.makedirs(self.pool.control_dir)
+    os.chmod(self.pool.control_dir, 0755)
+    self.assertEqual(self.pool.GetSshOptions('gerrit', 29418), [])
+
+    os.rmdir(self.pool.control_dir)
+    os.makedirs(os.path.join(self.tempdir, 'elsewhere'), 0700)
+    os.symlink('elsewhere', self.pool.control_dir)
+    self.assertEqual(self.pool.GetSshOptions('gerrit', 29418), [])
+    self.assertEqual(self.masters, [])
+
+  def testStartMaster(self):
+    """The master is detached from our stdio, and not retried on failure."""
+    self.stubs.UnsetAll()
+    self.mox.StubOutWithMock(cros_build_lib, 'RunCommand')
+    cros_build_lib.RunCommand(
+        ['ssh', '-MNf', '-p', '29418',
+         '-o', 'ControlPath=%s' % self.control_path,
+         '-o', 'ControlPersist=%d' % self.pool.persist, 'gerrit'],
+        error_code_ok=True, print_cmd=False, log_stdout_to_file=os.devnull,
+        combine_stdout_stderr=True).AndReturn(
+            cros_build_lib.CommandResult(returncode=255))
+    self.mox.ReplayAll()
+    for _ in range(2):
+      self.assertEqual(self.pool.GetSshOptions('gerrit', 29418),
+                       ['-o', 'ControlMaster=no',
+                        '-o', 'ControlPath=%s' % self.control_path])
+    self.mox.VerifyAll()
+
+  def testClose(self):
+    """Only live masters used by this process are shut down."""
+    self.pool.GetSshOptions('gerrit', 29418)
+    self.pool.GetSshOptions('other-gerrit', 29418)
+    sock = self._Listen()
+    self.mox.StubOutWithMock(cros_build_lib, 'RunCommand')
+    cros_build_lib.RunCommand(
+        ['ssh', '-O', 'exit', '-o', 'ControlPath=%s' % self.control_path,
+         'gerrit'], error_code_ok=True, print_cmd=False, redirect_stdout=True,
+        redirect_stderr=True)
+    self.mox.ReplayAll()
+    self.pool.Close()
+    self.pool.Close()
+    self.mox.VerifyAll()
+    sock.close()
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
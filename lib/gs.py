@@ -5,13 +5,30 @@
 """Library to make common google storage operations more reliable.
 """
 
+import base64
+import binascii
+import hashlib
 import logging
+import multiprocessing
 import os
+import re
+import stat
+import tempfile
+import time
 
 from chromite.buildbot import constants
 from chromite.lib import cache
 from chromite.lib import cros_build_lib
 from chromite.lib import osutils
+from chromite.lib import parallel
+
+# crcmod is shipped with newer gsutils; without it we can only compare md5s,
+# which composite objects don't have.
+try:
+  import crcmod.predefined
+  _Crc32c = crcmod.predefined.mkCrcFun('crc-32c')
+except ImportError:
+  _Crc32c = None
 
 
 # Default pathway; stored here rather than usual buildbot.constants since
@@ -24,6 +41,33 @@ PUBLIC_BASE_HTTPS_URL = 'https://commondatastorage.googleapis.com/'
 PRIVATE_BASE_HTTPS_URL = 'https://sandbox.google.com/storage/'
 BASE_GS_URL = 'gs://'
 
+# Files at least this big are uploaded via parallel composite uploads.
+COMPOSITE_UPLOAD_THRESHOLD = 512 * 1024 * 1024
+# Default size of a single component of a composite upload.
+COMPOSITE_CHUNK_SIZE = 128 * 1024 * 1024
+# GS accepts at most this many components in a single compose request.
+MAX_COMPOSE_COMPONENTS = 32
+# Size of the blocks read when hashing local files.
+_HASH_BLOCK_SIZE = 1024 * 1024
+# Hashes of files modified less than this many seconds ago aren't cached, as
+# the file may be modified again without changing its timestamp.
+_HASH_CACHE_MIN_AGE = 2
+
+# Bytes not uploaded because the remote object was already identical, by any
+# GSContext of this process or of the processes it forks.  Created by
+# _GetBytesSkippedCounter, so that importing this module stays cheap.
+_bytes_skipped = None
+
+# How long (in seconds) MetadataCache trusts lookups of mutable paths.
+METADATA_CACHE_TTL = 60
+# Paths that never change once written: versioned manifests, and the metadata
+# and crash reports of a versioned build.
+IMMUTABLE_PATH_PATTERNS = (
+    re.compile(r'/\d+\.\d+\.\d+(-rc\d+)?\.xml$'),
+    re.compile(r'/R\d+-\d+\.\d+\.\d+[^/]*/metadata\.json$'),
+    re.compile(r'/R\d+-\d+\.\d+\.\d+[^/]*/[^/]+\.dmp\.txt$'),
+)
+
 
 def CanonicalizeURL(url, strict=False):
   """Convert provided URL to gs:// URL, if it follows a known format.
@@ -71,6 +115,175 @@ class GSNoSuchKey(GSContextException):
   """Thrown when google storage returns code=NoSuchKey."""
 
 
+class GSChecksumMismatch(GSContextException):
+  """Thrown when a remote object's checksum doesn't match the local data."""
+
+
+def GetCacheDir(*parts):
+  """Return a private dir under the chromite cache for keeping state in.
+
+  The cache dir configured in $CROS_CACHEDIR is used if there is one, and a
+  per-user dir in the system tempdir otherwise.  Callers trust what they read
+  back from the dir, so it is created with mode 0700, and it is only used if
+  it, and the dirs above it up to the cache, are owned by the current user
+  and not writable by anyone else.
+
+  Args:
+    parts: The path of the dir, relative to the common cache.
+
+  Returns:
+    The path of the dir, or None if it isn't private to the current user.
+  """
+  base = os.environ.get(constants.SHARED_CACHE_ENVVAR)
+  if base is None:
+    base = top = os.path.join(tempfile.gettempdir(),
+                              'chromite-cache-%d' % os.getuid())
+  else:
+    top = os.path.join(base, constants.COMMON_CACHE)
+  path = os.path.join(base, constants.COMMON_CACHE, *parts)
+  try:
+    osutils.SafeMakedirs(path, mode=0o700)
+    current = path
+    while True:
+      st = os.lstat(current)
+      if (stat.S_ISLNK(st.st_mode) or st.st_uid != os.getuid() or
+          st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        logging.warning('Not caching in %s: %s may be modified by other users',
+                        path, current)
+        return None
+      if current == top:
+        return path
+      current = os.path.dirname(current)
+  except EnvironmentError as e:
+    logging.warning('Not caching in %s: %s', path, e)
+    return None
+
+
+def _Base64ToHex(value):
+  """Convert a base64 encoded hash as printed by gsutil into hex."""
+  return binascii.hexlify(base64.b64decode(value))
+
+
+def ParseLsLong(output):
+  """Parse the output of `gsutil ls -L` into per-object metadata.
+
+  Both the older (ETag/Object size) and the newer (Hash (md5)/Content-Length)
+  output formats are understood.
+
+  Args:
+    output: The stdout of `gsutil ls -L <urls>`.
+
+  Returns:
+    A dict mapping each listed gs:// url to a dict that may hold the keys
+    'md5' and 'crc32c' (hex encoded), 'size' (an int), and 'generation'.
+  """
+  objects = {}
+  current = None
+  for line in output.splitlines():
+    if line.startswith(BASE_GS_URL) and line.rstrip().endswith(':'):
+      current = objects.setdefault(line.rstrip()[:-1], {})
+      continue
+    if current is None or ':' not in line:
+      continue
+    key, value = [x.strip() for x in line.split(':', 1)]
+    key = key.lower()
+    if key == 'hash (md5)':
+      current['md5'] = _Base64ToHex(value)
+    elif key == 'hash (crc32c)':
+      current['crc32c'] = _Base64ToHex(value)
+    elif key == 'etag' and len(value) == 32:
+      # Old gsutil; for non-composite objects the ETag is the hex md5.
+      current.setdefault('md5', value.lower())
+    elif key in ('content-length', 'object size'):
+      current['size'] = int(value)
+    elif key == 'generation':
+      current['generation'] = value
+  return objects
+
+
+def Md5File(path, offset=0, length=None):
+  """Return the hex md5 of |path|, optionally just the given byte range."""
+  md5 = hashlib.md5()
+  with open(path, 'rb') as f:
+    f.seek(offset)
+    remaining = length
+    while remaining is None or remaining > 0:
+      size = _HASH_BLOCK_SIZE
+      if remaining is not None:
+        size = min(size, remaining)
+        remaining -= size
+      data = f.read(size)
+      if not data:
+        break
+      md5.update(data)
+  return md5.hexdigest()
+
+
+def _GetBytesSkippedCounter():
+  """Return the shared counter of the bytes skipped, creating it if needed."""
+  global _bytes_skipped
+  if _bytes_skipped is None:
+    _bytes_skipped = multiprocessing.Value('L', 0)
+  return _bytes_skipped
+
+
+def GetBytesSkipped():
+  """Return how many bytes uploads skipped as unchanged during this run.
+
+  This counts the uploads of all GSContexts of this process, and of the
+  processes it forked after the first call of this function (or the first
+  skipped upload), so call it before forking to count the children too.
+  """
+  return _GetBytesSkippedCounter().value
+
+
+def GetLocalHashes(path, cache_dir=None):
+  """Return the md5 (and crc32c if available) of a local file.
+
+  The hashes are cached on disk keyed by (path, size, inode, mtime, ctime),
+  so files that haven't changed since the last call aren't read again.  Files
+  modified in the last few seconds aren't cached, since they can change again
+  within the resolution of the timestamps.
+
+  Args:
+    path: Path to the local file.
+    cache_dir: Where to keep the hash cache; defaults to the shared cache.
+
+  Returns:
+    A dict with the hex encoded 'md5' and, if crcmod is available, 'crc32c'.
+  """
+  if cache_dir is None:
+    cache_dir = GetCacheDir('gs', 'hashes')
+  path = os.path.abspath(path)
+  st = os.stat(path)
+  entry = None
+  if time.time() - st.st_mtime < _HASH_CACHE_MIN_AGE:
+    cache_dir = None
+  if cache_dir is not None:
+    key = '%s\0%d\0%d\0%r\0%r' % (path, st.st_size, st.st_ino, st.st_mtime,
+                                 st.st_ctime)
+    entry = os.path.join(cache_dir, hashlib.sha1(key).hexdigest())
+    if os.path.exists(entry):
+      hashes = dict(x.split('=', 1) for x in osutils.ReadFile(entry).split())
+      if 'crc32c' in hashes or _Crc32c is None:
+        return hashes
+
+  md5 = hashlib.md5()
+  crc = 0
+  with open(path, 'rb') as f:
+    for data in iter(lambda: f.read(_HASH_BLOCK_SIZE), ''):
+      md5.update(data)
+      if _Crc32c is not None:
+        crc = _Crc32c(data, crc)
+  hashes = {'md5': md5.hexdigest()}
+  if _Crc32c is not None:
+    hashes['crc32c'] = '%08x' % crc
+  if entry is not None:
+    osutils.WriteFile(entry, ' '.join('%s=%s' % x for x in hashes.iteritems()),
+                      atomic=True, makedirs=True)
+  return hashes
+
+
 class GSContext(object):
   """A class to wrap common google storage operations."""
 
@@ -135,7 +348,8 @@ class GSContext(object):
     """Constructor.
 
     Args:
-      boto_file: Fully qualified path to user's .boto credential file.
+      boto_file: Fully qualified path to user's .boto credential file.  If
+        empty, gsutil is left to find its configuration by itself.
       acl_file: A permission file capable of setting different permissions
         for different sets of users.
       dry_run: Testing mode that prints commands that would be run.
@@ -162,12 +376,16 @@ class GSContext(object):
     self.acl_file = acl_file
 
     self.dry_run = dry_run
+    # Bytes this context didn't upload because the remote object was already
+    # identical; see GetBytesSkipped for the total of the run.
+    self.bytes_skipped = 0
     self._retries = self.DEFAULT_RETRIES if retries is None else int(retries)
     self._sleep_time = self.DEFAULT_SLEEP_TIME if sleep is None else int(sleep)
 
-    if init_boto:
-      self._InitBoto()
-    self._CheckFile('Boto credentials not found', self.boto_file)
+    if self.boto_file:
+      if init_boto:
+        self._InitBoto()
+      self._CheckFile('Boto credentials not found', self.boto_file)
 
   def _CheckFile(self, errmsg, afile):
     """Pre-flight check for valid inputs.
@@ -207,7 +425,7 @@ class GSContext(object):
     return self._DoCommand(['cat', path], redirect_stdout=True)
 
   def CopyInto(self, local_path, remote_dir, filename=None, acl=None,
-               version=None):
+               version=None, skip_unchanged=False):
     """Upload a local file into a directory in google storage.
 
     Args:
@@ -223,13 +441,14 @@ class GSContext(object):
         is what we expect.  This is useful for distributed reasons- for example,
         to ensure you don't overwrite someone else's creation, a version of
         0 states "only update if no version exists".
+      skip_unchanged: See Copy.
     """
     filename = filename if filename is not None else local_path
     # Basename it even if an explicit filename was given; we don't want
     # people using filename as a multi-directory path fragment.
     return self.Copy(local_path,
                       '%s/%s' % (remote_dir, os.path.basename(filename)),
-                      acl=acl, version=version)
+                      acl=acl, version=version, skip_unchanged=skip_unchanged)
 
   def _RunCommand(self, cmd, **kwargs):
     try:
@@ -261,16 +480,61 @@ class GSContext(object):
       retries = self._retries
 
     extra_env = kwargs.pop('extra_env', {})
-    extra_env.setdefault('BOTO_CONFIG', self.boto_file)
+    if self.boto_file:
+      extra_env.setdefault('BOTO_CONFIG', self.boto_file)
 
     if self.dry_run:
       logging.debug("%s: would've ran %r", self.__class__.__name__, cmd)
+    elif not retries:
+      # RetryCommand wraps even a single failure in a generic Exception;
+      # without retries, let callers see what went wrong.
+      return self._RunCommand(cmd, extra_env=extra_env, **kwargs)
     else:
       return cros_build_lib.RetryCommand(
           self._RunCommand, retries, cmd, sleep=self._sleep_time,
           extra_env=extra_env, **kwargs)
 
-  def Copy(self, src_path, dest_path, acl=None, version=None, **kwargs):
+  def IsUpToDate(self, local_path, remote_path):
+    """Return True if |remote_path| holds exactly the bytes of |local_path|.
+
+    Either md5 or crc32c is used, whichever both sides have.  Missing remote
+    objects, or objects we can't compare, are considered out of date.
+    """
+    # `gsutil ls` of a missing object reports that it "matched no objects"
+    # rather than NoSuchKey, so don't retry: any failure means "upload it".
+    try:
+      remote = self.Stat(remote_path, retries=0).get(remote_path)
+    except (GSContextException, cros_build_lib.RunCommandError):
+      return False
+    if not remote or remote.get('size') != os.path.getsize(local_path):
+      return False
+    local = GetLocalHashes(local_path)
+    for name in ('md5', 'crc32c'):
+      if name in local and name in remote:
+        return local[name] == remote[name]
+    return False
+
+  def _SkipUnchanged(self, local_path, remote_path, acl=None):
+    """Return True, and account for it, if the upload can be skipped.
+
+    If it is skipped, |acl| is still applied to |remote_path|.
+    """
+    if self.dry_run or not self.IsUpToDate(local_path, remote_path):
+      return False
+    size = os.path.getsize(local_path)
+    self.bytes_skipped += size
+    counter = _GetBytesSkippedCounter()
+    with counter.get_lock():
+      counter.value += size
+    logging.info('Skipping upload of %s; %s is identical (%d bytes saved, '
+                 '%d this run).', local_path, remote_path, size, counter.value)
+    # The object may have been uploaded with a different ACL.
+    if acl is not None:
+      self.SetACL(remote_path, acl=acl)
+    return True
+
+  def Copy(self, src_path, dest_path, acl=None, version=None,
+           skip_unchanged=False, **kwargs):
     """Copy to/from GS bucket.
 
     Canned ACL permissions can be specified on the gsutil cp command line.
@@ -290,12 +554,20 @@ class GSContext(object):
         is what we expect.  This is useful for distributed reasons- for example,
         to ensure you don't overwrite someone else's creation, a version of
         0 states "only update if no version exists".
+      skip_unchanged: If True and |src_path| is local, don't upload it when
+        the md5/crc32c of |dest_path| already matches; |acl| is still
+        applied.  See GetBytesSkipped.
 
     Raises:
       RunCommandError if the command failed despite retries.
     Returns:
-      Return the CommandResult from the run.
+      Return the CommandResult from the run, or None if it was skipped.
     """
+    acl = self.acl_file if acl is None else acl
+    if (skip_unchanged and not src_path.startswith(BASE_GS_URL) and
+        self._SkipUnchanged(src_path, dest_path, acl=acl)):
+      return None
+
     cmd, headers = [], []
 
     if version is not None:
@@ -303,7 +575,6 @@ class GSContext(object):
 
     cmd.append('cp')
 
-    acl = self.acl_file if acl is None else acl
     if acl is not None:
       cmd += ['-a', acl]
 
@@ -318,6 +589,153 @@ class GSContext(object):
     """Does a directory listing of the given gs path."""
     return self._DoCommand(['ls', '--', path], redirect_stdout=True)
 
+  def Stat(self, *paths, **kwargs):
+    """Return the metadata of the given gs objects.
+
+    Args:
+      paths: Full gs:// urls to look up.
+      retries: If given, how often to retry instead of the context's default.
+
+    Returns:
+      A dict mapping each gs:// url to its metadata; see ParseLsLong.
+    """
+    result = self._DoCommand(['ls', '-L', '--'] + list(paths),
+                             retries=kwargs.get('retries'),
+                             redirect_stdout=True)
+    return ParseLsLong(result.output) if result else {}
+
+  def Remove(self, *paths, **kwargs):
+    """Remove the given gs objects.
+
+    Args:
+      paths: Full gs:// urls to remove.
+      ignore_missing: If True, don't raise if an object doesn't exist.
+    """
+    try:
+      self._DoCommand(['rm', '--'] + list(paths), redirect_stderr=True)
+    except GSNoSuchKey:
+      if not kwargs.get('ignore_missing', False):
+        raise
+
+  def Compose(self, sources, dest_path):
+    """Concatenate the |sources| gs objects into the object |dest_path|."""
+    return self._DoCommand(['compose'] + list(sources) + [dest_path],
+                           redirect_stderr=True)
+
+  def _UploadCompositeChunk(self, local_path, offset, length, component_url,
+                            state_dir):
+    """Upload a single byte range of |local_path| as a component object.
+
+    Chunks whose checksum was already recorded in |state_dir| by a previous
+    (interrupted) attempt are not uploaded again.
+    """
+    marker = os.path.join(state_dir, os.path.basename(component_url))
+    if (os.path.exists(marker) and
+        osutils.ReadFile(marker) == Md5File(local_path, offset, length)):
+      logging.debug('Reusing previously uploaded chunk %s', component_url)
+      return
+
+    # gsutil only uploads whole files, or stdin, which RunCommand would have
+    # to hold in memory and which gsutil can't resume; so the range is copied
+    # to a file of its own.  It is hashed while it is copied, so that it is
+    # only read once.
+    chunk_path = marker + '.data'
+    md5 = hashlib.md5()
+    with open(local_path, 'rb') as src:
+      src.seek(offset)
+      with open(chunk_path, 'wb') as dst:
+        remaining = length
+        while remaining > 0:
+          data = src.read(min(remaining, _HASH_BLOCK_SIZE))
+          if not data:
+            break
+          dst.write(data)
+          md5.update(data)
+          remaining -= len(data)
+    md5 = md5.hexdigest()
+    try:
+      self.Copy(chunk_path, component_url, acl='private')
+    finally:
+      osutils.SafeUnlink(chunk_path)
+
+    if not self.dry_run:
+      remote_md5 = self.Stat(component_url).get(component_url, {}).get('md5')
+      if remote_md5 != md5:
+        raise GSChecksumMismatch('%s: expected md5 %s, got %s'
+                                 % (component_url, md5, remote_md5))
+    osutils.WriteFile(marker, md5, atomic=True)
+
+  def ParallelCompositeUpload(self, local_path, dest_path, acl=None,
+                              chunk_size=COMPOSITE_CHUNK_SIZE, processes=None,
+                              state_dir=None, skip_unchanged=False):
+    """Upload a large file as parallel chunks that are then composed.
+
+    The checksum of every finished chunk is recorded on local disk, so if the
+    upload is interrupted, rerunning it only uploads the missing chunks.  All
+    chunk checksums are verified against GS before the final compose.
+
+    Args:
+      local_path: Fully qualified path of the local file to upload.
+      dest_path: Full gs:// path of the destination object.
+      acl: One of the google storage canned_acls, or an acl file, to apply to
+        the final object.  Defaults to the acl_file given to the constructor.
+      chunk_size: Size of each component in bytes.  This is raised if needed
+        to keep within the MAX_COMPOSE_COMPONENTS limit.
+      processes: Number of chunks to upload at the same time.
+      state_dir: Where to keep the resume state; by default a directory in
+        the shared cache (see GetCacheDir) that is unique to (local_path,
+        dest_path, size, inode, mtime, ctime).
+      skip_unchanged: See Copy.  Composite objects only carry a crc32c, so
+        this needs crcmod to be available.
+
+    Raises:
+      GSChecksumMismatch if an uploaded chunk doesn't match the local data.
+      RunCommandError if a gsutil command failed despite retries.
+    """
+    acl = self.acl_file if acl is None else acl
+    if skip_unchanged and self._SkipUnchanged(local_path, dest_path, acl=acl):
+      return
+
+    st = os.stat(local_path)
+    if state_dir is None:
+      key = '%s\0%s\0%d\0%d\0%r\0%r' % (local_path, dest_path, st.st_size,
+                                       st.st_ino, st.st_mtime, st.st_ctime)
+      state_dir = GetCacheDir('gs', 'uploads', hashlib.sha1(key).hexdigest())
+      if state_dir is None:
+        # Without a private place to keep it, the upload can't be resumed.
+        state_dir = tempfile.mkdtemp(prefix='gs-upload')
+    osutils.SafeMakedirs(state_dir)
+
+    chunk_size = max(chunk_size,
+                     -(-st.st_size // MAX_COMPOSE_COMPONENTS), 1)
+    inputs = []
+    for i, offset in enumerate(xrange(0, max(st.st_size, 1), chunk_size)):
+      component_url = '%s_gscomposite_%03d' % (dest_path, i)
+      length = min(chunk_size, st.st_size - offset)
+      inputs.append([local_path, offset, length, component_url, state_dir])
+    components = [x[3] for x in inputs]
+
+    parallel.RunTasksInProcessPool(self._UploadCompositeChunk, inputs,
+                                   processes=processes)
+
+    if not self.dry_run:
+      # Recheck everything in case a chunk was reused from a stale state dir.
+      remote = self.Stat(*components)
+      for component_url in components:
+        marker = os.path.join(state_dir, os.path.basename(component_url))
+        expected = osutils.ReadFile(marker)
+        actual = remote.get(component_url, {}).get('md5')
+        if actual != expected:
+          osutils.SafeUnlink(marker)
+          raise GSChecksumMismatch('%s: expected md5 %s, got %s'
+                                   % (component_url, expected, actual))
+
+    self.Compose(components, dest_path)
+    if acl is not None:
+      self.SetACL(dest_path, acl=acl)
+    self.Remove(*components, ignore_missing=True)
+    osutils.RmDir(state_dir, ignore_missing=True)
+
   def SetACL(self, upload_url, acl=None):
     """Set access on a file already in google storage.
 
@@ -349,5 +767,131 @@ class GSContext(object):
       return False
     return True
 
+
+class MetadataCache(object):
+  """Caches the results of Cat/LS/Exists lookups against google storage.
+
+  Objects matching IMMUTABLE_PATH_PATTERNS (or explicitly stored as immutable)
+  are cached on disk forever, so they are shared by later runs.  Everything
+  else is kept in memory for |ttl| seconds.  Failed lookups are never cached.
+
+  Entries are plain strings; callers must not store anything on disk that is
+  unsafe to load (e.g. pickles), even though the cache dir is private.
+  """
+
+  def __init__(self, ctx=None, cache_dir=None, ttl=METADATA_CACHE_TTL,
+               immutable_patterns=IMMUTABLE_PATH_PATTERNS):
+    """Constructor.
+
+    Args:
+      ctx: The GSContext to run lookups with; one is created if needed.
+      cache_dir: Where to keep immutable entries; defaults to the shared cache
+        (see GetCacheDir).  If there is none, they are only kept in memory.
+      ttl: Seconds that results for mutable paths are trusted.
+      immutable_patterns: Regexes matching paths that never change.
+    """
+    self._ctx = ctx
+    if cache_dir is None:
+      cache_dir = GetCacheDir('gs', 'metadata')
+    self.cache_dir = cache_dir
+    self.ttl = ttl
+    self.immutable_patterns = immutable_patterns
+    self._entries = {}
+
+  @property
+  def ctx(self):
+    if self._ctx is None:
+      self._ctx = GSContext()
+    return self._ctx
+
+  def IsImmutable(self, path):
+    """Return True if |path| never changes once written."""
+    return any(x.search(path) for x in self.immutable_patterns)
+
+  def _GetEntryPath(self, op, path):
+    return os.path.join(self.cache_dir,
+                        hashlib.sha1('%s\0%s' % (op, path)).hexdigest())
+
+  def Lookup(self, op, path):
+    """Return the cached result of |op| on |path|, or None."""
+    entry = self._entries.get((op, path))
+    if entry is not None:
+      expires, value = entry
+      if expires is None or time.time() < expires:
+        return value
+      del self._entries[(op, path)]
+
+    if self.cache_dir is None:
+      return None
+    entry_path = self._GetEntryPath(op, path)
+    if os.path.exists(entry_path):
+      value = osutils.ReadFile(entry_path)
+      self._entries[(op, path)] = (None, value)
+      return value
+    return None
+
+  def Insert(self, op, path, value, immutable=None):
+    """Store the result of |op| on |path|.
+
+    Args:
+      op: Name of the lookup, e.g. 'cat'.
+      path: The gs:// path the lookup was for.
+      value: The (string) result.
+      immutable: Whether the result can be kept forever; if None, this is
+        decided by IsImmutable.
+    """
+    if immutable is None:
+      immutable = self.IsImmutable(path)
+    if immutable:
+      if self.cache_dir is not None:
+        osutils.WriteFile(self._GetEntryPath(op, path), value, atomic=True,
+                          makedirs=True)
+      self._entries[(op, path)] = (None, value)
+    else:
+      self._entries[(op, path)] = (time.time() + self.ttl, value)
+
+  def Invalidate(self, path=None):
+    """Forget cached results for |path|, or for everything if None."""
+    if path is None:
+      self._entries.clear()
+      if self.cache_dir is not None:
+        osutils.RmDir(self.cache_dir, ignore_missing=True)
+      return
+    for op in ('cat', 'ls', 'exists'):
+      self._entries.pop((op, path), None)
+      if self.cache_dir is not None:
+        osutils.SafeUnlink(self._GetEntryPath(op, path))
+
+  def Cat(self, path):
+    """Return the contents of a GS object."""
+    value = self.Lookup('cat', path)
+    if value is None:
+      value = self.ctx.Cat(path).output
+      self.Insert('cat', path, value)
+    return value
+
+  def LS(self, path):
+    """Return the list of gs:// urls matching |path|."""
+    value = self.Lookup('ls', path)
+    if value is None:
+      value = self.ctx.LS(path).output
+      # Listings of a directory change as objects are added to it.
+      self.Insert('ls', path, value, immutable=False)
+    return value.splitlines()
+
+  def Exists(self, path):
+    """Return True if the GS object exists."""
+    value = self.Lookup('exists', path)
+    if value is None:
+      exists = self.ctx.Exists(path)
+      if not exists:
+        return False
+      # An object that exists now may still be deleted later, unless it's
+      # immutable; a missing object may show up at any time.
+      value = '1'
+      self.Insert('exists', path, value)
+    return value == '1'
+
+
 # Set GSUTIL_BIN now.
 GSUTIL_BIN = GSContext.GetDefaultGSUtilBin()
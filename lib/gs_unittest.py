@@ -7,16 +7,20 @@
 """Unittests for the gs.py module."""
 
 import functools
+import hashlib
 import os
 import sys
+import time
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
     os.path.abspath(__file__)))))
 
+from chromite.buildbot import constants
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_build_lib_unittest
 from chromite.lib import cros_test_lib
 from chromite.lib import gs
 from chromite.lib import osutils
+from chromite.lib import parallel
 from chromite.lib import partial_mock
 
 # TODO(build): Finish test wrapper (http://crosbug.com/37517).
@@ -152,6 +156,97 @@ class CopyTest(AbstractGSContextTest):
     self.assertRaises(gs.GSContextException, self.Copy)
 
 
+class SkipUnchangedCopyTest(AbstractGSContextTest):
+  """Tests GSContext.Copy(skip_unchanged=True)."""
+
+  REMOTE = 'gs://test/path/file'
+  DATA = 'hello world'
+  MD5 = '5eb63bbbe01eeed093cb22bb8f5acdc3'
+
+  def setUp(self):
+    self.local_path = os.path.join(self.tempdir, 'file')
+    osutils.WriteFile(self.local_path, self.DATA)
+    self.mtime = time.time() - 60
+    os.utime(self.local_path, (self.mtime, self.mtime))
+    self.hash_dir = os.path.join(self.tempdir, 'hashes')
+    self.PatchObject(gs, 'GetCacheDir', return_value=self.hash_dir)
+
+  def _SetRemote(self, md5, size=len(DATA)):
+    output = '%s:\n\tObject size:\t%d\n\tEtag:\t%s\n' % (
+        self.REMOTE, size, md5)
+    self.gs_mock.AddCmdResult(partial_mock.In('-L'), output=output)
+
+  def testSkip(self):
+    """Identical remote objects aren't uploaded again."""
+    self._SetRemote(self.MD5)
+    bytes_skipped = gs.GetBytesSkipped()
+    self.assertEqual(self.ctx.Copy(self.local_path, self.REMOTE,
+                                   skip_unchanged=True), None)
+    self.gs_mock.assertCommandContains(['cp'], expected=False)
+    self.assertEqual(self.ctx.bytes_skipped, len(self.DATA))
+    self.assertEqual(gs.GetBytesSkipped(), bytes_skipped + len(self.DATA))
+
+  def testSkipCreatesCounter(self):
+    """The shared counter of skipped bytes is created on first use."""
+    self.PatchObject(gs, '_bytes_skipped', None)
+    self._SetRemote(self.MD5)
+    self.ctx.Copy(self.local_path, self.REMOTE, skip_unchanged=True)
+    self.assertEqual(gs.GetBytesSkipped(), len(self.DATA))
+
+  def testSkipAppliesAcl(self):
+    """The acl is applied even if the upload is skipped."""
+    self._SetRemote(self.MD5)
+    self.ctx.Copy(self.local_path, self.REMOTE, acl='public-read',
+                  skip_unchanged=True)
+    self.gs_mock.assertCommandContains(['cp'], expected=False)
+    self.gs_mock.assertCommandContains(['setacl', 'public-read', self.REMOTE])
+
+  def testMissingRemote(self):
+    """Missing remote objects are uploaded without retrying the lookup."""
+    self.gs_mock.AddCmdResult(
+        partial_mock.In('-L'), returncode=1,
+        error='CommandException: One or more URLs matched no objects.')
+    sleep = self.PatchObject(time, 'sleep')
+    self.ctx.Copy(self.local_path, self.REMOTE, skip_unchanged=True)
+    self.gs_mock.assertCommandContains(['cp', self.local_path, self.REMOTE])
+    self.gs_mock.assertCommandContains(['ls', '-L'], retries=0)
+    self.assertFalse(sleep.called)
+
+  def testDifferentHash(self):
+    """Changed files are uploaded."""
+    self._SetRemote('0' * 32)
+    self.ctx.Copy(self.local_path, self.REMOTE, skip_unchanged=True)
+    self.gs_mock.assertCommandContains(['cp', self.local_path, self.REMOTE])
+    self.assertEqual(self.ctx.bytes_skipped, 0)
+
+  def testDifferentSize(self):
+    """Size mismatches are uploaded without hashing."""
+    self._SetRemote(self.MD5, size=1)
+    self.ctx.Copy(self.local_path, self.REMOTE, skip_unchanged=True)
+    self.gs_mock.assertCommandContains(['cp', self.local_path, self.REMOTE])
+    self.assertFalse(os.path.exists(self.hash_dir))
+
+  def testHashCache(self):
+    """Unchanged files are hashed only once."""
+    self.assertEqual(gs.GetLocalHashes(self.local_path)['md5'], self.MD5)
+    self.PatchObject(gs.hashlib, 'md5', side_effect=AssertionError)
+    self.assertEqual(gs.GetLocalHashes(self.local_path)['md5'], self.MD5)
+
+  def testHashCacheRewritten(self):
+    """Files rewritten with the same size and mtime are hashed again."""
+    gs.GetLocalHashes(self.local_path)
+    osutils.WriteFile(self.local_path, self.DATA.upper())
+    os.utime(self.local_path, (self.mtime, self.mtime))
+    self.assertEqual(gs.GetLocalHashes(self.local_path)['md5'],
+                     hashlib.md5(self.DATA.upper()).hexdigest())
+
+  def testRecentlyModified(self):
+    """Hashes of files that may still change are not cached."""
+    os.utime(self.local_path, None)
+    gs.GetLocalHashes(self.local_path)
+    self.assertFalse(os.path.exists(self.hash_dir))
+
+
 class CopyIntoTest(CopyTest):
   """Test CopyInto functionality."""
 
@@ -163,6 +258,194 @@ class CopyIntoTest(CopyTest):
     return ctx.CopyInto(*args, filename=self.FILE, **kwargs)
 
 
+class ParseLsLongTest(cros_test_lib.TestCase):
+  """Tests for ParseLsLong()."""
+
+  NEW_FORMAT = """\
+gs://test/path/file:
+\tCreation time:\tFri, 08 Feb 2013 20:28:46 GMT
+\tContent-Length:\t11
+\tContent-Type:\tapplication/octet-stream
+\tHash (crc32c):\tyZRlqg==
+\tHash (md5):\tXrY7u+Ae7tCTyyK7j1rNww==
+\tETag:\tCOjq0e3BmbUCEAE=
+\tGeneration:\t1360355326455000
+TOTAL: 1 objects, 11 bytes (11.00 B)
+"""
+
+  OLD_FORMAT = """\
+gs://test/path/other:
+\tObject size:\t11
+\tLast mod:\tFri, 08 Feb 2013 20:28:46 GMT
+\tMIME type:\tapplication/octet-stream
+\tEtag:\t5eb63bbbe01eeed093cb22bb8f5acdc3
+"""
+
+  def testNewFormat(self):
+    """Verify gsutil 3.2x+ output is parsed."""
+    self.assertEqual(gs.ParseLsLong(self.NEW_FORMAT), {
+        'gs://test/path/file': {
+            'size': 11,
+            'md5': '5eb63bbbe01eeed093cb22bb8f5acdc3',
+            'crc32c': 'c99465aa',
+            'generation': '1360355326455000',
+        }})
+
+  def testOldFormat(self):
+    """Verify the older ETag based output is parsed."""
+    self.assertEqual(gs.ParseLsLong(self.OLD_FORMAT), {
+        'gs://test/path/other': {
+            'size': 11,
+            'md5': '5eb63bbbe01eeed093cb22bb8f5acdc3',
+        }})
+
+
+class CompositeUploadTest(AbstractGSContextTest):
+  """Tests GSContext.ParallelCompositeUpload()."""
+
+  REMOTE = 'gs://test/path/file'
+  CHUNK_SIZE = 10
+
+  def setUp(self):
+    self.local_path = os.path.join(self.tempdir, 'file')
+    self.data = ''.join(chr(ord('a') + i) * self.CHUNK_SIZE for i in range(3))
+    osutils.WriteFile(self.local_path, self.data)
+    self.state_dir = os.path.join(self.tempdir, 'state')
+    self.components = ['%s_gscomposite_%03d' % (self.REMOTE, i)
+                       for i in range(3)]
+    self.remote_md5 = dict(
+        (url, hashlib.md5(self.data[i * 10:(i + 1) * 10]).hexdigest())
+        for i, url in enumerate(self.components))
+    self.gs_mock.AddCmdResult(partial_mock.In('-L'), side_effect=self._LsLong)
+    # Run the chunk uploads inline so the mock sees every command.
+    self.PatchObject(parallel, 'RunTasksInProcessPool',
+                     lambda task, inputs, **_kwargs: [task(*x) for x in inputs])
+
+  def _LsLong(self, _inst, cmd, **_kwargs):
+    output = ''.join('%s:\n\tEtag:\t%s\n' % (url, self.remote_md5[url])
+                     for url in cmd[3:])
+    return self.gs_mock.CmdResult(0, output, '')
+
+  def Upload(self):
+    self.ctx.ParallelCompositeUpload(self.local_path, self.REMOTE,
+                                     chunk_size=self.CHUNK_SIZE,
+                                     state_dir=self.state_dir)
+
+  def testUpload(self):
+    """Verify each chunk is uploaded, composed and cleaned up."""
+    self.Upload()
+    for url in self.components:
+      self.gs_mock.assertCommandContains(['cp', url])
+    self.gs_mock.assertCommandContains(
+        ['compose'] + self.components + [self.REMOTE])
+    self.gs_mock.assertCommandContains(['rm', '--'] + self.components)
+    self.assertFalse(os.path.exists(self.state_dir))
+
+  def testResume(self):
+    """Verify chunks finished by an earlier attempt are not uploaded again."""
+    osutils.WriteFile(os.path.join(self.state_dir,
+                                   os.path.basename(self.components[0])),
+                      self.remote_md5[self.components[0]], makedirs=True)
+    self.Upload()
+    self.gs_mock.assertCommandContains(
+        ['cp', self.components[0]], expected=False)
+    self.gs_mock.assertCommandContains(
+        ['cp', self.components[1]])
+
+  def testChecksumMismatch(self):
+    """Verify a corrupted chunk aborts the upload before composing."""
+    self.remote_md5[self.components[1]] = '0' * 32
+    self.assertRaises(gs.GSChecksumMismatch, self.Upload)
+    self.gs_mock.assertCommandContains(['compose'], expected=False)
+    self.assertTrue(os.path.exists(self.state_dir))
+
+
+class GetCacheDirTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for GetCacheDir()."""
+
+  def setUp(self):
+    self.PatchObject(gs.tempfile, 'gettempdir', return_value=self.tempdir)
+    self.top = os.path.join(self.tempdir, 'chromite-cache-%d' % os.getuid())
+
+  def testPrivate(self):
+    """The dir is created, and only usable by the current user."""
+    path = gs.GetCacheDir('gs', 'hashes')
+    self.assertEqual(path, os.path.join(self.top, constants.COMMON_CACHE,
+                                        'gs', 'hashes'))
+    self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+
+  def testWritableByOthers(self):
+    """A cache that other users can write to is not used."""
+    os.makedirs(self.top)
+    os.chmod(self.top, 0o777)
+    self.assertEqual(gs.GetCacheDir('gs', 'hashes'), None)
+
+  def testSymlink(self):
+    """A cache planted as a symlink is not used."""
+    target = os.path.join(self.tempdir, 'target')
+    os.makedirs(target)
+    os.symlink(target, self.top)
+    self.assertEqual(gs.GetCacheDir('gs', 'hashes'), None)
+
+
+class MetadataCacheTest(AbstractGSContextTest):
+  """Tests for MetadataCache."""
+
+  MANIFEST = 'gs://test/buildspecs/25/3700.0.0.xml'
+  STATUS_DIR = 'gs://test/builder-status/'
+
+  def setUp(self):
+    self.cache = gs.MetadataCache(ctx=self.ctx, cache_dir=self.tempdir, ttl=60)
+    self.now = 1000.0
+    self.PatchObject(gs.time, 'time', side_effect=lambda: self.now)
+
+  def testImmutableOnDisk(self):
+    """Immutable objects are shared with later runs via disk."""
+    self.gs_mock.AddCmdResult(['cat', self.MANIFEST], output='<manifest/>')
+    self.assertEqual(self.cache.Cat(self.MANIFEST), '<manifest/>')
+    self.gs_mock.AddCmdResult(['cat', self.MANIFEST], returncode=1)
+    cache = gs.MetadataCache(ctx=self.ctx, cache_dir=self.tempdir)
+    self.assertEqual(cache.Cat(self.MANIFEST), '<manifest/>')
+
+  def testMutableTTL(self):
+    """Listings are reused only until the TTL runs out."""
+    self.gs_mock.AddCmdResult(['ls', '--', self.STATUS_DIR], output='a\nb')
+    self.assertEqual(self.cache.LS(self.STATUS_DIR), ['a', 'b'])
+    self.gs_mock.AddCmdResult(['ls', '--', self.STATUS_DIR], output='a\nb\nc')
+    self.now += 30
+    self.assertEqual(self.cache.LS(self.STATUS_DIR), ['a', 'b'])
+    self.now += 31
+    self.assertEqual(self.cache.LS(self.STATUS_DIR), ['a', 'b', 'c'])
+    cache = gs.MetadataCache(ctx=self.ctx, cache_dir=self.tempdir)
+    self.assertEqual(cache.Lookup('ls', self.STATUS_DIR), None)
+
+  def testInvalidate(self):
+    """Invalidated entries are looked up again."""
+    self.gs_mock.AddCmdResult(['cat', self.MANIFEST], output='old')
+    self.cache.Cat(self.MANIFEST)
+    self.cache.Invalidate(self.MANIFEST)
+    self.gs_mock.AddCmdResult(['cat', self.MANIFEST], output='new')
+    self.assertEqual(self.cache.Cat(self.MANIFEST), 'new')
+
+  def testMissingNotCached(self):
+    """Missing objects are checked again every time."""
+    self.gs_mock.AddCmdResult(partial_mock.In('getacl'), returncode=1,
+                              error='GSResponseError: code=NoSuchKey')
+    self.assertFalse(self.cache.Exists(self.MANIFEST))
+    self.gs_mock.AddCmdResult(partial_mock.In('getacl'))
+    self.assertTrue(self.cache.Exists(self.MANIFEST))
+
+
+  def testNoCacheDir(self):
+    """Without a private cache dir, nothing is kept on disk."""
+    self.PatchObject(gs, 'GetCacheDir', return_value=None)
+    cache = gs.MetadataCache(ctx=self.ctx)
+    self.gs_mock.AddCmdResult(['cat', self.MANIFEST], output='<manifest/>')
+    self.assertEqual(cache.Cat(self.MANIFEST), '<manifest/>')
+    cache = gs.MetadataCache(ctx=self.ctx)
+    self.assertEqual(cache.Lookup('cat', self.MANIFEST), None)
+
+
 #pylint: disable=E1101,W0212
 class GSContextInitTest(cros_test_lib.MockTempDirTestCase):
   """Tests GSContext.__init__() functionality."""
@@ -210,6 +493,14 @@ class GSContextInitTest(cros_test_lib.MockTempDirTestCase):
     with PatchGS('DEFAULT_GSUTIL_BIN', self.bad_path):
       self.assertRaises(gs.GSContextException, gs.GSContext)
 
+  def testInitNoBotoFile(self):
+    """An empty boto file leaves finding the configuration to gsutil."""
+    os.environ['BOTO_CONFIG'] = self.bad_path
+    ctx = gs.GSContext(boto_file='')
+    rc_mock = self.PatchObject(cros_build_lib, 'RunCommand')
+    ctx.Copy(self.acl_file, 'gs://bucket/file')
+    self.assertFalse('BOTO_CONFIG' in rc_mock.call_args[1]['extra_env'])
+
   def testInitAclFile(self):
     """Test ACL selection logic in __init__."""
     self.assertEqual(gs.GSContext().acl_file, None)
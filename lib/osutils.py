@@ -9,6 +9,7 @@ import errno
 import logging
 import os
 import shutil
+import signal
 import cStringIO
 import tempfile
 from chromite.lib import cros_build_lib
@@ -161,6 +162,112 @@ def RmDir(path, ignore_missing=False, sudo=False):
         raise
 
 
+def MoveToTrash(path, trash_dir, sudo=False):
+  """Move a path out of the way, to be deleted later by EmptyTrash.
+
+  Renaming is instant, whereas deleting a large tree can take minutes.  If
+  |trash_dir| is not on the same filesystem as |path|, |path| is deleted
+  right away instead.
+
+  Arguments:
+    path: The file or directory to get rid of.
+    trash_dir: The directory to move |path| into; created if needed.
+    sudo: Move directories as root.
+
+  Returns:
+    True if |path| existed.
+  """
+  if not os.path.lexists(path):
+    return False
+
+  SafeMakedirs(trash_dir, sudo=sudo)
+  if os.lstat(path).st_dev != os.stat(trash_dir).st_dev:
+    if os.path.isdir(path) and not os.path.islink(path):
+      RmDir(path, ignore_missing=True, sudo=sudo)
+    else:
+      SafeUnlink(path, sudo=sudo)
+    return True
+
+  # Keep the name of the path, for debugging, but never clash with an
+  # earlier path of the same name.
+  dest = os.path.join(trash_dir, '%s.%s' % (os.path.basename(path),
+                                            os.urandom(4).encode('hex')))
+  if sudo:
+    cros_build_lib.SudoRunCommand(['mv', '-T', '--', path, dest],
+                                  print_cmd=False)
+  else:
+    os.rename(path, dest)
+  return True
+
+
+def GetFreeSpace(path):
+  """Return the number of bytes available on the filesystem of |path|."""
+  st = os.statvfs(path)
+  return st.f_bavail * st.f_frsize
+
+
+def EmptyTrash(trash_dir, sudo=False, min_free_space=None):
+  """Delete what MoveToTrash put in |trash_dir|.
+
+  The deletion runs at idle io and lowest cpu priority in a detached process,
+  so that the caller does not wait for it.  Whatever it does not get to
+  before it is killed is deleted by the next call.
+
+  Arguments:
+    trash_dir: The trash directory to empty.
+    sudo: Delete as root.
+    min_free_space: If fewer bytes than this are free on the filesystem of
+      |trash_dir|, wait for the deletion, so that the caller does not run out
+      of disk space.
+
+  Returns:
+    The pid of the background process, or None if the deletion finished.
+  """
+  try:
+    paths = [os.path.join(trash_dir, x) for x in os.listdir(trash_dir)]
+  except EnvironmentError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    paths = []
+  if not paths:
+    return None
+
+  cmd = ['nice', '-n', '19']
+  if Which('ionice'):
+    cmd += ['ionice', '-c', '3']
+  # Never follow a mount point that was left behind into another filesystem.
+  cmd += ['rm', '-rf', '--one-file-system', '--'] + paths
+  run = cros_build_lib.SudoRunCommand if sudo else cros_build_lib.RunCommand
+  kwargs = dict(print_cmd=False, error_code_ok=True,
+                redirect_stdout=True, redirect_stderr=True)
+
+  if min_free_space is not None and GetFreeSpace(trash_dir) < min_free_space:
+    logging.info('Low on disk space; waiting for %s to be emptied.',
+                 trash_dir)
+    run(cmd, **kwargs)
+    return None
+
+  pid = os.fork()
+  if pid:
+    return pid
+
+  # Child; detach from the session so that ctrl-c of the caller does not
+  # interrupt the deletion, and let go of the output and locks of the caller,
+  # so that it can exit first.  Then delete and exit without running any of
+  # the cleanup handlers of the parent.
+  # pylint: disable=W0212
+  try:
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    null_fd = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+      os.dup2(null_fd, fd)
+    os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+    run(cmd, **kwargs)
+  finally:
+    os._exit(0)
+
+
 def Which(binary, path=None):
   """Return the absolute path to the specified binary.
 
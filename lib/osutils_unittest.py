@@ -93,6 +93,34 @@ class TestOsutils(cros_test_lib.TempDirTestCase):
     self.assertRaises(cros_build_lib.RunCommandError,
                       osutils.RmDir, subpath, sudo=True)
 
+  def testMoveToTrash(self):
+    """Test that paths moved to the trash are deleted when it is emptied."""
+    trash_dir = os.path.join(self.tempdir, 'trash')
+    for name in ('a', 'b'):
+      path = os.path.join(self.tempdir, name)
+      osutils.WriteFile(os.path.join(path, 'foon'), 'data', makedirs=True)
+      self.assertTrue(osutils.MoveToTrash(path, trash_dir))
+      self.assertFalse(os.path.exists(path))
+    self.assertFalse(osutils.MoveToTrash(path, trash_dir))
+    self.assertEqual(len(os.listdir(trash_dir)), 2)
+
+    # Waits for the deletion when the disk is (supposedly) full.
+    self.assertEqual(
+        osutils.EmptyTrash(trash_dir, min_free_space=float('inf')), None)
+    self.assertEqual(os.listdir(trash_dir), [])
+    self.assertEqual(osutils.EmptyTrash(trash_dir), None)
+
+  def testEmptyTrashInBackground(self):
+    """Test that the trash is emptied in the background."""
+    trash_dir = os.path.join(self.tempdir, 'trash')
+    path = os.path.join(self.tempdir, 'a')
+    osutils.WriteFile(os.path.join(path, 'foon'), 'data', makedirs=True)
+    osutils.MoveToTrash(path, trash_dir)
+    pid = osutils.EmptyTrash(trash_dir, min_free_space=0)
+    self.assertNotEqual(pid, None)
+    os.waitpid(pid, 0)
+    self.assertEqual(os.listdir(trash_dir), [])
+
 
 class IteratePathParentsTest(cros_test_lib.TestCase):
   """Test parent directory iteration functionality."""
@@ -14,6 +14,8 @@ import Queue
 import signal
 import sys
 import tempfile
+import threading
+import time
 import traceback
 
 from chromite.buildbot import cbuildbot_results as results_lib
@@ -47,6 +49,8 @@ class _BackgroundSteps(multiprocessing.Process):
     self._queue = multiprocessing.Queue()
     self._semaphore = semaphore
     self._started = multiprocessing.Event()
+    # The number of bytes of output of the next step printed so far.
+    self._printed = 0
 
   def AddStep(self, step):
     """Add a step to the list of steps to run in the background."""
@@ -63,6 +67,30 @@ class _BackgroundSteps(multiprocessing.Process):
       if ex.errno != errno.ESRCH:
         raise
 
+  def _PrintNewOutput(self, output):
+    """Print the output in |output| that has not been printed yet."""
+    output.seek(self._printed)
+    buf = output.read(_BUFSIZE)
+    while len(buf) > 0:
+      sys.stdout.write(buf)
+      self._printed += len(buf)
+      if len(buf) < _BUFSIZE:
+        break
+      buf = output.read(_BUFSIZE)
+    sys.stdout.flush()
+
+  def PrintOutput(self):
+    """Print the output the next step has written so far.
+
+    The rest of its output is printed when the 'WaitForStep' function is
+    called.
+    """
+    assert not self.Empty()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with open(self._steps[0][1].name, 'r') as output:
+      self._PrintNewOutput(output)
+
   def WaitForStep(self):
     """Wait for the next step to complete.
 
@@ -82,7 +110,6 @@ class _BackgroundSteps(multiprocessing.Process):
     output_name = output.name
     with open(output_name, 'r') as output:
       os.unlink(output_name)
-      pos = 0
       more_output = True
       while more_output:
         # Check whether the process is finished.
@@ -91,17 +118,19 @@ class _BackgroundSteps(multiprocessing.Process):
           more_output = False
         except Queue.Empty:
           more_output = True
+          if self.exitcode is not None:
+            # The process is gone.  Unless it reported back just before it
+            # exited, it was killed (e.g. by SIGKILL) and never will.
+            try:
+              error, results = self._queue.get(False)
+            except Queue.Empty:
+              error = 'Process exited with code %d\n' % self.exitcode
+              results = []
+            more_output = False
 
         # Print output so far.
-        output.seek(pos)
-        buf = output.read(_BUFSIZE)
-        while len(buf) > 0:
-          sys.stdout.write(buf)
-          pos += len(buf)
-          if len(buf) < _BUFSIZE:
-            break
-          buf = output.read(_BUFSIZE)
-        sys.stdout.flush()
+        self._PrintNewOutput(output)
+    self._printed = 0
 
     # Propagate any results.
     for result in results:
@@ -269,6 +298,154 @@ def RunParallelSteps(steps, max_parallel=None, halt_on_error=False):
     pass
 
 
+def _RunAndNotify(step, queue, index):
+  """Run |step|, then put (index, exited) on |queue|.
+
+  |exited| is True if the step called sys.exit(0).
+  """
+  exited = False
+  try:
+    step()
+  except SystemExit as ex:
+    if ex.code != 0:
+      raise
+    exited = True
+  finally:
+    queue.put((index, exited))
+
+
+def RunDependentSteps(steps, dependencies, finished=None):
+  """Run a list of functions in parallel, as far as their dependencies allow.
+
+  Each step starts as soon as all of the steps it depends on have finished.
+  A step that is the only one able to run is run in the foreground, so
+  chains of steps run just like they would in sequence.  Otherwise, steps
+  run in the background.  The output of the step that has been running the
+  longest is printed as it runs, and the output of the others as each of
+  them finishes.
+
+  If a step fails, the steps that depend on it, directly or not, are
+  skipped, but all other steps still run.  Once they have finished, the
+  exception is re-raised if it was the only one and happened in the
+  foreground; otherwise a BackgroundFailure is raised with the stack traces
+  of all failed steps.  If a background step calls sys.exit(0), no further
+  steps are started, and sys.exit(0) is called once the running steps have
+  finished.
+
+  Args:
+    steps: A list of functions to run.
+    dependencies: A list with, for each step, the indexes of the steps that
+      must finish before it starts.
+    finished: If given, called with the index of each step and its run time
+      in seconds as the step finishes successfully.
+
+  Raises:
+    ValueError if the dependencies are cyclic.
+  """
+  pending = {}
+  dependents = collections.defaultdict(list)
+  ready = collections.deque()
+  for index, deps in enumerate(dependencies):
+    if deps:
+      pending[index] = set(deps)
+      for dep in deps:
+        dependents[dep].append(index)
+    else:
+      ready.append(index)
+
+  def _Finish(index, start_time):
+    if finished is not None:
+      finished(index, time.time() - start_time)
+    for dependent in dependents[index]:
+      pending[dependent].discard(index)
+      if not pending[dependent]:
+        del pending[dependent]
+        ready.append(dependent)
+
+  def _Skip(index):
+    skipped = collections.deque(dependents[index])
+    while skipped:
+      dependent = skipped.popleft()
+      if pending.pop(dependent, None) is not None:
+        skipped.extend(dependents[dependent])
+
+  done = multiprocessing.Queue()
+  running = collections.OrderedDict()
+  exits = set()
+  tracebacks = []
+  exited = False
+  try:
+    while (ready and not exited) or running:
+      if len(ready) == 1 and not running:
+        index = ready.popleft()
+        start_time = time.time()
+        try:
+          steps[index]()
+        except Exception as ex:
+          # Everything that is left depends on this step.
+          if not tracebacks:
+            raise
+          if isinstance(ex, results_lib.StepFailure):
+            tracebacks.append(str(ex))
+          else:
+            tracebacks.append(traceback.format_exc())
+          _Skip(index)
+        else:
+          _Finish(index, start_time)
+        continue
+
+      while ready and not exited:
+        index = ready.popleft()
+        bg = _BackgroundSteps()
+        bg.AddStep(functools.partial(_RunAndNotify, steps[index], done, index))
+        bg.start()
+        running[index] = (bg, time.time())
+
+      # Wait with a timeout; a plain get() would not notice Ctrl-C.
+      try:
+        index, step_exited = done.get(timeout=_PRINT_INTERVAL)
+        if step_exited:
+          exits.add(index)
+      except Queue.Empty:
+        pass
+
+      # Print the output of the step that has been running the longest.
+      # Steps that have finished, or died without telling us, are collected
+      # below, so a killed step does not leave us waiting forever.
+      bg, _ = running.values()[0]
+      bg.PrintOutput()
+      for index, (bg, start_time) in running.items():
+        if bg.is_alive():
+          continue
+        del running[index]
+        error = bg.WaitForStep()
+        bg.join()
+        while True:
+          try:
+            exits.add(done.get(False)[0])
+          except Queue.Empty:
+            break
+        if error is not None:
+          tracebacks.append(error)
+          _Skip(index)
+        elif index in exits:
+          exited = True
+        else:
+          _Finish(index, start_time)
+  finally:
+    for bg, _ in running.itervalues():
+      bg.Kill()
+      bg.join()
+
+  if tracebacks:
+    raise BackgroundFailure('\n' + ''.join(tracebacks))
+  if exited:
+    sys.exit(0)
+  if pending:
+    raise ValueError('Cyclic dependencies between steps %s' %
+                     sorted(pending))
+
+
 class _AllTasksComplete(object):
   """Sentinel object to indicate that all tasks are complete."""
 
@@ -407,3 +584,69 @@ def RunTasksInProcessPool(task, inputs, processes=None, onexit=None):
   with BackgroundTaskRunner(task, processes=processes, onexit=onexit) as queue:
     for x in inputs:
       queue.put(x)
+
+
+def IterTasksInThreads(task, inputs, threads=None):
+  """Run the specified function with each supplied input in a pool of threads.
+
+  This function runs task(*x) for x in inputs in a pool of threads of this
+  process, and yields the results as the tasks finish.  Unlike
+  RunTasksInProcessPool, tasks can return results and share state, so this is
+  meant for tasks that mostly wait on the network or on subprocesses.
+
+  If a task raises an exception, no further tasks are started, and the
+  exception is re-raised here once the tasks already running have finished.
+
+  Example:
+    for result in IterTasksInThreads(somefunc, inputs):
+      # Handle result while the remaining tasks are still running.
+
+  Args:
+    task: Function to run on each input.
+    inputs: List of inputs.
+    threads: Number of threads, at most, to launch; defaults to one per input.
+
+  Yields:
+    The return value of each task, in the order the tasks complete.
+  """
+  pending = collections.deque(inputs)
+  if not pending:
+    return
+  num_tasks = len(pending)
+  results = Queue.Queue()
+  stop = threading.Event()
+
+  def _Worker():
+    while not stop.is_set():
+      try:
+        x = pending.popleft()
+      except IndexError:
+        return
+      try:
+        results.put((task(*x), None))
+      except Exception:
+        stop.set()
+        results.put((None, sys.exc_info()))
+        return
+
+  workers = [threading.Thread(target=_Worker)
+             for _ in xrange(min(threads or num_tasks, num_tasks))]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+  try:
+    for _ in xrange(num_tasks):
+      # Wait with a timeout; a plain get() would not notice Ctrl-C.
+      while True:
+        try:
+          result, exc_info = results.get(timeout=_PRINT_INTERVAL)
+          break
+        except Queue.Empty:
+          pass
+      if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+      yield result
+  finally:
+    stop.set()
+    for worker in workers:
+      worker.join()
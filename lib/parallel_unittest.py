@@ -6,6 +6,7 @@
 import contextlib
 import multiprocessing
 import os
+import signal
 import sys
 import tempfile
 import time
@@ -246,5 +247,140 @@ class TestHalting(cros_test_lib.OutputTestCase, cros_test_lib.MockTestCase):
     self.assertFalse(self.failed.is_set())
 
 
+class TestRunDependentSteps(cros_test_lib.OutputTestCase):
+  """Test the RunDependentSteps function."""
+
+  def setUp(self):
+    self.order = multiprocessing.Queue()
+    self.event = multiprocessing.Event()
+
+  def _GetOrder(self):
+    """Return the names put on the queue, in the order they were put."""
+    order = []
+    while True:
+      try:
+        order.append(self.order.get(timeout=1))
+      except Queue.Empty:
+        return [name for _, name in sorted(order)]
+
+  def _Step(self, name):
+    return lambda: self.order.put((time.time(), name))
+
+  def _Waiter(self):
+    self.assertTrue(self.event.wait(30))
+    self.order.put((time.time(), 'waiter'))
+
+  def testOrder(self):
+    """Steps run after their dependencies, and independent ones at once."""
+    steps = [self._Step('a'), self._Waiter, self.event.set, self._Step('d')]
+    finished = []
+    with self.OutputCapturer():
+      parallel.RunDependentSteps(steps, [[], [0], [0], [1, 2]],
+                                 finished=lambda i, _t: finished.append(i))
+    self.assertEqual(self._GetOrder(), ['a', 'waiter', 'd'])
+    self.assertEqual(finished[0], 0)
+    self.assertEqual(finished[-1], 3)
+    self.assertEqual(sorted(finished), range(4))
+
+  def testExceptionRaising(self):
+    """Failures are passed on, and stop the steps that depend on them."""
+    def _Fail():
+      raise ValueError()
+    steps = [_Fail, self._Step('b'), self._Step('c')]
+    with self.OutputCapturer():
+      self.assertRaises(parallel.BackgroundFailure, parallel.RunDependentSteps,
+                        steps, [[], [], [0]])
+    self.assertEqual(self._GetOrder(), ['b'])
+
+  def testIndependentStepsRunAfterFailure(self):
+    """Steps that do not depend on a failed step are still started."""
+    def _Fail():
+      self.event.set()
+      raise ValueError()
+    def _Slow():
+      # Finish well after _Fail has been collected.
+      self.assertTrue(self.event.wait(30))
+      time.sleep(parallel._PRINT_INTERVAL * 2)
+    steps = [self._Step('root'), _Fail, self._Step('a'), _Slow,
+             self._Step('c')]
+    with self.OutputCapturer():
+      self.assertRaises(parallel.BackgroundFailure, parallel.RunDependentSteps,
+                        steps, [[], [0], [1], [0], [3]])
+    self.assertEqual(self._GetOrder(), ['root', 'c'])
+
+  def testKilledStep(self):
+    """A step that is killed is reported as failed."""
+    def _Kill():
+      os.kill(os.getpid(), signal.SIGKILL)
+    steps = [_Kill, self._Step('b'), self._Step('c')]
+    with self.OutputCapturer():
+      try:
+        parallel.RunDependentSteps(steps, [[], [], [0]])
+      except parallel.BackgroundFailure as ex:
+        self.assertTrue('exited with code' in str(ex))
+      else:
+        self.fail('RunDependentSteps did not fail')
+    self.assertEqual(self._GetOrder(), ['b'])
+
+  def testCycle(self):
+    """Cyclic dependencies are detected."""
+    self.assertRaises(ValueError, parallel.RunDependentSteps,
+                      [self._Step('a'), self._Step('b')], [[1], [0]])
+
+
+class TestRunDependentStepsOutput(TestBackgroundWrapper):
+  """Test the output of the RunDependentSteps function."""
+
+  def setUp(self):
+    self.printed_hello = multiprocessing.Event()
+
+  def _HelloWorld(self):
+    """Write 'hello', and wait for it to show up before continuing."""
+    sys.stdout.write('hello')
+    sys.stdout.flush()
+    if self.printed_hello.wait(30):
+      sys.stdout.write(' world')
+
+  def _WaitForHello(self):
+    """Wait for 'hello' to be printed while _HelloWorld is still running."""
+    for _ in xrange(3000):
+      if self.tempfile.read():
+        self.printed_hello.set()
+        return
+      time.sleep(0.01)
+
+  def testStreaming(self):
+    """The output of a running background step is printed as it runs."""
+    out = self.wrapOutputTest(
+        lambda: parallel.RunDependentSteps(
+            [self._HelloWorld, self._WaitForHello], [[], []]))
+    self.assertEqual(out, _GREETING)
+
+
+class TestIterTasksInThreads(cros_test_lib.TestCase):
+  """Test the IterTasksInThreads function."""
+
+  def testResults(self):
+    """Results of all tasks are returned."""
+    results = parallel.IterTasksInThreads(lambda x, y: x * y,
+                                          [[x, 2] for x in xrange(20)],
+                                          threads=3)
+    self.assertEqual(sorted(results), range(0, 40, 2))
+    self.assertEqual(list(parallel.IterTasksInThreads(int, [])), [])
+
+  def testExceptionRaising(self):
+    """Exceptions are passed on, and stop further tasks."""
+    calls = []
+    def _Task(x):
+      calls.append(x)
+      if x == 2:
+        raise ValueError(x)
+      return x
+    results = parallel.IterTasksInThreads(_Task, [[x] for x in xrange(100)],
+                                          threads=1)
+    self.assertRaises(ValueError, list, results)
+    self.assertEqual(calls, [0, 1, 2])
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
@@ -4,14 +4,19 @@
 
 """Module that handles the processing of patches to the source tree."""
 
+import errno
+import json
 import logging
 import os
 import random
 import re
+import tempfile
 
 from chromite.buildbot import constants
 from chromite.lib import cros_build_lib
 from chromite.lib import git
+from chromite.lib import gs
+from chromite.lib import osutils
 
 _MAXIMUM_GERRIT_NUMBER_LENGTH = 6
 
@@ -196,6 +201,70 @@ class PatchCache(object):
     return self.__class__(list(self))
 
 
+class CommitMetadataCache(object):
+  """On-disk cache of the metadata parsed out of commits, keyed by sha1.
+
+  A commit's message, and thus its Change-Id and CQ-DEPEND lines, can't change
+  without its sha1 changing; neither can its ancestry.  So the results of
+  parsing them are stored as one small JSON file per sha1, in a directory
+  shared by all builds on the machine, and recurring changes (such as those of
+  a CQ pool that is retried) don't have to be parsed or walked again.
+
+  Entries are written atomically, so concurrent users at worst redo the work.
+  If there is no cache dir that only the current user can write to (see
+  gs.GetCacheDir), nothing is cached.
+  """
+
+  def __init__(self, cache_dir=None):
+    if cache_dir is None:
+      cache_dir = gs.GetCacheDir('commits')
+    self.cache_dir = cache_dir
+
+  def _GetPath(self, sha1):
+    return os.path.join(self.cache_dir, sha1[:2], sha1[2:])
+
+  def Get(self, sha1):
+    """Return the dict of metadata cached for |sha1| (empty if none)."""
+    if self.cache_dir is None:
+      return {}
+    try:
+      with open(self._GetPath(sha1)) as f:
+        data = json.load(f)
+    except (IOError, ValueError):
+      return {}
+    return data if isinstance(data, dict) else {}
+
+  def Update(self, sha1, **kwargs):
+    """Merge |kwargs| into the metadata cached for |sha1|."""
+    if self.cache_dir is None:
+      return
+    data = self.Get(sha1)
+    data.update(kwargs)
+    path = self._GetPath(sha1)
+    try:
+      osutils.SafeMakedirs(os.path.dirname(path))
+      fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+      with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+      os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+      # The cache is only an optimization; never fail the build over it.
+      if e.errno not in (errno.EACCES, errno.ENOSPC, errno.EROFS):
+        raise
+      logging.warning('Failed to cache metadata of commit %s: %s', sha1, e)
+
+
+_commit_cache = None
+
+
+def GetCommitMetadataCache():
+  """Return the CommitMetadataCache shared by all patches."""
+  global _commit_cache
+  if _commit_cache is None:
+    _commit_cache = CommitMetadataCache()
+  return _commit_cache
+
+
 def FormatChangeId(text, force_internal=False, force_external=False,
                    strict=False):
   """Format a Change-Id into a standardized form.
@@ -403,6 +472,31 @@ def FormatPatchDep(text, force_internal=False, force_external=False,
                 force_external=force_external, strict=strict)
 
 
+def _GetCommitData(git_repo, revs):
+  """Read the sha1, subject and commit message of |revs| in one git call.
+
+  Args:
+    git_repo: The git repository to look in.
+    revs: A list of revisions to look up.
+  Returns:
+    A list of (sha1, subject, commit_message) tuples, one for each revision
+    that is available in |git_repo|; revisions that aren't are skipped.
+  """
+  if not revs:
+    return []
+  ret = git.RunGit(
+      git_repo, ['log', '--no-walk', '--ignore-missing', '-z',
+                 '--pretty=format:%H%x00%s%x00%B'] + list(revs),
+      error_code_ok=True)
+  if ret.returncode != 0 or not ret.output:
+    return []
+  output = ret.output.split('\0')
+  if len(output) % 3:
+    return []
+  return [tuple(x.strip() for x in output[i:i + 3])
+          for i in xrange(0, len(output), 3)]
+
+
 class GitRepoPatch(object):
   """Representing a patch from a branch of a local or remote git repository."""
 
@@ -487,33 +581,19 @@ class GitRepoPatch(object):
     if git_repo in self._is_fetched:
       return self.sha1
 
-    def _PullData(rev):
-      ret = git.RunGit(
-          git_repo, ['log', '--pretty=format:%H%x00%s%x00%B', '-n1', rev],
-          error_code_ok=True)
-      if ret.returncode != 0:
-        return None, None, None
-      output = ret.output.split('\0')
-      if len(output) != 3:
-        return None, None, None
-      return [x.strip() for x in output]
-
     if self.sha1 is not None:
       # See if we've already got the object.
-      sha1, subject, msg = _PullData(self.sha1)
-      if sha1 is not None:
-        sha1 = FormatSha1(sha1, strict=True)
+      data = _GetCommitData(git_repo, [self.sha1])
+      if data:
+        sha1 = FormatSha1(data[0][0], strict=True)
         assert sha1 == self.sha1
-        self._EnsureId(msg)
-        self.commit_message = msg
-        self._subject_line = subject
-        self._is_fetched.add(git_repo)
+        self._RecordFetch(git_repo, *data[0][1:])
         return self.sha1
 
     git.RunGit(git_repo, ['fetch', self.project_url, self.ref])
 
-    sha1, subject, msg = _PullData('FETCH_HEAD')
-    sha1 = FormatSha1(sha1, strict=True)
+    data = _GetCommitData(git_repo, ['FETCH_HEAD'])
+    sha1 = FormatSha1(data[0][0] if data else None, strict=True)
 
     # Even if we know the sha1, still do a sanity check to ensure we
     # actually just fetched it.
@@ -525,11 +605,15 @@ class GitRepoPatch(object):
                              'most likely.' % (self, self.sha1, self.ref))
     else:
       self.sha1 = sha1
+    self._RecordFetch(git_repo, *data[0][1:])
+    return self.sha1
+
+  def _RecordFetch(self, git_repo, subject, msg):
+    """Store the commit data of this patch once it's in |git_repo|."""
     self._EnsureId(msg)
     self.commit_message = msg
     self._subject_line = subject
     self._is_fetched.add(git_repo)
-    return self.sha1
 
   def GetDiffStatus(self, git_repo):
     """Isolate the paths and modifications this patch induces.
@@ -712,6 +796,46 @@ class GitRepoPatch(object):
     dependencies = []
     logging.debug('Checking for Gerrit dependencies for change %s', self)
 
+    for sha1, change_id in self._GetParentChangeIds(git_repo, upstream):
+      if change_id is None:
+        cros_build_lib.Warning(
+            "Parent %s lacks a ChangeId; using the parent's sha1 as the "
+            "dependency.", sha1)
+        dep = FormatSha1(sha1, force_internal=self.internal, strict=True)
+      else:
+        dep = FormatChangeId(change_id, force_internal=self.internal,
+                             strict=True)
+      dependencies.append(dep)
+
+    if dependencies:
+      logging.debug('Found %s Gerrit dependencies for change %s', dependencies,
+                   self)
+      # Ensure that our parent's ChangeId's are internal if we are.
+
+    return dependencies
+
+  # How many upstream revisions to keep cached parents for, per commit.
+  _MAX_CACHED_UPSTREAMS = 4
+
+  def _GetParentChangeIds(self, git_repo, upstream):
+    """Return the parents of this patch that aren't merged into |upstream|.
+
+    The results are cached per (sha1 of this patch, sha1 of |upstream|).
+
+    Returns:
+      A list of (sha1, Change-Id) tuples, ordered from this patch back to
+      |upstream|.  The Change-Id is None for parents lacking one.
+    """
+    cache = GetCommitMetadataCache()
+    ret = git.RunGit(git_repo, ['rev-parse', '--verify', '-q',
+                                '%s^{commit}' % upstream], error_code_ok=True)
+    upstream_sha1 = ret.output.strip() if ret.returncode == 0 else None
+    if upstream_sha1 and self.sha1 is not None:
+      cached = cache.Get(self.sha1).get('parents', {}).get(upstream_sha1)
+      if cached is not None:
+        return [(str(sha1), change_id and str(change_id))
+                for sha1, change_id in cached]
+
     rev = self.Fetch(git_repo)
 
     try:
@@ -741,26 +865,24 @@ class GitRepoPatch(object):
       # Because the explicit null addition, strip off the last record.
       patches = return_obj.output.split('\0')
 
+    parents = []
     for patch_output in patches:
       sha1, commit_msg = patch_output.split('\n', 1)
       try:
-        dep = FormatChangeId(self._ParseChangeId(commit_msg),
-                             force_internal=self.internal, strict=True)
+        change_id = self._ParseChangeId(commit_msg)
       except BrokenChangeID, e:
         if not e.missing:
           raise
-        cros_build_lib.Warning(
-            "Parent %s lacks a ChangeId; using the parent's sha1 as the "
-            "dependency.", sha1)
-        dep = FormatSha1(sha1, force_internal=self.internal, strict=True)
-      dependencies.append(dep)
+        change_id = None
+      parents.append((sha1, change_id))
 
-    if dependencies:
-      logging.debug('Found %s Gerrit dependencies for change %s', dependencies,
-                   self)
-      # Ensure that our parent's ChangeId's are internal if we are.
-
-    return dependencies
+    if upstream_sha1:
+      cached = cache.Get(rev).get('parents', {})
+      if len(cached) >= self._MAX_CACHED_UPSTREAMS:
+        cached.clear()
+      cached[upstream_sha1] = parents
+      cache.Update(rev, parents=cached)
+    return parents
 
   def _SetChangeId(self, change_id):
     """Set this instances change_id, and id from the given ChangeId.
@@ -839,6 +961,12 @@ class GitRepoPatch(object):
     dependencies = []
     logging.debug('Checking for CQ-DEPEND dependencies for change %s', self)
 
+    cache = GetCommitMetadataCache()
+    if self.sha1 is not None:
+      cached = cache.Get(self.sha1).get('cq_depend')
+      if cached is not None:
+        return [str(x) for x in cached]
+
     self.Fetch(git_repo)
 
     matches = self._PALADIN_DEPENDENCY_RE.findall(self.commit_message)
@@ -857,6 +985,7 @@ class GitRepoPatch(object):
     if dependencies:
       logging.debug('Found %s Paladin dependencies for change %s', dependencies,
                    self)
+    cache.Update(self.sha1, cq_depend=dependencies)
     return dependencies
 
   def _SanityChecks(self, git_repo, upstream, inflight=False):
@@ -1165,6 +1294,53 @@ class GerritPatch(GitRepoPatch):
     return self.id == other.id
 
 
+def FetchPatches(git_repo, patches):
+  """Fetch |patches| into |git_repo| using as few git calls as possible.
+
+  This is equivalent to calling Fetch on each patch, but the patches whose
+  sha1 is known up front are handled in bulk: the ones not yet available
+  locally are fetched with one multi-ref `git fetch` per project_url, and
+  the commit data of all of them is read with a single `git log --no-walk`.
+  Patches whose sha1 isn't known yet are fetched one by one.
+
+  Args:
+    git_repo: The git repository to fetch the patches into.
+    patches: The GitRepoPatch instances to fetch.
+  Raises:
+    PatchException: If a patch's sha1 can't be found after fetching it.
+  """
+  # pylint: disable=W0212
+  git_repo = os.path.normpath(git_repo)
+  patches = [x for x in patches if git_repo not in x._is_fetched]
+  known = [x for x in patches if x.sha1 is not None]
+
+  data = dict((x[0], x[1:]) for x in
+              _GetCommitData(git_repo, [x.sha1 for x in known]))
+  by_url = {}
+  for patch in known:
+    if patch.sha1 not in data:
+      refs = by_url.setdefault(patch.project_url, [])
+      if patch.ref not in refs:
+        refs.append(patch.ref)
+  for project_url, refs in by_url.iteritems():
+    git.RunGit(git_repo, ['fetch', project_url] + refs)
+  if by_url:
+    data.update((x[0], x[1:]) for x in _GetCommitData(
+        git_repo, [x.sha1 for x in known if x.sha1 not in data]))
+
+  for patch in known:
+    if patch.sha1 not in data:
+      raise PatchException(patch,
+                           'Patch %s specifies sha1 %s, yet in fetching from '
+                           '%s we could not find that sha1.  Internal error '
+                           'most likely.' % (patch, patch.sha1, patch.ref))
+    patch._RecordFetch(git_repo, *data[patch.sha1])
+
+  for patch in patches:
+    if patch.sha1 is None:
+      patch.Fetch(git_repo)
+
+
 def GeneratePatchesFromRepo(git_repo, project, tracking_branch, branch,
                             remote, allow_empty=False, starting_ref=None):
   if starting_ref is None:
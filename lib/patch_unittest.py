@@ -101,10 +101,16 @@ I am the first commit.
     # Disallow write so as to smoke out any invalid writes to
     # cwd.
     os.chmod(self.default_cwd, 0500)
+    # Keep the commit metadata cache private to this test.
+    self.original_commit_cache = cros_patch._commit_cache
+    cros_patch._commit_cache = cros_patch.CommitMetadataCache(
+        os.path.join(self.tempdir, 'commit-cache'))
 
   def tearDown(self):
     if hasattr(self, 'original_cwd'):
       os.chdir(self.original_cwd)
+    if hasattr(self, 'original_commit_cache'):
+      cros_patch._commit_cache = self.original_commit_cache
 
   def _MkPatch(self, source, sha1, ref='refs/heads/master', **kwds):
     return self.patch_kls(source, 'chromiumos/chromite', ref,
@@ -180,6 +186,20 @@ I am the first commit.
     patch.Fetch(git3)
     self.assertEqual(patch.sha1, self._GetSha1(git3, patch.sha1))
 
+  def testFetchPatches(self):
+    git1, git2, patch1 = self._CommonGitSetup()
+    patch2 = self.CommitFile(git1, 'monkeys', 'rule', commit='second\n\nbody')
+    cros_patch.FetchPatches(git2, [patch1, patch2])
+    for patch in (patch1, patch2):
+      self.assertEqual(patch.sha1, self._GetSha1(git2, patch.sha1))
+    self.assertEqual(patch2._subject_line, 'second')
+    self.assertEqual(patch2.commit_message.split('\n')[-1], 'body')
+    # Verify reuse; nothing is fetched if the objects are already available.
+    patch1.project_url = patch2.project_url = '/dev/null'
+    git3 = self._MakeRepo('git3', git2)
+    cros_patch.FetchPatches(git3, [patch1, patch2])
+    self.assertEqual(patch2.sha1, self._GetSha1(git3, patch2.sha1))
+
   def testAlreadyApplied(self):
     git1 = self._MakeRepo('git1', self.source)
     patch1 = self._MkPatch(git1, self._GetSha1(git1, 'HEAD'))
@@ -377,6 +397,29 @@ I am the first commit.
   def testExternalGerritDependencies(self):
     self._assertGerritDependencies()
 
+  def testCachedDependencies(self):
+    git1 = self._MakeRepo('git1', self.source)
+    cid1, cid2, cid3 = self.MakeChangeId(3)
+    self.CommitChangeIdFile(git1, cid1)
+    patch = self.CommitChangeIdFile(git1, cid2, content='monkeys',
+                                    extra='CQ-DEPEND=%s' % cid3)
+    upstream = 'refs/remotes/origin/master'
+    gerrit_deps = patch.GerritDependencies(git1, upstream)
+    paladin_deps = patch.PaladinDependencies(git1)
+    self.assertEqual(gerrit_deps, [cid1])
+    self.assertEqual(paladin_deps, [cid3])
+
+    # A new instance of the same commit is answered from the cache alone.
+    patch = self._MkPatch(git1, patch.sha1)
+    def _Fetch(_git_repo):
+      raise AssertionError('Fetch should not be needed.')
+    patch.Fetch = _Fetch
+    self.assertEqual(patch.GerritDependencies(git1, upstream), gerrit_deps)
+    self.assertEqual(patch.PaladinDependencies(git1), paladin_deps)
+    # A different upstream isn't.
+    self.assertRaises(AssertionError, patch.GerritDependencies, git1,
+                      '%s~0' % patch.sha1)
+
   def testInternalGerritDependencies(self):
     self._assertGerritDependencies(constants.INTERNAL_REMOTE)
 
@@ -5,115 +5,260 @@
 
 """Support generic spreadsheet-like table information."""
 
+import bisect
+import csv
 import inspect
+import operator
 import re
 import sys
 
 from chromite.lib import cros_build_lib
 
 
+# Marks a table column that was deleted from a single row.
+_MISSING = object()
+
+
+class Row(object):
+  """A dict-like row of a Table, storing its values in column order.
+
+  All rows of a table share one dict mapping column names to positions, so a
+  row costs little more than the list of its values.  Like the dicts rows
+  used to be, a row can still be given keys that are not columns of its
+  table, and have keys deleted; the table ignores those keys.
+  """
+
+  __slots__ = ['_column_index',  # Shared dict of column name to position
+               '_extra',         # Dict of keys that aren't columns, or None
+               '_values',        # List of values in column order
+               ]
+
+  def __init__(self, column_index, values):
+    self._column_index = column_index
+    self._extra = None
+    self._values = values
+
+  def _Detach(self):
+    """Stop following column changes of the table this row was in."""
+    self._column_index = dict(self._column_index)
+
+  def __getitem__(self, col):
+    ix = self._column_index.get(col)
+    if ix is None:
+      if self._extra is None:
+        raise KeyError(col)
+      return self._extra[col]
+    val = self._values[ix]
+    if val is _MISSING:
+      raise KeyError(col)
+    return val
+
+  def __setitem__(self, col, val):
+    ix = self._column_index.get(col)
+    if ix is None:
+      if self._extra is None:
+        self._extra = {}
+      self._extra[col] = val
+    else:
+      self._values[ix] = val
+
+  def __delitem__(self, col):
+    ix = self._column_index.get(col)
+    if ix is None:
+      if self._extra is None:
+        raise KeyError(col)
+      del self._extra[col]
+    elif self._values[ix] is _MISSING:
+      raise KeyError(col)
+    else:
+      self._values[ix] = _MISSING
+
+  def __contains__(self, col):
+    ix = self._column_index.get(col)
+    if ix is None:
+      return self._extra is not None and col in self._extra
+    return self._values[ix] is not _MISSING
+
+  has_key = __contains__
+
+  def __len__(self):
+    return len(self.keys())
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __eq__(self, other):
+    if isinstance(other, Row):
+      other = dict(other.iteritems())
+    elif not isinstance(other, dict):
+      return NotImplemented
+    return dict(self.iteritems()) == other
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  __hash__ = None
+
+  def __repr__(self):
+    return repr(dict(self.iteritems()))
+
+  def get(self, col, default=None):
+    try:
+      return self[col]
+    except KeyError:
+      return default
+
+  def setdefault(self, col, default=None):
+    if col not in self:
+      self[col] = default
+    return self[col]
+
+  def pop(self, col, *args):
+    if col not in self and args:
+      return args[0]
+    val = self[col]
+    del self[col]
+    return val
+
+  def update(self, *args, **kwargs):
+    for col, val in dict(*args, **kwargs).iteritems():
+      self[col] = val
+
+  def keys(self):
+    keys = [col for col in sorted(self._column_index,
+                                  key=self._column_index.__getitem__)
+            if self._values[self._column_index[col]] is not _MISSING]
+    if self._extra:
+      keys.extend(self._extra)
+    return keys
+
+  def values(self):
+    return [self[col] for col in self.keys()]
+
+  def items(self):
+    return [(col, self[col]) for col in self.keys()]
+
+  def iterkeys(self):
+    return iter(self.keys())
+
+  def itervalues(self):
+    return iter(self.values())
+
+  def iteritems(self):
+    return iter(self.items())
+
+  def copy(self):
+    return dict(self.iteritems())
+
+
 class Table(object):
   """Class to represent column headers and rows of data."""
 
-  __slots__ = ['_column_set',  # Set of column headers (for faster lookup)
-               '_columns',     # List of column headers in order
-               '_name',        # Name to associate with table
-               '_rows',        # List of row dicts
+  __slots__ = ['_column_index',  # Dict of column header to its position
+               '_columns',       # List of column headers in order
+               '_indexes',       # Dict of id column tuple to {values: indices}
+               '_name',          # Name to associate with table
+               '_rows',          # List of Row objects
                ]
 
   EMPTY_CELL = ''
 
-  CSV_BQ = '__BEGINQUOTE__'
-  CSV_EQ = '__ENDQUOTE__'
-
   @staticmethod
   def _SplitCSVLine(line):
-    '''Split a single CSV line into separate values.
-
-    Behavior illustrated by the following examples, with all but
-    the last example taken from Google Docs spreadsheet behavior:
-    'a,b,c,d':           ==> ['a', 'b', 'c', 'd'],
-    'a, b, c, d':        ==> ['a', ' b', ' c', ' d'],
-    'a,b,c,':            ==> ['a', 'b', 'c', ''],
-    'a,"b c",d':         ==> ['a', 'b c', 'd'],
-    'a,"b, c",d':        ==> ['a', 'b, c', 'd'],
-    'a,"b, c, d",e':     ==> ['a', 'b, c, d', 'e'],
-    'a,"""b, c""",d':    ==> ['a', '"b, c"', 'd'],
-    'a,"""b, c"", d",e': ==> ['a', '"b, c", d', 'e'],
-    'a,b\,c,d':          ==> ['a', 'b,c', 'd'],
-
-    Return a list of values.'''
-    # Split on commas, handling two special cases:
-    # 1) Escaped commas are not separators.
-    # 2) A quoted value can have non-separator commas in it.  Quotes
-    #    should be removed.
-    vals = []
-    for val in re.split(r'(?<!\\),', line):
-      if not val:
-        vals.append(val)
-        continue
+    """Split a single CSV line into separate values.
 
-      # Handle regular double quotes at beginning/end specially.
-      if val[0] == '"':
-        val = Table.CSV_BQ + val[1:]
-      if val[-1] == '"' and (val[-2] != '"' or val[-3] == '"'):
-        val = val[0:-1] + Table.CSV_EQ
-
-      # Remove escape characters now.
-      val = val.replace(r'\,', ',')  # \ before ,
-      val = val.replace('""', '"')   # " before " (Google Spreadsheet syntax)
-
-      prevval = vals[-1] if vals else None
-
-      # If previous value started with quote and ended without one, then
-      # the current value is just a continuation of the previous value.
-      if prevval and prevval.startswith(Table.CSV_BQ):
-        val = prevval + "," + val
-        # Once entire value is read, strip surrounding quotes
-        if val.endswith(Table.CSV_EQ):
-          vals[-1] = val[len(Table.CSV_BQ):-len(Table.CSV_EQ)]
-        else:
-          vals[-1] = val
-      elif val.endswith(Table.CSV_EQ):
-        vals.append(val[len(Table.CSV_BQ):-len(Table.CSV_EQ)])
-      else:
-        vals.append(val)
+    A quote that is never closed is kept, along with the rest of the line:
+    'a,",c' ==> ['a', '",c'].  Otherwise see IterCSV.
+    """
+    try:
+      return next(csv.reader([line], escapechar='\\', strict=True), [])
+    except csv.Error:
+      vals = next(csv.reader([line], escapechar='\\'))
+      vals[-1] = '"' + vals[-1]
+      return vals
 
-    # If an unpaired Table.CSV_BQ is still in vals, then replace with ".
-    vals = [val.replace(Table.CSV_BQ, '"') for val in vals]
+  @staticmethod
+  def _CSVReader(csv_file):
+    """Yield the values of each record of |csv_file|.
 
-    return vals
+    The lines of a record that is not valid CSV, e.g. because a quote is
+    never closed, are split one at a time by _SplitCSVLine instead.
+    """
+    lines = []
+    def _RecordLines():
+      for line in csv_file:
+        lines.append(line)
+        yield line
+
+    reader = csv.reader(_RecordLines(), escapechar='\\', strict=True)
+    while True:
+      del lines[:]
+      try:
+        vals = next(reader)
+      except StopIteration:
+        return
+      except csv.Error:
+        for line in lines:
+          yield Table._SplitCSVLine(line.rstrip('\r\n'))
+        continue
+      yield vals
 
   @staticmethod
-  def LoadFromCSV(csv_file, name=None):
-    """Create a new Table object by loading contents of |csv_file|."""
-    if type(csv_file) is file:
-      file_handle = csv_file
-    else:
-      file_handle = open(csv_file, 'r')
-    table = None
+  def IterCSV(csv_file):
+    """Yield the rows of |csv_file| one at a time, as Row objects.
 
-    for line in file_handle:
-      if line[-1] == '\n':
-        line = line[0:-1]
+    The first line of |csv_file| has the column headers.  Values follow the
+    usual CSV quoting rules (as written by WriteCSV or exported by Google
+    Docs), so quoted values can contain commas, quotes and newlines.  A
+    backslash escapes the character after it, e.g. 'a\\,b' reads as 'a,b'.
+    A quote that is never closed is kept as part of its value.
 
-      vals = Table._SplitCSVLine(line)
-
-      if not table:
-        # Read headers
-        table = Table(vals, name=name)
+    Args:
+      csv_file: Path of a csv file, or an open file (or iterable of lines).
+    """
+    if isinstance(csv_file, basestring):
+      with open(csv_file, 'rb') as file_handle:
+        for row in Table.IterCSV(file_handle):
+          yield row
+      return
+
+    reader = Table._CSVReader(csv_file)
+    columns = next(reader, None)
+    if columns is None:
+      return
+    column_index = dict((col, ix) for ix, col in enumerate(columns))
+    num_columns = len(columns)
+    for vals in reader:
+      if len(vals) < num_columns:
+        vals.extend([Table.EMPTY_CELL] * (num_columns - len(vals)))
+      elif len(vals) > num_columns:
+        raise LookupError('Tried adding row with too many columns')
+      yield Row(column_index, vals)
 
-      else:
-        # Read data row
-        table.AppendRow(vals)
+  @staticmethod
+  def LoadFromCSV(csv_file, name=None):
+    """Create a new Table object by loading contents of |csv_file|.
 
+    See IterCSV for the format of |csv_file|.  If it is empty, the table
+    has no columns.
+    """
+    if isinstance(csv_file, basestring):
+      with open(csv_file, 'rb') as file_handle:
+        return Table.LoadFromCSV(file_handle, name=name)
+
+    reader = Table._CSVReader(csv_file)
+    table = Table(next(reader, []), name=name)
+    for vals in reader:
+      table.AppendRow(vals)
     return table
 
   def __init__(self, columns, name=None):
     self._columns = columns
-    self._column_set = set(columns)
+    self._column_index = dict((col, ix) for ix, col in enumerate(columns))
     self._rows = []
     self._name = name
+    self._indexes = {}
 
   def __str__(self):
     """Return a table-like string representation of this table."""
@@ -166,7 +311,10 @@ class Table(object):
 
   def Clear(self):
     """Remove all row data."""
+    for row in self._rows:
+      row._Detach()  # pylint: disable=W0212
     self._rows = []
+    self._InvalidateIndexes()
 
   def GetNumRows(self):
     """Return the number of rows in the table."""
@@ -186,6 +334,84 @@ class Table(object):
     If more than one row is returned they will be contained in a list."""
     return self._rows[index]
 
+  @staticmethod
+  def _GetIndexColumns(id_columns):
+    """Return the normalized index key for |id_columns|."""
+    return tuple(sorted(cros_build_lib.iflatten_instance(id_columns)))
+
+  def AddIndex(self, id_columns):
+    """Maintain a hash index on |id_columns| for lookups by value.
+
+    With an index, GetRowsByValue and GetRowIndicesByValue take constant time
+    when asked for exactly these columns.  The index is kept up to date by
+    AppendRow, SetRowByIndex and RemoveRowByIndex, so values in |id_columns|
+    must not be changed on row dicts directly unless they are passed to
+    SetRowByIndex afterwards.
+
+    The |id_columns| argument can either be a list of column names or a
+    single column name (string).
+    """
+    cols = self._GetIndexColumns(id_columns)
+    if cols not in self._indexes:
+      self._indexes[cols] = None
+
+  def RemoveIndex(self, id_columns):
+    """Stop maintaining the index on |id_columns|, if there is one."""
+    self._indexes.pop(self._GetIndexColumns(id_columns), None)
+
+  def HasIndex(self, id_columns):
+    """Return True if there is an index on |id_columns|."""
+    return self._GetIndexColumns(id_columns) in self._indexes
+
+  def _InvalidateIndexes(self):
+    """Forget all index contents; they will be rebuilt on next use."""
+    for cols in self._indexes:
+      self._indexes[cols] = None
+
+  def _GetKeyFunc(self, cols):
+    """Return a function giving the index key for |cols| of a row."""
+    positions = [self._column_index.get(col) for col in cols]
+    if None in positions:
+      # Rows have no value (rather than an empty one) for unknown columns.
+      return lambda row: tuple(row.get(col) for col in cols)
+    getter = operator.itemgetter(*positions)
+    # pylint: disable=W0212
+    if len(positions) == 1:
+      return lambda row: (getter(row._values),)
+    return lambda row: getter(row._values)
+
+  def _GetIndex(self, cols):
+    """Return the (up to date) index for |cols|, building it if needed."""
+    index = self._indexes[cols]
+    if index is None:
+      index = {}
+      key_func = self._GetKeyFunc(cols)
+      for ix, row in enumerate(self._rows):
+        index.setdefault(key_func(row), []).append(ix)
+      self._indexes[cols] = index
+    return index
+
+  def _IndexRow(self, row, ix):
+    """Add |row| at |ix| to all built indexes."""
+    for cols, index in self._indexes.iteritems():
+      if index is not None:
+        key = self._GetKeyFunc(cols)(row)
+        bisect.insort(index.setdefault(key, []), ix)
+
+  def _UnindexRow(self, row, ix):
+    """Remove |row| at |ix| from all built indexes."""
+    for cols, index in self._indexes.iteritems():
+      if index is not None:
+        key = self._GetKeyFunc(cols)(row)
+        indices = index.get(key)
+        if indices is None or ix not in indices:
+          # The row was changed behind our back; start over.
+          self._indexes[cols] = None
+          continue
+        indices.remove(ix)
+        if not indices:
+          del index[key]
+
   def _GenRowFilter(self, id_values):
     """Return a method that returns true for rows matching |id_values|."""
     def Grep(row):
@@ -198,14 +424,19 @@ class Table(object):
 
   def GetRowsByValue(self, id_values):
     """Return list of rows matching key/value pairs in |id_values|."""
-    # If row retrieval by value is heavily used for larger tables, then
-    # the implementation should change to be more efficient, at the
-    # expense of some pre-processing and extra storage.
-    grep = self._GenRowFilter(id_values)
-    return [r for r in self._rows if grep(r)]
+    return [self._rows[ix] for ix in self.GetRowIndicesByValue(id_values)]
 
   def GetRowIndicesByValue(self, id_values):
-    """Return list of indices for rows matching k/v pairs in |id_values|."""
+    """Return list of indices for rows matching k/v pairs in |id_values|.
+
+    This uses an index if one was added with AddIndex for exactly the columns
+    in |id_values|, and scans all rows otherwise.
+    """
+    cols = tuple(sorted(id_values))
+    if cols in self._indexes:
+      key = tuple(id_values[col] for col in cols)
+      return list(self._GetIndex(cols).get(key, ()))
+
     grep = self._GenRowFilter(id_values)
     indices = []
     for ix, row in enumerate(self._rows):
@@ -215,64 +446,79 @@ class Table(object):
     return indices
 
   def _PrepareValuesForAdd(self, values):
-    """Prepare a |values| dict/list to be added as a row.
+    """Prepare a |values| dict/Row/list to be added as a row.
 
-    If |values| is a dict, verify that only supported column
+    If |values| is a dict or Row, verify that only supported column
     values are included. Add empty string values for columns
     not seen in the row.  The original dict may be altered.
 
-    If |values| is a list, translate it to a dict using known
-    column order.  Append empty values as needed to match number
-    of expected columns.
+    If |values| is a list, it holds the values in known column
+    order.  Append empty values as needed to match number of
+    expected columns.
 
-    Return prepared dict.
+    Return prepared Row.
     """
-    if isinstance(values, dict):
+    if isinstance(values, (dict, Row)):
       for col in values:
-        if not col in self._column_set:
+        if not col in self._column_index:
           raise LookupError("Tried adding data to unknown column '%s'" % col)
 
-      for col in self._columns:
-        if not col in values:
-          values[col] = self.EMPTY_CELL
+      if isinstance(values, dict):
+        for col in self._columns:
+          if not col in values:
+            values[col] = self.EMPTY_CELL
+
+      vals = [values.get(col, self.EMPTY_CELL) for col in self._columns]
 
     elif isinstance(values, list):
       if len(values) > len(self._columns):
         raise LookupError("Tried adding row with too many columns")
-      if len(values) < len(self._columns):
-        shortage = len(self._columns) - len(values)
-        values.extend([self.EMPTY_CELL] * shortage)
+      vals = list(values)
+      if len(vals) < len(self._columns):
+        shortage = len(self._columns) - len(vals)
+        vals.extend([self.EMPTY_CELL] * shortage)
 
-      values = dict(zip(self._columns, values))
-
-    return values
+    return Row(self._column_index, vals)
 
   def AppendRow(self, values):
     """Add a single row of data to the table, according to |values|.
 
-    The |values| argument can be either a dict or list."""
+    The |values| argument can be either a dict, Row or list."""
     row = self._PrepareValuesForAdd(values)
     self._rows.append(row)
+    self._IndexRow(row, len(self._rows) - 1)
 
   def SetRowByIndex(self, index, values):
     """Replace the row at |index| with values from |values| dict."""
-    row = self._PrepareValuesForAdd(values)
+    if index < 0:
+      index += len(self._rows)
+    old_row = self._rows[index]
+    if values is old_row:
+      # The row was changed in place; it only needs to be reindexed.
+      row = old_row
+    else:
+      row = self._PrepareValuesForAdd(values)
+      old_row._Detach()  # pylint: disable=W0212
+    self._UnindexRow(old_row, index)
     self._rows[index] = row
+    self._IndexRow(row, index)
 
   def RemoveRowByIndex(self, index):
     """Remove the row at |index|."""
+    rows = self._rows[index]
+    for row in rows if isinstance(rows, list) else [rows]:
+      row._Detach()  # pylint: disable=W0212
     del self._rows[index]
+    # Removal shifts the indices of all later rows.
+    self._InvalidateIndexes()
 
   def HasColumn(self, name):
     """Return True if column |name| is in this table, False otherwise."""
-    return name in self._column_set
+    return name in self._column_index
 
   def GetColumnIndex(self, name):
     """Return the column index for column |name|, -1 if not found."""
-    for ix, col in enumerate(self._columns):
-      if name == col:
-        return ix
-    return -1
+    return self._column_index.get(name, -1)
 
   def GetColumnByIndex(self, index):
     """Return the column name at |index|"""
@@ -287,10 +533,19 @@ class Table(object):
       raise LookupError("Column %s already exists in table." % name)
 
     self._columns.insert(index, name)
-    self._column_set.add(name)
+    # Rows share the column index, so update it in place.
+    for ix, col in enumerate(self._columns):
+      self._column_index[col] = ix
 
+    if value is None:
+      value = self.EMPTY_CELL
+    index = self._column_index[name]
+    # pylint: disable=W0212
     for row in self._rows:
-      row[name] = value if value is not None else self.EMPTY_CELL
+      row._values.insert(index, value)
+      if row._extra:
+        # The row had its own key of that name; the column replaces it.
+        row._extra.pop(name, None)
 
   def AppendColumn(self, name, value=None):
     """Same as InsertColumn, but new column is appended after existing ones."""
@@ -300,6 +555,8 @@ class Table(object):
     """Invoke |row_processor| on each row in sequence."""
     for row in self._rows:
       row_processor(row)
+    # The processor may have changed indexed values.
+    self._InvalidateIndexes()
 
   def MergeTable(self, other_table, id_columns, merge_rules=None,
                  allow_new_columns=False, key=None, reverse=False,
@@ -328,6 +585,10 @@ class Table(object):
 
     To sort the final merged table, supply |key| and |reverse| arguments exactly
     as they work with the Sort method.
+
+    Rows are looked up through an index on |id_columns|, which is added for
+    the duration of the merge if this table does not have one already, so
+    merging takes time linear in the size of both tables.
     """
     # If requested, allow columns in other_table to create new columns
     # in this table if this table does not already have them.
@@ -347,8 +608,15 @@ class Table(object):
             previx = self.GetColumnIndex(prevcol)
             self.InsertColumn(previx + 1, col)
 
-    for other_row in other_table:
-      self._MergeRow(other_row, id_columns, merge_rules=merge_rules)
+    temp_index = not self.HasIndex(id_columns)
+    if temp_index:
+      self.AddIndex(id_columns)
+    try:
+      for other_row in other_table:
+        self._MergeRow(other_row, id_columns, merge_rules=merge_rules)
+    finally:
+      if temp_index:
+        self.RemoveIndex(id_columns)
 
     # Optionally re-sort the merged table.
     if key:
@@ -433,18 +701,29 @@ class Table(object):
   def Sort(self, key, reverse=False):
     """Sort the rows using the given |key| function."""
     self._rows.sort(key=key, reverse=reverse)
+    self._InvalidateIndexes()
 
   def WriteCSV(self, filehandle, hiddencols=None):
     """Write this table out as comma-separated values to |filehandle|.
 
+    Rows are written one at a time, quoting values as needed so that
+    LoadFromCSV reads them back unchanged.
+
     To skip certain columns during the write, use the |hiddencols| set.
     """
     def ColFilter(col):
       """Filter function for columns not in hiddencols."""
       return not hiddencols or col not in hiddencols
 
-    cols = [col for col in self._columns if ColFilter(col)]
-    filehandle.write(','.join(cols) + '\n')
+    def Escape(val):
+      """Escape backslashes, which LoadFromCSV reads as escapes."""
+      if val is _MISSING:
+        return self.EMPTY_CELL
+      return val.replace('\\', '\\\\')
+
+    ixs = [ix for ix, col in enumerate(self._columns) if ColFilter(col)]
+    writer = csv.writer(filehandle, lineterminator='\n')
+    writer.writerow([Escape(self._columns[ix]) for ix in ixs])
     for row in self._rows:
-      vals = [row.get(col, self.EMPTY_CELL) for col in cols]
-      filehandle.write(','.join(vals) + '\n')
+      # pylint: disable=W0212
+      writer.writerow([Escape(row._values[ix]) for ix in ixs])
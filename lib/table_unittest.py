@@ -6,9 +6,11 @@
 """Unit tests for the table module."""
 
 import cStringIO
+import logging
 import os
 import sys
 import tempfile
+import time
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
     os.path.abspath(__file__)))))
@@ -296,6 +298,28 @@ class TableTest(cros_test_lib.TestCase):
       vals = table.Table._SplitCSVLine(line)
       self.assertEquals(vals, tests[line])
 
+  def testReadCSVLine(self):
+    """Test splitting of csv lines read from a file."""
+    tests = {'a,b,c,d':           ['a', 'b', 'c', 'd'],
+             'a, b, c, d':        ['a', ' b', ' c', ' d'],
+             'a,b,c,':            ['a', 'b', 'c', ''],
+             'a,"b c",d':         ['a', 'b c', 'd'],
+             'a,"b, c",d':        ['a', 'b, c', 'd'],
+             'a,"b, c, d",e':     ['a', 'b, c, d', 'e'],
+             'a,"""b, c""",d':    ['a', '"b, c"', 'd'],
+             'a,"""b, c"", d",e': ['a', '"b, c", d', 'e'],
+
+             # Following not real Google Spreadsheet cases.
+             'a,b\,c,d':          ['a', 'b,c', 'd'],
+             'a,",c':             ['a', '",c'],
+             'a,"",c':            ['a', '', 'c'],
+             }
+    for line, vals in tests.iteritems():
+      columns = [str(ix) for ix in range(len(vals))]
+      data = '%s\n%s\n' % (','.join(columns), line)
+      row = next(table.Table.IterCSV(cStringIO.StringIO(data)))
+      self.assertEquals(row, dict(zip(columns, vals)))
+
   @osutils.TempDirDecorator
   def testWriteReadCSV(self):
     """Write and Read CSV and verify contents preserved."""
@@ -308,6 +332,95 @@ class TableTest(cros_test_lib.TestCase):
     self.assertEquals(mytable, self._table)
     self.assertFalse(mytable != self._table)
 
+  def testWriteReadCSVQuoting(self):
+    """Values with commas, quotes and newlines survive a round trip."""
+    self._table.AppendRow([r'a,b', 'say "hi"', 'two\nlines', 'back\\slash'])
+    out = cStringIO.StringIO()
+    self._table.WriteCSV(out)
+    mytable = table.Table.LoadFromCSV(cStringIO.StringIO(out.getvalue()))
+    self.assertEquals(mytable, self._table)
+
+    out = cStringIO.StringIO()
+    self._table.WriteCSV(out, hiddencols=set([self.COL1, self.COL2]))
+    self.assertEquals(out.getvalue().splitlines()[0],
+                      '%s,%s' % (self.COL0, self.COL3))
+
+  def testWriteCSVBackslashes(self):
+    """Backslashes are written doubled, as LoadFromCSV reads escapes."""
+    mytable = table.Table(['A', 'B'])
+    mytable.AppendRow([r'C:\dir', r'a\,b'])
+    out = cStringIO.StringIO()
+    mytable.WriteCSV(out)
+    self.assertEquals(out.getvalue(), 'A,B\n' + r'C:\\dir,"a\\,b"' + '\n')
+    self.assertEquals(
+        table.Table.LoadFromCSV(cStringIO.StringIO(out.getvalue())), mytable)
+
+  def testIterCSV(self):
+    """Rows can be read one at a time without loading a table."""
+    data = 'A,B,C\n1,2,3\n4,"5,6"\n'
+    rows = table.Table.IterCSV(cStringIO.StringIO(data))
+    row = next(rows)
+    self.assertEquals(row, {'A': '1', 'B': '2', 'C': '3'})
+    self.assertEquals(row.keys(), ['A', 'B', 'C'])
+    self.assertEquals(next(rows), {'A': '4', 'B': '5,6', 'C': ''})
+    self.assertRaises(StopIteration, next, rows)
+    self.assertEquals(list(table.Table.IterCSV(cStringIO.StringIO(''))), [])
+    mytable = table.Table.LoadFromCSV(cStringIO.StringIO(''), name='empty')
+    self.assertEquals((mytable.GetColumns(), len(mytable)), ([], 0))
+    self.assertEquals(mytable.GetName(), 'empty')
+
+  def testRowIsDictLike(self):
+    row = self._table[1]
+    self.assertTrue(isinstance(row, table.Row))
+    self.assertEquals(row.keys(), self.COLUMNS)
+    self.assertEquals(row.values(), self._GetRowValsInOrder(self.ROW1))
+    self.assertEquals(dict(row), self.ROW1)
+    self.assertEquals(row.copy(), self.ROW1)
+    self.assertTrue(self.COL3 in row)
+    self.assertFalse(self.EXTRACOL in row)
+    self.assertEquals(row.get(self.EXTRACOL, 'x'), 'x')
+    self.assertRaises(KeyError, row.__getitem__, self.EXTRACOL)
+    row[self.COL3] = 'Baz'
+    self.assertEquals(self._table[1][self.COL3], 'Baz')
+    self.assertNotEqual(row, self.ROW1)
+
+  def testRowDictAPI(self):
+    """Rows behave like the dicts they used to be."""
+    row = self._table[1]
+    golden = dict(self.ROW1)
+    for r in (row, golden):
+      r[self.EXTRACOL] = 'x'
+      r.setdefault(self.COL0, 'unused')
+      r.setdefault('other', 'y')
+      r.update({self.COL1: 'b'}, **{self.COL2: 'c'})
+    self.assertEquals(row, golden)
+    self.assertTrue(row.has_key(self.EXTRACOL))
+    self.assertEquals(sorted(row.iterkeys()), sorted(golden))
+    self.assertEquals(sorted(row.itervalues()), sorted(golden.values()))
+    self.assertEquals(sorted(row.iteritems()), sorted(golden.iteritems()))
+    self.assertEquals(row.pop(self.COL0), golden.pop(self.COL0))
+    self.assertEquals(row.pop(self.EXTRACOL), golden.pop(self.EXTRACOL))
+    self.assertEquals(row.pop(self.COL0, 'gone'), 'gone')
+    self.assertRaises(KeyError, row.pop, self.COL0)
+    self.assertEquals(row, golden)
+    self.assertEquals(len(row), len(golden))
+
+    # The table ignores the keys that aren't columns, and writes removed
+    # columns as empty cells.
+    out = cStringIO.StringIO()
+    self._table.WriteCSV(out)
+    self.assertEquals(out.getvalue().splitlines()[2], ',b,c,%s' %
+                      self.ROW1[self.COL3])
+
+  def testRemovedRowsKeepValues(self):
+    """Rows no longer in the table don't see later column changes."""
+    row = self._table[0]
+    del self._table[0]
+    self._table.InsertColumn(0, self.EXTRACOL)
+    self.assertRowsEqual(self.ROW0, row)
+    self.assertEquals('', self._table[0][self.EXTRACOL])
+    self.assertRowsEqual(self.ROW1, self._table[0])
+
   def testInsertColumn(self):
     self._table.InsertColumn(1, self.EXTRACOL, 'blah')
     goldenrow = dict(self.ROW1)
@@ -338,5 +451,105 @@ class TableTest(cros_test_lib.TestCase):
     self.assertRowsEqual(final_row1, self._table[1])
     self.assertRowsEqual(final_row2, self._table[2])
 
+  def testIndexedLookups(self):
+    self._table.AddIndex([self.COL0])
+    self.assertTrue(self._table.HasIndex(self.COL0))
+    self.assertFalse(self._table.HasIndex([self.COL0, self.COL1]))
+    self.assertEquals([1, 2],
+                      self._table.GetRowIndicesByValue({self.COL0: 'Abc'}))
+
+    self._table.AppendRow(dict(self.ROW1a))
+    self.assertEquals([1, 2, 3],
+                      self._table.GetRowIndicesByValue({self.COL0: 'Abc'}))
+    self._table.SetRowByIndex(2, dict(self.ROW0))
+    self.assertEquals([1, 3],
+                      self._table.GetRowIndicesByValue({self.COL0: 'Abc'}))
+    self.assertEquals([0, 2],
+                      self._table.GetRowIndicesByValue({self.COL0: 'Xyz'}))
+    self._table.RemoveRowByIndex(0)
+    self.assertEquals([0, 2],
+                      self._table.GetRowIndicesByValue({self.COL0: 'Abc'}))
+    self._table.Sort(lambda row: row[self.COL0])
+    self.assertEquals([0, 1],
+                      self._table.GetRowIndicesByValue({self.COL0: 'Abc'}))
+    self.assertEquals([self.ROW1, self.ROW1a],
+                      self._table.GetRowsByValue({self.COL0: 'Abc'}))
+
+    # Rows changed in place are picked up once passed back to the table.
+    row = self._table[0]
+    row[self.COL0] = 'Def'
+    self._table.SetRowByIndex(0, row)
+    self.assertEquals([1],
+                      self._table.GetRowIndicesByValue({self.COL0: 'Abc'}))
+    self.assertEquals([0],
+                      self._table.GetRowIndicesByValue({self.COL0: 'Def'}))
+
+    self._table.RemoveIndex(self.COL0)
+    self.assertFalse(self._table.HasIndex(self.COL0))
+    self.assertEquals([0],
+                      self._table.GetRowIndicesByValue({self.COL0: 'Def'}))
+
+  def testMergeTableKeepsIndexes(self):
+    self._table.AddIndex(self.COL2)
+    other_table = self._CreateTableWithRows(self.COLUMNS,
+                                            [self.ROW0b, self.EXTRAROW])
+    self._table.MergeTable(other_table, self.COL2,
+                           merge_rules={self.COL3: 'accept_other_val'})
+    self.assertTrue(self._table.HasIndex(self.COL2))
+    self.assertFalse(self._table.HasIndex(self.COL0))
+    self.assertEquals([3],
+                      self._table.GetRowIndicesByValue({self.COL2: 'The'}))
+    self.assertRowsEqual(self.ROW0b, self._table[0])
+
+
+class TableBenchmark(cros_test_lib.BenchmarkTestCase):
+  """Benchmark for merging many large tables."""
+
+  COLUMNS = ['Package', 'Slot', 'Overlay', 'Target']
+  TABLES = 10
+  ROWS = 10000
+
+  def _CreateTable(self, num):
+    mytable = table.Table(list(self.COLUMNS), name='board%d' % num)
+    # Each table overlaps half of its rows with the previous one.
+    first = num * self.ROWS / 2
+    for pkg in xrange(first, first + self.ROWS):
+      mytable.AppendRow(['cat/pkg%d' % pkg, '0', 'portage-stable',
+                         'board%d' % num])
+    return mytable
+
+  def testMergeTables(self):
+    tables = [self._CreateTable(num) for num in xrange(self.TABLES)]
+    merge_rules = {'Target': 'join_with: '}
+
+    start = time.time()
+    merged = tables[0]
+    for other_table in tables[1:]:
+      merged.MergeTable(other_table, ['Package', 'Slot'],
+                        merge_rules=merge_rules)
+    elapsed = time.time() - start
+
+    self.assertEquals((self.TABLES + 1) * self.ROWS / 2, len(merged))
+    self.assertEquals('board0 board1',
+                      merged.GetRowsByValue({'Package': 'cat/pkg5000'}
+                                            )[0]['Target'])
+    logging.info('Merged %d tables of %d rows in %.2fs', self.TABLES,
+                 self.ROWS, elapsed)
+
+  def testLoadCSV(self):
+    out = cStringIO.StringIO()
+    self._CreateTable(0).WriteCSV(out)
+    data = out.getvalue() * self.TABLES
+
+    start = time.time()
+    mytable = table.Table.LoadFromCSV(cStringIO.StringIO(data))
+    elapsed = time.time() - start
+
+    # Repeated header lines just become (ordinary) rows.
+    self.assertEquals(self.TABLES * (self.ROWS + 1) - 1, len(mytable))
+    logging.info('Loaded %d rows from %d bytes of csv in %.2fs', len(mytable),
+                 len(data), elapsed)
+
+
 if __name__ == "__main__":
   cros_test_lib.main()
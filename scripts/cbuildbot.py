@@ -12,6 +12,7 @@ full and pre-flight-queue builds.
 
 import distutils.version
 import errno
+import functools
 import glob
 import logging
 import optparse
@@ -27,6 +28,8 @@ from chromite.buildbot import cbuildbot_results as results_lib
 from chromite.buildbot import constants
 from chromite.buildbot import remote_try
 from chromite.buildbot import repository
+from chromite.buildbot import stage_cache
+from chromite.buildbot import stage_graph
 from chromite.buildbot import tee
 from chromite.buildbot import trybot_patch_pool
 
@@ -37,6 +40,7 @@ from chromite.lib import cros_build_lib
 from chromite.lib import gclient
 from chromite.lib import gerrit
 from chromite.lib import git
+from chromite.lib import gs
 from chromite.lib import osutils
 from chromite.lib import patch as cros_patch
 from chromite.lib import parallel
@@ -139,6 +143,7 @@ class Builder(object):
     build_config:  The configuration dictionary from cbuildbot_config.
     options:  The options provided from optparse in main().
     archive_urls:  Where our artifacts for this builder will be archived.
+    stage_graph:  The StageGraph of the stages run by RunStages, if any.
     release_tag:  The associated "chrome os version" of this build.
   """
 
@@ -153,10 +158,17 @@ class Builder(object):
 
     self.archive_stages = {}
     self.archive_urls = {}
+    self.stage_graph = None
     self.release_tag = None
     self.patch_pool = trybot_patch_pool.TrybotPatchPool()
 
     bs.BuilderStage.SetManifestBranch(self.options.branch)
+    if self.build_config['stage_cache'] and not self.options.clobber:
+      gs_url = None if options.debug else build_config['stage_cache_url']
+      cache_dir = os.path.join(options.cache_dir, constants.COMMON_CACHE,
+                               'stages')
+      bs.BuilderStage.SetStageCache(
+          stage_cache.StageCache(cache_dir, gs_url=gs_url))
 
   def Initialize(self):
     """Runs through the initialization steps of an actual build."""
@@ -293,6 +305,8 @@ class Builder(object):
     print_report = True
     exception_thrown = False
     success = True
+    # Share the count of skipped uploads with the stages run in children.
+    gs.GetBytesSkipped()
     try:
       self.Initialize()
       sync_instance = self.GetSyncInstance()
@@ -325,6 +339,12 @@ class Builder(object):
         print '\n\n\n@@@BUILD_STEP Report@@@\n'
         results_lib.Results.Report(sys.stdout, self.archive_urls,
                                    self.release_tag)
+        if self.stage_graph:
+          self.stage_graph.ReportCriticalPath(sys.stdout)
+        bytes_skipped = gs.GetBytesSkipped()
+        if bytes_skipped:
+          print 'Skipped uploading %d bytes already in Google Storage.' % (
+              bytes_skipped)
         success = results_lib.Results.BuildSucceededSoFar()
         if exception_thrown and success:
           success = False
@@ -376,49 +396,76 @@ class SimpleBuilder(Builder):
     steps = [self._GetStageInstance(*x, config=config).Run for x in stage_list]
     parallel.RunParallelSteps(steps + [archive_stage.Run])
 
+  def _AddStage(self, stage, *args, **kwargs):
+    """Wrapper to add a stage to the stage graph of this build.
+
+    Args:
+      consumes: Artifacts the stage consumes, besides the ones it declares.
+      Other arguments are passed on to the stage.
+    """
+    consumes = kwargs.pop('consumes', ())
+    stage_instance = self._GetStageInstance(stage, *args, **kwargs)
+    self.stage_graph.AddStage(stage_instance, consumes=consumes)
+    return stage_instance
+
   def RunStages(self):
     """Runs through build process."""
+    self.stage_graph = stage_graph.StageGraph()
+    build_stages = {}
+
     # TODO(sosa): Split these out into classes.
     if self.build_config['build_type'] == constants.CHROOT_BUILDER_TYPE:
-      self._RunStage(stages.UprevStage, boards=[], enter_chroot=False)
-      self._RunStage(stages.BuildBoardStage, [constants.CHROOT_BUILDER_BOARD])
-      self._RunStage(stages.SyncChromeStage)
-      self._RunStage(stages.PatchChromeStage)
-      self._RunStage(stages.SDKPackageStage)
-      self._RunStage(stages.SDKTestStage)
-      self._RunStage(stages.UploadPrebuiltsStage,
-                     constants.CHROOT_BUILDER_BOARD, None)
+      self._AddStage(stages.UprevStage, boards=[], enter_chroot=False)
+      # The SDK is built from the uprevved packages.
+      self._AddStage(stages.BuildBoardStage, [constants.CHROOT_BUILDER_BOARD],
+                     consumes=['uprev'])
+      self._AddStage(stages.SyncChromeStage)
+      self._AddStage(stages.PatchChromeStage)
+      self._AddStage(stages.SDKPackageStage)
+      self._AddStage(stages.SDKTestStage)
+      self._AddStage(stages.UploadPrebuiltsStage,
+                     constants.CHROOT_BUILDER_BOARD, None,
+                     consumes=['sdk_tested'])
     elif self.build_config['build_type'] == constants.REFRESH_PACKAGES_TYPE:
-      self._RunStage(stages.BuildBoardStage)
-      self._RunStage(stages.RefreshPackageStatusStage)
+      self._AddStage(stages.BuildBoardStage)
+      self._AddStage(stages.RefreshPackageStatusStage)
     else:
-      self._RunStage(stages.BuildBoardStage)
-      self._RunStage(stages.UprevStage)
-      self._RunStage(stages.SyncChromeStage)
-      self._RunStage(stages.PatchChromeStage)
-
+      self._AddStage(stages.BuildBoardStage)
+      self._AddStage(stages.UprevStage)
+      self._AddStage(stages.SyncChromeStage)
+      self._AddStage(stages.PatchChromeStage)
+
+      # Build all boards at once, as far as the build slots allow, so that
+      # one board builds its images while the next one compiles.  The
+      # test/archive stages of each board run once its image is built.
+      build_slots = stages.BoardBuildSlots()
       configs = self.build_config['board_specific_configs']
       for board in self.build_config['boards']:
         config = configs.get(board, self.build_config)
         archive_stage = self._GetStageInstance(stages.ArchiveStage, board,
                                                config=config)
         self.archive_stages[board] = archive_stage
+        build_stages[board] = self._AddStage(
+            stages.BuildTargetStage, board, archive_stage, self.release_tag,
+            build_slots=build_slots, config=config)
+        self.stage_graph.AddStep(
+            'Test and archive stages [%s]' % board,
+            functools.partial(self._RunBackgroundStagesForBoard, board),
+            consumes=['image:%s' % board])
+        self.stage_graph.AddStep(
+            'Upload stage cache [%s]' % board,
+            bs.BuilderStage.UploadStageCache,
+            consumes=['image:%s' % board])
 
-      # Set up a process pool to run test/archive stages in the background.
-      # This process runs task(board) for each board added to the queue.
-      task = self._RunBackgroundStagesForBoard
-      with parallel.BackgroundTaskRunner(task) as queue:
-        for board in self.build_config['boards']:
-          # Run BuildTarget in the foreground.
+    try:
+      self.stage_graph.Run()
+    finally:
+      finished = self.stage_graph.GetFinished()
+      for board in self.build_config['boards']:
+        if board in build_stages and build_stages[board].name in finished:
           archive_stage = self.archive_stages[board]
-          config = configs.get(board, self.build_config)
-          self._RunStage(stages.BuildTargetStage, board, archive_stage,
-                         self.release_tag, config=config)
           self.archive_urls[board] = archive_stage.GetDownloadUrl()
 
-          # Kick off task(board) in the background.
-          queue.put([board])
-
 
 class DistributedBuilder(SimpleBuilder):
   """Build class that has special logic to handle distributed builds.
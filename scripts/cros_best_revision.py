@@ -46,6 +46,7 @@ class ChromeCommitter(object):
     self._dryrun = dryrun
     self._lkgm = None
     self._old_lkgm = None
+    self._gs_cache = gs.MetadataCache()
 
   def CheckoutChromeLKGM(self):
     """Checkout chromeos LKGM file for chrome into tmp checkout dir."""
@@ -64,9 +65,7 @@ class ChromeCommitter(object):
 
   def _GetLatestCanaryVersions(self):
     """Returns the latest CANDIDATES_TO_CONSIDER canary versions."""
-    gs_handle = gs.GSContext()
-    version_paths = gs_handle.LS(
-        manifest_version.BUILD_STATUS_URL).output.splitlines()
+    version_paths = self._gs_cache.LS(manifest_version.BUILD_STATUS_URL)
 
     # Strip gs://<path> prefix and trailing /'s.
     versions = [os.path.basename(v.rstrip('/')) for v in version_paths]
@@ -95,7 +94,7 @@ class ChromeCommitter(object):
     for version in versions:
       for builder in canaries:
         status = manifest_version.BuildSpecsManager.GetBuildStatus(
-            builder, version, retries=0)
+            builder, version, retries=0, cache=self._gs_cache)
         if status:
           if status.Passed():
             version_scores[version] = version_scores.get(version, 0) + 1
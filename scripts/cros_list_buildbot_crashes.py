@@ -21,6 +21,8 @@ from chromite.buildbot import cbuildbot_config
 from chromite.buildbot import constants
 from chromite.buildbot import manifest_version
 from chromite.lib import cros_build_lib
+from chromite.lib import gs
+from chromite.lib import osutils
 from chromite.lib import parallel
 
 
@@ -28,6 +30,21 @@ def ConvertGoogleStorageURLToHttpURL(url):
   return url.replace('gs://', 'http://sandbox.google.com/storage/')
 
 
+def _GetGSContext():
+  """Return the GSContext to list and read the crash reports with.
+
+  If there are no boto credentials to set it up with, fall back to the
+  gsutil in $PATH and the configuration it finds by itself, like the plain
+  gsutil commands this script used to run.  Lookups aren't retried: a bot
+  without crashes fails the listing.
+  """
+  try:
+    return gs.GSContext(retries=0)
+  except gs.GSContextException:
+    return gs.GSContext(boto_file='', gsutil_bin=osutils.Which('gsutil'),
+                        retries=0)
+
+
 class CrashTriager(object):
 
   CRASH_PATTERN = re.compile(r'/([^/.]*)\.(\d+)[^/]*\.dmp\.txt$')
@@ -43,6 +60,9 @@ class CrashTriager(object):
     self.all_programs = all_programs
     self.list_all = list_all
     self.jobs = jobs
+    # Listings are only trusted for a short while, but crash reports never
+    # change once uploaded, so they are kept on disk for later runs.
+    self.gs_cache = gs.MetadataCache(ctx=_GetGSContext())
 
   def Run(self):
     """Run the crash triager, printing the most common stack traces."""
@@ -79,14 +99,10 @@ class CrashTriager(object):
     chrome_branch = self.chrome_branch
     gsutil_archive = self._GetGSPath(bot_id, build_config)
     pattern = '%s/R%s-**.dmp.txt' % (gsutil_archive, chrome_branch)
-    out = cros_build_lib.RunCommand(['gsutil', 'ls', pattern],
-                                    error_code_ok=True,
-                                    redirect_stdout=True,
-                                    redirect_stderr=True,
-                                    print_cmd=False)
-    if out.returncode == 0:
-      return out.output.split('\n')
-    return []
+    try:
+      return self.gs_cache.LS(pattern)
+    except (gs.GSContextException, cros_build_lib.RunCommandError):
+      return []
 
   def _ProcessCrashListForBot(self, bot_id, build_config):
     """Process crashes for a given bot.
@@ -119,13 +135,14 @@ class CrashTriager(object):
 
     Args:
       crash_report_url: The URL where the crash is stored.
+
+    Returns:
+      The stack trace, or None if it could not be retrieved.
     """
-    out = cros_build_lib.RunCommand(['gsutil', 'cat', crash_report_url],
-                                    error_code_ok=True,
-                                    redirect_stdout=True,
-                                    redirect_stderr=True,
-                                    print_cmd=False)
-    return out
+    try:
+      return self.gs_cache.Cat(crash_report_url)
+    except (gs.GSContextException, cros_build_lib.RunCommandError):
+      return None
 
   def _DownloadStackTrace(self, program, crash_date, url):
     """Download a crash report, queuing up the stack trace info.
@@ -135,9 +152,9 @@ class CrashTriager(object):
       crash_date: The date of the crash.
       url: The URL where the crash is stored.
     """
-    out = self._GetStackTrace(url)
-    if out.returncode == 0:
-      self.stack_trace_queue.put((program, crash_date, url, out.output))
+    output = self._GetStackTrace(url)
+    if output is not None:
+      self.stack_trace_queue.put((program, crash_date, url, output))
 
   @contextlib.contextmanager
   def _DownloadCrashesInBackground(self):
@@ -144,6 +144,7 @@ class Uploader(object):
     rows_deleted, rows_with_owner_deleted = (0, 0)
 
     # Also need to delete rows in spreadsheet that are not in csv table.
+    self._csv_table.AddIndex(self.ID_COL)
     ss_rows = self._scomm.GetRows()
     for ss_row in ss_rows:
       ss_package = gdata_lib.ScrubValFromSS(ss_row[self.SS_ID_COL])